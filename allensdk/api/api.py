@@ -41,8 +41,13 @@ import errno
 import warnings
 import io
 import zipfile
+import hashlib
+import tempfile
+import time
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 import requests
+import requests.adapters
 import pandas as pd
 from requests_toolbelt import exceptions
 from requests_toolbelt.downloadutils import stream
@@ -50,11 +55,61 @@ from requests_toolbelt.downloadutils import stream
 import allensdk.core.json_utilities as json_utilities
 
 
+class HttpSession(requests.Session):
+    ''' A requests session whose connections are pooled and kept alive 
+    between requests, so that bulk queries against the same host do not pay 
+    TCP and TLS setup on every call.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Maximum number of connections kept open per host. Default is 10.
+    timeout : float or tuple of float, optional
+        Applied to every request that does not specify its own timeout. If a 
+        tuple, specify seperate connect and read timeouts.
+    gzip : bool, optional
+        If True (default), advertise gzip/deflate content encoding.
+    max_retries : int, optional
+        Number of times a failed connection will be retried. Default is 0.
+
+    '''
+
+    def __init__(self, pool_size=10, timeout=(9.05, 31.1), gzip=True, max_retries=0):
+        super(HttpSession, self).__init__()
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size,
+                                                max_retries=max_retries)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        if gzip:
+            self.headers['Accept-Encoding'] = 'gzip, deflate'
+        else:
+            self.headers['Accept-Encoding'] = 'identity'
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = self.timeout
+        return super(HttpSession, self).request(method, url, **kwargs)
+
+
 class Api(object):
     _log = logging.getLogger('allensdk.api.api')
     _file_download_log = logging.getLogger('allensdk.api.api.retrieve_file_over_http')
     default_api_url = 'http://api.brain-map.org'
     download_url = 'http://download.alleninstitute.org'
+    partial_file_suffix = '.part'
+    download_retries = 3
+    download_retry_delay = 1.0
+    zip_spool_size = 2 ** 26
+    _interrupted_download_errors = (exceptions.StreamingError,
+                                    requests.exceptions.ConnectionError,
+                                    requests.exceptions.ChunkedEncodingError,
+                                    requests.exceptions.ReadTimeout)
 
     def __init__(self, api_base_url_string=None):
         if api_base_url_string is None:
@@ -62,6 +117,35 @@ class Api(object):
 
         self.set_api_urls(api_base_url_string)
         self.default_working_directory = os.getcwd()
+        self.session = HttpSession()
+
+    def configure_http_session(self, pool_size=10, timeout=(9.05, 31.1), gzip=True, max_retries=0):
+        '''Replace the pooled, keep-alive session shared by all json, xml and 
+        file retrievals made through this object.
+
+        Parameters
+        ----------
+        pool_size : int, optional
+            Maximum number of connections kept open per host. Default is 10.
+        timeout : float or tuple of float, optional
+            Default timeout for each request. If a tuple, specify seperate 
+            connect and read timeouts.
+        gzip : bool, optional
+            If True (default), advertise gzip/deflate content encoding.
+        max_retries : int, optional
+            Number of times a failed connection will be retried. Default is 0.
+
+        Returns
+        -------
+        HttpSession
+            the newly configured session
+        '''
+        self.session.close()
+        self.session = HttpSession(pool_size=pool_size, 
+                                   timeout=timeout, 
+                                   gzip=gzip, 
+                                   max_retries=max_retries)
+        return self.session
 
     def set_api_urls(self, api_base_url_string):
         '''Set the internal RMA and well known file download endpoint urls
@@ -144,7 +228,7 @@ class Api(object):
         '''
         return parsed_json['msg']
 
-    def json_msg_query(self, url, dataframe=False):
+    def json_msg_query(self, url, dataframe=False, stream=False):
         ''' Common case where the url is fully constructed
             and the response data is stored in the 'msg' field.
 
@@ -154,12 +238,17 @@ class Api(object):
             Where to get the data in json form
         dataframe : boolean
             True converts to a pandas dataframe, False (default) doesn't
+        stream : boolean
+            True returns a generator over the 'msg' rows, decoded as they 
+            are downloaded, instead of parsing the whole response.
 
         Returns
         -------
-        dict or DataFrame
-            returned data; type depends on dataframe option
+        dict, DataFrame or generator
+            returned data; type depends on dataframe and stream options
         '''
+        if stream is True:
+            return self.retrieve_streamed_json_over_http(url)
 
         data = self.do_query(lambda *a, **k: url,
                              self.read_data)
@@ -278,6 +367,24 @@ class Api(object):
         '''
         return self.well_known_file_endpoint + '/' + str(well_known_file_id)
 
+    @staticmethod
+    def well_known_file_checks(well_known_file):
+        '''Collect the size and md5 digest recorded for a well known file, as 
+        keyword arguments for retrieve_file_over_http.
+
+        Parameters
+        ----------
+        well_known_file : dict
+            WellKnownFile record from the api.
+
+        Returns
+        -------
+        dict
+            expected_size and expected_md5; None for values the record lacks.
+        '''
+        return {'expected_size': well_known_file.get('file_size'),
+                'expected_md5': well_known_file.get('md5')}
+
     def cleanup_truncated_file(self, file_path):
         '''Helper for removing files.
 
@@ -291,9 +398,19 @@ class Api(object):
             if e.errno != errno.ENOENT:
                 raise
 
-    def retrieve_file_over_http(self, url, file_path, zipped=False):
+    def retrieve_file_over_http(self, url, file_path, zipped=False, 
+                                expected_size=None, expected_md5=None):
         '''Get a file from the data api and save it.
 
+        The file is downloaded to a partial file alongside file_path and 
+        renamed into place once complete, so file_path never holds a 
+        truncated download. Interrupted transfers are resumed with HTTP range 
+        requests (up to download_retries times, backing off exponentially 
+        from download_retry_delay seconds); if they still fail, the partial 
+        file is kept and resumed on the next call. Resumed requests are 
+        conditional on the remote file being unchanged (If-Range); if it has 
+        changed, the download starts over.
+
         Parameters
         ----------
         url : string
@@ -304,6 +421,13 @@ class Api(object):
             If true, assume that the response is a zipped directory and attempt 
             to extract contained files into the directory containing file_path. 
             Default is False.
+        expected_size : int, optional
+            Size of the complete file in bytes (e.g. from a well known file 
+            record). Transfers are always checked against the size reported 
+            by the server, if any.
+        expected_md5 : string, optional
+            Hex md5 digest of the complete file. If provided, the download is 
+            checked against it before being moved into place.
 
         See Also
         --------
@@ -316,37 +440,98 @@ class Api(object):
 
         self._file_download_log.info("Downloading URL: %s", url)
 
+        partial_path = file_path + self.partial_file_suffix
+
         try:
             if zipped:
-                stream_zip_directory_over_http(url, os.path.dirname(file_path))
+                stream_zip_directory_over_http(url, os.path.dirname(file_path), 
+                                               session=self.session,
+                                               spool_size=self.zip_spool_size)
             else:
-                stream_file_over_http(url, file_path)
-
-        except exceptions.StreamingError as e:
-            self._file_download_log.error("Couldn't retrieve file %s from %s (streaming)." % (file_path,url))
-            self.cleanup_truncated_file(file_path)
-            raise
-
-        except requests.exceptions.ConnectionError as e:
-            self._file_download_log.error("Couldn't retrieve file %s from %s (connection)." % (file_path,url))
-            self.cleanup_truncated_file(file_path)
-            raise
-
-        except requests.exceptions.ReadTimeout as e:
-            self._file_download_log.error("Couldn't retrieve file %s from %s (timeout)." % (file_path,url))
-            self.cleanup_truncated_file(file_path)
-            raise
-
-        except requests.exceptions.RequestException as e:
-            self._file_download_log.error("Couldn't retrieve file %s from %s (request)." % (file_path,url))
-            self.cleanup_truncated_file(file_path)
+                self.resume_file_over_http(url, partial_path, 
+                                           expected_size=expected_size,
+                                           expected_md5=expected_md5)
+                replace_file(partial_path, file_path)
+
+        except self._interrupted_download_errors as e:
+            self._file_download_log.error("Couldn't retrieve file %s from %s (interrupted)." % (file_path,url))
+            # an unzipped download leaves its partial file to be resumed 
+            # and any existing copy of file_path untouched
+            if zipped:
+                self.cleanup_truncated_file(file_path)
             raise
 
         except Exception as e:
             self._file_download_log.error("Couldn't retrieve file %s from %s" % (file_path, url))
-            self.cleanup_truncated_file(file_path)
+            if zipped:
+                self.cleanup_truncated_file(file_path)
+            else:
+                self.cleanup_truncated_file(partial_path)
             raise
 
+    def resume_file_over_http(self, url, partial_path, 
+                              expected_size=None, expected_md5=None):
+        '''Download a file, continuing from the end of partial_path if it 
+        already exists and the remote file has not been modified since 
+        partial_path was written. Interrupted transfers are resumed up to 
+        download_retries times.
+
+        Parameters
+        ----------
+        url : string
+            Url from which to get the file.
+        partial_path : string
+            Path to which the file is streamed.
+        expected_size : int, optional
+            Size of the complete file in bytes.
+        expected_md5 : string, optional
+            Hex md5 digest of the complete file.
+
+        Raises
+        ------
+        IOError
+            If the completed download does not match expected_size or 
+            expected_md5.
+        '''
+        retries = 0
+
+        while True:
+            offset = 0
+            if_range = None
+            if os.path.exists(partial_path):
+                offset = os.path.getsize(partial_path)
+                if_range = formatdate(os.path.getmtime(partial_path), usegmt=True)
+
+            try:
+                total_size = stream_file_over_http(url, partial_path, 
+                                                   session=self.session, 
+                                                   resume_from=offset,
+                                                   if_range=if_range)
+                received = os.path.getsize(partial_path)
+                if total_size is None or received >= total_size:
+                    break
+
+                raise exceptions.StreamingError(
+                    "Download of %s ended after %d of %d bytes" % (url, received, total_size))
+
+            except requests.exceptions.HTTPError as e:
+                if offset == 0 or e.response is None or e.response.status_code != 416:
+                    raise
+
+                # the partial file does not fit the remote file; start over
+                self.cleanup_truncated_file(partial_path)
+                continue
+
+            except self._interrupted_download_errors as e:
+                if retries >= self.download_retries:
+                    raise
+
+            retries += 1
+            self._file_download_log.warning("Resuming download of %s (attempt %d of %d)", 
+                                            url, retries, self.download_retries)
+            time.sleep(self.download_retry_delay * 2 ** (retries - 1))
+
+        verify_file(partial_path, expected_size, expected_md5)
 
     def retrieve_parsed_json_over_http(self, url, post=False):
         '''Get the document and put it in a Python data structure
@@ -368,12 +553,41 @@ class Api(object):
         if post is False:
             data = json_utilities.read_url_get(
                 requests.utils.quote(url,
-                                     ';/?:@&=+$,'))
+                                     ';/?:@&=+$,'),
+                session=self.session)
         else:
-            data = json_utilities.read_url_post(url)
+            data = json_utilities.read_url_post(url, session=self.session)
 
         return data
 
+    def retrieve_streamed_json_over_http(self, url, key='msg', envelope=None):
+        '''Get the document and decode the array under one of its keys 
+        incrementally, so that only one element at a time is held in memory.
+
+        Parameters
+        ----------
+        url : string
+            Full API query url.
+        key : string, optional
+            Top-level key of the array to stream (default 'msg').
+        envelope : dict, optional
+            If provided, filled with the other top-level fields of the 
+            response (e.g. success, total_rows).
+
+        Returns
+        -------
+        generator
+            Elements of the array as parsed by the JSON library.
+        '''
+        self._log.info("Streaming URL: %s", url)
+
+        return json_utilities.read_url_get_rows(
+            requests.utils.quote(url,
+                                 ';/?:@&=+$,'),
+            key=key,
+            session=self.session,
+            envelope=envelope)
+
     def retrieve_xml_over_http(self, url):
         '''Get the document and put it in a Python data structure
 
@@ -389,14 +603,19 @@ class Api(object):
         '''
         self._log.info("Downloading URL: %s", url)
                 
-        response = requests.get(url)
+        response = self.session.get(url)
 
         return response.content
 
 
-def stream_zip_directory_over_http(url, directory, members=None, timeout=(9.05, 31.1)):
+def stream_zip_directory_over_http(url, directory, members=None, timeout=(9.05, 31.1), 
+                                   session=None, spool_size=2 ** 26):
     ''' Supply an http get request and stream the response to a file.
 
+    The archive is spooled in memory up to spool_size bytes, then to a 
+    temporary file, and its members are extracted one at a time, so memory 
+    use does not grow with the size of the archive.
+
     Parameters
     ----------
     url : str
@@ -408,20 +627,33 @@ def stream_zip_directory_over_http(url, directory, members=None, timeout=(9.05,
     timeout : float or tuple of float, optional
         Specify a timeout for the request. If a tuple, specify seperate connect 
         and read timeouts.
+    session : requests.Session, optional
+        Issue the request through this (pooled) session. If not provided, a 
+        new connection is opened.
+    spool_size : int, optional
+        Maximum number of bytes of the archive held in memory. Default is 64 MiB.
 
     '''
 
-    buf = io.BytesIO()
+    get = requests.get if session is None else session.get
+
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as buf:
 
-    with closing( requests.get(url, stream=True, timeout=timeout) ) as request:
-        stream.stream_response_to_file( request, buf )
+        with closing( get(url, stream=True, timeout=timeout) ) as request:
+            stream.stream_response_to_file( request, buf )
 
-    zipper = zipfile.ZipFile(buf)
-    zipper.extractall(path=directory, members=members)
-    zipper.close()
+        buf.seek(0)
 
+        with closing(zipfile.ZipFile(buf)) as zipper:
+            if members is None:
+                members = zipper.namelist()
 
-def stream_file_over_http(url, file_path, timeout=(9.05, 31.1)):
+            for member in members:
+                zipper.extract(member, path=directory)
+
+
+def stream_file_over_http(url, file_path, timeout=(9.05, 31.1), session=None, 
+                          resume_from=0, if_range=None):
     ''' Supply an http get request and stream the response to a file.
 
     Parameters
@@ -433,11 +665,160 @@ def stream_file_over_http(url, file_path, timeout=(9.05, 31.1)):
     timeout : float or tuple of float, optional
         Specify a timeout for the request. If a tuple, specify seperate connect 
         and read timeouts.
+    session : requests.Session, optional
+        Issue the request through this (pooled) session. If not provided, a 
+        new connection is opened.
+    resume_from : int, optional
+        If nonzero, request only the bytes following this offset and append 
+        them to file_path. If the server ignores the range request, file_path 
+        is overwritten with the full response.
+    if_range : str, optional
+        Entity tag or HTTP date that the remote file must still match for the 
+        range request to be honored (If-Range). Otherwise the server sends the 
+        full file, which overwrites file_path.
+
+    The modification time of file_path is set to the Last-Modified date of 
+    the response, if one is reported, so that it can be used as the 
+    validator of a later resumed request.
+
+    Returns
+    -------
+    int or None :
+        Size in bytes of the complete file, if reported by the server.
 
     '''
 
-    with closing(requests.get(url, stream=True, timeout=timeout)) as response:
+    get = requests.get if session is None else session.get
+
+    kwargs = {'stream': True, 'timeout': timeout}
+    if resume_from:
+        kwargs['headers'] = {'Range': 'bytes={0}-'.format(resume_from),
+                             'Accept-Encoding': 'identity'}
+        if if_range is not None:
+            kwargs['headers']['If-Range'] = if_range
+
+    with closing(get(url, **kwargs)) as response:
 
         response.raise_for_status()
-        with open(file_path, 'wb') as fil:
-            stream.stream_response_to_file(response, path=fil)
+        partial = bool(resume_from) and response.status_code == 206
+
+        try:
+            with open(file_path, 'ab' if partial else 'wb') as fil:
+                stream.stream_response_to_file(response, path=fil)
+        finally:
+            last_modified = reported_last_modified(response)
+            if last_modified is not None and os.path.exists(file_path):
+                os.utime(file_path, (last_modified, last_modified))
+
+        return reported_file_size(response, resume_from if partial else 0)
+
+
+def reported_last_modified(response):
+    ''' Read the Last-Modified date of a response.
+
+    Parameters
+    ----------
+    response : requests.Response
+        Response whose headers will be inspected.
+
+    Returns
+    -------
+    float or None :
+        Seconds since the epoch, or None if the date was not reported.
+
+    '''
+
+    try:
+        return float(mktime_tz(parsedate_tz(response.headers.get('Last-Modified'))))
+    except (AttributeError, TypeError, ValueError, OverflowError):
+        return None
+
+
+def reported_file_size(response, offset=0):
+    ''' Determine the size of a complete file from the headers of a (possibly 
+    partial) response.
+
+    Parameters
+    ----------
+    response : requests.Response
+        Response whose headers will be inspected.
+    offset : int, optional
+        Byte offset at which this response's content begins.
+
+    Returns
+    -------
+    int or None :
+        Size in bytes, or None if it could not be determined (for instance 
+        because the content was compressed in transit).
+
+    '''
+
+    headers = response.headers
+
+    try:
+        content_range = headers.get('Content-Range')
+        if content_range is not None:
+            return int(content_range.rsplit('/', 1)[1])
+
+        if headers.get('Content-Encoding', 'identity') != 'identity':
+            return None
+
+        content_length = headers.get('Content-Length')
+        if content_length is not None:
+            return offset + int(content_length)
+    except (AttributeError, IndexError, TypeError, ValueError):
+        pass
+
+    return None
+
+
+def verify_file(file_path, expected_size=None, expected_md5=None):
+    ''' Check a downloaded file against its expected size and md5 digest. 
+    Files that fail are removed.
+
+    Parameters
+    ----------
+    file_path : str
+        File to check.
+    expected_size : int, optional
+        Size in bytes. Not checked if None.
+    expected_md5 : str, optional
+        Hex md5 digest. Not checked if None.
+
+    Raises
+    ------
+    IOError
+        If the file does not match.
+
+    '''
+
+    problem = None
+
+    if expected_size is not None and os.path.getsize(file_path) != int(expected_size):
+        problem = 'is %d bytes, expected %d' % (os.path.getsize(file_path), int(expected_size))
+
+    elif expected_md5 is not None:
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as fil:
+            for chunk in iter(lambda: fil.read(2 ** 20), b''):
+                md5.update(chunk)
+
+        if md5.hexdigest() != expected_md5.lower():
+            problem = 'has md5 %s, expected %s' % (md5.hexdigest(), expected_md5)
+
+    if problem is not None:
+        os.remove(file_path)
+        raise IOError('downloaded file %s %s' % (file_path, problem))
+
+
+def replace_file(source, destination):
+    ''' Atomically (on POSIX) move source to destination, overwriting 
+    destination if it exists.
+    '''
+
+    try:
+        os.replace(source, destination)
+    except AttributeError:
+        if os.name == 'nt' and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
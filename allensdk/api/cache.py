@@ -37,33 +37,218 @@ from allensdk.config.manifest import Manifest, ManifestVersionError
 from allensdk.config.manifest_builder import ManifestBuilder
 import allensdk.core.json_utilities as ju
 from allensdk.deprecated import deprecated
+from allensdk.api.file_lock import FileLock
+from allensdk.api.api import replace_file
 
 import pandas as pd
 import pandas.io.json as pj
+import numpy as np
 
 import functools
+import itertools
 from functools import wraps
+from collections import OrderedDict, namedtuple
 import os
+import sys
+import time
+import threading
+import weakref
 import logging
 import csv
+import importlib
+import simplejson as json
+from six import string_types
 
 
-def memoize(f):
-   memodict = dict()
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 
+                                     'max_entries', 'entries', 
+                                     'max_bytes', 'nbytes'])
 
-   @wraps(f)
-   def wrapper(*args, **kwargs):
-       key = (args, tuple(kwargs.items()))
 
-       if key not in memodict:
-           memodict[key] = f(*args, **kwargs)
+def sizeof(value):
+    ''' Estimate the memory held by a cached value. Arrays and data frames 
+    report their buffer sizes; tuples, lists and dicts are summed over their 
+    elements.
+    '''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True)))
+    elif isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    elif isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+class MemoCache(object):
+    ''' A thread-safe least-recently-used store for memoized results, bounded 
+    by number of entries and/or bytes and optionally expiring entries after 
+    ttl seconds. 
+
+    If the first argument of a call (typically self) can be weakly referenced, 
+    the cache holds only a weak reference to it and drops that object's 
+    entries once it is garbage collected.
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        self._dead_owners = []
+
+    def make_key(self, args, kwargs):
+        if len(args) > 0:
+            try:
+                owner = weakref.ref(args[0], self._owner_collected)
+                args = (owner,) + tuple(args[1:])
+            except TypeError:
+                pass
+
+        return (tuple(args), tuple(sorted(kwargs.items())))
+
+    def get(self, key):
+        ''' Returns a tuple (found, value).
+        '''
+        with self._lock:
+            self._purge_dead_owners()
+
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                value, nbytes, expires = entry
+
+                if expires is None or expires > time.time():
+                    self._entries.pop(key)
+                    self._entries[key] = entry
+                    self._hits += 1
+                    return True, value
+
+                self._remove(key)
+
+            self._misses += 1
+            return False, None
+
+    def put(self, key, value):
+        nbytes = sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, nbytes, expires)
+            self._nbytes += nbytes
+
+            while ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                   (self.max_bytes is not None and self._nbytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def info(self):
+        with self._lock:
+            self._purge_dead_owners()
+            return CacheInfo(self._hits, self._misses, 
+                             self.max_entries, len(self._entries), 
+                             self.max_bytes, self._nbytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self._hits = 0
+            self._misses = 0
+            self._dead_owners = []
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._nbytes -= nbytes
+
+    def _owner_collected(self, owner):
+        self._dead_owners.append(owner)
+
+        # if the cache is busy (possibly in this very thread), the entries 
+        # will be dropped on the next access instead
+        if self._lock.acquire(False):
+            try:
+                self._purge_dead_owners()
+            finally:
+                self._lock.release()
+
+    def _purge_dead_owners(self):
+        if not self._dead_owners:
+            return
+
+        dead = self._dead_owners
+        self._dead_owners = []
 
-       return memodict[key]
+        for key in list(self._entries.keys()):
+            args = key[0]
+            if len(args) > 0 and any(args[0] is d for d in dead):
+                self._remove(key)
 
-   return wrapper
+
+def memoize(f=None, max_entries=None, max_bytes=None, ttl=None):
+    ''' Cache the results of a function or method by its arguments. May be 
+    used bare (@memoize) or with arguments (@memoize(max_bytes=2**30)).
+
+    Parameters
+    ----------
+    f : function
+        function to be memoized
+    max_entries : int, optional
+        Least recently used results are discarded beyond this many.
+    max_bytes : int, optional
+        Least recently used results are discarded once the results held 
+        exceed this size. Array buffers are counted by their nbytes. Results 
+        larger than this are not cached.
+    ttl : float, optional
+        Results older than this many seconds are recomputed.
+
+    Notes
+    -----
+    The first argument (usually self) is held by weak reference if possible, 
+    so memoizing a method does not keep its instances alive. The wrapper 
+    exposes cache_info() and cache_clear().
+    '''
+    if f is None:
+        return functools.partial(memoize, 
+                                 max_entries=max_entries, 
+                                 max_bytes=max_bytes, 
+                                 ttl=ttl)
+
+    cache = MemoCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            key = cache.make_key(args, kwargs)
+            found, value = cache.get(key)
+        except TypeError:
+            # unhashable arguments cannot be cached
+            return f(*args, **kwargs)
+
+        if not found:
+            value = f(*args, **kwargs)
+            cache.put(key, value)
+
+        return value
+
+    wrapper.cache_info = cache.info
+    wrapper.cache_clear = cache.clear
+
+    return wrapper
 
 class Cache(object):
     _log = logging.getLogger('allensdk.api.cache')
+    partial_file_suffix = '.part'
 
     def __init__(self,
                  manifest=None,
@@ -291,7 +476,10 @@ class Cache(object):
             'create' always generates the data,
             'file' loads from disk,
             'lazy' queries the server if no file exists,
-            None generates the data and bypasses all caching behavior
+            None generates the data and bypasses all caching behavior.
+            Files are created while holding a FileLock on path, so that 
+            processes sharing a cache create each file once; loading an 
+            existing file takes no lock unless its creation is in progress.
         pre : function
             df|json->df|json, takes one data argument and returns filtered version, None for pass-through
         post : function
@@ -324,26 +512,27 @@ class Cache(object):
         if not strategy in ['lazy', 'pass_through', 'file', 'create']:
             raise ValueError("Unknown query strategy: {}.".format(strategy))
 
-        if 'lazy' == strategy:
-            if os.path.exists(path):
+        if strategy == 'pass_through':
+            data = fn(*args, **kwargs)
+
+            if reader:
+                data = reader(path)
+
+        else:
+            # cached files are moved into place once complete, so one 
+            # that exists can be read without waiting for the lock
+            if 'lazy' == strategy and os.path.exists(path):
                 strategy = 'file'
-            else:
-                strategy = 'create'
 
-        if strategy == 'pass_through':
-                data = fn(*args, **kwargs)
-        elif strategy in ['create']:
-            Manifest.safe_make_parent_dirs(path)
-
-            if writer:
-                data = fn(*args, **kwargs)
-                data = pre(data)
-                writer(path, data)
+            if strategy == 'file':
+                if reader:
+                    data = reader(path)
+
             else:
-                data = fn(*args, **kwargs)
+                Manifest.safe_make_parent_dirs(path)
 
-        if reader:
-            data = reader(path)
+                data = Cache._create(fn, args, kwargs, path, strategy, 
+                                     pre, reader, writer)
 
         # Note: don't provide post if fn or reader doesn't return data
         if post:
@@ -358,6 +547,47 @@ class Cache(object):
 
         return
 
+    @staticmethod
+    def _create(fn, args, kwargs, path, strategy, pre, reader, writer):
+        '''Create (or, for the lazy strategy, wait for another process to 
+        create) a cached file and load it.
+        '''
+        data = None
+
+        # Concurrent processes sharing a cache directory take turns here: 
+        # the first to arrive creates the file, the rest wait for it and 
+        # then find it already present.
+        with FileLock(path):
+            if 'lazy' == strategy:
+                if os.path.exists(path):
+                    strategy = 'file'
+                else:
+                    strategy = 'create'
+
+            if strategy == 'create':
+                if writer:
+                    data = fn(*args, **kwargs)
+                    data = pre(data)
+
+                    # streamed data is downloaded while it is written, so 
+                    # write beside path and move the file into place only 
+                    # once it is complete
+                    partial_path = path + Cache.partial_file_suffix
+                    try:
+                        writer(partial_path, data)
+                        replace_file(partial_path, path)
+                    except Exception:
+                        if os.path.exists(partial_path):
+                            os.remove(partial_path)
+                        raise
+                else:
+                    data = fn(*args, **kwargs)
+
+            if reader:
+                data = reader(path)
+
+        return data
+
     @staticmethod
     def csv_writer(pth, gen):
         csv_writer = None
@@ -379,6 +609,190 @@ class Cache(object):
                 row_count = row_count + 1
                 csv_writer.writerow(row)
 
+    binary_formats = ('parquet', 'feather', 'hdf5')
+    _binary_magic = ((b'PAR1', 'parquet'),
+                     (b'FEA1', 'feather'),
+                     (b'ARROW1', 'feather'),
+                     (b'\x89HDF\r\n\x1a\n', 'hdf5'))
+    _hdf5_key = 'data'
+    _json_columns_key = 'allensdk_json_columns'
+
+    @staticmethod
+    def default_binary_format():
+        '''Parquet if pyarrow is installed, otherwise an HDF5 table (via 
+        PyTables, a core dependency).
+        '''
+        try:
+            importlib.import_module('pyarrow')
+            return 'parquet'
+        except ImportError:
+            return 'hdf5'
+
+    @staticmethod
+    def binary_writer(pth, data, fmt=None):
+        '''Write query results to a binary columnar file.
+
+        Parameters
+        ----------
+        pth : string
+            where to write the data
+        data : DataFrame or iterable of dict
+            query results
+        fmt : string, optional
+            'parquet', 'feather' or 'hdf5'. Defaults to 
+            Cache.default_binary_format().
+
+        Notes
+        -----
+        Object columns holding anything other than strings (e.g. nested 
+        records or booleans with missing values) are stored as json strings. 
+        Their names are recorded in the file's metadata, so that 
+        Cache.binary_reader decodes them again.
+        '''
+        if fmt is None:
+            fmt = Cache.default_binary_format()
+
+        if not fmt in Cache.binary_formats:
+            raise ValueError("Unknown binary format: {}.".format(fmt))
+
+        if isinstance(data, pd.DataFrame):
+            data = data.copy()
+        else:
+            data = Cache.rows_to_dataframe(data)
+
+        json_columns = []
+        for column in data.columns[data.dtypes == object]:
+            values = data[column]
+            present = values.notnull()
+
+            if not all(isinstance(v, string_types) for v in values[present]):
+                data[column] = [json.dumps(v, default=ju.json_handler) if p else None 
+                                for v, p in zip(values, present)]
+                json_columns.append(str(column))
+
+        if fmt == 'hdf5':
+            with pd.HDFStore(pth, mode='w') as store:
+                store.put(Cache._hdf5_key, data, format='table')
+                setattr(store.get_storer(Cache._hdf5_key).attrs, 
+                        Cache._json_columns_key, json_columns)
+            return
+
+        import pyarrow as pa
+
+        if fmt == 'feather':
+            drop = isinstance(data.index, pd.RangeIndex)
+            data = data.reset_index(drop=drop)
+
+        table = pa.Table.from_pandas(data, preserve_index=(fmt == 'parquet'))
+        metadata = dict(table.schema.metadata or {})
+        metadata[Cache._json_columns_key.encode('utf-8')] = \
+            json.dumps(json_columns).encode('utf-8')
+        table = table.replace_schema_metadata(metadata)
+
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, pth)
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(table, pth)
+
+    @staticmethod
+    def rows_to_dataframe(rows, chunk_rows=2000):
+        '''Build a dataframe from an iterable of records a chunk at a time, 
+        so that a generator of streamed query results is never held as one 
+        list of dicts.
+
+        Parameters
+        ----------
+        rows : iterable of dict
+            query results
+        chunk_rows : int, optional
+            number of records converted at a time
+        '''
+        rows = iter(rows)
+        chunks = []
+
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+
+            if not chunk:
+                break
+
+            chunks.append(pd.DataFrame(chunk))
+
+        if not chunks:
+            return pd.DataFrame()
+
+        return pd.concat(chunks, ignore_index=True, sort=False)
+
+    @staticmethod
+    def binary_reader(pth, columns=None):
+        '''Read a file written by Cache.binary_writer as a pandas dataframe. 
+        The format is detected from the file's signature.
+
+        Parameters
+        ----------
+        pth : string
+            where to read the data
+        columns : list of string, optional
+            read only these columns
+        '''
+        with open(pth, 'rb') as fil:
+            head = fil.read(8)
+
+        fmt = None
+        for magic, candidate in Cache._binary_magic:
+            if head.startswith(magic):
+                fmt = candidate
+                break
+
+        if fmt == 'hdf5':
+            with pd.HDFStore(pth, mode='r') as store:
+                data = store.select(Cache._hdf5_key, columns=columns)
+                json_columns = getattr(store.get_storer(Cache._hdf5_key).attrs, 
+                                       Cache._json_columns_key, [])
+
+        elif fmt in ('parquet', 'feather'):
+            if fmt == 'parquet':
+                import pyarrow.parquet as pq
+                table = pq.read_table(pth, columns=columns, use_pandas_metadata=True)
+            else:
+                import pyarrow.feather as feather
+                table = feather.read_table(pth, columns=columns)
+
+            metadata = table.schema.metadata or {}
+            json_columns = json.loads(
+                metadata.get(Cache._json_columns_key.encode('utf-8'), b'[]').decode('utf-8'))
+            data = table.to_pandas()
+
+        else:
+            raise IOError("{} is not a parquet, feather or hdf5 file".format(pth))
+
+        for column in json_columns:
+            if column in data.columns:
+                data[column] = [json.loads(v) if isinstance(v, string_types) else None 
+                                for v in data[column]]
+
+        return data
+
+    @staticmethod
+    def cache_binary_dataframe(columns=None, fmt=None):
+        '''Cache query results in a binary columnar file, which preserves 
+        dtypes and loads much faster than csv or json.
+
+        Parameters
+        ----------
+        columns : list of string, optional
+            load only these columns from the cached file
+        fmt : string, optional
+            'parquet', 'feather' or 'hdf5'. Defaults to 
+            Cache.default_binary_format().
+        '''
+        return {
+            'writer': functools.partial(Cache.binary_writer, fmt=fmt),
+            'reader': functools.partial(Cache.binary_reader, columns=columns)
+        }
+
     @staticmethod
     def cache_csv_json():
         return {
@@ -0,0 +1,241 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2015-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+import errno
+import time
+import threading
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+class FileLock(object):
+    ''' Advisory lock on a file path, shared between threads and processes 
+    (including processes on other hosts using the same NFS mount, as long 
+    as the server supports POSIX record locks).
+
+    The lock is held on a sidecar file (path + '.lock'), which exists only 
+    while the lock is held or waited for and is removed on release. 
+    Acquisition is reentrant within a thread. If the sidecar file cannot be 
+    created (for instance because the directory is read-only), the lock 
+    degrades to a no-op.
+
+    Parameters
+    ----------
+    path : str
+        The path to be protected. If None, the lock is a no-op.
+    timeout : float, optional
+        Give up (raising LockTimeout) after waiting this many seconds. By 
+        default, wait indefinitely.
+    poll_interval : float, optional
+        Seconds between attempts when waiting for another process.
+
+    '''
+
+    _log = logging.getLogger('allensdk.api.file_lock')
+    suffix = '.lock'
+
+    # per-process bookkeeping: POSIX locks belong to the process, not the 
+    # file descriptor, so threads are excluded with an RLock and the 
+    # descriptor is only closed by the outermost release. Records are 
+    # dropped once no thread holds or waits for them.
+    _registry_lock = threading.Lock()
+    _held = {}
+
+    def __init__(self, path, timeout=None, poll_interval=0.1):
+        self.lock_path = None if path is None else os.path.abspath(path + self.suffix)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    @classmethod
+    def pending(cls, path):
+        ''' Whether some thread or process holds or is waiting for the lock 
+        on path (for instance, because it is still writing the file).
+        '''
+        return os.path.isfile(path + cls.suffix)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _record(self):
+        with FileLock._registry_lock:
+            record = FileLock._held.get(self.lock_path, None)
+            if record is None:
+                record = {'thread_lock': threading.RLock(), 'depth': 0, 'fd': None, 'users': 0}
+                FileLock._held[self.lock_path] = record
+            record['users'] += 1
+            return record
+
+    def _forget(self, record):
+        with FileLock._registry_lock:
+            record['users'] -= 1
+            if record['users'] == 0:
+                del FileLock._held[self.lock_path]
+
+    def acquire(self):
+        if self.lock_path is None:
+            return
+
+        start = time.time()
+        record = self._record()
+
+        if not _acquire_with_timeout(record['thread_lock'], self.timeout):
+            self._forget(record)
+            raise LockTimeout("timed out waiting for %s" % self.lock_path)
+
+        record['depth'] += 1
+        if record['depth'] > 1:
+            return
+
+        waiting_logged = False
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+            except (IOError, OSError) as e:
+                self._log.warning("could not create lock file %s (%s); proceeding unlocked", 
+                                  self.lock_path, e)
+                return
+
+            try:
+                _lock_fd(fd)
+
+                # the previous holder removes the lock file on release; if it 
+                # did so after we opened it, we locked a file nobody else sees
+                if _is_current(fd, self.lock_path):
+                    break
+                os.close(fd)
+                time.sleep(self.poll_interval)
+                continue
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno not in (errno.EACCES, errno.EAGAIN, errno.EDEADLK):
+                    self._release_thread_lock(record)
+                    raise
+
+            if self.timeout is not None and time.time() - start > self.timeout:
+                self._release_thread_lock(record)
+                raise LockTimeout("timed out waiting for %s" % self.lock_path)
+
+            if not waiting_logged:
+                self._log.info("waiting for another process to finish with %s", 
+                               self.lock_path[:-len(self.suffix)])
+                waiting_logged = True
+
+            time.sleep(self.poll_interval)
+
+        record['fd'] = fd
+
+    def release(self):
+        if self.lock_path is None:
+            return
+
+        with FileLock._registry_lock:
+            record = FileLock._held[self.lock_path]
+
+        if record['depth'] == 1 and record['fd'] is not None:
+            fd = record['fd']
+            record['fd'] = None
+            try:
+                # remove the lock file while still holding it, so that 
+                # waiters notice and open a fresh one
+                try:
+                    os.remove(self.lock_path)
+                except OSError:
+                    pass
+                _unlock_fd(fd)
+            finally:
+                os.close(fd)
+
+        self._release_thread_lock(record)
+
+    def _release_thread_lock(self, record):
+        record['depth'] -= 1
+        record['thread_lock'].release()
+        self._forget(record)
+
+
+class LockTimeout(IOError):
+    pass
+
+
+def _acquire_with_timeout(lock, timeout):
+    if timeout is None:
+        return lock.acquire()
+
+    deadline = time.time() + timeout
+    while not lock.acquire(False):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _lock_fd(fd):
+    if fcntl is not None:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    elif msvcrt is not None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+
+def _unlock_fd(fd):
+    if fcntl is not None:
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def _is_current(fd, path):
+    try:
+        path_stat = os.stat(path)
+    except OSError:
+        return False
+
+    fd_stat = os.fstat(fd)
+    return (path_stat.st_dev, path_stat.st_ino) == (fd_stat.st_dev, fd_stat.st_ino)
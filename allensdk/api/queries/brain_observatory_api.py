@@ -367,7 +367,8 @@ class BrainObservatoryApi(RmaTemplate):
         self._log.warning(
             "Downloading ophys_experiment %d NWB. This can take some time." % ophys_experiment_id)
 
-        self.retrieve_file_over_http(self.api_url + file_url, file_name)
+        self.retrieve_file_over_http(self.api_url + file_url, file_name,
+                                     **self.well_known_file_checks(data[0]))
 
     @cacheable(strategy='create',
                pathfinder=Cache.pathfinder(file_name_position=2,
@@ -387,7 +388,8 @@ class BrainObservatoryApi(RmaTemplate):
         self._log.warning(
             "Downloading ophys_experiment %d analysis file. This can take some time." % (ophys_experiment_id, ))
 
-        self.retrieve_file_over_http(self.api_url + file_url, file_name)
+        self.retrieve_file_over_http(self.api_url + file_url, file_name,
+                                     **self.well_known_file_checks(data[0]))
 
 
     @cacheable(strategy='create',
@@ -405,7 +407,8 @@ class BrainObservatoryApi(RmaTemplate):
         self._log.warning(
             "Downloading ophys_experiment %d events file. This can take some time." % ophys_experiment_id)
 
-        self.retrieve_file_over_http(self.api_url + file_url, file_name)
+        self.retrieve_file_over_http(self.api_url + file_url, file_name,
+                                     **self.well_known_file_checks(data[0]))
 
     def filter_experiments_and_containers(self, objs,
                                           ids=None,
@@ -667,7 +670,8 @@ class BrainObservatoryApi(RmaTemplate):
         except Exception as _:
             raise Exception("No OphysCellSpecimenIdMapping file found.")
 
-        self.retrieve_file_over_http(self.api_url + file_url, file_name)
+        self.retrieve_file_over_http(self.api_url + file_url, file_name,
+                                     **self.well_known_file_checks(data[0]))
 
         return pd.read_csv(file_name)
 
@@ -328,12 +328,13 @@ class CellTypesApi(RmaApi):
                                    num_rows='all')
 
         try:
-            file_url = results[0]['ephys_result'][
-                'well_known_files'][0]['download_link']
+            well_known_file = results[0]['ephys_result']['well_known_files'][0]
+            file_url = well_known_file['download_link']
         except Exception as _:
             raise Exception("Specimen %d has no ephys data" % specimen_id)
 
-        self.retrieve_file_over_http(self.api_url + file_url, file_name)
+        self.retrieve_file_over_http(self.api_url + file_url, file_name,
+                                     **self.well_known_file_checks(well_known_file))
 
     def save_reconstruction(self, specimen_id, file_name):
         """
@@ -359,12 +360,14 @@ class CellTypesApi(RmaApi):
                                    num_rows='all')
 
         try:
-            file_url = results[0]['neuron_reconstructions'][
-                0]['well_known_files'][0]['download_link']
+            well_known_file = results[0]['neuron_reconstructions'][
+                0]['well_known_files'][0]
+            file_url = well_known_file['download_link']
         except:
             raise Exception("Specimen %d has no reconstruction" % specimen_id)
 
-        self.retrieve_file_over_http(self.api_url + file_url, file_name)
+        self.retrieve_file_over_http(self.api_url + file_url, file_name,
+                                     **self.well_known_file_checks(well_known_file))
 
     def save_reconstruction_markers(self, specimen_id, file_name):
         """
@@ -392,9 +395,11 @@ class CellTypesApi(RmaApi):
                                    num_rows='all')
 
         try:
-            file_url = results[0]['neuron_reconstructions'][
-                0]['well_known_files'][0]['download_link']
+            well_known_file = results[0]['neuron_reconstructions'][
+                0]['well_known_files'][0]
+            file_url = well_known_file['download_link']
         except:
             raise LookupError("Specimen %d has no marker file" % specimen_id)
 
-        self.retrieve_file_over_http(self.api_url + file_url, file_name)
+        self.retrieve_file_over_http(self.api_url + file_url, file_name,
+                                     **self.well_known_file_checks(well_known_file))
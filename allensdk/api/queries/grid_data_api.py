@@ -209,13 +209,15 @@ class GridDataApi(RmaApi):
             include='well_known_file_type'
         )
 
-        well_known_file_urls = {
-            wkf['well_known_file_type']['name']: 
-            self.construct_well_known_file_download_url(wkf['id']) for wkf in well_known_files
+        well_known_files = {
+            wkf['well_known_file_type']['name']: wkf for wkf in well_known_files
         }
-        
-        self.retrieve_file_over_http(well_known_file_urls[header_type], header_path)
-        self.retrieve_file_over_http(well_known_file_urls[voxel_type], voxel_path)
+
+        for file_type, path in ((header_type, header_path), (voxel_type, voxel_path)):
+            wkf = well_known_files[file_type]
+            self.retrieve_file_over_http(
+                self.construct_well_known_file_download_url(wkf['id']), path,
+                **self.well_known_file_checks(wkf))
 
 
     @cacheable()
@@ -52,6 +52,9 @@ class RmaApi(Api):
     ALL = 'all'
     START_ROW = 'start_row'
     COUNT = 'count'
+    COUNT_ONLY = 'count_only'
+    TOTAL_ROWS = 'total_rows'
+    STREAM = 'stream'
     ONLY = 'only'
     EXCEPT = 'except'
     EXCPT = 'excpt'
@@ -243,6 +246,12 @@ class RmaApi(Api):
             how many database rows are returned (may not correspond directly to JSON tree structure)
         start_row : int or string, optional
             which database row is start of returned data  (may not correspond directly to JSON tree structure)
+        count_only : boolean, optional
+            True to return only the total number of rows matching the query 
+            rather than the rows themselves.
+        stream : boolean, optional
+            True to return a generator that decodes rows as they are 
+            downloaded rather than a list of the whole response.
 
 
         Notes
@@ -254,9 +263,24 @@ class RmaApi(Api):
         Using the &debug=true option with an RMA URL will include debugging information in the
         response, including the normalized query.
         '''
-        return self.json_msg_query(
-            self.build_query_url(
-                self.model_stage(*args, **kwargs)))
+        stream = kwargs.pop(RmaApi.STREAM, False)
+
+        if kwargs.pop(RmaApi.COUNT_ONLY, False):
+            kwargs[RmaApi.COUNT] = True
+            kwargs[RmaApi.NUM_ROWS] = 1
+            kwargs[RmaApi.START_ROW] = 0
+
+            url = self.build_query_url(self.model_stage(*args, **kwargs))
+
+            return self.do_query(lambda *a, **k: url,
+                                 lambda d: int(d[RmaApi.TOTAL_ROWS]))
+
+        url = self.build_query_url(self.model_stage(*args, **kwargs))
+
+        if stream:
+            return self.json_msg_query(url, stream=True)
+
+        return self.json_msg_query(url)
 
     def service_query(self, *args, **kwargs):
         '''Construct and Execute a single-stage RMA query
@@ -34,6 +34,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import functools
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 
 class RmaPager(object):
@@ -46,8 +48,25 @@ class RmaPager(object):
               **kwargs):
         total_rows = kwargs.pop('total_rows', None)
         num_rows = kwargs.get('num_rows', None)
+        prefetch = kwargs.pop('prefetch', None)
 
-        if total_rows == 'all':
+        if total_rows is None or \
+                (num_rows is None and (total_rows == 'all' or prefetch)):
+            # without a row limit there is nothing to page over, and 
+            # without a page size neither the end of an open-ended query 
+            # nor the prefetched pages can be found; issue the query once
+            kwargs['count'] = False
+            kwargs['start_row'] = 0
+
+            for r in fn(*args, **kwargs):
+                yield r
+
+        elif prefetch:
+            for r in RmaPager.prefetching_pager(fn, prefetch, total_rows,
+                                                *args, **kwargs):
+                yield r
+
+        elif total_rows == 'all':
             start_row = 0
             result_count = num_rows
             kwargs = kwargs
@@ -58,8 +77,11 @@ class RmaPager(object):
                 data = fn(*args, **kwargs)
 
                 start_row = start_row + num_rows
-                result_count = len(data)
+
+                # data may be a generator of streamed rows, so count as we go
+                result_count = 0
                 for r in data:
+                    result_count += 1
                     yield r
 
         else:
@@ -71,17 +93,109 @@ class RmaPager(object):
                 kwargs['start_row'] = start_row
 
                 data = fn(*args, **kwargs)
-                result_count = len(data)
+
+                result_count = 0
+                for r in data:
+                    result_count += 1
+                    yield r
 
                 start_row = start_row + result_count
+
+    @staticmethod
+    def prefetching_pager(fn,
+                          workers,
+                          total_rows,
+                          *args,
+                          **kwargs):
+        ''' Page through a query by first asking for the number of matching 
+        rows, then fetching pages concurrently. At most `workers` pages are 
+        in flight or buffered at a time and rows are yielded in order.
+
+        Parameters
+        ----------
+        fn : function
+            Query function. Must accept count_only, num_rows, start_row and 
+            count keyword arguments (as RmaApi.model_query does). Called with 
+            count_only=True, it must return the number of matching rows.
+        workers : int
+            Number of pages fetched concurrently.
+        total_rows : int or string
+            Maximum number of rows to return, or 'all'.
+
+        Notes
+        -----
+        num_rows must be passed as a keyword argument. RmaPager.pager issues 
+        a single query instead when num_rows or total_rows is None.
+        '''
+        num_rows = kwargs.get('num_rows', None)
+
+        count_kwargs = dict(kwargs)
+        count_kwargs['count_only'] = True
+        row_count = fn(*args, **count_kwargs)
+
+        if total_rows != 'all':
+            row_count = min(row_count, total_rows)
+
+        start_rows = iter(range(0, row_count, num_rows))
+
+        def fetch(start_row):
+            page_kwargs = dict(kwargs)
+            page_kwargs['count'] = False
+            page_kwargs['start_row'] = start_row
+
+            # read streamed pages in the worker, one page per window slot
+            return list(fn(*args, **page_kwargs))
+
+        pool = ThreadPool(workers)
+        pending = deque()
+
+        def submit():
+            start_row = next(start_rows, None)
+            if start_row is not None:
+                pending.append(pool.apply_async(fetch, (start_row,)))
+
+        try:
+            for _ in range(workers):
+                submit()
+
+            while pending:
+                data = pending.popleft().get()
+                submit()
+
                 for r in data:
                     yield r
+        finally:
+            pool.terminate()
+
 
 def pageable(total_rows=None,
-             num_rows=None):
+             num_rows=None,
+             prefetch=None):
+    '''decorator for paged rma queries. The decorated function is 
+    called repeatedly with increasing start_row until total_rows rows have 
+    been returned.
+
+    Parameters
+    ----------
+    total_rows : int or string, optional
+        default number of rows to return; 'all' pages until exhausted.
+    num_rows : int, optional
+        default number of rows per page.
+    prefetch : int, optional
+        default number of pages to fetch concurrently. If set, a count query 
+        is issued first and pages are then requested by a pool of this many 
+        threads, so the decorated function must accept a count_only keyword 
+        argument and return the row count when it is True.
+
+    Each of these defaults may be overridden by passing the same keyword 
+    argument to the decorated function. Without total_rows, or without 
+    num_rows when total_rows is 'all' or prefetch is set, the query is 
+    issued once.
+    '''
     def decor(func):
         decor.total_rows=total_rows
         decor.num_rows=num_rows
+        decor.prefetch=prefetch
 
         @functools.wraps(func)
         def w(*args,
@@ -90,6 +204,8 @@ def pageable(total_rows=None,
                 kwargs['num_rows'] = decor.num_rows
             if decor.total_rows and not 'total_rows' in kwargs:
                 kwargs['total_rows'] = decor.total_rows
+            if decor.prefetch and not 'prefetch' in kwargs:
+                kwargs['prefetch'] = decor.prefetch
 
             result = RmaPager.pager(func,
                                     *args,
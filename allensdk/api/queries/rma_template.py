@@ -43,10 +43,95 @@ class RmaTemplate(RmaApi):
     <http://help.brain-map.org/display/api/Atlas+Drawings+and+Ontologies>`_
     '''
 
+    # jinja templates keyed by their source; shared across instances since
+    # every Api subclass compiles the same class-level query manifest
+    _compiled_templates = {}
+
     def __init__(self, base_uri=None, query_manifest=None):
         super(RmaTemplate, self).__init__(base_uri)
         self.templates = query_manifest
 
+    @property
+    def templates(self):
+        return self._templates
+
+    @templates.setter
+    def templates(self, query_manifest):
+        self._templates = query_manifest
+        self._registry = self.compile_templates(query_manifest)
+
+    @classmethod
+    def compile_template(cls, source):
+        template = cls._compiled_templates.get(source)
+
+        if template is None:
+            template = Template(source)
+            cls._compiled_templates[source] = template
+
+        return template
+
+    def compile_templates(self, query_manifest):
+        ''' Index a query manifest by (group, name), compiling the criteria
+        and include templates and joining the default only clause.
+
+        Parameters
+        ----------
+        query_manifest : dict
+            template group name -> list of template entries
+
+        Returns
+        -------
+        dict
+            (group, name) -> (entry, criteria template, include template,
+            quoted only clause).  Only the first entry with a given name
+            is kept, matching the lookup order of the manifest.
+        '''
+        registry = {}
+
+        if not query_manifest:
+            return registry
+
+        for group, entries in query_manifest.items():
+            for entry in entries:
+                key = (group, entry['name'])
+
+                if key not in registry:
+                    registry[key] = self.compile_entry(entry)
+
+        return registry
+
+    def compile_entry(self, entry):
+        criteria = None
+        if 'criteria' in entry:
+            criteria = self.compile_template(entry['criteria'])
+
+        include = None
+        if 'include' in entry:
+            include = self.compile_template(entry['include'])
+
+        only = None
+        if 'only' in entry:
+            only = [self.quote_string(','.join(entry['only']))]
+
+        return (entry, criteria, include, only)
+
+    def find_template(self, template_name, entry_name):
+        key = (template_name, entry_name)
+        compiled = self._registry.get(key)
+
+        if compiled is None:
+            # entries added to the manifest after construction
+            templates = [e for e in self.templates[template_name]
+                         if e['name'] == entry_name]
+
+            if len(templates) == 0:
+                raise Exception('Entry %s not found.' % (entry_name))
+
+            compiled = self.compile_entry(templates[0])
+            self._registry[key] = compiled
+
+        return compiled
+
     def to_filter_rhs(self, rhs):
         if type(rhs) == list:
             return ','.join(str(r) for r in rhs)
@@ -54,19 +139,12 @@ class RmaTemplate(RmaApi):
         return rhs
 
     def template_query(self, template_name, entry_name, **kwargs):
-        cb = self.templates[template_name]
-        templates = [e for e in cb if e['name'] == entry_name]
-
-        if len(templates) > 0:
-            template = templates[0]
-        else:
-            raise Exception('Entry %s not found.' % (entry_name))
+        template, criteria_template, include_template, only = \
+            self.find_template(template_name, entry_name)
 
         query_args = {'model': template['model']}
 
-        if 'criteria' in template:
-            criteria_template = Template(template['criteria'])
-
+        if criteria_template is not None:
             if 'criteria_params' in template:
                 criteria_params = {key: self.to_filter_rhs(kwargs.get(key))
                                    for key in template['criteria_params']
@@ -78,9 +156,7 @@ class RmaTemplate(RmaApi):
             if criteria_str:
                 query_args['criteria'] = criteria_str
 
-        if 'include' in template:
-            include_template = Template(template['include'])
-
+        if include_template is not None:
             if 'include_params' in template:
                 include_params = {key: self.to_filter_rhs(kwargs.get(key))
                                   for key in template['include_params']
@@ -96,9 +172,8 @@ class RmaTemplate(RmaApi):
             if kwargs.get('only') is not None:
                 query_args['only'] = [self.quote_string(
                     ','.join(kwargs.get('only')))]
-        elif 'only' in template:
-            query_args['only'] = [
-                self.quote_string(','.join(template['only']))]
+        elif only is not None:
+            query_args['only'] = list(only)
 
         if 'except' in kwargs:
             if kwargs.get('except') is not None:
@@ -33,12 +33,13 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
-from .stimulus_analysis import StimulusAnalysis
+from .stimulus_analysis import StimulusAnalysis, correlation_matrix, \
+    condition_codes, condition_response, condition_anova, \
+    running_modulation, trial_reliability
 import scipy.stats as st
 import pandas as pd
 import numpy as np
 import h5py
-from math import sqrt
 import logging
 from . import observatory_plots as oplots
 from . import circle_plots as cplots
@@ -119,22 +120,15 @@ class DriftingGratings(StimulusAnalysis):
         response = np.empty(
             (self.number_ori, self.number_tf, self.numbercells + 1, 3))
 
-        def ptest(x):
-            return len(np.where(x < (0.05 / (8 * 5)))[0])
-
-        for ori in self.orivals:
-            ori_pt = np.where(self.orivals == ori)[0][0]
-            for tf in self.tfvals:
-                tf_pt = np.where(self.tfvals == tf)[0][0]
-                subset_response = self.mean_sweep_response[
-                    (self.stim_table.temporal_frequency == tf) & (self.stim_table.orientation == ori)]
-                subset_pval = self.pval[(self.stim_table.temporal_frequency == tf) & (
-                    self.stim_table.orientation == ori)]
-                response[ori_pt, tf_pt, :, 0] = subset_response.mean(axis=0)
-                response[ori_pt, tf_pt, :, 1] = subset_response.std(
-                    axis=0) / sqrt(len(subset_response))
-                response[ori_pt, tf_pt, :, 2] = subset_pval.apply(
-                    ptest, axis=0)
+        if response.size > 0:
+            codes = condition_codes([self.stim_table.orientation.values,
+                                     self.stim_table.temporal_frequency.values],
+                                    [self.orivals, self.tfvals])
+            response[:] = condition_response(
+                self.mean_sweep_response.values, self.pval.values, codes,
+                self.number_ori * self.number_tf,
+                0.05 / (8 * 5)).reshape(response.shape)
+
         return response
 
     def get_peak(self):
@@ -164,85 +158,90 @@ class DriftingGratings(StimulusAnalysis):
                                                                     'cell_specimen_id'))
         cids = self.data_set.get_cell_specimen_ids()
 
-        orivals_rad = np.deg2rad(self.orivals)        
-        for nc in range(self.numbercells):
-            cell_peak = np.where(self.response[:, 1:, nc, 0] == np.nanmax(
-                self.response[:, 1:, nc, 0]))
-            prefori = cell_peak[0][0]
-            preftf = cell_peak[1][0] + 1
-            peak.cell_specimen_id.iloc[nc] = cids[nc]
-            peak.ori_dg.iloc[nc] = prefori
-            peak.tf_dg.iloc[nc] = preftf
-
-            pref = self.response[prefori, preftf, nc, 0]
-            orth1 = self.response[np.mod(prefori + 2, 8), preftf, nc, 0]
-            orth2 = self.response[np.mod(prefori - 2, 8), preftf, nc, 0]
-            orth = (orth1 + orth2) / 2
-            null = self.response[np.mod(prefori + 4, 8), preftf, nc, 0]
-
-            tuning = self.response[:, preftf, nc, 0]
-            tuning = np.where(tuning>0, tuning, 0)
-            #new circular variance below
-            CV_top_os = np.empty((8), dtype=np.complex128)
-            CV_top_ds = np.empty((8), dtype=np.complex128)
-            for i in range(8):
-                CV_top_os[i] = (tuning[i]*np.exp(1j*2*orivals_rad[i]))
-                CV_top_ds[i] = (tuning[i]*np.exp(1j*orivals_rad[i]))
-            peak.cv_os_dg.iloc[nc] = np.abs(CV_top_os.sum())/tuning.sum()
-            peak.cv_ds_dg.iloc[nc] = np.abs(CV_top_ds.sum())/tuning.sum()
-            
-            peak.osi_dg.iloc[nc] = (pref - orth) / (pref + orth)
-            peak.dsi_dg.iloc[nc] = (pref - null) / (pref + null)
-            peak.peak_dff_dg.iloc[nc] = pref
-
-            groups = []
-            for ori in self.orivals:
-                for tf in self.tfvals[1:]:
-                    groups.append(self.mean_sweep_response[(self.stim_table.temporal_frequency == tf) & (
-                        self.stim_table.orientation == ori)][str(nc)])
-            groups.append(self.mean_sweep_response[
-                          self.stim_table.temporal_frequency == 0][str(nc)])
-            _, p = st.f_oneway(*groups)
-            peak.ptest_dg.iloc[nc] = p
-
-            subset = self.mean_sweep_response[(self.stim_table.temporal_frequency == self.tfvals[
-                                               preftf]) & (self.stim_table.orientation == self.orivals[prefori])]
-            #running modulation                                 
-            subset_stat = subset[subset.dx < 1]
-            subset_run = subset[subset.dx >= 1]
+        if self.numbercells == 0:
+            return peak
+
+        cells = np.arange(self.numbercells)
+        columns = list(map(str, cells))
+        mean_sweep_response = self.mean_sweep_response[columns].values
+        dx = self.mean_sweep_response.dx.values
+        orientation = self.stim_table.orientation.values
+        temporal_frequency = self.stim_table.temporal_frequency.values
+
+        response = self.response[:, :, :self.numbercells, 0]
+        prefori, preftf = np.unravel_index(
+            np.nanargmax(response[:, 1:].reshape(-1, self.numbercells), axis=0),
+            (self.number_ori, self.number_tf - 1))
+        preftf = preftf + 1
+
+        pref = response[prefori, preftf, cells]
+        orth1 = response[np.mod(prefori + 2, 8), preftf, cells]
+        orth2 = response[np.mod(prefori - 2, 8), preftf, cells]
+        orth = (orth1 + orth2) / 2
+        null = response[np.mod(prefori + 4, 8), preftf, cells]
+
+        tuning = response[:, preftf, cells]
+        tuning = np.where(tuning>0, tuning, 0)
+        #new circular variance below
+        orivals_rad = np.deg2rad(self.orivals)[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cv_os = np.abs((tuning*np.exp(1j*2*orivals_rad)).sum(axis=0))/tuning.sum(axis=0)
+            cv_ds = np.abs((tuning*np.exp(1j*orivals_rad)).sum(axis=0))/tuning.sum(axis=0)
+            osi = (pref - orth) / (pref + orth)
+            dsi = (pref - null) / (pref + null)
+
+        # one group per orientation and (non-blank) temporal frequency, plus blank sweeps
+        n_groups = self.number_ori * (self.number_tf - 1)
+        groups = condition_codes([orientation, temporal_frequency],
+                                 [self.orivals, self.tfvals[1:]])
+        groups[temporal_frequency == 0] = n_groups
+        ptest = condition_anova(mean_sweep_response, groups, n_groups + 1)
+
+        p_run = np.empty(self.numbercells)
+        p_run.fill(np.NaN)
+        run_modulation = p_run.copy()
+        reliability = np.empty(self.numbercells)
+        tf_index = np.empty(self.numbercells)
+
+        # cells sharing a preferred condition are evaluated together
+        for ori, tf in set(zip(prefori, preftf)):
+            group = cells[(prefori == ori) & (preftf == tf)]
+            rows = (temporal_frequency == self.tfvals[tf]) & (orientation == self.orivals[ori])
+
+            #running modulation
+            subset = mean_sweep_response[rows][:, group]
+            subset_run = subset[dx[rows] >= 1]
+            subset_stat = subset[dx[rows] < 1]
             if (len(subset_run) > 2) & (len(subset_stat) > 2):
-                (_,peak.p_run_dg.iloc[nc]) = st.ttest_ind(subset_run[str(nc)], subset_stat[str(nc)], equal_var=False)
-                
-                if subset_run[str(nc)].mean()>subset_stat[str(nc)].mean():
-                    peak.run_modulation_dg.iloc[nc] = (subset_run[str(nc)].mean() - subset_stat[str(nc)].mean())/np.abs(subset_run[str(nc)].mean())
-                elif subset_run[str(nc)].mean()<subset_stat[str(nc)].mean():
-                    peak.run_modulation_dg.iloc[nc] = -1*((subset_stat[str(nc)].mean() - subset_run[str(nc)].mean())/np.abs(subset_stat[str(nc)].mean()))
-
-            else:
-                peak.p_run_dg.iloc[nc] = np.NaN
-                peak.run_modulation_dg.iloc[nc] = np.NaN
-            
-            #reliability 
-            subset = self.sweep_response[(self.stim_table.temporal_frequency == self.tfvals[
-                                               preftf]) & (self.stim_table.orientation == self.orivals[prefori])]
-            corr_matrix = np.empty((len(subset),len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    r,p = st.pearsonr(subset[str(nc)].iloc[i][30:90], subset[str(nc)].iloc[j][30:90])
-                    corr_matrix[i,j] = r
-            mask = np.ones((len(subset), len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    if i>=j:
-                        mask[i,j] = np.NaN
-            corr_matrix *= mask
-            peak.reliability_dg.iloc[nc] = np.nanmean(corr_matrix)
-            
+                p_run[group], run_modulation[group] = \
+                    running_modulation(subset_run, subset_stat)
+
+            #reliability
+            subset = self.sweep_response[rows]
+            traces = np.array([ [ trace[30:90] for trace in subset[str(nc)] ]
+                                for nc in group ], dtype=float)
+            reliability[group] = trial_reliability(traces)
+
             #TF index
-            tf_tuning = self.response[prefori,1:,nc,0]
-            trials = self.mean_sweep_response[(self.stim_table.temporal_frequency!=0)&(self.stim_table.orientation==self.orivals[prefori])][str(nc)].values
-            SSE_part = np.sqrt(np.sum((trials-trials.mean())**2)/(len(trials)-5))
-            peak.tf_index_dg.iloc[nc] = (np.ptp(tf_tuning))/(np.ptp(tf_tuning) + 2*SSE_part)
+            tf_tuning = response[ori, 1:][:, group]
+            trials = mean_sweep_response[(temporal_frequency!=0)&(orientation==self.orivals[ori])][:, group]
+            SSE_part = np.sqrt(np.sum((trials-trials.mean(axis=0))**2, axis=0)/(len(trials)-5))
+            tf_index[group] = (np.ptp(tf_tuning, axis=0))/(np.ptp(tf_tuning, axis=0) + 2*SSE_part)
+
+        for column, values in (('cell_specimen_id', cids[:self.numbercells]),
+                               ('ori_dg', prefori),
+                               ('tf_dg', preftf),
+                               ('cv_os_dg', cv_os),
+                               ('cv_ds_dg', cv_ds),
+                               ('osi_dg', osi),
+                               ('dsi_dg', dsi),
+                               ('peak_dff_dg', pref),
+                               ('ptest_dg', ptest),
+                               ('p_run_dg', p_run),
+                               ('run_modulation_dg', run_modulation),
+                               ('reliability_dg', reliability),
+                               ('tf_index_dg', tf_index)):
+            peak[column] = pd.Series(list(values), index=peak.index, dtype=object)
 
         return peak
 
@@ -381,20 +380,7 @@ class DriftingGratings(StimulusAnalysis):
         response = response.reshape(self.number_ori * (self.number_tf-1), self.numbercells).T
         N, Nstim = response.shape
 
-        signal_corr = np.zeros((N, N))
-        signal_p = np.empty((N, N))
-        if corr == 'pearson':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        signal_corr, signal_p = correlation_matrix(response, corr)
 
         signal_corr = np.triu(signal_corr) + np.triu(signal_corr, 1).T  # fill in lower triangle
         signal_p = np.triu(signal_p) + np.triu(signal_p, 1).T  # fill in lower triangle
@@ -409,20 +395,7 @@ class DriftingGratings(StimulusAnalysis):
         response = response.reshape(self.number_ori * (self.number_tf-1), self.numbercells)
         Nstim, N = response.shape
 
-        rep_sim = np.zeros((Nstim, Nstim))
-        rep_sim_p = np.empty((Nstim, Nstim))
-        if corr == 'pearson':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        rep_sim, rep_sim_p = correlation_matrix(response, corr)
 
         rep_sim = np.triu(rep_sim) + np.triu(rep_sim, 1).T # fill in lower triangle
         rep_sim_p = np.triu(rep_sim_p) + np.triu(rep_sim_p, 1).T  # fill in lower triangle
@@ -440,36 +413,15 @@ class DriftingGratings(StimulusAnalysis):
         noise_corr_blank = np.zeros((self.numbercells, self.numbercells))
         noise_corr_blank_p = np.zeros((self.numbercells, self.numbercells))
 
-        if corr == 'pearson':
-            for k in range(self.number_ori):
-                for l in range(self.number_tf-1):
-                    for i in range(self.numbercells):
-                        for j in range(i, self.numbercells):
-                            noise_corr[i, j, k, l], noise_corr_p[i, j, k, l] = st.pearsonr(response[i, k, l], response[j, k, l])
-
-                    noise_corr[:, :, k, l] = np.triu(noise_corr[:, :, k, l]) + np.triu(noise_corr[:, :, k, l], 1).T
-
-            for i in range(self.numbercells):
-                for j in range(i, self.numbercells):
-                    noise_corr_blank[i, j], noise_corr_blank_p[i, j] = st.pearsonr(response_blank[i], response_blank[j])
-
-        elif corr == 'spearman':
-            for k in range(self.number_ori):
-                for l in range(self.number_tf-1):
-                    for i in range(self.numbercells):
-                        for j in range(i, self.numbercells):
-                            noise_corr[i, j, k, l], noise_corr_p[i, j, k, l] = st.spearmanr(response[i, k, l], response[j, k, l])
-
-                    noise_corr[:, :, k, l] = np.triu(noise_corr[:, :, k, l]) + np.triu(noise_corr[:, :, k, l], 1).T
-
-            for i in range(self.numbercells):
-                for j in range(i, self.numbercells):
-                    noise_corr_blank[i, j], noise_corr_blank_p[i, j] = st.spearmanr(response_blank[i], response_blank[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        for k in range(self.number_ori):
+            for l in range(self.number_tf-1):
+                r, p = correlation_matrix(np.vstack(response[:, k, l]), corr)
+                noise_corr[:, :, k, l] = np.triu(r) + np.triu(r, 1).T
+                noise_corr_p[:, :, k, l] = np.triu(p)
 
-        noise_corr_blank[:, :] = np.triu(noise_corr_blank[:, :]) + np.triu(noise_corr_blank[:, :], 1).T
+        r, p = correlation_matrix(response_blank, corr)
+        noise_corr_blank[:, :] = np.triu(r) + np.triu(r, 1).T
+        noise_corr_blank_p[:, :] = np.triu(p)
 
         return noise_corr, noise_corr_p, noise_corr_blank, noise_corr_blank_p
 
@@ -36,7 +36,7 @@
 import scipy.stats as st
 import numpy as np
 import pandas as pd
-from .stimulus_analysis import StimulusAnalysis
+from .stimulus_analysis import StimulusAnalysis, correlation_matrix, trial_reliability
 import logging
 import h5py
 from . import observatory_plots as oplots
@@ -148,29 +148,25 @@ class NaturalScenes(StimulusAnalysis):
                                                                     'cell_specimen_id','image_selectivity_ns'))
         cids = self.data_set.get_cell_specimen_ids()
 
+        if self.numbercells == 0:
+            return peak
+
+        frames = self.stim_table.frame.values
+        scene_masks = [ frames == (im - 1) for im in range(self.number_scenes) ]
+
+        preferred_scenes = np.argmax(self.response[1:, :self.numbercells, 0], axis=0)
+        reliability = self.get_reliability(preferred_scenes)
+        selectivity = image_selectivity(self.response[1:, :self.numbercells, 0].T)
+
         for nc in range(self.numbercells):
-            nsp = np.argmax(self.response[1:, nc, 0])
+            nsp = preferred_scenes[nc]
             peak.cell_specimen_id.iloc[nc] = cids[nc]
             peak.scene_ns[nc] = nsp
 #            peak.response_reliability_ns[nc] = self.response[
 #                nsp + 1, nc, 2] / 0.50  # assume 50 trials
             peak.peak_dff_ns[nc] = self.response[nsp + 1, nc, 0]
-#            subset = self.mean_sweep_response[self.stim_table.frame == nsp]
-#            subset_stat = subset[subset.dx < 2]
-#            subset_run = subset[subset.dx >= 2]
-#            if (len(subset_run) > 5) & (len(subset_stat) > 5):
-#                (_, peak.p_run_ns[nc]) = st.ks_2samp(
-#                    subset_run[str(nc)], subset_stat[str(nc)])
-#                peak.run_modulation_ns[nc] = subset_run[
-#                    str(nc)].mean() / subset_stat[str(nc)].mean()
-#            else:
-#                peak.p_run_ns[nc] = np.NaN
-#                peak.run_modulation_ns[nc] = np.NaN
-            groups = []
-            for im in range(self.number_scenes):
-                subset = self.mean_sweep_response[
-                    self.stim_table.frame == (im - 1)]
-                groups.append(subset[str(nc)].values)
+            mean_sweep_response = self.mean_sweep_response[str(nc)].values
+            groups = [ mean_sweep_response[mask] for mask in scene_masks ]
             (_, peak.ptest_ns[nc]) = st.f_oneway(*groups)
             test = self.sweep_response[
                 self.stim_table.frame == nsp][str(nc)].mean()
@@ -192,41 +188,38 @@ class NaturalScenes(StimulusAnalysis):
                 peak.p_run_ns.iloc[nc] = np.NaN
                 peak.run_modulation_ns.iloc[nc] = np.NaN                
             
-            #reliability
-            subset = self.sweep_response[self.stim_table.frame==nsp]            
-            corr_matrix = np.empty((len(subset),len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    r,p = st.pearsonr(subset[str(nc)].iloc[i][28:42], subset[str(nc)].iloc[j][28:42])
-                    corr_matrix[i,j] = r
-            mask = np.ones((len(subset), len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    if i>=j:
-                        mask[i,j] = np.NaN
-            corr_matrix *= mask
-            peak.reliability_ns.iloc[nc] = np.nanmean(corr_matrix)
-            
-            #image selectivity
-            fmin = self.response[1:,nc,0].min()
-            fmax = self.response[1:,nc,0].max()
-            rtj = np.empty((1000,1))
-            for j in range(1000):
-                thresh = fmin + j*((fmax-fmin)/1000.)
-                theta = np.empty((118,1))
-                for im in range(118):
-                    if self.response[im+1,nc,0] > thresh:  #im+1 to only look at images, not blanksweep
-                        theta[im] = 1
-                    else:
-                        theta[im] = 0
-                rtj[j] = theta.mean()
-            
-            biga = rtj.mean()
-            bigs = 1 - (2*biga)
-            peak.image_selectivity_ns.iloc[nc] = bigs
+            peak.reliability_ns.iloc[nc] = reliability[nc]
+            peak.image_selectivity_ns.iloc[nc] = selectivity[nc]
 
         return peak
 
+    def get_reliability(self, preferred_scenes):
+        ''' Computes the trial-to-trial reliability of each cell's response to
+        its preferred scene: the mean pearson correlation between all pairs of
+        trials over the response window.  Cells that prefer the same scene are
+        evaluated together.
+
+        Parameters
+        ----------
+        preferred_scenes: np.ndarray
+            preferred scene (frame) of each cell
+
+        Returns
+        -------
+        np.ndarray of reliabilities
+        '''
+        reliability = np.empty(self.numbercells)
+        frames = self.stim_table.frame.values
+
+        for scene in np.unique(preferred_scenes):
+            cells = np.where(preferred_scenes == scene)[0]
+            subset = self.sweep_response[frames == scene][list(map(str, cells))]
+            traces = np.array([ [ trace[28:42] for trace in subset[str(nc)] ]
+                                for nc in cells ], dtype=float)
+            reliability[cells] = trial_reliability(traces)
+
+        return reliability
+
     def plot_time_to_peak(self, 
                           p_value_max=oplots.P_VALUE_MAX, 
                           color_map=oplots.STIMULUS_COLOR_MAP):
@@ -300,20 +293,7 @@ class NaturalScenes(StimulusAnalysis):
         response = response[:self.numbercells, :]
         N, Nstim = response.shape
 
-        signal_corr = np.zeros((N, N))
-        signal_p = np.empty((N, N))
-        if corr == 'pearson':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        signal_corr, signal_p = correlation_matrix(response, corr)
 
         signal_corr = np.triu(signal_corr) + np.triu(signal_corr, 1).T  # fill in lower triangle
         signal_p = np.triu(signal_p) + np.triu(signal_p, 1).T  # fill in lower triangle
@@ -327,20 +307,7 @@ class NaturalScenes(StimulusAnalysis):
         response = response[:, :self.numbercells]
         Nstim, N = response.shape
 
-        rep_sim = np.zeros((Nstim, Nstim))
-        rep_sim_p = np.empty((Nstim, Nstim))
-        if corr == 'pearson':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        rep_sim, rep_sim_p = correlation_matrix(response, corr)
 
         rep_sim = np.triu(rep_sim) + np.triu(rep_sim, 1).T # fill in lower triangle
         rep_sim_p = np.triu(rep_sim_p) + np.triu(rep_sim_p, 1).T  # fill in lower triangle
@@ -354,26 +321,10 @@ class NaturalScenes(StimulusAnalysis):
         noise_corr = np.zeros((self.numbercells, self.numbercells, self.number_scenes))
         noise_corr_p = np.zeros((self.numbercells, self.numbercells, self.number_scenes))
 
-        if corr == 'pearson':
-            for k in range(self.number_scenes):
-                for i in range(self.numbercells):
-                    for j in range(i, self.numbercells):
-                        noise_corr[i, j, k], noise_corr_p[i, j, k] = st.pearsonr(response[i, k], response[j, k])
-
-                noise_corr[:, :, k] = np.triu(noise_corr[:, :, k]) + np.triu(noise_corr[:, :, k], 1).T
-                noise_corr_p[:, :, k] = np.triu(noise_corr_p[:, :, k]) + np.triu(noise_corr_p[:, :, k], 1).T
-
-        elif corr == 'spearman':
-            for k in range(self.number_scenes):
-                for i in range(self.numbercells):
-                    for j in range(i, self.numbercells):
-                        noise_corr[i, j, k], noise_corr_p[i, j, k] = st.spearmanr(response[i, k], response[j, k])
-
-                noise_corr[:, :, k] = np.triu(noise_corr[:, :, k]) + np.triu(noise_corr[:, :, k], 1).T
-                noise_corr_p[:, :, k] = np.triu(noise_corr_p[:, :, k]) + np.triu(noise_corr_p[:, :, k], 1).T
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        for k in range(self.number_scenes):
+            r, p = correlation_matrix(np.vstack(response[:, k]), corr)
+            noise_corr[:, :, k] = np.triu(r) + np.triu(r, 1).T
+            noise_corr_p[:, :, k] = np.triu(p) + np.triu(p, 1).T
 
         return noise_corr, noise_corr_p
 
@@ -406,3 +357,40 @@ class NaturalScenes(StimulusAnalysis):
 
         return ns
 
+
+def image_selectivity(responses, n_thresholds=1000):
+    """ Image selectivity of each row of a (cells, images) array of mean
+    responses.  For thresholds evenly spaced from each row's minimum to its
+    maximum, the fraction of images with a response above the threshold is
+    averaged; selectivity is 1 minus twice that average.  The fractions are
+    accumulated by sorting the responses together with the thresholds rather
+    than by testing every threshold against every image.
+
+    Parameters
+    ----------
+    responses: np.ndarray
+        (cells, images) array of mean responses
+
+    n_thresholds: int
+        number of thresholds
+
+    Returns
+    -------
+    np.ndarray of selectivities
+    """
+    responses = np.array(responses, dtype=float, ndmin=2)
+    n_images = responses.shape[1]
+
+    fmin = responses.min(axis=1)[:, np.newaxis]
+    fmax = responses.max(axis=1)[:, np.newaxis]
+    thresholds = fmin + np.arange(n_thresholds) * ((fmax - fmin) / float(n_thresholds))
+
+    # a stable sort keeps each response ahead of any threshold equal to it,
+    # so only thresholds strictly below a response are counted for it
+    combined = np.concatenate([responses, thresholds], axis=1)
+    is_threshold = np.argsort(combined, axis=1, kind='mergesort') >= n_images
+    thresholds_below = np.cumsum(is_threshold, axis=1)
+    exceeded = np.where(is_threshold, 0, thresholds_below).sum(axis=1)
+
+    return 1 - 2 * (exceeded / float(n_images * n_thresholds))
+
@@ -431,8 +431,7 @@ def calculate_roi_and_neuropil_traces(movie_h5, roi_mask_list, motion_border):
 
     # a combined binary mask for all ROIs (this is used to 
     #   subtracted ROIs from annuli
-    mask_array = create_roi_mask_array(roi_mask_list)
-    combined_mask = mask_array.max(axis=0)
+    combined_mask = RoiMaskSet.from_masks(roi_mask_list).combined_mask()
 
     logging.info("%d total ROIs" % len(roi_mask_list))
 
@@ -482,8 +481,200 @@ def create_roi_mask_array(rois):
         width = rois[0].img_cols
         masks = np.zeros((len(rois), height, width), dtype=np.uint8)
         for i, roi in enumerate(rois):
-            masks[i, :, :] = roi.get_mask_plane()
+            masks[i, roi.y:roi.y + roi.height, roi.x:roi.x + roi.width] = roi.mask
     else:
         masks = None
     return masks
 
+
+class RoiMaskSet(object):
+    '''
+    Sparse representation of a set of image-sized ROI masks. The pixels
+    of each mask are stored as flat (row-major) indices into the image
+    plane, in compressed sparse row layout: the pixels of mask i are
+    indices[indptr[i]:indptr[i+1]].
+
+    Parameters
+    ----------
+    image_w: integer
+        Width of image that the ROIs reside in
+
+    image_h: integer
+        Height of image that the ROIs reside in
+
+    indptr: integer[number masks + 1]
+        Offsets of each mask's pixels in indices
+
+    indices: integer[number pixels]
+        Flat pixel indices of all masks, concatenated
+
+    labels: list (optional)
+        User-defined text label to identify each mask
+    '''
+
+    def __init__(self, image_w, image_h, indptr, indices, labels=None):
+        self.img_rows = image_h
+        self.img_cols = image_w
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.labels = labels
+
+        n = len(self.indptr) - 1
+        self.x = np.zeros(n, dtype=int)
+        self.y = np.zeros(n, dtype=int)
+        self.width = np.zeros(n, dtype=int)
+        self.height = np.zeros(n, dtype=int)
+
+        # bounding boxes of the non-empty masks, reduced over each mask's pixels
+        counts = np.diff(self.indptr)
+        full = counts > 0
+        if full.any():
+            rows, cols = np.divmod(self.indices, image_w)
+            offsets = self.indptr[:-1][full]
+            self.x[full] = np.minimum.reduceat(cols, offsets)
+            self.y[full] = np.minimum.reduceat(rows, offsets)
+            self.width[full] = np.maximum.reduceat(cols, offsets) - self.x[full] + 1
+            self.height[full] = np.maximum.reduceat(rows, offsets) - self.y[full] + 1
+
+    @staticmethod
+    def from_planes(planes, image_w=None, image_h=None, labels=None):
+        '''
+        Build a mask set from image-sized mask planes. Pixels with
+        values >0 belong to the mask.
+
+        Parameters
+        ----------
+        planes: iterable of integer[image_h][image_w]
+            Mask planes. Each plane is only read once, so this may be a
+            generator that reuses a single buffer.
+
+        image_w, image_h: integer (optional)
+            Image dimensions, required if planes is empty
+
+        labels: list (optional)
+            User-defined text label to identify each mask
+
+        Returns
+        -------
+            RoiMaskSet object
+        '''
+        indptr = [0]
+        indices = []
+        for plane in planes:
+            image_h, image_w = plane.shape
+            px = np.flatnonzero(plane)
+            indices.append(px)
+            indptr.append(indptr[-1] + len(px))
+
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        return RoiMaskSet(image_w, image_h, indptr, indices, labels=labels)
+
+    @staticmethod
+    def from_masks(rois):
+        '''
+        Build a mask set from a list of Mask objects.
+
+        Parameters
+        ----------
+        rois: list<Mask>
+            List of masks. All masks must be on the same size image.
+
+        Returns
+        -------
+            RoiMaskSet object
+        '''
+        if not rois:
+            return RoiMaskSet(0, 0, [0], [])
+
+        image_w = rois[0].img_cols
+        indptr = [0]
+        indices = []
+        for roi in rois:
+            rows, cols = np.nonzero(roi.mask)
+            indices.append((rows + roi.y) * image_w + cols + roi.x)
+            indptr.append(indptr[-1] + len(rows))
+
+        return RoiMaskSet(image_w, rois[0].img_rows, indptr,
+                          np.concatenate(indices),
+                          labels=[roi.label for roi in rois])
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes
+
+    def pixels(self, i):
+        '''
+        Returns the (row, column) coordinates of the pixels of mask i
+        '''
+        return np.divmod(self.indices[self.indptr[i]:self.indptr[i + 1]], self.img_cols)
+
+    def to_dense(self, out=None, dtype=np.uint8):
+        '''
+        Create the full image mask array.
+
+        Parameters
+        ----------
+        out: np.ndarray (optional)
+            Contiguous array of shape (number masks, image_h, image_w) to
+            write the masks into, for example a memory-mapped file. It
+            is filled in place, without intermediate image planes.
+
+        dtype: np.dtype
+            Type of the array to allocate if out is not given
+
+        Returns
+        -------
+        np.ndarray: NxHxW array
+            Array of len(self) image masks, with ones on mask pixels.
+        '''
+        shape = (len(self), self.img_rows, self.img_cols)
+        if out is None:
+            out = np.zeros(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError("out must have shape %s, not %s" % (shape, out.shape))
+        else:
+            out[...] = 0
+
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        out.reshape(len(self), -1)[rows, self.indices] = 1
+
+        return out
+
+    def combined_mask(self):
+        '''
+        Returns the union of all masks on the image plane
+
+        Returns
+        -------
+        np.ndarray: HxW boolean array
+        '''
+        mask = np.zeros(self.img_rows * self.img_cols, dtype=bool)
+        mask[self.indices] = True
+        return mask.reshape(self.img_rows, self.img_cols)
+
+    def get_roi_mask(self, i, border=None):
+        '''
+        Create an RoiMask object for mask i.
+
+        Parameters
+        ----------
+        border: float[4] (optional)
+            Coordinates defining useable area of image. See create_roi_mask().
+            Defaults to the entire image.
+
+        Returns
+        -------
+            RoiMask object
+        '''
+        if border is None:
+            border = [0, 0, 0, 0]
+        label = self.labels[i] if self.labels is not None else None
+
+        rows, cols = self.pixels(i)
+        return create_roi_mask(self.img_cols, self.img_rows, border,
+                               pix_list=np.column_stack([cols, rows]),
+                               label=label)
+
@@ -36,9 +36,10 @@
 import scipy.stats as st
 import numpy as np
 import pandas as pd
-from math import sqrt
 import logging
-from .stimulus_analysis import StimulusAnalysis
+from .stimulus_analysis import StimulusAnalysis, correlation_matrix, \
+    condition_codes, condition_response, condition_anova, \
+    running_modulation, trial_reliability
 from .brain_observatory_exceptions import BrainObservatoryAnalysisException, MissingStimulusException
 from . import observatory_plots as oplots
 from . import circle_plots as cplots
@@ -161,27 +162,15 @@ class StaticGratings(StimulusAnalysis):
         response = np.empty((self.number_ori, self.number_sf,
                              self.number_phase, self.numbercells + 1, 3))
 
-        def ptest(x):
-            return len(np.where(x < (0.05 / (self.number_ori * (self.number_sf - 1))))[0])
-
-        for ori in self.orivals:
-            ori_pt = np.where(self.orivals == ori)[0][0]
-
-            for sf in self.sfvals:
-                sf_pt = np.where(self.sfvals == sf)[0][0]
-
-                for phase in self.phasevals:
-                    phase_pt = np.where(self.phasevals == phase)[0][0]
-                    subset_response = self.mean_sweep_response[(self.stim_table.spatial_frequency == sf) & (
-                        self.stim_table.orientation == ori) & (self.stim_table.phase == phase)]
-                    subset_pval = self.pval[(self.stim_table.spatial_frequency == sf) & (
-                        self.stim_table.orientation == ori) & (self.stim_table.phase == phase)]
-                    response[ori_pt, sf_pt, phase_pt, :,
-                             0] = subset_response.mean(axis=0)
-                    response[ori_pt, sf_pt, phase_pt, :, 1] = subset_response.std(
-                        axis=0) / sqrt(len(subset_response))
-                    response[ori_pt, sf_pt, phase_pt, :,
-                             2] = subset_pval.apply(ptest, axis=0)
+        if response.size > 0:
+            codes = condition_codes([self.stim_table.orientation.values,
+                                     self.stim_table.spatial_frequency.values,
+                                     self.stim_table.phase.values],
+                                    [self.orivals, self.sfvals, self.phasevals])
+            response[:] = condition_response(
+                self.mean_sweep_response.values, self.pval.values, codes,
+                self.number_ori * self.number_sf * self.number_phase,
+                0.05 / (self.number_ori * (self.number_sf - 1))).reshape(response.shape)
 
         return response
 
@@ -209,97 +198,100 @@ class StaticGratings(StimulusAnalysis):
                                                                     'run_modulation_sg', 'sf_index_sg'))
         cids = self.data_set.get_cell_specimen_ids()
 
-        orivals_rad = np.deg2rad(self.orivals)
-        for nc in range(self.numbercells):
-            cell_peak = np.where(self.response[:, 1:, :, nc, 0] == np.nanmax(
-                self.response[:, 1:, :, nc, 0]))
-            pref_ori = cell_peak[0][0]
-            pref_sf = cell_peak[1][0] + 1
-            pref_phase = cell_peak[2][0]
-            peak.cell_specimen_id.iloc[nc] = cids[nc]
-            peak.ori_sg[nc] = pref_ori
-            peak.sf_sg[nc] = pref_sf
-            peak.phase_sg[nc] = pref_phase
+        if self.numbercells == 0:
+            return peak
+
+        cells = np.arange(self.numbercells)
+        columns = list(map(str, cells))
+        mean_sweep_response = self.mean_sweep_response[columns].values
+        dx = self.mean_sweep_response.dx.values
+        orientation = self.stim_table.orientation.values
+        spatial_frequency = self.stim_table.spatial_frequency.values
+        phase = self.stim_table.phase.values
+
+        response = self.response[:, :, :, :self.numbercells, 0]
+        pref_ori, pref_sf, pref_phase = np.unravel_index(
+            np.nanargmax(response[:, 1:].reshape(-1, self.numbercells), axis=0),
+            (self.number_ori, self.number_sf - 1, self.number_phase))
+        pref_sf = pref_sf + 1
 
 #            peak.response_reliability_sg[nc] = self.response[
 #                pref_ori, pref_sf, pref_phase, nc, 2] / 0.48  # TODO: check number of trials
 
-            pref = self.response[pref_ori, pref_sf, pref_phase, nc, 0]
-            orth = self.response[
-                np.mod(pref_ori + 3, 6), pref_sf, pref_phase, nc, 0]
-            tuning = self.response[:, pref_sf, pref_phase, nc, 0]
-            tuning = np.where(tuning>0, tuning, 0)
-            CV_top_os = np.empty((6), dtype=np.complex128)
-            for i in range(6):
-                CV_top_os[i] = (tuning[i]*np.exp(1j*2*orivals_rad[i]))
-            peak.cv_os_sg.iloc[nc] = np.abs(CV_top_os.sum())/tuning.sum()
-                
-            peak.osi_sg[nc] = (pref - orth) / (pref + orth)
-            peak.peak_dff_sg[nc] = pref
-            groups = []
-
-            for ori in self.orivals:
-                for sf in self.sfvals[1:]:
-                    for phase in self.phasevals:
-                        groups.append(self.mean_sweep_response[(self.stim_table.spatial_frequency == sf) & (
-                            self.stim_table.orientation == ori) & (self.stim_table.phase == phase)][str(nc)])
-            groups.append(self.mean_sweep_response[
-                          self.stim_table.spatial_frequency == 0][str(nc)])
-
-            _, p = st.f_oneway(*groups)
-            peak.ptest_sg[nc] = p
-
-            test_rows = (self.stim_table.orientation == self.orivals[pref_ori]) & \
-                (self.stim_table.spatial_frequency == self.sfvals[pref_sf]) & \
-                (self.stim_table.phase == self.phasevals[pref_phase])
-
-            if len(test_rows) < 2:
-                msg = "Static grating p value requires at least 2 trials at the preferred "
-                "orientation/spatial frequency/phase. Cell %d (%f, %f, %f) has %d." % \
-                    (int(nc), self.orivals[pref_ori], self.sfvals[pref_sf],
-                     self.phasevals[pref_phase], len(test_rows))
+        pref = response[pref_ori, pref_sf, pref_phase, cells]
+        orth = response[np.mod(pref_ori + 3, 6), pref_sf, pref_phase, cells]
+        tuning = response[:, pref_sf, pref_phase, cells]
+        tuning = np.where(tuning>0, tuning, 0)
+        orivals_rad = np.deg2rad(self.orivals)[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cv_os = np.abs((tuning*np.exp(1j*2*orivals_rad)).sum(axis=0))/tuning.sum(axis=0)
+            osi = (pref - orth) / (pref + orth)
+
+        # one group per orientation, (non-blank) spatial frequency and phase, plus blank sweeps
+        n_groups = self.number_ori * (self.number_sf - 1) * self.number_phase
+        groups = condition_codes([orientation, spatial_frequency, phase],
+                                 [self.orivals, self.sfvals[1:], self.phasevals])
+        groups[spatial_frequency == 0] = n_groups
+        ptest = condition_anova(mean_sweep_response, groups, n_groups + 1)
+
+        time_to_peak = np.empty(self.numbercells)
+        p_run = np.empty(self.numbercells)
+        p_run.fill(np.NaN)
+        run_modulation = p_run.copy()
+        reliability = np.empty(self.numbercells)
+        sf_index = np.empty(self.numbercells)
+
+        # cells sharing a preferred condition are evaluated together
+        for ori, sf, ph in set(zip(pref_ori, pref_sf, pref_phase)):
+            group = cells[(pref_ori == ori) & (pref_sf == sf) & (pref_phase == ph)]
+            rows = (orientation == self.orivals[ori]) & \
+                (spatial_frequency == self.sfvals[sf]) & \
+                (phase == self.phasevals[ph])
+
+            if len(rows) < 2:
+                msg = ("Static grating p value requires at least 2 trials at the preferred "
+                       "orientation/spatial frequency/phase. Cell %d (%f, %f, %f) has %d." %
+                       (int(group[0]), self.orivals[ori], self.sfvals[sf],
+                        self.phasevals[ph], len(rows)))
 
                 raise BrainObservatoryAnalysisException(msg)
 
-            test = self.sweep_response[test_rows][str(nc)].mean()
-            peak.time_to_peak_sg[nc] = (
-                np.argmax(test) - self.interlength) / self.acquisition_rate
+            subset = self.sweep_response[rows]
+            traces = np.array([ list(subset[str(nc)]) for nc in group ], dtype=float)
+            time_to_peak[group] = (
+                np.argmax(traces.mean(axis=1), axis=1) - self.interlength) / self.acquisition_rate
+
+            #reliability
+            reliability[group] = trial_reliability(traces[:, :, 28:42])
 
             #running modulation
-            subset = self.mean_sweep_response[(self.stim_table.spatial_frequency==self.sfvals[pref_sf])&(self.stim_table.orientation==self.orivals[pref_ori])&(self.stim_table.phase==self.phasevals[pref_phase])]            
-            subset_run = subset[subset.dx>=1]
-            subset_stat = subset[subset.dx<1]
+            subset = mean_sweep_response[rows][:, group]
+            subset_run = subset[dx[rows] >= 1]
+            subset_stat = subset[dx[rows] < 1]
             if (len(subset_run)>4) & (len(subset_stat)>4):
-                (_,peak.p_run_sg.iloc[nc]) = st.ttest_ind(subset_run[str(nc)], subset_stat[str(nc)], equal_var=False)
-                
-                if subset_run[str(nc)].mean()>subset_stat[str(nc)].mean():
-                    peak.run_modulation_sg.iloc[nc] = (subset_run[str(nc)].mean() - subset_stat[str(nc)].mean())/np.abs(subset_run[str(nc)].mean())
-                elif subset_run[str(nc)].mean()<subset_stat[str(nc)].mean():
-                    peak.run_modulation_sg.iloc[nc] = -1*((subset_stat[str(nc)].mean() - subset_run[str(nc)].mean())/np.abs(subset_stat[str(nc)].mean()))
-            else:
-                peak.p_run_sg.iloc[nc] = np.NaN
-                peak.run_modulation_sg.iloc[nc] = np.NaN                
-            
-            #reliability
-            subset = self.sweep_response[(self.stim_table.spatial_frequency==self.sfvals[pref_sf])&(self.stim_table.orientation==self.orivals[pref_ori])&(self.stim_table.phase==self.phasevals[pref_phase])]         
-            corr_matrix = np.empty((len(subset),len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    r,p = st.pearsonr(subset[str(nc)].iloc[i][28:42], subset[str(nc)].iloc[j][28:42])
-                    corr_matrix[i,j] = r
-            mask = np.ones((len(subset), len(subset)))
-            for i in range(len(subset)):
-                for j in range(len(subset)):
-                    if i>=j:
-                        mask[i,j] = np.NaN
-            corr_matrix *= mask
-            peak.reliability_sg.iloc[nc] = np.nanmean(corr_matrix)
+                p_run[group], run_modulation[group] = \
+                    running_modulation(subset_run, subset_stat)
 
             #SF index
-            sf_tuning = self.response[pref_ori,1:,pref_phase,nc,0]
-            trials = self.mean_sweep_response[(self.stim_table.spatial_frequency!=0)&(self.stim_table.orientation==self.orivals[pref_ori])&(self.stim_table.phase==self.phasevals[pref_phase])][str(nc)].values
-            SSE_part = np.sqrt(np.sum((trials-trials.mean())**2)/(len(trials)-5))
-            peak.sf_index_sg.iloc[nc] = (np.ptp(sf_tuning))/(np.ptp(sf_tuning) + 2*SSE_part)
+            sf_tuning = response[ori, 1:, ph][:, group]
+            trials = mean_sweep_response[(spatial_frequency!=0)&(orientation==self.orivals[ori])&(phase==self.phasevals[ph])][:, group]
+            SSE_part = np.sqrt(np.sum((trials-trials.mean(axis=0))**2, axis=0)/(len(trials)-5))
+            sf_index[group] = (np.ptp(sf_tuning, axis=0))/(np.ptp(sf_tuning, axis=0) + 2*SSE_part)
+
+        for column, values in (('cell_specimen_id', cids[:self.numbercells]),
+                               ('ori_sg', pref_ori),
+                               ('sf_sg', pref_sf),
+                               ('phase_sg', pref_phase),
+                               ('cv_os_sg', cv_os),
+                               ('osi_sg', osi),
+                               ('peak_dff_sg', pref),
+                               ('ptest_sg', ptest),
+                               ('time_to_peak_sg', time_to_peak),
+                               ('p_run_sg', p_run),
+                               ('run_modulation_sg', run_modulation),
+                               ('reliability_sg', reliability),
+                               ('sf_index_sg', sf_index)):
+            peak[column] = pd.Series(list(values), index=peak.index, dtype=object)
 
         return peak
 
@@ -468,20 +460,7 @@ class StaticGratings(StimulusAnalysis):
         response = response.reshape(self.number_ori * (self.number_sf-1) * self.number_phase, self.numbercells).T
         N, Nstim = response.shape
 
-        signal_corr = np.zeros((N, N))
-        signal_p = np.empty((N, N))
-        if corr == 'pearson':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(N):
-                for j in range(i, N): # matrix is symmetric
-                    signal_corr[i, j], signal_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        signal_corr, signal_p = correlation_matrix(response, corr)
 
         signal_corr = np.triu(signal_corr) + np.triu(signal_corr, 1).T  # fill in lower triangle
         signal_p = np.triu(signal_p) + np.triu(signal_p, 1).T  # fill in lower triangle
@@ -496,20 +475,7 @@ class StaticGratings(StimulusAnalysis):
         response = response.reshape(self.number_ori * (self.number_sf-1) * self.number_phase, self.numbercells)
         Nstim, N = response.shape
 
-        rep_sim = np.zeros((Nstim, Nstim))
-        rep_sim_p = np.empty((Nstim, Nstim))
-        if corr == 'pearson':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.pearsonr(response[i], response[j])
-
-        elif corr == 'spearman':
-            for i in range(Nstim):
-                for j in range(i, Nstim): # matrix is symmetric
-                    rep_sim[i, j], rep_sim_p[i, j] = st.spearmanr(response[i], response[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        rep_sim, rep_sim_p = correlation_matrix(response, corr)
 
         rep_sim = np.triu(rep_sim) + np.triu(rep_sim, 1).T # fill in lower triangle
         rep_sim_p = np.triu(rep_sim_p) + np.triu(rep_sim_p, 1).T  # fill in lower triangle
@@ -527,38 +493,16 @@ class StaticGratings(StimulusAnalysis):
         noise_corr_blank = np.zeros((self.numbercells, self.numbercells))
         noise_corr_blank_p = np.zeros((self.numbercells, self.numbercells))
 
-        if corr == 'pearson':
-            for k in range(self.number_ori):
-                for l in range(self.number_sf-1):
-                    for m in range(self.number_phase):
-                        for i in range(self.numbercells):
-                            for j in range(i, self.numbercells):
-                                noise_corr[i, j, k, l, m], noise_corr_p[i, j, k, l, m] = st.pearsonr(response[i, k, l, m], response[j, k, l, m])
-
-                        noise_corr[:, :, k, l, m] = np.triu(noise_corr[:, :, k, l, m]) + np.triu(noise_corr[:, :, k, l, m], 1).T
-
-            for i in range(self.numbercells):
-                for j in range(i, self.numbercells):
-                    noise_corr_blank[i, j], noise_corr_blank_p[i, j] = st.pearsonr(response_blank[i], response_blank[j])
-
-        elif corr == 'spearman':
-            for k in range(self.number_ori):
-                for l in range(self.number_sf-1):
-                    for m in range(self.number_phase):
-                        for i in range(self.numbercells):
-                            for j in range(i, self.numbercells):
-                                noise_corr[i, j, k, l, m], noise_corr_p[i, j, k, l, m] = st.spearmanr(response[i, k, l, m], response[j, k, l, m])
-
-                        noise_corr[:, :, k, l, m] = np.triu(noise_corr[:, :, k, l, m]) + np.triu(noise_corr[:, :, k, l, m], 1).T
-
-            for i in range(self.numbercells):
-                for j in range(i, self.numbercells):
-                    noise_corr_blank[i, j], noise_corr_blank_p[i, j] = st.spearmanr(response_blank[i], response_blank[j])
-
-        else:
-            raise Exception('correlation should be pearson or spearman')
+        for k in range(self.number_ori):
+            for l in range(self.number_sf-1):
+                for m in range(self.number_phase):
+                    r, p = correlation_matrix(np.vstack(response[:, k, l, m]), corr)
+                    noise_corr[:, :, k, l, m] = np.triu(r) + np.triu(r, 1).T
+                    noise_corr_p[:, :, k, l, m] = np.triu(p)
 
-        noise_corr_blank[:, :] = np.triu(noise_corr_blank[:, :]) + np.triu(noise_corr_blank[:, :], 1).T
+        r, p = correlation_matrix(response_blank, corr)
+        noise_corr_blank[:, :] = np.triu(r) + np.triu(r, 1).T
+        noise_corr_blank_p[:, :] = np.triu(p)
 
         return noise_corr, noise_corr_p, noise_corr_blank, noise_corr_blank_p
 
@@ -34,9 +34,12 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import scipy.stats as st
+from scipy import special
+import scipy.sparse as sparse
 import numpy as np
 import pandas as pd
 import logging
+import warnings
 from .findlevel import findlevel
 from .brain_observatory_exceptions import BrainObservatoryAnalysisException
 from . import observatory_plots as oplots
@@ -82,6 +85,7 @@ class StimulusAnalysis(object):
         self._stim_table = StimulusAnalysis._PRELOAD
         self._response = StimulusAnalysis._PRELOAD
         self._sweep_response = StimulusAnalysis._PRELOAD
+        self._sweep_response_array = StimulusAnalysis._PRELOAD
         self._mean_sweep_response = StimulusAnalysis._PRELOAD
         self._pval = StimulusAnalysis._PRELOAD
         self._peak = StimulusAnalysis._PRELOAD
@@ -101,6 +105,13 @@ class StimulusAnalysis(object):
 
         return self._sweep_response
 
+    @property
+    def sweep_response_array(self):
+        if self._sweep_response_array is StimulusAnalysis._PRELOAD:
+            self._sweep_response_array = self.get_sweep_response_array()
+
+        return self._sweep_response_array
+
     @property
     def mean_sweep_response(self):
         if self._mean_sweep_response is StimulusAnalysis._PRELOAD:
@@ -258,7 +269,7 @@ class StimulusAnalysis(object):
         """ Implemented by subclasses. """
         raise BrainObservatoryAnalysisException("get_peak not implemented")
 
-    def get_speed_tuning(self, binsize):
+    def get_speed_tuning(self, binsize, seed=None, chunk_size=None):
         """ Calculates speed tuning, spontaneous versus visually driven.  The return is a 5-tuple
         of speed and dF/F histograms.
 
@@ -280,6 +291,19 @@ class StimulusAnalysis(object):
 
             peak_run: pd.DataFrame of speed-related properties of a cell.
 
+        Parameters
+        ----------
+        binsize: int
+            number of samples in each speed bin above 1 cm/s
+
+        seed: int
+            seed for the shuffles used to test for speed modulation.  If None,
+            the global numpy random state is used.
+
+        chunk_size: int
+            number of shuffles evaluated at a time.  If None, all shuffles are
+            evaluated at once.
+
         Returns
         -------
         tuple: binned_dx_sp, binned_cells_sp, binned_dx_vis, binned_cells_vis, peak_run
@@ -351,31 +375,12 @@ class StimulusAnalysis(object):
                 binned_cells_sp[:, i, 1] = np.std(
                     celltraces_sorted_sp[:, start:start + binsize], axis=1) / np.sqrt(binsize)
 
-        binned_cells_shuffled_sp = np.empty((self.numbercells, nbins, 2, 200))
-        for shuf in range(200):
-            celltraces_shuffled = celltraces_sp[
-                :, np.random.permutation(np.size(celltraces_sp, 1))]
-            celltraces_shuffled_sorted = celltraces_shuffled[
-                :, np.argsort(dx_sp)]
-            for i in range(nbins):
-                offset = findlevel(dx_sorted, 1, 'up')
-
-                if offset is None:
-                    StimulusAnalysis._log.info(
-                        "dx never crosses 1, all speed data going into single bin")
-                    offset = celltraces_shuffled_sorted.shape[1]
-
-                if i == 0:
-                    binned_cells_shuffled_sp[:, i, 0, shuf] = np.mean(
-                        celltraces_shuffled_sorted[:, :offset], axis=1)
-                    binned_cells_shuffled_sp[:, i, 1, shuf] = np.std(
-                        celltraces_shuffled_sorted[:, :offset], axis=1)
-                else:
-                    start = offset + (i - 1) * binsize
-                    binned_cells_shuffled_sp[:, i, 0, shuf] = np.mean(
-                        celltraces_shuffled_sorted[:, start:start + binsize], axis=1)
-                    binned_cells_shuffled_sp[:, i, 1, shuf] = np.std(
-                        celltraces_shuffled_sorted[:, start:start + binsize], axis=1)
+        rng = np.random if seed is None else np.random.RandomState(seed)
+
+        shuffled_means_sp = _shuffled_bin_means(
+            celltraces_sp, np.argsort(dx_sp),
+            _speed_bin_edges(dx_sorted, nbins, binsize),
+            200, rng, chunk_size)
 
         nbins = 1 + len(np.where(dx_vis >= 1)[0]) // binsize
         dx_sorted = dx_vis[np.argsort(dx_vis)]
@@ -408,44 +413,28 @@ class StimulusAnalysis(object):
                 binned_cells_vis[:, i, 1] = np.std(
                     celltraces_sorted_vis[:, start:start + binsize], axis=1) / np.sqrt(binsize)
 
-        binned_cells_shuffled_vis = np.empty((self.numbercells, nbins, 2, 200))
-        for shuf in range(200):
-            celltraces_shuffled = celltraces_vis[
-                :, np.random.permutation(np.size(celltraces_vis, 1))]
-            celltraces_shuffled_sorted = celltraces_shuffled[
-                :, np.argsort(dx_vis)]
-            for i in range(nbins):
-                offset = findlevel(dx_sorted, 1, 'up')
-
-                if offset is None:
-                    StimulusAnalysis._log.info(
-                        "dx never crosses 1, all speed data going into single bin")
-                    offset = len(dx_sorted)
-
-                if i == 0:
-                    binned_cells_shuffled_vis[:, i, 0, shuf] = np.mean(
-                        celltraces_shuffled_sorted[:, :offset], axis=1)
-                    binned_cells_shuffled_vis[:, i, 1, shuf] = np.std(
-                        celltraces_shuffled_sorted[:, :offset], axis=1)
-                else:
-                    start = offset + (i - 1) * binsize
-                    binned_cells_shuffled_vis[:, i, 0, shuf] = np.mean(
-                        celltraces_shuffled_sorted[:, start:start + binsize], axis=1)
-                    binned_cells_shuffled_vis[:, i, 1, shuf] = np.std(
-                        celltraces_shuffled_sorted[:, start:start + binsize], axis=1)
-
-        shuffled_variance_sp = binned_cells_shuffled_sp[
-            :, :, 0, :].std(axis=1)**2
+        shuffled_means_vis = _shuffled_bin_means(
+            celltraces_vis, np.argsort(dx_vis),
+            _speed_bin_edges(dx_sorted, nbins, binsize),
+            200, rng, chunk_size)
+
+        shuffled_variance_sp = shuffled_means_sp.std(axis=1)**2
         variance_threshold_sp = np.percentile(
             shuffled_variance_sp, 99.9, axis=1)
         response_variance_sp = binned_cells_sp[:, :, 0].std(axis=1)**2
 
-        shuffled_variance_vis = binned_cells_shuffled_vis[
-            :, :, 0, :].std(axis=1)**2
+        shuffled_variance_vis = shuffled_means_vis.std(axis=1)**2
         variance_threshold_vis = np.percentile(
             shuffled_variance_vis, 99.9, axis=1)
         response_variance_vis = binned_cells_vis[:, :, 0].std(axis=1)**2
 
+        ptest_sp = _speed_tuning_ks_test(celltraces_sorted_sp,
+                                         binned_cells_sp, binned_dx_sp,
+                                         binsize)
+        ptest_vis = _speed_tuning_ks_test(celltraces_sorted_vis,
+                                          binned_cells_vis, binned_dx_vis,
+                                          binsize)
+
         for nc in range(self.numbercells):
             if response_variance_vis[nc] > variance_threshold_vis[nc]:
                 peak_run.mod_vis[nc] = True
@@ -456,44 +445,56 @@ class StimulusAnalysis(object):
             if response_variance_sp[nc] <= variance_threshold_sp[nc]:
                 peak_run.mod_sp[nc] = False
             temp = binned_cells_sp[nc, :, 0]
-            start_max = temp.argmax()
-            peak_run.speed_max_sp[nc] = binned_dx_sp[start_max, 0]
-            start_min = temp.argmin()
-            peak_run.speed_min_sp[nc] = binned_dx_sp[start_min, 0]
-            if peak_run.speed_max_sp[nc] > peak_run.speed_min_sp[nc]:
-                test_values = celltraces_sorted_sp[
-                    nc, start_max * binsize:(start_max + 1) * binsize]
-                other_values = np.delete(celltraces_sorted_sp[nc, :], range(
-                    start_max * binsize, (start_max + 1) * binsize))
-                (_, peak_run.ptest_sp[nc]) = st.ks_2samp(
-                    test_values, other_values)
-            else:
-                test_values = celltraces_sorted_sp[
-                    nc, start_min * binsize:(start_min + 1) * binsize]
-                other_values = np.delete(celltraces_sorted_sp[nc, :], range(
-                    start_min * binsize, (start_min + 1) * binsize))
-                (_, peak_run.ptest_sp[nc]) = st.ks_2samp(
-                    test_values, other_values)
+            peak_run.speed_max_sp[nc] = binned_dx_sp[temp.argmax(), 0]
+            peak_run.speed_min_sp[nc] = binned_dx_sp[temp.argmin(), 0]
+            peak_run.ptest_sp[nc] = ptest_sp[nc]
             temp = binned_cells_vis[nc, :, 0]
-            start_max = temp.argmax()
-            peak_run.speed_max_vis[nc] = binned_dx_vis[start_max, 0]
-            start_min = temp.argmin()
-            peak_run.speed_min_vis[nc] = binned_dx_vis[start_min, 0]
-            if peak_run.speed_max_vis[nc] > peak_run.speed_min_vis[nc]:
-                test_values = celltraces_sorted_vis[
-                    nc, start_max * binsize:(start_max + 1) * binsize]
-                other_values = np.delete(celltraces_sorted_vis[nc, :], range(
-                    start_max * binsize, (start_max + 1) * binsize))
-            else:
-                test_values = celltraces_sorted_vis[
-                    nc, start_min * binsize:(start_min + 1) * binsize]
-                other_values = np.delete(celltraces_sorted_vis[nc, :], range(
-                    start_min * binsize, (start_min + 1) * binsize))
-            (_, peak_run.ptest_vis[nc]) = st.ks_2samp(
-                test_values, other_values)
+            peak_run.speed_max_vis[nc] = binned_dx_vis[temp.argmax(), 0]
+            peak_run.speed_min_vis[nc] = binned_dx_vis[temp.argmin(), 0]
+            peak_run.ptest_vis[nc] = ptest_vis[nc]
 
         return binned_dx_sp, binned_cells_sp, binned_dx_vis, binned_cells_vis, peak_run
 
+    def get_sweep_response_array(self):
+        """ Gathers the response to each sweep in the stimulus table into a
+        dense (sweeps, cells + 1, samples) array.  Each window starts
+        interlength samples before the sweep and ends interlength samples
+        after sweeplength.  Cell traces are expressed as percent dF/F relative
+        to the mean of the first interlength samples; the last entry along
+        the second axis is the raw running speed, matching the 'dx' column
+        of sweep_response.  Samples falling outside of the recording are NaN,
+        and baselines are the mean of the samples within it.
+
+        Returns
+        -------
+        np.ndarray
+        """
+        StimulusAnalysis._log.info('Gathering responses for each sweep')
+
+        window = np.arange(self.sweeplength + 2 * self.interlength)
+        starts = self.stim_table['start'].values.astype(int) - self.interlength
+        inds = starts[:, np.newaxis] + window
+        lengths = self._sweep_lengths()
+
+        celltraces = np.asarray(self.celltraces)
+        dxcm = np.asarray(self.dxcm)
+
+        dtype = np.result_type(celltraces.dtype, np.float32)
+        responses = np.empty((len(starts), self.numbercells + 1, len(window)),
+                             dtype=dtype)
+
+        for nc in range(self.numbercells):
+            responses[:, nc, :] = _take_windows(celltraces[nc], inds)
+        responses[:, -1, :] = _take_windows(dxcm, inds)
+
+        cells = responses[:, :self.numbercells, :]
+        baseline = _mean_within(cells[:, :, :self.interlength], lengths)
+        cells /= baseline[:, :, np.newaxis]
+        cells -= 1
+        cells *= 100
+
+        return responses
+
     def get_sweep_response(self):
         """ Calculates the response to each sweep in the stimulus table for each cell and the mean response.
         The return is a 3-tuple of:
@@ -504,41 +505,49 @@ class StimulusAnalysis(object):
 
             * pval: p value from 1-way ANOVA comparing response during sweep to response prior to sweep
 
+        The traces in sweep_response are views into sweep_response_array,
+        and the means and p values are computed from that array directly.
+        Windows that run past the end of the recording are truncated, and
+        their statistics use only the samples that were recorded.
+
         Returns
         -------
         3-tuple: sweep_response, mean_sweep_response, pval
         """
-        def do_mean(x):
-            # +1])
-            return np.mean(x[self.interlength:self.interlength + self.sweeplength + self.extralength])
-
-        def do_p_value(x):
-            (_, p) = st.f_oneway(x[:self.interlength], x[
-                self.interlength:self.interlength + self.sweeplength + self.extralength])
-            return p
-
         StimulusAnalysis._log.info('Calculating responses for each sweep')
-        sweep_response = pd.DataFrame(index=self.stim_table.index.values, 
-                                      columns=list(map(str, range(self.numbercells + 1))))
+        responses = self.sweep_response_array
+
+        index = self.stim_table.index.values
+        columns = list(map(str, range(self.numbercells))) + ['dx']
 
-        sweep_response.rename(
-            columns={str(self.numbercells): 'dx'}, inplace=True)
+        lengths = self._sweep_lengths()
 
-        for index, row in self.stim_table.iterrows():
-            start = int(row['start'] - self.interlength)
-            end = int(row['start'] + self.sweeplength + self.interlength)
+        traces = np.empty(responses.shape[:2], dtype=object)
+        for i, length in enumerate(lengths):
+            for j in range(responses.shape[1]):
+                traces[i, j] = responses[i, j, :length]
+        sweep_response = pd.DataFrame(traces, index=index, columns=columns)
 
-            for nc in range(self.numbercells):
-                temp = self.celltraces[int(nc), start:end]
-                sweep_response[str(nc)][index] = 100 * \
-                    ((temp / np.mean(temp[:self.interlength])) - 1)
-            sweep_response['dx'][index] = self.dxcm[start:end]
+        mean_response, p_values = sweep_response_statistics(
+            responses, self.interlength,
+            self.sweeplength + self.extralength,
+            lengths=lengths)
 
-        mean_sweep_response = sweep_response.applymap(do_mean)
+        mean_sweep_response = pd.DataFrame(mean_response, index=index,
+                                           columns=columns)
+        pval = pd.DataFrame(p_values, index=index, columns=columns)
 
-        pval = sweep_response.applymap(do_p_value)
         return sweep_response, mean_sweep_response, pval
 
+    def _sweep_lengths(self):
+        """ Number of samples of each sweep window, counted from its start,
+        that lie before the end of the recording.
+        """
+        window_length = self.sweeplength + 2 * self.interlength
+        starts = self.stim_table['start'].values.astype(int) - self.interlength
+
+        return np.clip(np.shape(self.celltraces)[1] - starts, 0, window_length)
+
     def plot_representational_similarity(self, repsim, stimulus=False):
         if stimulus:
             pass
@@ -581,3 +590,504 @@ class StimulusAnalysis(object):
         else:
             raise Exception("Could not find row for csid(%s) idx(%s)" % (str(csid), str(idx)))
     
+
+
+def _take_windows(trace, inds):
+    """ Index a 1D trace with a 2D array of sample indices, filling samples
+    that fall outside of the trace with NaN.
+    """
+    valid = (inds >= 0) & (inds < len(trace))
+
+    if valid.all():
+        return trace[inds]
+
+    windows = trace[np.clip(inds, 0, max(len(trace) - 1, 0))].astype(float)
+    windows[~valid] = np.nan
+    return windows
+
+
+def _mean_within(windows, lengths):
+    """ Mean along the last axis of a (sweeps, cells, samples) array, using
+    only the first lengths[i] samples of sweep i.
+    """
+    n = np.minimum(lengths, windows.shape[2])
+
+    if (n == windows.shape[2]).all():
+        return windows.mean(axis=2)
+
+    in_range = np.arange(windows.shape[2]) < n[:, np.newaxis]
+    total = np.where(in_range[:, np.newaxis, :], windows, 0).sum(axis=2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return total / n[:, np.newaxis]
+
+
+def sweep_response_statistics(responses, interlength, response_length,
+                              chunk_size=256, lengths=None):
+    """ Compute the mean response and the p value of a one-way ANOVA
+    comparing the response to the baseline for every sweep and cell of a
+    sweep response array.  The baseline is the first interlength samples of
+    each trace and the response is the following response_length samples.
+    The p values match scipy.stats.f_oneway applied trace by trace.
+
+    Parameters
+    ----------
+    responses: np.ndarray
+        (sweeps, cells, samples) array, as from get_sweep_response_array
+
+    interlength: int
+        number of baseline samples at the start of each trace
+
+    response_length: int
+        number of response samples following the baseline
+
+    chunk_size: int
+        number of sweeps reduced at a time, bounding temporary memory
+
+    lengths: np.ndarray
+        if given, the number of leading samples of each sweep to use; later
+        samples are left out as if the trace had been truncated
+
+    Returns
+    -------
+    tuple: (sweeps, cells) arrays of mean responses and p values
+    """
+    responses = np.asarray(responses)
+    n_sweeps = responses.shape[0]
+    samples = np.arange(responses.shape[2])
+
+    if lengths is not None:
+        lengths = np.asarray(lengths)
+
+    def masked(values, mask):
+        return values if mask is None else np.where(mask, values, 0)
+
+    mean_response = np.empty(responses.shape[:2])
+    p_values = np.empty(responses.shape[:2])
+
+    for lo in range(0, n_sweeps, chunk_size):
+        hi = min(lo + chunk_size, n_sweeps)
+
+        baseline = responses[lo:hi, :, :interlength].astype(float)
+        response = responses[lo:hi, :, interlength:
+                             interlength + response_length].astype(float)
+        n_base = baseline.shape[2]
+        n_resp = response.shape[2]
+
+        if lengths is not None and (lengths[lo:hi] < responses.shape[2]).any():
+            in_range = samples < lengths[lo:hi, np.newaxis]
+            base_mask = in_range[:, np.newaxis, :interlength]
+            resp_mask = in_range[:, np.newaxis, 
+                                 interlength:interlength + response_length]
+            n_base = base_mask.sum(axis=2)
+            n_resp = resp_mask.sum(axis=2)
+        else:
+            base_mask = resp_mask = None
+
+        baseline = masked(baseline, base_mask)
+        response = masked(response, resp_mask)
+        n_total = n_base + n_resp
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_response[lo:hi] = response.sum(axis=2) / n_resp
+
+            # center on the grand mean for stability, as f_oneway does
+            offset = (baseline.sum(axis=2) + response.sum(axis=2)) / n_total
+        baseline = masked(baseline - offset[:, :, np.newaxis], base_mask)
+        response = masked(response - offset[:, :, np.newaxis], resp_mask)
+
+        sum_base = baseline.sum(axis=2)
+        sum_resp = response.sum(axis=2)
+        sum_total = sum_base + sum_resp
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ss_total = ((baseline ** 2).sum(axis=2) +
+                        (response ** 2).sum(axis=2) -
+                        sum_total ** 2 / n_total)
+            ss_between = (sum_base ** 2 / n_base + sum_resp ** 2 / n_resp -
+                          sum_total ** 2 / n_total)
+            ss_within = ss_total - ss_between
+            df_within = n_total - 2
+            f = ss_between / (ss_within / df_within)
+
+        p_values[lo:hi] = special.fdtrc(1, df_within, f)
+
+    return mean_response, p_values
+
+
+def correlation_matrix(data, corr='spearman', block_size=None):
+    """ Correlate every row of a 2D array with every other row.  This is
+    equivalent to calling scipy.stats.pearsonr or scipy.stats.spearmanr on
+    each pair of rows, but is computed as a product of standardized (and, for
+    spearman, rank transformed) rows.  Rows containing NaN or with no
+    variance produce NaN correlations, and p values that follow the scipy
+    functions for NaN coefficients.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        (variables, observations) array
+
+    corr: string
+        'pearson' or 'spearman'
+
+    block_size: int
+        if given, compute the result this many rows at a time to bound the
+        size of temporary arrays
+
+    Returns
+    -------
+    tuple: (variables, variables) arrays of correlation coefficients and p values
+    """
+    if corr not in ('pearson', 'spearman'):
+        raise Exception('correlation should be pearson or spearman')
+
+    data = np.array(data, dtype=float, ndmin=2)
+    n_rows, n_obs = data.shape
+
+    r = np.empty((n_rows, n_rows))
+    p = np.empty((n_rows, n_rows))
+    r.fill(np.nan)
+    p.fill(np.nan)
+
+    if n_rows == 0 or n_obs <= 1:
+        return r, p
+
+    invalid = np.isnan(data).any(axis=1)
+    data[invalid] = 0
+
+    if corr == 'spearman':
+        data = np.apply_along_axis(st.rankdata, 1, data)
+
+    data -= data.mean(axis=1)[:, np.newaxis]
+    norms = np.sqrt((data ** 2).sum(axis=1))
+    invalid |= (norms == 0)
+    norms[invalid] = 1
+    data /= norms[:, np.newaxis]
+    data[invalid] = 0
+
+    df = n_obs - 2
+    valid = ~invalid
+
+    if block_size is None:
+        block_size = n_rows
+
+    for lo in range(0, n_rows, block_size):
+        hi = min(lo + block_size, n_rows)
+
+        block_r = np.clip(data[lo:hi].dot(data.T), -1.0, 1.0)
+        block_r[~(valid[lo:hi, np.newaxis] & valid[np.newaxis, :])] = np.nan
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if corr == 'pearson':
+                t_squared = block_r ** 2 * (df / ((1.0 - block_r) * (1.0 + block_r)))
+                block_p = special.betainc(0.5 * df, 0.5,
+                                          np.fmin(df / (df + t_squared), 1.0))
+                block_p[np.abs(block_r) == 1.0] = 0.0
+            else:
+                t = block_r * np.sqrt((df / ((block_r + 1.0) * (1.0 - block_r))).clip(0))
+                block_p = 2 * st.t.sf(np.abs(t), df)
+
+        r[lo:hi] = block_r
+        p[lo:hi] = block_p
+
+    return r, p
+
+
+def _speed_bin_edges(dx_sorted, nbins, binsize):
+    """ Sample edges of the speed bins used by get_speed_tuning.  The first
+    bin holds all speeds below 1 cm/s; the rest hold binsize samples each.
+    """
+    offset = findlevel(dx_sorted, 1, 'up')
+
+    if offset is None:
+        offset = len(dx_sorted)
+
+    edges = np.concatenate([[0], offset + binsize * np.arange(nbins)])
+    return np.minimum(edges, len(dx_sorted))
+
+
+def _shuffled_bin_means(traces, order, edges, shuffles, rng, chunk_size=None):
+    """ Bin means of each row of traces after shuffling its samples.  Each
+    shuffle matches binning traces[:, rng.permutation(n)][:, order] by
+    edges, but the bin sums for a chunk of shuffles are computed at once as
+    the product of traces with a sparse sample-to-bin indicator matrix.
+
+    Returns
+    -------
+    np.ndarray: (rows, bins, shuffles) array of bin means
+    """
+    n_rows, n_samples = traces.shape
+    n_bins = len(edges) - 1
+    n_columns = n_bins + 1  # the last column collects samples beyond the bins
+
+    position_bins = np.empty(n_samples, dtype=int)
+    position_bins.fill(n_bins)
+    for i in range(n_bins):
+        position_bins[edges[i]:edges[i + 1]] = i
+    counts = np.diff(edges).astype(float)
+
+    if chunk_size is None:
+        chunk_size = shuffles
+
+    means = np.empty((n_rows, n_bins, shuffles))
+
+    for lo in range(0, shuffles, chunk_size):
+        hi = min(lo + chunk_size, shuffles)
+        n_chunk = hi - lo
+
+        sample_bins = np.empty((n_samples, n_chunk), dtype=np.int32)
+        for i in range(n_chunk):
+            samples = rng.permutation(n_samples)[order]
+            sample_bins[samples, i] = position_bins + i * n_columns
+
+        indicator = sparse.csr_matrix(
+            (np.ones(sample_bins.size), sample_bins.ravel(),
+             np.arange(0, sample_bins.size + 1, n_chunk)),
+            shape=(n_samples, n_chunk * n_columns))
+
+        sums = indicator.T.dot(traces.T).T
+        sums = sums.reshape(n_rows, n_chunk, n_columns)[:, :, :n_bins]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means[:, :, lo:hi] = (sums / counts).transpose(0, 2, 1)
+
+    return means
+
+
+def _speed_tuning_ks_test(sorted_traces, binned_cells, binned_dx, binsize):
+    """ For each cell, the p value of scipy.stats.ks_2samp comparing the
+    samples of its peak (or trough) speed bin to the rest of its samples, as
+    computed in get_speed_tuning.  ks_2samp is called once per cell so that
+    the p values follow the installed scipy, which may compute them exactly
+    rather than from the asymptotic distribution.
+    """
+    n_rows, n_samples = sorted_traces.shape
+
+    means = binned_cells[:, :, 0]
+    start_max = means.argmax(axis=1)
+    start_min = means.argmin(axis=1)
+    peak = np.where(binned_dx[start_max, 0] > binned_dx[start_min, 0],
+                    start_max, start_min)
+
+    starts = np.minimum(peak * binsize, n_samples)
+    stops = np.minimum((peak + 1) * binsize, n_samples)
+
+    p_values = np.empty(n_rows)
+    in_bin = np.zeros(n_samples, dtype=bool)
+
+    for nc in range(n_rows):
+        in_bin[:] = False
+        in_bin[starts[nc]:stops[nc]] = True
+
+        (_, p_values[nc]) = st.ks_2samp(sorted_traces[nc, in_bin],
+                                        sorted_traces[nc, ~in_bin])
+
+    return p_values
+
+
+def trial_reliability(traces):
+    """ Mean pearson correlation between all pairs of trials, for each cell.
+
+    Parameters
+    ----------
+    traces: np.ndarray
+        (cells, trials, samples) array of response traces
+
+    Returns
+    -------
+    np.ndarray of reliabilities, NaN where no pair of trials has a defined
+    correlation
+    """
+    traces = np.array(traces, dtype=float, ndmin=3)
+    n_trials = traces.shape[1]
+
+    traces -= traces.mean(axis=2)[:, :, np.newaxis]
+    norms = np.sqrt((traces ** 2).sum(axis=2))
+    invalid = ~(norms > 0)
+    norms[invalid] = 1
+    traces /= norms[:, :, np.newaxis]
+
+    r = np.clip(np.matmul(traces, traces.transpose(0, 2, 1)), -1.0, 1.0)
+    r[invalid[:, :, np.newaxis] | invalid[:, np.newaxis, :]] = np.nan
+
+    upper = np.triu_indices(n_trials, 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(r[:, upper[0], upper[1]], axis=1)
+
+
+def condition_codes(factors, levels):
+    """ Assign each row of a stimulus table to a stimulus condition.  The
+    condition of a row is the combination of the positions of its factor
+    values within the corresponding levels, flattened in C order.
+
+    Parameters
+    ----------
+    factors: list of np.ndarray
+        values of each stimulus factor (e.g. orientation), one per row
+
+    levels: list of np.ndarray
+        the distinct values of each factor
+
+    Returns
+    -------
+    np.ndarray of condition codes, -1 for rows whose values are not among
+    the levels
+    """
+    codes = np.zeros(len(factors[0]), dtype=int)
+    matched = np.ones(len(factors[0]), dtype=bool)
+
+    for values, factor_levels in zip(factors, levels):
+        values = np.asarray(values)
+        factor_levels = np.asarray(factor_levels)
+
+        order = np.argsort(factor_levels, kind='mergesort')
+        positions = np.searchsorted(factor_levels[order], values)
+        positions = order[np.minimum(positions, len(factor_levels) - 1)]
+
+        matched &= (factor_levels[positions] == values)
+        codes = codes * len(factor_levels) + positions
+
+    codes[~matched] = -1
+    return codes
+
+
+def _grouped_sum(values, codes, n_conditions):
+    """ Sum the rows of a 2D array by condition code with one bincount. """
+    n_columns = values.shape[1]
+    flat_codes = (codes[:, np.newaxis] * n_columns +
+                  np.arange(n_columns)).ravel()
+    sums = np.bincount(flat_codes, weights=values.ravel(),
+                       minlength=n_conditions * n_columns)
+    return sums.reshape(n_conditions, n_columns)
+
+
+def condition_response(values, p_values, codes, n_conditions, p_threshold):
+    """ Summarize trial responses by stimulus condition, as the get_response
+    methods do.  NaN responses are skipped in the mean and standard
+    deviation, as pandas does.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        (trials, columns) array of mean sweep responses
+
+    p_values: np.ndarray
+        (trials, columns) array of sweep response p values
+
+    codes: np.ndarray
+        condition code of each trial, as from condition_codes
+
+    n_conditions: int
+        number of conditions
+
+    p_threshold: float
+        p value below which a trial response is significant
+
+    Returns
+    -------
+    (conditions, columns, 3) np.ndarray of mean response, standard error of
+    the mean, and number of significant trials
+    """
+    rows = codes >= 0
+    codes = codes[rows]
+    values = np.asarray(values, dtype=float)[rows]
+    p_values = np.asarray(p_values, dtype=float)[rows]
+
+    valid = ~np.isnan(values)
+    trials = np.bincount(codes, minlength=n_conditions)[:, np.newaxis]
+    counts = _grouped_sum(valid.astype(float), codes, n_conditions)
+
+    response = np.empty((n_conditions, values.shape[1], 3))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = _grouped_sum(np.where(valid, values, 0), codes,
+                             n_conditions) / counts
+        deviations = np.where(valid, values - means[codes], 0)
+        variances = _grouped_sum(deviations ** 2, codes,
+                                 n_conditions) / (counts - 1)
+        variances[counts < 2] = np.nan
+
+        response[:, :, 0] = means
+        response[:, :, 1] = np.sqrt(variances) / np.sqrt(trials)
+
+    with np.errstate(invalid='ignore'):
+        significant = (p_values < p_threshold).astype(float)
+    response[:, :, 2] = _grouped_sum(significant, codes, n_conditions)
+
+    return response
+
+
+def condition_anova(values, codes, n_conditions):
+    """ p value of a one-way ANOVA across conditions for each column,
+    matching scipy.stats.f_oneway applied to the trials of every condition.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        (trials, columns) array of responses
+
+    codes: np.ndarray
+        condition code of each trial; trials with code -1 are left out
+
+    n_conditions: int
+        number of conditions
+
+    Returns
+    -------
+    np.ndarray of p values
+    """
+    rows = codes >= 0
+    codes = codes[rows]
+    values = np.array(values, dtype=float)[rows]
+
+    group_sizes = np.bincount(codes, minlength=n_conditions)[:, np.newaxis]
+    bign = len(values)
+
+    # center on the grand mean for stability, as f_oneway does
+    values -= values.mean(axis=0)
+    square_of_sums = values.sum(axis=0) ** 2 / bign
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sstot = (values ** 2).sum(axis=0) - square_of_sums
+        ssbn = (_grouped_sum(values, codes, n_conditions) ** 2 /
+                group_sizes).sum(axis=0) - square_of_sums
+        sswn = sstot - ssbn
+        dfbn = n_conditions - 1
+        dfwn = bign - n_conditions
+        f = (ssbn / dfbn) / (sswn / dfwn)
+
+    return special.fdtrc(dfbn, dfwn, f)
+
+
+def running_modulation(run, stat):
+    """ Compare running and stationary trial responses for each column.
+
+    Parameters
+    ----------
+    run: np.ndarray
+        (trials, columns) responses on trials with running
+
+    stat: np.ndarray
+        (trials, columns) responses on stationary trials
+
+    Returns
+    -------
+    tuple: p values of Welch's t-test and running modulation indices
+    """
+    (_, p_run) = st.ttest_ind(run, stat, axis=0, equal_var=False)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        run_mean = np.nanmean(run, axis=0)
+        stat_mean = np.nanmean(stat, axis=0)
+
+        modulation = np.where(
+            run_mean > stat_mean,
+            (run_mean - stat_mean) / np.abs(run_mean),
+            np.where(run_mean < stat_mean,
+                     -1 * ((stat_mean - run_mean) / np.abs(stat_mean)),
+                     np.nan))
+
+    return p_run, modulation
@@ -37,7 +37,6 @@ import six
 import numpy as np
 import scipy.ndimage.interpolation as spndi
 from scipy.misc import imresize
-from allensdk.api.cache import memoize
 import itertools
 
 # some handles for stimulus types
@@ -230,44 +229,127 @@ class BinaryIntervalSearchTree(object):
         assert (return_val[0] <= fi) and (fi <= return_val[1])
         return return_val
 
+class IntervalIndex(object):
+    """Sorted arrays of non-overlapping intervals, searched with np.searchsorted.  Intervals follow the conventions of
+    BinaryIntervalSearchTree.from_df: an interval contains start <= x < end, or x == start if start == end.
+
+    :param starts: interval starts
+    :param ends: interval ends
+    """
+
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+
+        self.order = np.argsort(starts, kind='mergesort')
+        self.starts = starts[self.order]
+
+        # -.01 prevents endpoint-overlapping intervals; assigns ties to intervals that start at requested index
+        ends = ends[self.order]
+        self.ends = np.where(self.starts == ends, ends, ends - .01)
+
+        # Check that the intervals are non-overlapping (except potentially at the end point)
+        assert np.all(self.ends[:-1] <= self.starts[1:])
+
+    @staticmethod
+    def from_df(input_df):
+        return IntervalIndex(input_df['start'].values, input_df['end'].values)
+
+    def preceding(self, x):
+        """Sorted position of the last interval starting at or before each x, or -1"""
+        return np.searchsorted(self.starts, x, side='right') - 1
+
+    def contains(self, x, positions):
+        """Whether the intervals at sorted positions contain each x"""
+        valid = positions >= 0
+        found = np.zeros(np.shape(x), dtype=bool)
+        found[valid] = x[valid] <= self.ends[positions[valid]]
+        return found
+
+    def search(self, x):
+        """Sorted position of the interval containing each x, or -1"""
+        x = np.asarray(x, dtype=float)
+        positions = self.preceding(x)
+        return np.where(self.contains(x, positions), positions, -1)
+
+
 class StimulusSearch(object):
+    """Finds the stimulus presentation shown at acquisition frames of an experiment.  Frames that fall between
+    presentations of an epoch are assigned the most recent presentation in the epoch.
+
+    :param nwb_dataset: BrainObservatoryNwbDataSet
+    """
 
     def __init__(self, nwb_dataset):
 
         self.nwb_data = nwb_dataset
         self.epoch_df = nwb_dataset.get_stimulus_epoch_table()
         self.master_df = nwb_dataset.get_stimulus_table('master')
-        self.epoch_bst = BinaryIntervalSearchTree.from_df(self.epoch_df)
-        self.master_bst = BinaryIntervalSearchTree.from_df(self.master_df)
+        self.epoch_index = IntervalIndex.from_df(self.epoch_df)
+        self.master_index = IntervalIndex.from_df(self.master_df)
+        self._records = None
 
-    @memoize
-    def search(self, fi):
+        # first frame after each presentation
+        self.master_next = np.floor(self.master_index.ends) + 1
 
-        try:
+        # start of the run of back-to-back epochs that each epoch belongs to
+        epoch_next = np.floor(self.epoch_index.ends) + 1
+        run_start = np.ones(len(self.epoch_index.starts), dtype=bool)
+        run_start[1:] = self.epoch_index.starts[1:] > epoch_next[:-1]
+        self.epoch_run_start = self.epoch_index.starts[run_start][np.cumsum(run_start) - 1]
+
+    def search_indices(self, frames):
+        """Return the row of master_df shown at each frame, or -1 if no stimulus was shown.
+
+        :param frames: array-like of acquisition frame indices
+        :return: np.ndarray of int, the shape of frames
+        """
+        frames = np.asarray(frames, dtype=float)
 
-            # Look in fine-grain tree:
-            search_result = self.master_bst.search(fi)
-            return search_result
-        except KeyError:
+        presentation = self.master_index.preceding(frames)
+        in_presentation = self.master_index.contains(frames, presentation)
 
-            # Current frame not found in a fine-grain interval;
-            #   see if it is unregistered to a coarse-grain epoch:
-            try:
+        # frames between presentations belong to the most recent presentation if
+        # epochs cover every frame since it ended
+        epoch = self.epoch_index.search(frames)
+        in_epoch = epoch >= 0
+        covered = np.zeros(frames.shape, dtype=bool)
+        has_presentation = in_epoch & (presentation >= 0)
+        covered[has_presentation] = self.epoch_run_start[epoch[has_presentation]] <= \
+            self.master_next[presentation[has_presentation]]
 
-                # THis will thow KeyError if not in coarse-grain epoch
-                self.epoch_bst.search(fi)
+        found = in_presentation | covered
+        rows = np.full(frames.shape, -1, dtype=int)
+        rows[found] = self.master_index.order[presentation[found]]
+
+        return rows
+
+    def search_many(self, frames):
+        """Return the stimulus presentation shown at each frame.
+
+        :param frames: array-like of acquisition frame indices
+        :return: pd.DataFrame with the columns of the master stimulus table and one row per frame.  Rows are NaN
+        where no stimulus was shown.
+        """
+        rows = self.search_indices(np.ravel(frames))
+        return self.master_df.reindex(rows).reset_index(drop=True)
+
+    def search(self, fi):
+        """Return the stimulus presentation shown at a frame as a tuple of (start, end, row of the master stimulus
+        table as a dict), or None if no stimulus was shown."""
+        row = self.search_indices(fi)
+        if np.ndim(row) != 0:
+            raise ValueError("search takes a single frame; use search_many for several")
 
-                # Frame is in a coarse-grain  epoch, but not a fine grain interval;
-                #   look backwards to find most recent find nearest matching interval
-                if fi < self.epoch_df.iloc[0]['start']:
-                    return None
-                else:
-                    return self.search(fi-1)
+        row = int(row)
+        if row < 0:
+            return None
 
-            except KeyError:
+        if self._records is None:
+            self._records = self.master_df.to_dict('records')
 
-                # Frame is unregistered at the coarse level; return None
-                return None
+        x = self._records[row]
+        return (x['start'], x['end'] if x['start'] == x['end'] else x['end'] - .01, x)
 
 def rotate(X, Y, theta):
     x = np.array([X, Y])
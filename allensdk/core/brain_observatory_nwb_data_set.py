@@ -33,6 +33,8 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import contextlib
+import copy
 import functools
 import dateutil
 import re
@@ -40,6 +42,8 @@ import os
 import six
 import itertools
 import logging
+import operator
+import threading
 from pkg_resources import parse_version
 
 import h5py
@@ -52,7 +56,7 @@ import allensdk.brain_observatory.stimulus_info as si
 
 from allensdk.brain_observatory.brain_observatory_exceptions import (MissingStimulusException,
                                                                      NoEyeTrackingException)
-from allensdk.api.cache import memoize
+from allensdk.api.cache import MemoCache
 from allensdk.core import h5_utilities 
 
 from allensdk.brain_observatory.stimulus_info import mask_stimulus_template as si_mask_stimulus_template
@@ -140,6 +144,7 @@ class BrainObservatoryNwbDataSet(object):
 
         self.nwb_file = nwb_file
         self.pipeline_version = None
+        self.__init_handles()
 
         if os.path.exists(self.nwb_file):
             meta = self.get_metadata()
@@ -152,6 +157,114 @@ class BrainObservatoryNwbDataSet(object):
                                     " Please update your AllenSDK." % (nwb_file, pipeline_version_str, self.SUPPORTED_PIPELINE_VERSION))
 
         self._stimulus_search = None
+        self._cell_specimen_index = None
+        self._table_cache = {}
+        self._template_cache = {}
+
+    def __init_handles(self):
+        self._handle_lock = threading.Lock()
+        self._handle_local = threading.local()
+        self._handle_depth = 0
+        self._handle_generation = 0
+        self._handles = []
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        ''' Keep read-only handles to the NWB file open until close() is
+        called, instead of opening the file once per accessor call.  Groups
+        and datasets looked up while the handles are open are cached.  Each
+        thread reading from the data set gets its own handle.  Calls may be
+        nested; the handles are closed by the outermost close().  The data
+        set can also be used as a context manager:
+
+            with data_set:
+                ts, dff = data_set.get_dff_traces()
+                st = data_set.get_stimulus_table('master')
+
+        Returns
+        -------
+        self
+        '''
+        with self._handle_lock:
+            self._handle_depth += 1
+        return self
+
+    def close(self):
+        ''' Close the handles kept open since the matching call to open().
+        '''
+        with self._handle_lock:
+            if self._handle_depth == 0:
+                return
+
+            self._handle_depth -= 1
+            if self._handle_depth == 0:
+                self._release_handles()
+
+    @property
+    def is_open(self):
+        ''' True between open() and the matching close() '''
+        return self._handle_depth > 0
+
+    def _release_handles(self):
+        # caller holds self._handle_lock
+        for f in self._handles:
+            if f:
+                f.close()
+
+        self._handles = []
+
+        # threads compare against this before reusing their handle
+        self._handle_generation += 1
+
+    def _thread_handle(self):
+        local = self._handle_local
+
+        if getattr(local, 'generation', None) != self._handle_generation:
+            with self._handle_lock:
+                local.file = h5py.File(self.nwb_file, 'r')
+                local.objects = {}
+                local.generation = self._handle_generation
+                self._handles.append(local.file)
+
+        return local.file
+
+    @contextlib.contextmanager
+    def _h5_file(self):
+        ''' Yield a read-only h5py.File: this thread's handle if the data set
+        is open, otherwise one that is closed on exit.
+        '''
+        if self._handle_depth > 0:
+            yield self._thread_handle()
+        else:
+            with h5py.File(self.nwb_file, 'r') as f:
+                yield f
+
+    def _h5_object(self, f, path, find=None):
+        ''' Look up a group or dataset in f by path, or by calling find(f) if
+        given, caching the result if f is this thread's open handle.
+        '''
+        if find is None:
+            find = operator.itemgetter(path)
+
+        local = self._handle_local
+
+        if self._handle_depth == 0 or getattr(local, 'file', None) is not f:
+            return find(f)
+
+        obj = local.objects.get(path)
+        if obj is None:
+            obj = local.objects[path] = find(f)
+
+        return obj
+
+    def _pipeline_object(self, f, path):
+        return self._h5_object(f, 'processing/%s/%s' %
+                               (self.PIPELINE_DATASET, path))
 
     def get_stimulus_epoch_table(self):
         '''Returns a pandas dataframe that summarizes the stimulus epoch duration for each acquisition time index in
@@ -163,14 +276,14 @@ class BrainObservatoryNwbDataSet(object):
 
         Returns
         -------
-        timestamps: 2D numpy array
-            Timestamp for each fluorescence sample
-
-        traces: 2D numpy array
-            Fluorescence traces for each cell
+        epoch table: pd.DataFrame
+            The stimulus, start frame and end frame of each epoch, in order of
+            start.  The table is cached until the NWB file is modified.
         '''
 
+        return self._cached_table('epoch', self._get_stimulus_epoch_table)
 
+    def _get_stimulus_epoch_table(self):
         # These are thresholds used by get_epoch_mask_list to set a maximum limit on the delta aqusistion frames to
         #  count as different trials (rows in the stim table).  This helps account for dropped frames, so that they dont
         #  cause the cutting of an entire experiment into too many stimulus epochs.  If these thresholds are too low,
@@ -179,56 +292,40 @@ class BrainObservatoryNwbDataSet(object):
                           si.THREE_SESSION_B:15,
                           si.THREE_SESSION_C:7,
                           si.THREE_SESSION_C2:7}
+        threshold = threshold_dict.get(self.get_session_type(), None)
 
-        stimulus_table_dict = {}
+        stimuli = []
+        intervals = []
         for stimulus in self.list_stimuli():
+            stimulus_interval_list = get_epoch_mask_list(self.get_stimulus_table(stimulus), threshold=threshold)
+            stimuli += [stimulus] * len(stimulus_interval_list)
+            intervals += stimulus_interval_list
 
-            stimulus_table_dict[stimulus] = self.get_stimulus_table(stimulus)
+        # epochs in order of their start; a stable sort keeps ties in stimulus order
+        intervals = np.array(intervals, dtype=int).reshape(-1, 2)
+        order = np.argsort(intervals[:, 0], kind='mergesort')
 
-            if stimulus == si.SPONTANEOUS_ACTIVITY:
-                stimulus_table_dict[stimulus]['frame'] = 0
+        interval_df = pd.DataFrame({'stimulus': np.array(stimuli, dtype=object)[order],
+                                    'start': intervals[order, 0],
+                                    'end': intervals[order, 1]},
+                                   columns=['stimulus', 'start', 'end'])
 
-        interval_list = []
-        interval_stimulus_dict = {}
-        for stimulus in self.list_stimuli():
-            stimulus_interval_list = get_epoch_mask_list(stimulus_table_dict[stimulus], threshold=threshold_dict.get(self.get_session_type(), None))
-            for stimulus_interval in stimulus_interval_list:
-                interval_stimulus_dict[stimulus_interval] = stimulus
-            interval_list += stimulus_interval_list
-        interval_list.sort(key=lambda x: x[0])
-
-        stimulus_signature_list = ['gap']
-        duration_signature_list = [int(interval_list[0][0])]
-        interval_signature_list = [(0,int(interval_list[0][0]))]
-        for ii, interval in enumerate(interval_list):
-            stimulus_signature_list.append(interval_stimulus_dict[interval])
-            duration_signature_list.append(int(interval[1] - interval[0]))
-            interval_signature_list.append((int(interval[0]), int(interval[1])))
-
-            if ii != len(interval_list)-1:
-                stimulus_signature_list.append('gap')
-                duration_signature_list.append((int(interval_list[ii+1][0] - interval_list[ii][1])))
-                interval_signature_list.append((int(interval_list[ii][1]), int(interval_list[ii+1][0])))
-
-        stimulus_signature_list.append('gap')
-        interval_signature_list.append((int(interval_list[-1][1]), len(self.get_fluorescence_timestamps())))
-        duration_signature_list.append(interval_signature_list[-1][1]-interval_signature_list[-1][0])
-
-        interval_df = pd.DataFrame({'stimulus':stimulus_signature_list,
-                                    'duration':duration_signature_list,
-                                    'interval':interval_signature_list})
-
-        # Gaps are ininformative; remove them:
-        interval_df = interval_df[interval_df.stimulus != 'gap']
-        interval_df['start'] = [x[0] for x in interval_df['interval'].values]
-        interval_df['end'] = [x[1] for x in interval_df['interval'].values]
-
-        interval_df.reset_index(inplace=True, drop=True)
-        interval_df.drop(['interval', 'duration'], axis=1, inplace=True)
         return interval_df
 
+    def _cached_table(self, key, build):
+        ''' Return a copy of the table made by build(), which is cached until
+        the modification time of the NWB file changes.
+        '''
+        mtime = os.path.getmtime(self.nwb_file)
+
+        cached = self._table_cache.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = self._table_cache[key] = (mtime, build())
+
+        return cached[1].copy()
 
-    def get_fluorescence_traces(self, cell_specimen_ids=None):
+
+    def get_fluorescence_traces(self, cell_specimen_ids=None, lazy=False):
         ''' Returns an array of fluorescence traces for all ROI and
         the timestamps for each datapoint
 
@@ -238,6 +335,10 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return traces for. If this is None (default)
             then all are returned
 
+        lazy: bool (optional)
+            If True, return a LazyTraceArray that reads traces from the file
+            only when it is sliced.  Default False.
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -247,27 +348,31 @@ class BrainObservatoryNwbDataSet(object):
             Fluorescence traces for each cell
         '''
         timestamps = self.get_fluorescence_timestamps()
-        with h5py.File(self.nwb_file, 'r') as f:
-            ds = f['processing'][self.PIPELINE_DATASET][
-                'Fluorescence']['imaging_plane_1']['data']
+
+        if lazy:
+            return timestamps, self._lazy_traces(
+                'Fluorescence/imaging_plane_1/data', cell_specimen_ids)
+
+        with self._h5_file() as f:
+            ds = self._pipeline_object(f, 'Fluorescence/imaging_plane_1/data')
 
             if cell_specimen_ids is None:
                 cell_traces = ds.value
             else:
                 inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                cell_traces = ds[inds, :]
+                cell_traces = _read_rows(ds, inds)
 
         return timestamps, cell_traces
 
     def get_fluorescence_timestamps(self):
         ''' Returns an array of timestamps in seconds for the fluorescence traces '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
-            timestamps = f['processing'][self.PIPELINE_DATASET][
-                'Fluorescence']['imaging_plane_1']['timestamps'].value
+        with self._h5_file() as f:
+            timestamps = self._pipeline_object(
+                f, 'Fluorescence/imaging_plane_1/timestamps').value
         return timestamps
 
-    def get_neuropil_traces(self, cell_specimen_ids=None):
+    def get_neuropil_traces(self, cell_specimen_ids=None, lazy=False):
         ''' Returns an array of neuropil fluorescence traces for all ROIs
         and the timestamps for each datapoint
 
@@ -277,6 +382,10 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return traces for. If this is None (default)
             then all are returned
 
+        lazy: bool (optional)
+            If True, return a LazyTraceArray that reads traces from the file
+            only when it is sliced.  Default False.
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -288,23 +397,34 @@ class BrainObservatoryNwbDataSet(object):
 
         timestamps = self.get_fluorescence_timestamps()
 
-        with h5py.File(self.nwb_file, 'r') as f:
-            if self.pipeline_version >= parse_version("2.0"):
-                ds = f['processing'][self.PIPELINE_DATASET][
-                    'Fluorescence']['imaging_plane_1_neuropil_response']['data']
-            else:
-                ds = f['processing'][self.PIPELINE_DATASET][
-                    'Fluorescence']['imaging_plane_1']['neuropil_traces']
+        if lazy:
+            return timestamps, self._lazy_traces(
+                self._neuropil_traces_path(), cell_specimen_ids)
+
+        with self._h5_file() as f:
+            ds = self._pipeline_object(f, self._neuropil_traces_path())
 
             if cell_specimen_ids is None:
                 np_traces = ds.value
             else:
                 inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                np_traces = ds[inds, :]
+                np_traces = _read_rows(ds, inds)
 
         return timestamps, np_traces
 
 
+    def _neuropil_traces_path(self):
+        if self.pipeline_version >= parse_version("2.0"):
+            return 'Fluorescence/imaging_plane_1_neuropil_response/data'
+        else:
+            return 'Fluorescence/imaging_plane_1/neuropil_traces'
+
+    def _neuropil_r_path(self):
+        if self.pipeline_version >= parse_version("2.0"):
+            return 'Fluorescence/imaging_plane_1_neuropil_response/r'
+        else:
+            return 'Fluorescence/imaging_plane_1/r'
+
     def get_neuropil_r(self, cell_specimen_ids=None):
         ''' Returns a scalar value of r for neuropil correction of flourescence traces
 
@@ -320,23 +440,18 @@ class BrainObservatoryNwbDataSet(object):
             Scalar for neuropil subtraction for each cell
         '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
-            if self.pipeline_version >= parse_version("2.0"):
-                r_ds = f['processing'][self.PIPELINE_DATASET][
-                    'Fluorescence']['imaging_plane_1_neuropil_response']['r']
-            else:
-                r_ds = f['processing'][self.PIPELINE_DATASET][
-                    'Fluorescence']['imaging_plane_1']['r']
+        with self._h5_file() as f:
+            r_ds = self._pipeline_object(f, self._neuropil_r_path())
 
             if cell_specimen_ids is None:
                 r = r_ds.value
             else:
                 inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                r = r_ds[inds]
+                r = _read_rows(r_ds, inds)
 
         return r
 
-    def get_demixed_traces(self, cell_specimen_ids=None):
+    def get_demixed_traces(self, cell_specimen_ids=None, lazy=False):
         ''' Returns an array of demixed fluorescence traces for all ROIs
         and the timestamps for each datapoint
 
@@ -346,6 +461,10 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return traces for. If this is None (default)
             then all are returned
 
+        lazy: bool (optional)
+            If True, return a LazyTraceArray that reads traces from the file
+            only when it is sliced.  Default False.
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -357,18 +476,23 @@ class BrainObservatoryNwbDataSet(object):
 
         timestamps = self.get_fluorescence_timestamps()
 
-        with h5py.File(self.nwb_file, 'r') as f:
-            ds = f['processing'][self.PIPELINE_DATASET][
-                'Fluorescence']['imaging_plane_1_demixed_signal']['data']
+        if lazy:
+            return timestamps, self._lazy_traces(
+                'Fluorescence/imaging_plane_1_demixed_signal/data',
+                cell_specimen_ids)
+
+        with self._h5_file() as f:
+            ds = self._pipeline_object(
+                f, 'Fluorescence/imaging_plane_1_demixed_signal/data')
             if cell_specimen_ids is None:
                 traces = ds.value
             else:
                 inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                traces = ds[inds, :]
+                traces = _read_rows(ds, inds)
 
         return timestamps, traces
 
-    def get_corrected_fluorescence_traces(self, cell_specimen_ids=None):
+    def get_corrected_fluorescence_traces(self, cell_specimen_ids=None, lazy=False):
         ''' Returns an array of demixed and neuropil-corrected fluorescence traces
         for all ROIs and the timestamps for each datapoint
 
@@ -378,6 +502,10 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return traces for. If this is None (default)
             then all are returned
 
+        lazy: bool (optional)
+            If True, return a LazyTraceArray that reads traces from the file
+            only when it is sliced.  Default False.
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -387,6 +515,17 @@ class BrainObservatoryNwbDataSet(object):
             Corrected fluorescence traces for each cell
         '''
 
+        if lazy:
+            # starting in version 2.0, neuropil correction follows trace demixing
+            if self.pipeline_version >= parse_version("2.0"):
+                path = 'Fluorescence/imaging_plane_1_demixed_signal/data'
+            else:
+                path = 'Fluorescence/imaging_plane_1/data'
+
+            return self.get_fluorescence_timestamps(), CorrectedLazyTraceArray(
+                self, path, self._neuropil_traces_path(), self._neuropil_r_path(),
+                self._cell_rows(cell_specimen_ids))
+
         # starting in version 2.0, neuropil correction follows trace demixing
         if self.pipeline_version >= parse_version("2.0"):
             timestamps, cell_traces = self.get_demixed_traces(cell_specimen_ids)
@@ -410,17 +549,30 @@ class BrainObservatoryNwbDataSet(object):
 
         '''
 
-        all_cell_specimen_ids = list(self.get_cell_specimen_ids())
-        
+        if self._cell_specimen_index is None:
+            all_cell_specimen_ids = self.get_cell_specimen_ids().tolist()
+
+            # reversed so that the first row wins, as with list.index
+            self._cell_specimen_index = {
+                cell_specimen_id: i for i, cell_specimen_id
+                in reversed(list(enumerate(all_cell_specimen_ids))) }
+
         try:
-            inds = [list(all_cell_specimen_ids).index(i)
-                    for i in cell_specimen_ids]
-        except ValueError as e:
+            inds = [self._cell_specimen_index[i] for i in cell_specimen_ids]
+        except (KeyError, TypeError) as e:
             raise ValueError("Cell specimen not found (%s)" % str(e))
 
         return inds
 
-    def get_dff_traces(self, cell_specimen_ids=None):
+    def _cell_rows(self, cell_specimen_ids):
+        if cell_specimen_ids is None:
+            return None
+        return np.array(self.get_cell_specimen_indices(cell_specimen_ids), dtype=int)
+
+    def _lazy_traces(self, path, cell_specimen_ids):
+        return LazyTraceArray(self, path, self._cell_rows(cell_specimen_ids))
+
+    def get_dff_traces(self, cell_specimen_ids=None, lazy=False):
         ''' Returns an array of dF/F traces for all ROIs and
         the timestamps for each datapoint
 
@@ -430,6 +582,10 @@ class BrainObservatoryNwbDataSet(object):
             List of cell IDs to return data for. If this is None (default)
             then all are returned
 
+        lazy: bool (optional)
+            If True, return a LazyTraceArray that reads traces from the file
+            only when it is sliced.  Default False.
+
         Returns
         -------
         timestamps: 2D numpy array
@@ -438,20 +594,129 @@ class BrainObservatoryNwbDataSet(object):
         dF/F: 2D numpy array
             dF/F values for each cell
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
-            dff_ds = f['processing'][self.PIPELINE_DATASET][
-                'DfOverF']['imaging_plane_1']
+        with self._h5_file() as f:
+            timestamps = self._pipeline_object(
+                f, 'DfOverF/imaging_plane_1/timestamps').value
 
-            timestamps = dff_ds['timestamps'].value
+            if lazy:
+                return timestamps, self._lazy_traces(
+                    'DfOverF/imaging_plane_1/data', cell_specimen_ids)
+            dff_ds = self._pipeline_object(f, 'DfOverF/imaging_plane_1/data')
 
             if cell_specimen_ids is None:
-                cell_traces = dff_ds['data'].value
+                cell_traces = dff_ds.value
             else:
                 inds = self.get_cell_specimen_indices(cell_specimen_ids)
-                cell_traces = dff_ds['data'][inds, :]
+                cell_traces = _read_rows(dff_ds, inds)
 
         return timestamps, cell_traces
 
+    TRIAL_RESPONSE_TRACES = {
+        'dff': 'get_dff_traces',
+        'corrected': 'get_corrected_fluorescence_traces',
+        'fluorescence': 'get_fluorescence_traces',
+        'demixed': 'get_demixed_traces',
+        'neuropil': 'get_neuropil_traces'
+    }
+
+    def get_trial_responses(self, stimulus_table, pre=0, post=0, length=None,
+                            trace_type='dff', cell_specimen_ids=None,
+                            dtype=None):
+        ''' Returns a trials x cells x samples array of traces aligned to
+        the start of each trial.  Trial i covers frames
+
+            start[i] - pre, ..., start[i] + length + post - 1
+
+        Only the frames spanned by the trials are read from the file, and
+        the windows are gathered from them with one fancy index.  Samples
+        outside of the recording are NaN.
+
+        Parameters
+        ----------
+        stimulus_table: pd.DataFrame or array-like
+            Table with 'start' and 'end' frame columns, such as one returned by
+            get_stimulus_table, or an array of start frames, or an Nx2 array of
+            start and end frames.
+        pre: int
+            Number of frames before each start to include.  Default 0.
+        post: int
+            Number of frames after each trial to include.  Default 0.
+        length: int (optional)
+            Number of frames in each trial.  Defaults to the longest
+            end - start in stimulus_table.
+        trace_type: string
+            One of 'dff' (default), 'corrected', 'fluorescence', 'demixed' or
+            'neuropil'.
+        cell_specimen_ids: list or array (optional)
+            List of cell IDs to return responses for. If this is None (default)
+            then all are returned
+        dtype: numpy dtype (optional)
+            Type of the returned array, e.g. np.float32.  Defaults to the
+            type of the traces.
+
+        Returns
+        -------
+        responses: 3D numpy array
+            Traces of each cell (axis 1) during each trial (axis 0)
+        '''
+
+        if trace_type not in self.TRIAL_RESPONSE_TRACES:
+            raise KeyError("Unknown trace type %s.  Must be one of %s" %
+                           (trace_type, sorted(self.TRIAL_RESPONSE_TRACES)))
+
+        if isinstance(stimulus_table, pd.DataFrame):
+            starts = stimulus_table['start'].values
+            ends = stimulus_table['end'].values if 'end' in stimulus_table else None
+        else:
+            frames = np.asarray(stimulus_table)
+            if frames.ndim == 2:
+                starts, ends = frames[:, 0], frames[:, 1]
+            else:
+                starts, ends = frames, None
+
+        starts = np.asarray(starts).astype(int)
+
+        if length is None:
+            if ends is None:
+                raise ValueError("length is required without trial end frames")
+            length = int(np.max(np.asarray(ends).astype(int) - starts)) if len(starts) else 0
+
+        getter = getattr(self, self.TRIAL_RESPONSE_TRACES[trace_type])
+        _, traces = getter(cell_specimen_ids, lazy=True)
+        if dtype is not None:
+            traces = traces.astype(dtype)
+
+        n_samples = pre + length + post
+        if len(starts) == 0 or n_samples <= 0:
+            return np.empty((len(starts), traces.shape[0], max(n_samples, 0)),
+                            dtype=traces.dtype)
+
+        # frame of each sample of each trial, trials x samples
+        frames = starts[:, np.newaxis] + np.arange(-pre, length + post)
+        valid = (frames >= 0) & (frames < traces.shape[1])
+
+        # read the frames spanned by all trials once
+        first = max(int(frames.min()), 0)
+        last = min(int(frames.max()) + 1, traces.shape[1])
+        if first < last:
+            window = traces[:, first:last]
+        else:
+            window = np.empty((traces.shape[0], 0), dtype=traces.dtype)
+
+        if valid.all():
+            responses = window[:, frames - first]
+        else:
+            if not np.issubdtype(window.dtype, np.floating):
+                window = window.astype(float)
+
+            # pad with a NaN column for samples outside of the recording
+            window = np.hstack([ window, np.full((window.shape[0], 1), np.nan,
+                                                 dtype=window.dtype) ])
+            responses = window[:, np.where(valid, frames - first, window.shape[1] - 1)]
+
+        # cells x trials x samples -> trials x cells x samples
+        return np.ascontiguousarray(responses.transpose(1, 0, 2))
+
     def get_roi_ids(self):
         ''' Returns an array of IDs for all ROIs in the file
 
@@ -459,9 +724,9 @@ class BrainObservatoryNwbDataSet(object):
         -------
         ROI IDs: list
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
-            roi_id = f['processing'][self.PIPELINE_DATASET][
-                'ImageSegmentation']['roi_ids'].value
+        with self._h5_file() as f:
+            roi_id = self._pipeline_object(
+                f, 'ImageSegmentation/roi_ids').value
         return roi_id
 
     def get_cell_specimen_ids(self):
@@ -471,9 +736,9 @@ class BrainObservatoryNwbDataSet(object):
         -------
         cell specimen IDs: list
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
-            cell_id = f['processing'][self.PIPELINE_DATASET][
-                'ImageSegmentation']['cell_specimen_ids'].value
+        with self._h5_file() as f:
+            cell_id = self._pipeline_object(
+                f, 'ImageSegmentation/cell_specimen_ids').value
         return cell_id
 
     def get_session_type(self):
@@ -484,8 +749,8 @@ class BrainObservatoryNwbDataSet(object):
         -------
         session type: string
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
-            session_type = f['general/session_type'].value
+        with self._h5_file() as f:
+            session_type = self._h5_object(f, 'general/session_type').value
         return session_type.decode('utf-8')
 
     def get_max_projection(self):
@@ -496,9 +761,10 @@ class BrainObservatoryNwbDataSet(object):
         max projection: np.ndarray
         '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
-            max_projection = f['processing'][self.PIPELINE_DATASET]['ImageSegmentation'][
-                'imaging_plane_1']['reference_images']['maximum_intensity_projection_image']['data'].value
+        with self._h5_file() as f:
+            max_projection = self._pipeline_object(
+                f, 'ImageSegmentation/imaging_plane_1/reference_images/'
+                'maximum_intensity_projection_image/data').value
         return max_projection
 
     def list_stimuli(self):
@@ -509,8 +775,8 @@ class BrainObservatoryNwbDataSet(object):
         stimuli: list of strings
         '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
-            keys = list(f["stimulus/presentation/"].keys())
+        with self._h5_file() as f:
+            keys = list(self._h5_object(f, 'stimulus/presentation').keys())
         return [ k.replace('_stimulus', '') for k in keys ]
 
 
@@ -521,21 +787,23 @@ class BrainObservatoryNwbDataSet(object):
 
         epoch_table = self.get_stimulus_epoch_table()
 
-        stimulus_table_dict = {}
-        for stimulus in self.list_stimuli():
-            stimulus_table_dict[stimulus] = self.get_stimulus_table(stimulus)
-
         table_list = []
         for stimulus in self.list_stimuli():
-            curr_stimtable = stimulus_table_dict[stimulus]
+            curr_stimtable = self.get_stimulus_table(stimulus)
+            epochs = epoch_table[epoch_table['stimulus'] == stimulus]
 
-            for _, row in epoch_table[epoch_table['stimulus'] == stimulus].iterrows():
+            # the epochs of a stimulus are disjoint, so each presentation can
+            # only lie within the last epoch starting at or before it
+            epoch_starts = epochs['start'].values
+            epoch_ends = epochs['end'].values
+            epoch_ind = np.searchsorted(epoch_starts, curr_stimtable['start'].values, side='right') - 1
 
-                epoch_start_ind, epoch_end_ind = row['start'], row['end']
-                curr_subtable = curr_stimtable[(epoch_start_ind <= curr_stimtable['start']) &
-                                                (curr_stimtable['end'] <= epoch_end_ind)].copy()
-                curr_subtable['stimulus'] = stimulus
-                table_list.append(curr_subtable)
+            in_epoch = epoch_ind >= 0
+            in_epoch[in_epoch] = curr_stimtable['end'].values[in_epoch] <= epoch_ends[epoch_ind[in_epoch]]
+
+            curr_subtable = curr_stimtable[in_epoch].copy()
+            curr_subtable['stimulus'] = stimulus
+            table_list.append(curr_subtable)
 
         new_table = pd.concat(table_list, sort=True)
         new_table.reset_index(drop=True, inplace=True)
@@ -551,14 +819,24 @@ class BrainObservatoryNwbDataSet(object):
         For more information, see:
         http://help.brain-map.org/display/observatory/Documentation?preview=/10616846/10813485/VisualCoding_VisualStimuli.pdf 
 
+        Tables are cached until the NWB file is modified.  Each call returns
+        a copy that the caller is free to modify.
+
         '''
 
         if stimulus_name == 'master':
-            return self._get_master_stimulus_table()
+            return self._cached_table('master', self._get_master_stimulus_table)
 
-        with h5py.File(self.nwb_file, 'r') as nwb_file:
+        return self._cached_table(('stimulus', stimulus_name),
+                                  functools.partial(self._read_stimulus_table, stimulus_name))
 
-            stimulus_group = _find_stimulus_presentation_group(nwb_file, stimulus_name)
+    def _read_stimulus_table(self, stimulus_name):
+        with self._h5_file() as nwb_file:
+
+            stimulus_group = self._h5_object(
+                nwb_file, (_STIMULUS_PRESENTATION_PATH, stimulus_name),
+                functools.partial(_find_stimulus_presentation_group,
+                                  stimulus_name=stimulus_name))
 
             if stimulus_name in self.STIMULUS_TABLE_TYPES['abstract_feature_series']:
                 datasets = h5_utilities.load_datasets_by_relnames(
@@ -581,8 +859,7 @@ class BrainObservatoryNwbDataSet(object):
         raise IOError("Could not find a stimulus table named '%s'" % stimulus_name)
                 
 
-    @memoize
-    def get_stimulus_template(self, stimulus_name):
+    def get_stimulus_template(self, stimulus_name, lazy=False):
         ''' Return an array of the stimulus template for the specified stimulus.
 
         Parameters
@@ -590,14 +867,26 @@ class BrainObservatoryNwbDataSet(object):
         stimulus_name: string
             Must be one of the strings returned by list_stimuli().
 
+        lazy: boolean
+            If True, return a LazyStimulusTemplate that reads frames from the
+            file as they are indexed and keeps the most recently used frames.
+            Default False.
+
         Returns
         -------
-        stimulus table: pd.DataFrame
+        stimulus template: np.ndarray or LazyStimulusTemplate
+            frames x height x width
         '''
-        stim_name = stimulus_name + "_image_stack"
-        with h5py.File(self.nwb_file, 'r') as f:
-            image_stack = f['stimulus']['templates'][stim_name]['data'].value
-        return image_stack
+
+        template = self._template_cache.get(stimulus_name)
+        if template is None:
+            template = self._template_cache[stimulus_name] = \
+                LazyStimulusTemplate(self, stimulus_name)
+
+        if lazy:
+            return template
+
+        return template.read()
 
     def get_locally_sparse_noise_stimulus_template(self,
                                                    stimulus,
@@ -671,14 +960,56 @@ class BrainObservatoryNwbDataSet(object):
         np.ndarray: NxWxH array, where N is number of cells
         '''
 
-        roi_masks = self.get_roi_mask(cell_specimen_ids)
+        roi_masks = self.get_roi_mask_set(cell_specimen_ids)
 
         if len(roi_masks) == 0:
             raise IOError("no masks found for given cell specimen ids")
 
-        roi_arr = roi.create_roi_mask_array(roi_masks)
+        return roi_masks.to_dense()
+
+    def get_roi_mask_set(self, cell_specimen_ids=None):
+        ''' Returns the ROI masks of the requested cells in a sparse
+        representation.  All masks are read under a single file handle
+        into one reused image buffer.
+
+        Parameters
+        ----------
+        cell specimen IDs: list or array (optional)
+            List of cell IDs to return masks for. If this is None (default)
+            then all are returned
+
+        Returns
+        -------
+            RoiMaskSet object
+        '''
+
+        with self._h5_file() as f:
+            mask_loc = self._pipeline_object(
+                f, 'ImageSegmentation/imaging_plane_1')
+            roi_list = self._pipeline_object(
+                f, 'ImageSegmentation/imaging_plane_1/roi_list').value
+
+            if cell_specimen_ids is None:
+                inds = range(self.number_of_cells)
+            else:
+                inds = self.get_cell_specimen_indices(cell_specimen_ids)
 
-        return roi_arr
+            labels = [ roi_list[i] for i in inds ]
+            datasets = [ mask_loc[v]["img_mask"] for v in labels ]
+
+            def planes():
+                buf = None
+                for ds in datasets:
+                    if buf is None or buf.shape != ds.shape or buf.dtype != ds.dtype:
+                        buf = np.empty(ds.shape, dtype=ds.dtype)
+                    ds.read_direct(buf)
+                    yield buf
+
+            shape = datasets[0].shape if datasets else (0, 0)
+            return roi.RoiMaskSet.from_planes(planes(),
+                                              image_w=shape[1],
+                                              image_h=shape[0],
+                                              labels=labels)
 
     def get_roi_mask(self, cell_specimen_ids=None):
         ''' Returns an array of all the ROI masks
@@ -694,11 +1025,11 @@ class BrainObservatoryNwbDataSet(object):
             List of ROI_Mask objects
         '''
 
-        with h5py.File(self.nwb_file, 'r') as f:
-            mask_loc = f['processing'][self.PIPELINE_DATASET][
-                'ImageSegmentation']['imaging_plane_1']
-            roi_list = f['processing'][self.PIPELINE_DATASET][
-                'ImageSegmentation']['imaging_plane_1']['roi_list'].value
+        with self._h5_file() as f:
+            mask_loc = self._pipeline_object(
+                f, 'ImageSegmentation/imaging_plane_1')
+            roi_list = self._pipeline_object(
+                f, 'ImageSegmentation/imaging_plane_1/roi_list').value
 
             inds = None
             if cell_specimen_ids is None:
@@ -736,10 +1067,10 @@ class BrainObservatoryNwbDataSet(object):
 
         meta = {}
 
-        with h5py.File(self.nwb_file, 'r') as f:
+        with self._h5_file() as f:
             for memory_key, disk_key in BrainObservatoryNwbDataSet.FILE_METADATA_MAPPING.items():
                 try:
-                    v = f[disk_key].value
+                    v = self._h5_object(f, disk_key).value
 
                     # convert numpy strings to python strings
                     if v.dtype.type is np.string_:
@@ -803,9 +1134,9 @@ class BrainObservatoryNwbDataSet(object):
     def get_running_speed(self):
         ''' Returns the mouse running speed in cm/s
         '''
-        with h5py.File(self.nwb_file, 'r') as f:
-            dx_ds = f['processing'][self.PIPELINE_DATASET][
-                'BehavioralTimeSeries']['running_speed']
+        with self._h5_file() as f:
+            dx_ds = self._pipeline_object(
+                f, 'BehavioralTimeSeries/running_speed')
             dxcm = dx_ds['data'].value
             dxtime = dx_ds['timestamps'].value
 
@@ -841,9 +1172,9 @@ class BrainObservatoryNwbDataSet(object):
         else:
             location_key = "pupil_location"
         try:
-            with h5py.File(self.nwb_file, 'r') as f:
-                eye_tracking = f['processing'][self.PIPELINE_DATASET][
-                    'EyeTracking'][location_key]
+            with self._h5_file() as f:
+                eye_tracking = self._pipeline_object(
+                    f, 'EyeTracking/%s' % location_key)
                 pupil_location = eye_tracking['data'].value
                 pupil_times = eye_tracking['timestamps'].value
         except KeyError:
@@ -861,9 +1192,9 @@ class BrainObservatoryNwbDataSet(object):
             Areas is an (Nx1) array of pupil areas in pixels.
         '''
         try:
-            with h5py.File(self.nwb_file, 'r') as f:
-                pupil_tracking = f['processing'][self.PIPELINE_DATASET][
-                    'PupilTracking']['pupil_size']
+            with self._h5_file() as f:
+                pupil_tracking = self._pipeline_object(
+                    f, 'PupilTracking/pupil_size')
                 pupil_size = pupil_tracking['data'].value
                 pupil_times = pupil_tracking['timestamps'].value
         except KeyError:
@@ -876,8 +1207,9 @@ class BrainObservatoryNwbDataSet(object):
         '''
 
         motion_correction = None
-        with h5py.File(self.nwb_file, 'r') as f:
-            pipeline_ds = f['processing'][self.PIPELINE_DATASET]
+        with self._h5_file() as f:
+            pipeline_ds = self._h5_object(
+                f, 'processing/%s' % self.PIPELINE_DATASET)
 
             # pipeline 0.9 stores this in xy_translations
             # pipeline 1.0 stores this in xy_translation
@@ -903,12 +1235,19 @@ class BrainObservatoryNwbDataSet(object):
         return motion_correction
 
     def save_analysis_dataframes(self, *tables):
+        # HDF5 will not open the file for writing while it is open for reading
+        with self._handle_lock:
+            self._release_handles()
+
         store = pd.HDFStore(self.nwb_file, mode='a')
         for k, v in tables:
             store.put('analysis/%s' % (k), v)
         store.close()
 
     def save_analysis_arrays(self, *datasets):
+        with self._handle_lock:
+            self._release_handles()
+
         with h5py.File(self.nwb_file, 'a') as f:
             for k, v in datasets:
                 if k in f['analysis']:
@@ -922,6 +1261,23 @@ class BrainObservatoryNwbDataSet(object):
             self._stimulus_search = si.StimulusSearch(self)
         return self._stimulus_search
 
+    def get_frame_stimulus_table(self, frame_inds):
+        ''' Returns the stimulus presentation shown at each of many acquisition frames
+
+        Parameters
+        ----------
+        frame_inds: array-like of int
+            Acquisition frame indices
+
+        Returns
+        -------
+        pd.DataFrame
+            The columns of the master stimulus table, with one row per frame.
+            Rows are NaN where no stimulus was shown.
+        '''
+
+        return self.stimulus_search.search_many(frame_inds)
+
     def get_stimulus(self, frame_ind):
 
         search_result = self.stimulus_search.search(frame_ind)
@@ -934,7 +1290,8 @@ class BrainObservatoryNwbDataSet(object):
             curr_stimulus = search_result[2]['stimulus']
             if curr_stimulus in si.LOCALLY_SPARSE_NOISE_STIMULUS_TYPES + si.NATURAL_MOVIE_STIMULUS_TYPES + [si.NATURAL_SCENES]:
                 curr_frame = search_result[2]['frame']
-                return search_result, self.get_stimulus_template(curr_stimulus)[int(curr_frame), :, :]
+                template = self.get_stimulus_template(curr_stimulus, lazy=True)
+                return search_result, template[int(curr_frame)]
             elif curr_stimulus == si.STATIC_GRATINGS or curr_stimulus == si.DRIFTING_GRATINGS:
                 return search_result, None
 
@@ -984,6 +1341,348 @@ def _find_stimulus_presentation_group(nwb_file,
     return matches[0]
 
 
+def _read_rows(ds, inds, cols=None):
+    ''' Read rows of a dataset in the requested order.  h5py requires
+    increasing, unique indices for a selection, so the rows are read as one
+    hyperslab per run of consecutive indices into a single output array,
+    which is reordered only if inds are not already increasing and unique.
+
+    Parameters
+    ----------
+    ds : h5py.Dataset
+        Dataset to read from.  Rows are indexed along the first axis.
+    inds : array-like of int
+        Rows to read, in any order, possibly repeated.
+    cols : slice, optional
+        Columns to read from each row.  Defaults to all.
+
+    Returns
+    -------
+    np.ndarray
+        ds[inds] or ds[inds, cols]
+    '''
+
+    inds = np.asarray(inds, dtype=int).reshape(-1)
+    rows = np.unique(inds)
+
+    shape = ds.shape[1:]
+    if cols is not None:
+        shape = (len(range(*cols.indices(shape[0]))),) + shape[1:]
+
+    if len(rows) == 0:
+        return np.empty((0,) + shape, dtype=ds.dtype)
+
+    def key(start, end):
+        if cols is None:
+            return slice(start, end)
+        return (slice(start, end), cols)
+
+    # boundaries between runs of consecutive rows
+    breaks = np.where(np.diff(rows) != 1)[0] + 1
+    starts = rows[np.concatenate([[0], breaks])]
+    ends = rows[np.concatenate([breaks - 1, [len(rows) - 1]])] + 1
+
+    in_order = len(rows) == len(inds) and np.array_equal(rows, inds)
+
+    if len(starts) == 1:
+        data = ds[key(starts[0], ends[0])]
+    else:
+        data = np.empty((len(rows),) + shape, dtype=ds.dtype)
+        offset = 0
+        for start, end in zip(starts, ends):
+            data[offset:offset + end - start] = ds[key(start, end)]
+            offset += end - start
+
+    if in_order:
+        return data
+
+    return data[np.searchsorted(rows, inds)]
+
+
+class LazyTraceArray(object):
+    ''' A cells x frames trace matrix in an NWB file that is read only when
+    sliced.  Slicing follows numpy semantics for the first two axes:
+
+        traces[10]             # one cell, all frames
+        traces[:, 1000:2000]   # all cells, a window of frames
+        traces[[3, 1], ::2]    # some cells, every other frame
+
+    Only the rows and the bounding range of frames that a slice touches are
+    read from the file.  Rows are read with _read_rows.
+
+    Parameters
+    ----------
+    data_set: BrainObservatoryNwbDataSet
+        Data set that owns the file.  If it is open, its handles are used.
+    path: string
+        Path of the traces dataset relative to the pipeline group.
+    rows: array-like of int (optional)
+        Rows of the dataset exposed by this array.  Default all.
+    dtype: numpy dtype (optional)
+        Type of the arrays returned.  Defaults to the type stored.
+    '''
+
+    def __init__(self, data_set, path, rows=None, dtype=None):
+        self.data_set = data_set
+        self.path = path
+        self.rows = None if rows is None else np.asarray(rows, dtype=int)
+
+        with data_set._h5_file() as f:
+            ds = data_set._pipeline_object(f, path)
+            n_rows, self.n_frames = ds.shape
+            stored_dtype = ds.dtype
+
+        self.n_rows = n_rows if self.rows is None else len(self.rows)
+        self.dtype = np.dtype(stored_dtype if dtype is None else dtype)
+
+    @property
+    def shape(self):
+        return (self.n_rows, self.n_frames)
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def size(self):
+        return self.n_rows * self.n_frames
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.n_rows
+
+    def __repr__(self):
+        return "%s(%s, shape=%s, dtype=%s)" % (
+            self.__class__.__name__, self.path, self.shape, self.dtype)
+
+    def astype(self, dtype):
+        ''' Return a view of the same traces that converts slices to dtype,
+        e.g. traces.astype(np.float32) to halve the memory of each slice.
+        '''
+        view = copy.copy(self)
+        view.dtype = np.dtype(dtype)
+        return view
+
+    def __array__(self, dtype=None):
+        data = self[:, :]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError("too many indices for a cells x frames array")
+
+        row_key = key[0]
+        col_key = key[1] if len(key) > 1 else slice(None)
+
+        rows = np.arange(self.n_rows)[row_key]
+        scalar_row = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+        if self.rows is not None:
+            rows = self.rows[rows]
+
+        # read the bounding slice of frames, then select within it
+        col_index = None
+        if isinstance(col_key, slice):
+            start, stop, step = col_key.indices(self.n_frames)
+            if step > 0:
+                cols = slice(start, max(start, stop), step)
+            else:
+                col_index = np.arange(self.n_frames)[col_key]
+        else:
+            col_index = np.arange(self.n_frames)[col_key]
+
+        if col_index is not None:
+            if np.size(col_index) == 0:
+                cols = slice(0, 0)
+            else:
+                cols = slice(np.min(col_index), np.max(col_index) + 1)
+            col_index = col_index - cols.start
+
+        with self.data_set._h5_file() as f:
+            data = self._read(f, rows, cols)
+
+        if col_index is not None:
+            data = data[:, col_index]
+        if scalar_row:
+            data = data[0]
+
+        return data.astype(self.dtype, copy=False)
+
+    def _read(self, f, rows, cols):
+        ds = self.data_set._pipeline_object(f, self.path)
+        return _read_rows(ds, rows, cols)
+
+
+class CorrectedLazyTraceArray(LazyTraceArray):
+    ''' A LazyTraceArray of neuropil-corrected fluorescence traces, computed
+    from the slices of the fluorescence traces, neuropil traces and r that
+    it touches.
+    '''
+
+    def __init__(self, data_set, path, neuropil_path, r_path, rows=None,
+                 dtype=None):
+        super(CorrectedLazyTraceArray, self).__init__(data_set, path, rows, dtype)
+        self.neuropil_path = neuropil_path
+        self.r_path = r_path
+
+    def _read(self, f, rows, cols):
+        pipeline_object = functools.partial(self.data_set._pipeline_object, f)
+
+        traces = _read_rows(pipeline_object(self.path), rows, cols)
+        neuropil = _read_rows(pipeline_object(self.neuropil_path), rows, cols)
+        r = _read_rows(pipeline_object(self.r_path), rows)
+
+        return traces - neuropil * r[:, np.newaxis]
+
+
+class LazyStimulusTemplate(object):
+    ''' A frames x height x width stimulus template in an NWB file that is
+    read one frame range at a time as it is indexed:
+
+        template[10]             # one frame
+        template[100:200]        # a range of frames
+        template[[3, 1], :10]    # some frames, cropped
+
+    Frames read for small requests are kept in a least-recently-used cache
+    of at most cache_frames frames, so memory follows the frames in use
+    rather than the length of the movie.  Requests for more frames than
+    that are read directly without being cached, and contiguous ranges of
+    that size are read as a single hyperslab.
+
+    Parameters
+    ----------
+    data_set: BrainObservatoryNwbDataSet
+        Data set that owns the file.  If it is open, its handles are used.
+    stimulus_name: string
+        Must be one of the strings returned by data_set.list_stimuli().
+    cache_frames: int (optional)
+        Number of frames to keep.  Default 100.
+    '''
+
+    def __init__(self, data_set, stimulus_name, cache_frames=100):
+        self.data_set = data_set
+        self.path = 'stimulus/templates/%s_image_stack/data' % stimulus_name
+        self.cache_frames = cache_frames
+        self._frames = MemoCache(max_entries=cache_frames)
+
+        with data_set._h5_file() as f:
+            ds = data_set._h5_object(f, self.path)
+            self.shape = ds.shape
+            self.dtype = ds.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "%s(%s, shape=%s, dtype=%s)" % (
+            self.__class__.__name__, self.path, self.shape, self.dtype)
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def cache_info(self):
+        return self._frames.info()
+
+    def cache_clear(self):
+        self._frames.clear()
+
+    def read(self, start=0, stop=None):
+        ''' Read a contiguous range of frames directly from the file,
+        bypassing the frame cache.
+
+        Parameters
+        ----------
+        start: int (optional)
+            First frame.  Default 0.
+        stop: int (optional)
+            One past the last frame.  Default the end of the movie.
+
+        Returns
+        -------
+        np.ndarray
+            frames x height x width
+        '''
+
+        if stop is None:
+            stop = self.shape[0]
+
+        with self.data_set._h5_file() as f:
+            ds = self.data_set._h5_object(f, self.path)
+
+            if start == 0 and stop == self.shape[0]:
+                return ds[()]
+
+            return ds[start:stop]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if isinstance(key[0], slice):
+            start, stop, step = key[0].indices(self.shape[0])
+            if step == 1 and stop - start > self.cache_frames:
+                return self.read(start, stop)[(slice(None),) + key[1:]]
+
+        frames = np.arange(self.shape[0])[key[0]]
+        scalar_frame = np.ndim(frames) == 0
+        frames = np.atleast_1d(frames)
+
+        data = self._read_frames(frames)
+
+        if scalar_frame:
+            data = data[0]
+            return data[key[1:]] if len(key) > 1 else data
+
+        return data[(slice(None),) + key[1:]]
+
+    def _read_frames(self, frames):
+        unique_frames = np.unique(frames)
+
+        with self.data_set._h5_file() as f:
+            ds = self.data_set._h5_object(f, self.path)
+
+            if len(unique_frames) > self.cache_frames:
+                return _read_rows(ds, frames)
+
+            found = {}
+            for frame in unique_frames:
+                hit, value = self._frames.get(frame)
+                if hit:
+                    found[frame] = value
+
+            missing = [ frame for frame in unique_frames if frame not in found ]
+            if missing:
+                block = _read_rows(ds, missing)
+                for frame, value in zip(missing, block):
+                    # copy so that a cached frame does not hold the whole block
+                    found[frame] = value.copy()
+                    self._frames.put(frame, found[frame])
+
+        data = np.empty((len(frames),) + tuple(self.shape[1:]), dtype=self.dtype)
+        for i, frame in enumerate(frames):
+            data[i] = found[frame]
+
+        return data
+
+
 def align_running_speed(dxcm, dxtime, timestamps):
     ''' If running speed timestamps differ from fluorescence
     timestamps, adjust by inserting NaNs to running speed.
@@ -33,6 +33,7 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import codecs
 import numpy as np
 import simplejson as json
 import math
@@ -46,7 +47,7 @@ try:
 except ImportError:
     import urllib2 as urllib_request
 try:
-    from urllib.parse import urlparse
+    import urllib.parse as urlparse
 except ImportError:
     import urlparse
 
@@ -64,11 +65,13 @@ def read(file_name):
 
 def write(file_name, obj):
     """ Shortcut for writing JSON to a file.  This also takes care of serializing numpy and data types. """
+    # serialize once: obj may be a generator that can only be consumed once
+    json_string = write_string(obj)
+    if not isinstance(json_string, bytes):
+        json_string = json_string.encode('utf-8')  # Python 3
+
     with open(file_name, 'wb') as f:
-        try:
-            f.write(write_string(obj))   # Python 2.7
-        except TypeError:
-            f.write(bytes(write_string(obj), 'utf-8'))  # Python 3
+        f.write(json_string)
 
 
 def write_string(obj):
@@ -89,7 +92,7 @@ def read_url(url, method='POST'):
         raise Exception('Unknown request method: (%s)' % method)
 
 
-def read_url_get(url):
+def read_url_get(url, session=None):
     '''Transform a JSON contained in a file into an equivalent
     nested python dict.
 
@@ -97,6 +100,9 @@ def read_url_get(url):
     ----------
     url : string
         where to get the json.
+    session : requests.Session, optional
+        if provided, issue the request through this (pooled, keep-alive) 
+        session rather than opening a new connection.
 
     Returns
     -------
@@ -106,13 +112,18 @@ def read_url_get(url):
     Note: if the input is a bare array or literal, for example,
     the output will be of the corresponding type.
     '''
+    if session is not None:
+        response = session.get(url)
+        response.raise_for_status()
+        return json.loads(response.content.decode('utf-8'))
+
     response = urllib_request.urlopen(url)
     json_string = response.read().decode('utf-8')
 
     return json.loads(json_string)
 
 
-def read_url_post(url):
+def read_url_post(url, session=None):
     '''Transform a JSON contained in a file into an equivalent
     nested python dict.
 
@@ -120,6 +131,9 @@ def read_url_post(url):
     ----------
     url : string
         where to get the json.
+    session : requests.Session, optional
+        if provided, issue the request through this (pooled, keep-alive) 
+        session rather than opening a new connection.
 
     Returns
     -------
@@ -134,6 +148,13 @@ def read_url_post(url):
         (urlp.scheme, urlp.netloc, urlp.path, '', ''))
     data = json.dumps(dict(urlparse.parse_qsl(urlp.query)))
 
+    if session is not None:
+        response = session.post(main_url, 
+                                data=data, 
+                                headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+        return json.loads(response.content.decode('utf-8'))
+
     handler = urllib_request.HTTPHandler()
     opener = urllib_request.build_opener(handler)
 
@@ -154,6 +175,192 @@ def read_url_post(url):
     return json.loads(json_string)
 
 
+def read_url_get_rows(url, key='msg', session=None, envelope=None, 
+                      chunk_size=2 ** 16):
+    '''Incrementally decode the array stored under a key of a JSON object 
+    served at a url, yielding its elements as they arrive rather than 
+    parsing the whole document.
+
+    Parameters
+    ----------
+    url : string
+        where to get the json.
+    key : string, optional
+        top-level key of the array to stream (default 'msg').
+    session : requests.Session, optional
+        if provided, issue the request through this (pooled, keep-alive) 
+        session rather than opening a new connection.
+    envelope : dict, optional
+        if provided, filled with the other top-level fields of the 
+        document (e.g. success, total_rows) as they are decoded.
+    chunk_size : int, optional
+        number of bytes read from the response at a time.
+
+    Returns
+    -------
+    generator
+        Python version of each element of the array.
+    '''
+    if session is not None:
+        response = session.get(url, stream=True)
+        try:
+            response.raise_for_status()
+            for item in iter_json_array(
+                    response.iter_content(chunk_size), key, envelope):
+                yield item
+        finally:
+            response.close()
+    else:
+        response = urllib_request.urlopen(url)
+        try:
+            chunks = iter(lambda: response.read(chunk_size), b'')
+            for item in iter_json_array(chunks, key, envelope):
+                yield item
+        finally:
+            response.close()
+
+
+class _JsonChunks(object):
+    ''' A text buffer over an iterable of utf-8 encoded chunks. '''
+
+    _whitespace = ' \t\n\r'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = u''
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        ''' Append the next chunk to the buffer; False at end of input. '''
+        if self.eof:
+            return False
+
+        chunk = next(self.chunks, None)
+
+        if chunk is None:
+            self.eof = True
+            text = self.decoder.decode(b'', final=True)
+        elif isinstance(chunk, bytes):
+            text = self.decoder.decode(chunk)
+        else:
+            text = chunk
+
+        # drop what has been consumed so the buffer stays about one value long
+        self.text = self.text[self.pos:] + text
+        self.pos = 0
+
+        return True
+
+    def peek(self):
+        ''' Skip whitespace and return the next character ('' at end). '''
+        while True:
+            while self.pos < len(self.text) and \
+                    self.text[self.pos] in self._whitespace:
+                self.pos += 1
+
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+
+            if not self.read():
+                return ''
+
+    def expect(self, characters):
+        c = self.peek()
+
+        if c == '' or c not in characters:
+            raise ValueError("Expected one of %r at position %d of json "
+                             "stream, found %r" % (characters, self.pos, c))
+
+        self.pos += 1
+
+        return c
+
+    def value(self, decoder=json.JSONDecoder()):
+        ''' Decode the next complete value, reading more input as needed. '''
+        self.peek()
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+
+                # a number at the end of the buffer may continue in the 
+                # next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self.read()
+
+
+def iter_json_array(chunks, key='msg', envelope=None):
+    '''Incrementally decode the array stored under a key of a JSON object, 
+    yielding one element at a time. Only the element being decoded is held 
+    in memory, so large API responses can be consumed row by row.
+
+    Parameters
+    ----------
+    chunks : iterable of bytes or string
+        the json document, in pieces (e.g. requests' iter_content).
+    key : string, optional
+        top-level key of the array to stream (default 'msg').
+    envelope : dict, optional
+        if provided, filled with the other top-level fields of the 
+        document as they are decoded.
+
+    Returns
+    -------
+    generator
+        Python version of each element of the array.
+
+    Notes
+    -----
+    A ValueError is raised if the value under key is not an array (for 
+    example the error message of a failed API query) or if the key is 
+    missing.
+    '''
+    stream = _JsonChunks(chunks)
+    found = False
+
+    if envelope is None:
+        envelope = {}
+
+    stream.expect('{')
+
+    if stream.peek() == '}':
+        stream.pos += 1
+    else:
+        while True:
+            name = stream.value()
+            stream.expect(':')
+
+            if name == key and stream.peek() == '[':
+                found = True
+                stream.pos += 1
+
+                if stream.peek() == ']':
+                    stream.pos += 1
+                else:
+                    while True:
+                        yield stream.value()
+
+                        if stream.expect(',]') == ']':
+                            break
+            else:
+                envelope[name] = stream.value()
+
+            if stream.expect(',}') == '}':
+                break
+
+    if not found:
+        raise ValueError("json document has no %s array: %s" % 
+                         (key, envelope.get(key)))
+
+
 def json_handler(obj):
     """ Used by write_json convert a few non-standard types to things that the json package can handle. """
     if hasattr(obj, 'to_dict'):
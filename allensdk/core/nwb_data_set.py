@@ -33,6 +33,7 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import os
 import h5py
 import numpy as np
 
@@ -53,6 +54,7 @@ class NwbDataSet(object):
            NWB file name
         """
         self.file_name = file_name
+        self._cached_pipeline_version = (None, None)
         if spike_time_key is None:
             self.spike_time_key = NwbDataSet.SPIKE_TIMES
         else:
@@ -83,74 +85,119 @@ class NwbDataSet(object):
             the first element indicates the end of the test pulse and the
             second index is the end of valid response data.
         """
+        return self.get_sweeps([sweep_number])[0]
+
+    def get_sweeps(self, sweep_numbers, dtype=None, convert=True, metadata=False):
+        """ Retrieve many sweeps under a single open file handle.  Each sweep
+        is returned as by get_sweep().
+
+        Parameters
+        ----------
+        sweep_numbers: list of int
+
+        dtype: numpy dtype (optional)
+            Read the stimulus and response as this type, e.g. np.float32 to
+            halve their memory.  The conversion to SI units is then done in
+            place.  By default, the arrays are returned as get_sweep() does.
+
+        convert: bool
+            If False, return the stored stimulus and response without
+            converting them to SI units.  The factors that convert them are
+            returned as 'stimulus_conversion' and 'response_conversion', so
+            that callers can fold them into their own scaling.  Default True.
+
+        metadata: bool
+            If True, also return each sweep's get_sweep_metadata() dictionary
+            as 'metadata'.  Default False.
+
+        Returns
+        -------
+        list of dict
+            One dictionary per sweep, in the order of sweep_numbers.
+        """
         with h5py.File(self.file_name, 'r') as f:
+            version = self._pipeline_version(f)
 
-            swp = f['epochs']['Sweep_%d' % sweep_number]
-
-            # fetch data from file and convert to correct SI unit
-            # this operation depends on file version. early versions of
-            #   the file have incorrect conversion information embedded
-            #   in the nwb file and data was stored in the appropriate
-            #   SI unit. For those files, return uncorrected data.
-            #   For newer files (1.1 and later), apply conversion value.
-            major, minor = self.get_pipeline_version()
-            if (major == 1 and minor > 0) or major > 1:
-                # stimulus
-                stimulus_dataset = swp['stimulus']['timeseries']['data']
-                conversion = float(stimulus_dataset.attrs["conversion"])
-                stimulus = stimulus_dataset.value * conversion
-                # acquisition
-                response_dataset = swp['response']['timeseries']['data']
-                conversion = float(response_dataset.attrs["conversion"])
-                response = response_dataset.value * conversion
-            else:   # old file version
-                stimulus_dataset = swp['stimulus']['timeseries']['data']
-                stimulus = stimulus_dataset.value
-                response = swp['response']['timeseries']['data'].value
-
-            if 'unit' in stimulus_dataset.attrs:
-                unit = stimulus_dataset.attrs["unit"].decode('UTF-8')
-
-                unit_str = None
-                if unit.startswith('A'):
-                    unit_str = "Amps"
-                elif unit.startswith('V'):
-                    unit_str = "Volts"
-                assert unit_str is not None, Exception(
-                    "Stimulus time series unit not recognized")
-            else:
-                unit = None
-                unit_str = 'Unknown'
-
-            swp_idx_start = swp['stimulus']['idx_start'].value
-            swp_length = swp['stimulus']['count'].value
-
-            swp_idx_stop = swp_idx_start + swp_length - 1
-            sweep_index_range = (swp_idx_start, swp_idx_stop)
-
-            # if the sweep has an experiment, extract the experiment's index
-            # range
-            try:
-                exp = f['epochs']['Experiment_%d' % sweep_number]
-                exp_idx_start = exp['stimulus']['idx_start'].value
-                exp_length = exp['stimulus']['count'].value
-                exp_idx_stop = exp_idx_start + exp_length - 1
-                experiment_index_range = (exp_idx_start, exp_idx_stop)
-            except KeyError:
-                # this sweep has no experiment.  return the index range of the
-                # entire sweep.
-                experiment_index_range = sweep_index_range
-
-            assert sweep_index_range[0] == 0, Exception(
-                "index range of the full sweep does not start at 0.")
-
-            return {
-                'stimulus': stimulus,
-                'response': response,
-                'stimulus_unit' : unit_str,
-                'index_range': experiment_index_range,
-                'sampling_rate': 1.0 * swp['stimulus']['timeseries']['starting_time'].attrs['rate']
-            }
+            sweeps = []
+            for sweep_number in sweep_numbers:
+                sweep = self._read_sweep(f, sweep_number, version, dtype, convert)
+                if metadata:
+                    sweep['metadata'] = self._read_sweep_metadata(f, sweep_number)
+                sweeps.append(sweep)
+
+            return sweeps
+
+    def _read_sweep(self, f, sweep_number, version, dtype=None, convert=True):
+        swp = f['epochs']['Sweep_%d' % sweep_number]
+
+        # fetch data from file and convert to correct SI unit
+        # this operation depends on file version. early versions of
+        #   the file have incorrect conversion information embedded
+        #   in the nwb file and data was stored in the appropriate
+        #   SI unit. For those files, return uncorrected data.
+        #   For newer files (1.1 and later), apply conversion value.
+        major, minor = version
+        stimulus_dataset = swp['stimulus']['timeseries']['data']
+        response_dataset = swp['response']['timeseries']['data']
+        if (major == 1 and minor > 0) or major > 1:
+            stimulus_conversion = float(stimulus_dataset.attrs["conversion"])
+            response_conversion = float(response_dataset.attrs["conversion"])
+        else:   # old file version
+            stimulus_conversion = None
+            response_conversion = None
+
+        stimulus = _read_converted(stimulus_dataset, stimulus_conversion, dtype, convert)
+        response = _read_converted(response_dataset, response_conversion, dtype, convert)
+
+        if 'unit' in stimulus_dataset.attrs:
+            unit = stimulus_dataset.attrs["unit"].decode('UTF-8')
+
+            unit_str = None
+            if unit.startswith('A'):
+                unit_str = "Amps"
+            elif unit.startswith('V'):
+                unit_str = "Volts"
+            assert unit_str is not None, Exception(
+                "Stimulus time series unit not recognized")
+        else:
+            unit = None
+            unit_str = 'Unknown'
+
+        swp_idx_start = swp['stimulus']['idx_start'].value
+        swp_length = swp['stimulus']['count'].value
+
+        swp_idx_stop = swp_idx_start + swp_length - 1
+        sweep_index_range = (swp_idx_start, swp_idx_stop)
+
+        # if the sweep has an experiment, extract the experiment's index
+        # range
+        try:
+            exp = f['epochs']['Experiment_%d' % sweep_number]
+            exp_idx_start = exp['stimulus']['idx_start'].value
+            exp_length = exp['stimulus']['count'].value
+            exp_idx_stop = exp_idx_start + exp_length - 1
+            experiment_index_range = (exp_idx_start, exp_idx_stop)
+        except KeyError:
+            # this sweep has no experiment.  return the index range of the
+            # entire sweep.
+            experiment_index_range = sweep_index_range
+
+        assert sweep_index_range[0] == 0, Exception(
+            "index range of the full sweep does not start at 0.")
+
+        sweep = {
+            'stimulus': stimulus,
+            'response': response,
+            'stimulus_unit' : unit_str,
+            'index_range': experiment_index_range,
+            'sampling_rate': 1.0 * swp['stimulus']['timeseries']['starting_time'].attrs['rate']
+        }
+
+        if not convert:
+            sweep['stimulus_conversion'] = 1.0 if stimulus_conversion is None else stimulus_conversion
+            sweep['response_conversion'] = 1.0 if response_conversion is None else response_conversion
+
+        return sweep
 
     def set_sweep(self, sweep_number, stimulus, response):
         """ Overwrite the stimulus or response of an NWB file.
@@ -170,31 +217,7 @@ class NwbDataSet(object):
         """
 
         with h5py.File(self.file_name, 'r+') as f:
-            swp = f['epochs']['Sweep_%d' % sweep_number]
-
-            # this is the length of the entire sweep data, including test pulse and
-            # whatever might be in front of it
-            # TODO: remove deprecated 'idx_stop'
-            if 'idx_stop' in swp['stimulus']:
-                sweep_length = swp['stimulus']['idx_stop'].value + 1
-            else:
-                sweep_length = swp['stimulus']['count'].value
-
-            if stimulus is not None:
-                # if the data is shorter than the sweep, pad it with zeros
-                missing_data = sweep_length - len(stimulus)
-                if missing_data > 0:
-                    stimulus = np.append(stimulus, np.zeros(missing_data))
-
-                swp['stimulus']['timeseries']['data'][...] = stimulus
-
-            if response is not None:
-                # if the data is shorter than the sweep, pad it with zeros
-                missing_data = sweep_length - len(response)
-                if missing_data > 0:
-                    response = np.append(response, np.zeros(missing_data))
-
-                swp['response']['timeseries']['data'][...] = response
+            _write_sweep(f, sweep_number, stimulus, response)
 
     def get_pipeline_version(self):
         """ Returns the AI pipeline version number, stored in the 
@@ -206,17 +229,33 @@ class NwbDataSet(object):
             int tuple: (major, minor)
         """
         try:
+            if self._cached_pipeline_version[0] == os.path.getmtime(self.file_name):
+                return self._cached_pipeline_version[1]
+
             with h5py.File(self.file_name, 'r') as f:
-                if 'generated_by' in f["general"]:
-                    info = f["general/generated_by"]
-                    # generated_by stores array of keys and values
-                    # keys are even numbered, corresponding values are in
-                    #   odd indices
-                    for i in range(len(info)):
-                        val = info[i]
-                        if info[i] == 'version':
-                            version = info[i+1]
-                            break
+                return self._pipeline_version(f)
+        except:
+            return 0, 0
+
+    def _pipeline_version(self, f):
+        """ get_pipeline_version() from an open file.  The version is cached
+        until the file is modified.
+        """
+        mtime = os.path.getmtime(self.file_name) if os.path.exists(self.file_name) else None
+        if mtime is not None and self._cached_pipeline_version[0] == mtime:
+            return self._cached_pipeline_version[1]
+
+        try:
+            if 'generated_by' in f["general"]:
+                info = f["general/generated_by"]
+                # generated_by stores array of keys and values
+                # keys are even numbered, corresponding values are in
+                #   odd indices
+                for i in range(len(info)):
+                    val = info[i]
+                    if info[i] == 'version':
+                        version = info[i+1]
+                        break
             toks = version.split('.')
             if len(toks) >= 2:
                 major = int(toks[0])
@@ -224,6 +263,8 @@ class NwbDataSet(object):
         except:
             minor = 0
             major = 0
+
+        self._cached_pipeline_version = (mtime, (major, minor))
         return major, minor
 
     def get_spike_times(self, sweep_number, key=None):
@@ -273,30 +314,14 @@ class NwbDataSet(object):
             key = self.spike_time_key
 
         with h5py.File(self.file_name, 'r+') as f:
-            # make sure expected directory structure is in place
-            if "analysis" not in f.keys():
-                f.create_group("analysis")
-
-            analysis_dir = f["analysis"]
-            if NwbDataSet.SPIKE_TIMES not in analysis_dir.keys():
-                #   analysis_dir.create_group(NwbDataSet.SPIKE_TIMES)
-                g = analysis_dir.create_group(NwbDataSet.SPIKE_TIMES)
-                # mixup in specification for validator resulted everything
-                #   in 'analysis' requiring a custom label, even though
-                #   it's already known to be custom. don't argue, just
-                #   support the metadata redundancy
-                g.attrs["neurodata_type"] = "Custom"
-
-            spike_dir = analysis_dir[NwbDataSet.SPIKE_TIMES]
-
-            # see if desired dataset already exists
-            sweep_name = "Sweep_%d" % sweep_number
-            if sweep_name in spike_dir.keys():
-                # rewriting data -- delete old dataset
-                del spike_dir[sweep_name]
+            _write_spike_times(f, sweep_number, spike_times)
 
-            spike_dir.create_dataset(
-                sweep_name, data=spike_times, dtype='f8', maxshape=(None,))
+    def writer(self, **kwargs):
+        """ Return an NwbSweepWriter that writes sweeps and spike times to
+        this file under a single open handle.  Keyword arguments are passed
+        to NwbSweepWriter.
+        """
+        return NwbSweepWriter(self, **kwargs)
 
     def get_sweep_numbers(self):
         """ Get all of the sweep numbers in the file, including test sweeps. """
@@ -368,24 +393,255 @@ class NwbDataSet(object):
             fields are ones encoded in the original AIBS in vitro .nwb files.
         """
         with h5py.File(self.file_name, 'r') as f:
+            return self._read_sweep_metadata(f, sweep_number)
+
+    def _read_sweep_metadata(self, f, sweep_number):
+        sweep_metadata = {}
+
+        # the sweep level metadata is stored in
+        # stimulus/presentation/Sweep_XX in the .nwb file
 
+        # indicates which metadata fields to return
+        metadata_fields = ['aibs_stimulus_amplitude_pa', 'aibs_stimulus_name',
+                           'gain', 'initial_access_resistance', 'seal']
+        try:
+            stim_details = f['stimulus']['presentation'][
+                'Sweep_%d' % sweep_number]
+            for field in metadata_fields:
+                # check if sweep contains the specific metadata field
+                if field in stim_details.keys():
+                    sweep_metadata[field] = stim_details[field].value
+
+        except KeyError:
             sweep_metadata = {}
 
-            # the sweep level metadata is stored in
-            # stimulus/presentation/Sweep_XX in the .nwb file
+        return sweep_metadata
+
+
+class NwbSweepWriter(object):
+    """ Writes sweep responses and spike times to an NWB file under one
+    open handle.  set_sweep() and set_spike_times() take the same arguments
+    as the NwbDataSet methods, but only buffer the data; it is written in
+    order of sweep number when flush() is called, when the buffered arrays
+    exceed max_buffered_bytes, or when the writer is closed:
+
+        with NwbDataSet(file_name).writer() as output:
+            for sweep_number in sweep_numbers:
+                output.set_sweep(sweep_number, None, response)
+                output.set_spike_times(sweep_number, spike_times)
+
+    Sweeps read with get_sweep() or get_sweeps() are flushed first, so that
+    reads see the data written.  The stimulus and response datasets already
+    exist in the file and keep their layout; they are overwritten in place.
+
+    Parameters
+    ----------
+    data_set: NwbDataSet
+        Data set whose file is written.
+    max_buffered_bytes: int (optional)
+        Flush once the buffered arrays exceed this size.  Default 256MB.
+    compression: string (optional)
+        h5py compression filter for the spike time datasets created, e.g.
+        'gzip'.  Default None.
+    """
+
+    def __init__(self, data_set, max_buffered_bytes=2**28, compression=None):
+        self.data_set = data_set
+        self.max_buffered_bytes = max_buffered_bytes
+        self.compression = compression
+
+        self._file = None
+        self._sweeps = {}
+        self._spike_times = {}
+        self._buffered_bytes = 0
 
-            # indicates which metadata fields to return
-            metadata_fields = ['aibs_stimulus_amplitude_pa', 'aibs_stimulus_name',
-                               'gain', 'initial_access_resistance', 'seal']
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self._file is None:
+            self._file = h5py.File(self.data_set.file_name, 'r+')
+        return self
+
+    def close(self):
+        if self._file is not None:
             try:
-                stim_details = f['stimulus']['presentation'][
-                    'Sweep_%d' % sweep_number]
-                for field in metadata_fields:
-                    # check if sweep contains the specific metadata field
-                    if field in stim_details.keys():
-                        sweep_metadata[field] = stim_details[field].value
+                self.flush()
+            finally:
+                self._file.close()
+                self._file = None
+
+    def set_sweep(self, sweep_number, stimulus, response):
+        """ Buffer a sweep's stimulus and/or response.  See NwbDataSet.set_sweep().
+        """
+        previous = self._sweeps.get(sweep_number, (None, None))
+        if stimulus is None:
+            stimulus = previous[0]
+        if response is None:
+            response = previous[1]
+
+        self._sweeps[sweep_number] = (stimulus, response)
+        self._buffered(_nbytes(stimulus, response) - _nbytes(*previous))
+
+    def set_spike_times(self, sweep_number, spike_times, key=None):
+        """ Buffer a sweep's spike times.  See NwbDataSet.set_spike_times().
+        """
+        spike_times = np.asarray(spike_times, dtype='f8')
+        previous = self._spike_times.get(sweep_number, None)
+
+        self._spike_times[sweep_number] = spike_times
+        self._buffered(spike_times.nbytes - _nbytes(previous))
+
+    def flush(self, sweep_numbers=None):
+        """ Write buffered sweeps and spike times to the file.
+
+        Parameters
+        ----------
+        sweep_numbers: list of int (optional)
+            Sweeps to write.  Default all buffered sweeps.
+        """
+        if sweep_numbers is None:
+            sweep_numbers = set(self._sweeps) | set(self._spike_times)
+
+        sweep_numbers = [ n for n in sorted(set(sweep_numbers))
+                          if n in self._sweeps or n in self._spike_times ]
+        if not sweep_numbers:
+            return
+
+        self.open()
+
+        for sweep_number in sweep_numbers:
+            if sweep_number in self._sweeps:
+                stimulus, response = self._sweeps.pop(sweep_number)
+                self._buffered_bytes -= _nbytes(stimulus, response)
+                _write_sweep(self._file, sweep_number, stimulus, response)
+
+        for sweep_number in sweep_numbers:
+            if sweep_number in self._spike_times:
+                spike_times = self._spike_times.pop(sweep_number)
+                self._buffered_bytes -= spike_times.nbytes
+                _write_spike_times(self._file, sweep_number, spike_times,
+                                   compression=self.compression)
+
+        self._file.flush()
+
+    def get_sweep(self, sweep_number):
+        """ See NwbDataSet.get_sweep().
+        """
+        return self.get_sweeps([sweep_number])[0]
+
+    def get_sweeps(self, sweep_numbers, dtype=None, convert=True, metadata=False):
+        """ See NwbDataSet.get_sweeps().
+        """
+        self.open()
+        self.flush(sweep_numbers)
+
+        data_set = self.data_set
+        version = data_set._pipeline_version(self._file)
+
+        sweeps = []
+        for sweep_number in sweep_numbers:
+            sweep = data_set._read_sweep(self._file, sweep_number, version,
+                                         dtype, convert)
+            if metadata:
+                sweep['metadata'] = data_set._read_sweep_metadata(self._file,
+                                                                  sweep_number)
+            sweeps.append(sweep)
+
+        return sweeps
+
+    def _buffered(self, nbytes):
+        self._buffered_bytes += nbytes
+        if self._buffered_bytes > self.max_buffered_bytes:
+            self.flush()
+
+
+def _nbytes(*arrays):
+    """ Total size of the arrays that are not None.
+    """
+    return sum(np.asarray(a).nbytes for a in arrays if a is not None)
+
+
+def _write_sweep(f, sweep_number, stimulus, response):
+    """ Overwrite the stimulus and/or response of a sweep in an open file.
+    See NwbDataSet.set_sweep().
+    """
+    swp = f['epochs']['Sweep_%d' % sweep_number]
+
+    # this is the length of the entire sweep data, including test pulse and
+    # whatever might be in front of it
+    # TODO: remove deprecated 'idx_stop'
+    if 'idx_stop' in swp['stimulus']:
+        sweep_length = swp['stimulus']['idx_stop'].value + 1
+    else:
+        sweep_length = swp['stimulus']['count'].value
+
+    if stimulus is not None:
+        # if the data is shorter than the sweep, pad it with zeros
+        missing_data = sweep_length - len(stimulus)
+        if missing_data > 0:
+            stimulus = np.append(stimulus, np.zeros(missing_data))
+
+        swp['stimulus']['timeseries']['data'][...] = stimulus
+
+    if response is not None:
+        # if the data is shorter than the sweep, pad it with zeros
+        missing_data = sweep_length - len(response)
+        if missing_data > 0:
+            response = np.append(response, np.zeros(missing_data))
+
+        swp['response']['timeseries']['data'][...] = response
+
+
+def _write_spike_times(f, sweep_number, spike_times, compression=None):
+    """ Set or overwrite the spike times of a sweep in an open file.  See
+    NwbDataSet.set_spike_times().
+    """
+    # make sure expected directory structure is in place
+    if "analysis" not in f.keys():
+        f.create_group("analysis")
+
+    analysis_dir = f["analysis"]
+    if NwbDataSet.SPIKE_TIMES not in analysis_dir.keys():
+        #   analysis_dir.create_group(NwbDataSet.SPIKE_TIMES)
+        g = analysis_dir.create_group(NwbDataSet.SPIKE_TIMES)
+        # mixup in specification for validator resulted everything
+        #   in 'analysis' requiring a custom label, even though
+        #   it's already known to be custom. don't argue, just
+        #   support the metadata redundancy
+        g.attrs["neurodata_type"] = "Custom"
+
+    spike_dir = analysis_dir[NwbDataSet.SPIKE_TIMES]
+
+    # see if desired dataset already exists
+    sweep_name = "Sweep_%d" % sweep_number
+    if sweep_name in spike_dir.keys():
+        # rewriting data -- delete old dataset
+        del spike_dir[sweep_name]
+
+    # one chunk holds the whole spike train
+    spike_times = np.asarray(spike_times, dtype='f8')
+    spike_dir.create_dataset(
+        sweep_name, data=spike_times, dtype='f8', maxshape=(None,),
+        chunks=(max(len(spike_times), 1),), compression=compression)
+
+
+def _read_converted(dataset, conversion, dtype=None, convert=True):
+    """ Read a time series dataset, optionally as dtype, and multiply it by
+    its conversion factor.  A conversion of None leaves the data as stored.
+    Without a dtype, the result has the type of dataset.value * conversion.
+    """
+    convert = convert and conversion is not None
 
-            except KeyError:
-                sweep_metadata = {}
+    if dtype is None:
+        data = dataset.value
+        return data * conversion if convert else data
 
-            return sweep_metadata
+    with dataset.astype(dtype):
+        data = dataset[()]
+    if convert:
+        data *= conversion
+    return data
@@ -1071,8 +1071,7 @@ def extractor_for_nwb_sweeps(dataset, sweep_numbers,
     start = []
     end = []
 
-    for sweep_number in sweep_numbers:
-        data = dataset.get_sweep(sweep_number)
+    for data in dataset.get_sweeps(sweep_numbers):
         v = data['response'] * 1e3 # mV
         i = data['stimulus'] * 1e12 # pA
         hz = data['sampling_rate']
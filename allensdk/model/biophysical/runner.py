@@ -115,28 +115,38 @@ def run_sync(description, sweeps=None):
 
     output_path = manifest.get_path("output_path")
 
-    # run sweeps
-    for sweep in sweeps:
-        _runner_log.info("Loading sweep: %d" % (sweep))
-        utils.setup_iclamp(stimulus_path, sweep=sweep)
-
-        _runner_log.info("Simulating sweep: %d" % (sweep))
-        vec = utils.record_values()
-        tstart = time.time()
-        h.finitialize()
-        h.run()
-        tstop = time.time()
-        _runner_log.info("Time: %f" % (tstop - tstart))
-
-        # write to an NWB File
-        _runner_log.info("Writing sweep: %d" % (sweep))
-        recorded_data = utils.get_recorded_data(vec)
-
-        if _lock is not None:
-            _lock.acquire()
-        save_nwb(output_path, recorded_data["v"], sweep, sweeps_by_type)
-        if _lock is not None:
-            _lock.release()
+    # a single process keeps the output open and writes all of its sweeps
+    #   at once; processes in a pool take turns writing one sweep each
+    output = None
+    if _lock is None:
+        output = NwbDataSet(output_path).writer().open()
+
+    try:
+        # run sweeps
+        for sweep in sweeps:
+            _runner_log.info("Loading sweep: %d" % (sweep))
+            utils.setup_iclamp(stimulus_path, sweep=sweep)
+
+            _runner_log.info("Simulating sweep: %d" % (sweep))
+            vec = utils.record_values()
+            tstart = time.time()
+            h.finitialize()
+            h.run()
+            tstop = time.time()
+            _runner_log.info("Time: %f" % (tstop - tstart))
+
+            # write to an NWB File
+            _runner_log.info("Writing sweep: %d" % (sweep))
+            recorded_data = utils.get_recorded_data(vec)
+
+            if _lock is not None:
+                _lock.acquire()
+            save_nwb(output_path, recorded_data["v"], sweep, sweeps_by_type, output)
+            if _lock is not None:
+                _lock.release()
+    finally:
+        if output is not None:
+            output.close()
 
 
 def prepare_nwb_output(nwb_stimulus_path,
@@ -158,11 +168,12 @@ def prepare_nwb_output(nwb_stimulus_path,
     copy(nwb_stimulus_path, nwb_result_path)
     data_set = NwbDataSet(nwb_result_path)
     data_set.fill_sweep_responses(0.0, extend_experiment=True)
-    for sweep in data_set.get_sweep_numbers():
-        data_set.set_spike_times(sweep, [])
+    with data_set.writer() as output:
+        for sweep in data_set.get_sweep_numbers():
+            output.set_spike_times(sweep, [])
 
 
-def save_nwb(output_path, v, sweep, sweeps_by_type):
+def save_nwb(output_path, v, sweep, sweeps_by_type, output=None):
     '''Save a single voltage output result into an existing sweep in a NWB file.
     This is intended to overwrite a recorded trace with a simulated voltage.
 
@@ -174,8 +185,12 @@ def save_nwb(output_path, v, sweep, sweeps_by_type):
         voltage
     sweep : integer
         which entry to overwrite in the file.
+    output : NwbSweepWriter, optional
+        Open writer for output_path.  If given, the sweep is buffered in it
+        rather than written by reopening the file.
     '''
-    output = NwbDataSet(output_path)
+    if output is None:
+        output = NwbDataSet(output_path)
     output.set_sweep(sweep, None, v)
 
     sweep_by_type = {t: [sweep]
@@ -89,13 +89,14 @@ def load_sweep(file_name, sweep_number):
     return data
 
 
-def write_sweep_response(file_name, sweep_number, response, spike_times):
-    ''' Overwrite the response in a file. '''
+def write_sweep_response(file_name, sweep_number, response, spike_times, writer=None):
+    ''' Overwrite the response in a file.  If an open NwbSweepWriter for the
+    file is given, the response is buffered in it instead. '''
 
     logging.debug("writing sweep")
 
     write_start_time = time.time()
-    ephds = NwbDataSet(file_name)
+    ephds = NwbDataSet(file_name) if writer is None else writer
 
     ephds.set_sweep(sweep_number, stimulus=None, response=response)
     ephds.set_spike_times(sweep_number, spike_times)
@@ -103,7 +104,7 @@ def write_sweep_response(file_name, sweep_number, response, spike_times):
     logging.debug("write time %f" % (time.time() - write_start_time))
 
 
-def simulate_sweep_from_file(neuron, sweep_number, input_file_name, output_file_name, spike_cut_value):
+def simulate_sweep_from_file(neuron, sweep_number, input_file_name, output_file_name, spike_cut_value, writer=None):
     ''' Load a sweep stimulus, simulate the response, and write it out. '''
 
     sweep_start_time = time.time()
@@ -119,7 +120,7 @@ def simulate_sweep_from_file(neuron, sweep_number, input_file_name, output_file_
 
     sim_data = simulate_sweep(neuron, data['stimulus'], spike_cut_value)
 
-    write_sweep_response(output_file_name, sweep_number, sim_data['voltage'], sim_data['interpolated_spike_times'])
+    write_sweep_response(output_file_name, sweep_number, sim_data['voltage'], sim_data['interpolated_spike_times'], writer)
 
     logging.debug("total sweep time %f" % ( time.time() - sweep_start_time ))
 
@@ -127,8 +128,9 @@ def simulate_neuron(neuron, sweep_numbers, input_file_name, output_file_name, sp
 
     start_time = time.time()
 
-    for sweep_number in sweep_numbers:
-        simulate_sweep_from_file(neuron, sweep_number, input_file_name, output_file_name, spike_cut_value)
+    with NwbDataSet(output_file_name).writer() as writer:
+        for sweep_number in sweep_numbers:
+            simulate_sweep_from_file(neuron, sweep_number, input_file_name, output_file_name, spike_cut_value, writer)
 
     logging.debug("total elapsed time %f" % (time.time() - start_time))
 
@@ -0,0 +1,400 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' A local stand-in for the api.brain-map.org RMA service, for exercising 
+Api, RmaApi, RmaPager and the Cache strategies offline.
+
+Responses are replayed from a Recording, which maps request paths (with 
+their query strings) to canned responses and may also route patterns of 
+requests to handlers that build responses on the fly. Recordings can be 
+captured from the live service with a RecordingSession and saved to json.
+
+Example
+-------
+    recording = Recording()
+    recording.add_route(r'model::ApiCamCellMetric', rma_rows(cells))
+    recording.add('/api/v2/well_known_file_download/1', nwb_bytes)
+
+    with replay_server(recording, latency=0.05, bandwidth=2 ** 20) as url:
+        boc = BrainObservatoryCache(manifest_file=path, base_uri=url)
+'''
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlsplit, unquote
+from contextlib import contextmanager
+import base64
+import random
+import re
+import threading
+import time
+
+import simplejson as json
+
+import allensdk.core.json_utilities as ju
+from allensdk.api.api import HttpSession
+
+
+class ThreadedServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class QuietHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve(handler, path='/'):
+    ''' Run a threaded http server on a free local port, yielding its url 
+    (with path appended) and shutting it down afterwards.
+    '''
+    server = ThreadedServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        yield 'http://127.0.0.1:{0}{1}'.format(server.server_address[1], path)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def request_key(url):
+    ''' The part of a url that identifies a recorded response: its 
+    unquoted path and query string, without scheme or host.
+    '''
+    parts = urlsplit(url)
+    key = unquote(parts.path)
+
+    if parts.query:
+        key += '?' + unquote(parts.query)
+
+    return key
+
+
+def rma_options(key):
+    ''' Read the paging options (num_rows, start_row, count) from the 
+    rma::options clause of a request key.
+    '''
+    options = {'num_rows': 50, 'start_row': 0, 'count': True}
+
+    num_rows = re.search(r"\[num_rows\$eq'?(\w+)'?\]", key)
+    if num_rows is not None:
+        options['num_rows'] = 'all' if num_rows.group(1) == 'all' \
+            else int(num_rows.group(1))
+
+    start_row = re.search(r'\[start_row\$eq(\d+)\]', key)
+    if start_row is not None:
+        options['start_row'] = int(start_row.group(1))
+
+    count = re.search(r'\[count\$eq(\w+)\]', key)
+    if count is not None:
+        options['count'] = count.group(1) == 'true'
+
+    return options
+
+
+def rma_rows(rows):
+    ''' A route handler serving a fixed set of model rows as RMA would, 
+    honoring the num_rows, start_row and count options. Encoded pages are 
+    kept, so that repeated requests cost the server nothing.
+    '''
+    pages = {}
+
+    def handler(key):
+        body = pages.get(key)
+
+        if body is None:
+            options = rma_options(key)
+            start = options['start_row']
+
+            if options['num_rows'] == 'all':
+                page = rows[start:]
+            else:
+                page = rows[start:start + options['num_rows']]
+
+            envelope = {'success': True,
+                        'id': 0,
+                        'start_row': start,
+                        'num_rows': len(page),
+                        'msg': page}
+
+            if options['count']:
+                envelope['total_rows'] = len(rows)
+
+            body = json.dumps(envelope).encode('utf-8')
+            pages[key] = body
+
+        return 200, 'application/json', body
+
+    return handler
+
+
+class Recording(object):
+    ''' Canned responses keyed by request path and query string. '''
+
+    def __init__(self, responses=None):
+        self.responses = {} if responses is None else responses
+        self.routes = []
+
+    def add(self, url, body, status=200, content_type=None):
+        ''' Record a response. Dicts and lists are encoded as json. '''
+        if not isinstance(body, bytes):
+            if isinstance(body, (dict, list)):
+                body = ju.write_string(body)
+                content_type = content_type or 'application/json'
+            body = body.encode('utf-8')
+
+        self.responses[request_key(url)] = \
+            (status, content_type or 'application/octet-stream', body)
+
+    def add_route(self, pattern, handler):
+        ''' Respond to requests whose key matches a regular expression by 
+        calling handler(key), which returns (status, content type, body). 
+        Recorded responses take precedence over routes.
+        '''
+        self.routes.append((re.compile(pattern), handler))
+
+    def lookup(self, key):
+        response = self.responses.get(key)
+
+        if response is not None:
+            return response
+
+        for pattern, handler in self.routes:
+            if pattern.search(key):
+                return handler(key)
+
+        return (404, 'application/json', 
+                ju.write_string({'success': False, 
+                                 'msg': 'No recording for {0}'.format(key)}).encode('utf-8'))
+
+    def save(self, path):
+        ju.write(path, 
+                 {key: {'status': status,
+                        'content_type': content_type,
+                        'body': base64.b64encode(body).decode('ascii')}
+                  for key, (status, content_type, body) in self.responses.items()})
+
+    @classmethod
+    def load(cls, path):
+        return cls({key: (r['status'], 
+                          r['content_type'], 
+                          base64.b64decode(r['body'].encode('ascii')))
+                    for key, r in ju.read(path).items()})
+
+
+class RecordingSession(HttpSession):
+    ''' An HttpSession that records every response it receives, so that a 
+    session against the live service can later be replayed offline:
+
+        api.session = RecordingSession(recording)
+        ...
+        recording.save('responses.json')
+    '''
+
+    def __init__(self, recording, **kwargs):
+        super(RecordingSession, self).__init__(**kwargs)
+        self.recording = recording
+
+    def request(self, method, url, **kwargs):
+        response = super(RecordingSession, self).request(method, url, **kwargs)
+
+        # reading content here still leaves iter_content usable by the caller
+        self.recording.add(response.url,
+                           response.content,
+                           status=response.status_code,
+                           content_type=response.headers.get('Content-Type'))
+
+        return response
+
+
+def replay_server(recording, latency=0.0, bandwidth=None, errors=None, 
+                  chunk_size=2 ** 14):
+    ''' Serve a recording from a local server. Yields the base url, to be 
+    passed as base_uri to an Api or cache.
+
+    Parameters
+    ----------
+    recording : Recording
+        responses to replay.
+    latency : float, optional
+        seconds to wait before each response.
+    bandwidth : float, optional
+        bytes per second at which response bodies are sent.
+    errors : dict, callable or float, optional
+        error injection. A dict maps (0-based) request indices, a callable 
+        maps (request index, request key) to None for a normal response, an 
+        http status code to fail with, or 'truncate' to cut the body off 
+        halfway and drop the connection. A float is the probability 
+        (from a seeded generator) that a request fails with a 503.
+    chunk_size : int, optional
+        bytes written at a time when throttling.
+
+    Notes
+    -----
+    Byte range requests are honored, so interrupted downloads can resume. 
+    The keys of the requests received are listed, in order, in the 
+    `requests` attribute of the yielded url.
+    '''
+    if errors is None:
+        inject = lambda index, key: None
+    elif isinstance(errors, dict):
+        inject = lambda index, key: errors.get(index)
+    elif callable(errors):
+        inject = errors
+    else:
+        rng = random.Random(0)
+        inject = lambda index, key: 503 if rng.random() < errors else None
+
+    log = []
+    log_lock = threading.Lock()
+
+    class ReplayHandler(QuietHandler):
+        def do_GET(self):
+            key = request_key(self.path)
+
+            with log_lock:
+                index = len(log)
+                log.append(key)
+
+            time.sleep(latency)
+
+            error = inject(index, key)
+            if isinstance(error, int):
+                self.respond(error, 'application/json', ju.write_string(
+                    {'success': False, 'msg': 'Injected error'}).encode('utf-8'))
+                return
+
+            status, content_type, body = recording.lookup(key)
+
+            self.respond(status, content_type, body, 
+                         truncate=(error == 'truncate'))
+
+        def respond(self, status, content_type, body, truncate=False):
+            start = 0
+            range_header = self.headers.get('Range')
+            if status == 200 and range_header is not None:
+                start = int(range_header.split('=')[1].split('-')[0])
+
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            content = body[start:]
+
+            if start > 0:
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                    start, len(body) - 1, len(body)))
+            else:
+                self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+
+            if truncate:
+                content = content[:len(content) // 2]
+
+            if bandwidth is None:
+                self.wfile.write(content)
+            else:
+                for ii in range(0, len(content), chunk_size):
+                    chunk = content[ii:ii + chunk_size]
+                    self.wfile.write(chunk)
+                    time.sleep(len(chunk) / float(bandwidth))
+
+            if truncate:
+                self.wfile.flush()
+                self.close_connection = True
+
+    return _logged(serve(ReplayHandler), log)
+
+
+@contextmanager
+def _logged(server, log):
+    with server as url:
+        yield ReplayUrl(url.rstrip('/'), log)
+
+
+class ReplayUrl(str):
+    ''' The base url of a replay server, also carrying the keys of the 
+    requests it has received (in order) as `requests`.
+    '''
+
+    def __new__(cls, url, requests):
+        obj = super(ReplayUrl, cls).__new__(cls, url)
+        obj.requests = requests
+        return obj
+
+
+def time_cold_cache(make_cache, calls, repeats=3):
+    ''' Time a sequence of cache calls, each time starting from a newly 
+    constructed cache with nothing on disk.
+
+    Parameters
+    ----------
+    make_cache : function
+        returns a new cache whose manifest lives in an empty directory.
+    calls : list of (string, function)
+        named functions, called in order with the cache as the argument.
+    repeats : int, optional
+        number of cold runs; the fastest time of each call is kept.
+
+    Returns
+    -------
+    dict
+        call name -> seconds, with the sum of all calls as 'total'.
+    '''
+    times = {}
+
+    for _ in range(repeats):
+        cache = make_cache()
+
+        for name, call in calls:
+            start = time.time()
+            call(cache)
+            elapsed = time.time() - start
+
+            times[name] = min(times.get(name, elapsed), elapsed)
+
+    times['total'] = sum(times[name] for name, _ in calls)
+
+    return times
@@ -36,6 +36,8 @@
 
 import io
 from six.moves import builtins
+import hashlib
+import time
 import zipfile
 import os
 
@@ -43,17 +45,100 @@ import numpy as np
 import pytest
 from mock import MagicMock, patch, mock_open
 from requests.exceptions import HTTPError
+from requests_toolbelt.exceptions import StreamingError
 import requests
 
 import allensdk.core.json_utilities as ju
-from allensdk.api.api import Api, stream_file_over_http, stream_zip_directory_over_http
+from allensdk.api.api import (Api, HttpSession, stream_file_over_http, 
+                              stream_zip_directory_over_http)
+from .rma_server import QuietHandler, serve
 
 
 _msg = {'whatever': True}
 
+
+def local_json_server(payload, connect_latency=0.0):
+    ''' Serve a fixed json document from a keep-alive capable local server. 
+    Each new connection is delayed by connect_latency seconds, standing in for 
+    the TCP and TLS handshakes of a remote host.
+    '''
+    body = ju.write_string(payload).encode('utf-8')
+
+    class Handler(QuietHandler):
+        def setup(self):
+            time.sleep(connect_latency)
+            QuietHandler.setup(self)
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return serve(Handler, '/api/v2/data/query.json')
+
+
+def local_file_server(body, truncate=(), honor_range=True, requests_log=None, 
+                      latency=0.0, updated_body=None, updated_at=None):
+    ''' Serve a file, optionally honoring range requests. The responses 
+    whose (0-based) indices are in truncate are cut off halfway through. 
+    Each response is delayed by latency seconds. From the updated_at'th 
+    response on, updated_body is served instead, with a later Last-Modified 
+    date.
+    '''
+    requests_log = [] if requests_log is None else requests_log
+
+    class Handler(QuietHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            index = len(requests_log)
+            range_header = self.headers.get('Range')
+            requests_log.append(range_header)
+
+            content, last_modified = body, 'Tue, 15 Nov 1994 12:45:26 GMT'
+            if updated_at is not None and index >= updated_at:
+                content, last_modified = updated_body, 'Wed, 16 Nov 1994 12:45:26 GMT'
+
+            start = 0
+            if honor_range and range_header is not None and \
+                    self.headers.get('If-Range', last_modified) == last_modified:
+                start = int(range_header.split('=')[1].split('-')[0])
+
+            if start >= len(content) and start > 0:
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            total = len(content)
+            content = content[start:]
+
+            if start > 0:
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                    start, total - 1, total))
+            else:
+                self.send_response(200)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+
+            if index in truncate:
+                self.wfile.write(content[:len(content) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+            else:
+                self.wfile.write(content)
+
+    return serve(Handler, '/api/v2/well_known_file_download/1')
+
+
 @pytest.fixture
 def api():
-    return Api()
+    api = Api()
+    api.download_retry_delay = 0
+    return api
 
 
 @pytest.fixture
@@ -90,7 +175,7 @@ def test_request_timeout(api):
     def raise_read_timeout(response, path=None):
         raise requests.exceptions.ReadTimeout
 
-    with patch('requests.get', return_value=MagicMock()) as get_mock:
+    with patch.object(api.session, 'get', return_value=MagicMock()) as get_mock:
         response_mock = get_mock.return_value
         response_mock.raise_for_status = MagicMock()
         
@@ -110,11 +195,14 @@ def test_request_timeout(api):
 
     assert e_info.typename == 'ReadTimeout'
     stream_mock.assert_called_with(response_mock, path=open_mock.return_value)
-    get_mock.assert_called_once_with('http://example.com/yo.jpg',
-                                     stream=True,
-                                     timeout=(9.05, 31.1))
-    open_mock.assert_called_once_with('/tmp/testfile', 'wb')
-    os_remove.assert_called_once_with('/tmp/testfile')
+    assert get_mock.call_count == 1 + api.download_retries
+    get_mock.assert_called_with('http://example.com/yo.jpg',
+                                stream=True,
+                                timeout=(9.05, 31.1))
+    open_mock.assert_called_with('/tmp/testfile.part', 'wb')
+
+    # the partial file is kept so that the download can be resumed
+    os_remove.assert_not_called()
 
 
 @patch("allensdk.core.json_utilities.read_url_post", return_value=_msg)
@@ -124,7 +212,8 @@ def test_do_query_post(ju_read_url_post, api):
                  "wow",
                  post=True)
 
-    ju_read_url_post.assert_called_once_with('http://localhost/wow')
+    ju_read_url_post.assert_called_once_with('http://localhost/wow',
+                                             session=api.session)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -134,7 +223,8 @@ def test_do_query_get(ju_read_url_get, api):
                  "wow",
                  post=False)
 
-    ju_read_url_get.assert_called_once_with('http://localhost/wow')
+    ju_read_url_get.assert_called_once_with('http://localhost/wow',
+                                            session=api.session)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -142,7 +232,8 @@ def test_load_api_schema(ju_read_url_get, api):
     api.load_api_schema()
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/enumerate.json')
+        'http://api.brain-map.org/api/v2/data/enumerate.json',
+        session=api.session)
 
 
 def test_stream_file_over_http(response, tmpdir_factory):
@@ -172,4 +263,345 @@ def test_stream_zip_directory_over_http(zip_response, tmpdir_factory):
         data = fil.read()
 
     assert(data == '122333444455555')
-    
\ No newline at end of file
+    
+
+def test_stream_zip_directory_over_http_bounded_memory(tmpdir_factory):
+    tracemalloc = pytest.importorskip('tracemalloc')
+
+    spool_size = 2 ** 20
+    member_size = 2 ** 21
+    n_members = 4
+
+    tmpdir = tmpdir_factory.mktemp('zip_stream_memory')
+    archive_path = str(tmpdir.join('archive.zip'))
+    with zipfile.ZipFile(archive_path, mode='w') as zipper:
+        for ii in range(n_members):
+            zipper.writestr('member_{0}.dat'.format(ii), os.urandom(member_size))
+    assert os.path.getsize(archive_path) > 4 * spool_size
+
+    def iter_content(chunk_size=512, *a, **k):
+        with open(archive_path, 'rb') as archive:
+            for chunk in iter(lambda: archive.read(chunk_size), b''):
+                yield chunk
+
+    response = MagicMock()
+    response.iter_content = iter_content
+    out_dir = str(tmpdir.mkdir('out'))
+
+    with patch('requests.get', return_value=response):
+        tracemalloc.start()
+        try:
+            stream_zip_directory_over_http('https://fish.gov', out_dir,
+                                           spool_size=spool_size)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    for ii in range(n_members):
+        assert os.path.getsize(os.path.join(out_dir, 'member_{0}.dat'.format(ii))) == member_size
+
+    # rolling the spool over to disk briefly copies it
+    assert peak < 3 * spool_size
+
+def test_http_session_default_timeout():
+    session = HttpSession(timeout=(1.0, 2.0))
+
+    with patch.object(requests.Session, 'request') as request_mock:
+        session.get('http://localhost/wow')
+        session.get('http://localhost/wow', timeout=5.0)
+
+    assert request_mock.call_args_list[0][1]['timeout'] == (1.0, 2.0)
+    assert request_mock.call_args_list[1][1]['timeout'] == 5.0
+
+
+def test_http_session_pool():
+    session = HttpSession(pool_size=3, gzip=False)
+    adapter = session.get_adapter('http://api.brain-map.org')
+
+    assert adapter._pool_maxsize == 3
+    assert session.headers['Accept-Encoding'] == 'identity'
+
+
+def test_configure_http_session(api):
+    old_session = api.session
+    new_session = api.configure_http_session(pool_size=2, timeout=1.0)
+
+    assert api.session is new_session
+    assert new_session is not old_session
+    assert new_session.timeout == 1.0
+    assert new_session.pool_size == 2
+
+
+def test_read_url_get_session():
+    session = MagicMock()
+    session.get.return_value.content = b'{"msg": [1, 2, 3]}'
+
+    data = ju.read_url_get('http://localhost/wow', session=session)
+
+    session.get.assert_called_once_with('http://localhost/wow')
+    assert data == {'msg': [1, 2, 3]}
+
+
+def test_read_url_post_session():
+    session = MagicMock()
+    session.post.return_value.content = b'{"msg": [1, 2, 3]}'
+
+    data = ju.read_url_post('http://localhost/wow?a=1', session=session)
+
+    session.post.assert_called_once_with(
+        'http://localhost/wow', data='{"a": "1"}',
+        headers={'Content-Type': 'application/json'})
+    session.post.return_value.raise_for_status.assert_called_once_with()
+    assert data == {'msg': [1, 2, 3]}
+
+
+def test_read_url_post_session_http_error():
+    session = MagicMock()
+    session.post.return_value.content = b'{"msg": "Internal Server Error"}'
+    session.post.return_value.raise_for_status.side_effect = \
+        HTTPError('500 Server Error')
+
+    with pytest.raises(HTTPError):
+        ju.read_url_post('http://localhost/wow?a=1', session=session)
+
+
+def test_retrieve_xml_over_http(api):
+    with patch.object(api.session, 'get') as get_mock:
+        get_mock.return_value.content = b'<svg/>'
+        xml = api.retrieve_xml_over_http('http://localhost/wow.svg')
+
+    get_mock.assert_called_once_with('http://localhost/wow.svg')
+    assert xml == b'<svg/>'
+
+
+def test_stream_file_over_http_session(response, tmpdir_factory):
+
+    path = tmpdir_factory.mktemp('file_stream_test').join('test.txt')
+    session = MagicMock()
+    session.get.return_value = response
+
+    with patch('requests.get') as get_mock:
+        stream_file_over_http('https://fish.gov', str(path), session=session)
+
+    assert not get_mock.called
+    session.get.assert_called_once_with('https://fish.gov', stream=True, 
+                                        timeout=(9.05, 31.1))
+
+    with open(str(path), 'r') as fil:
+        assert fil.read() == '123'
+
+
+_file_body = os.urandom(2 ** 16)
+
+
+def test_retrieve_file_resumes(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+    log = []
+
+    with local_file_server(_file_body, truncate=(0, 1), requests_log=log) as url:
+        api.retrieve_file_over_http(url, path)
+
+    with open(path, 'rb') as fil:
+        assert fil.read() == _file_body
+    assert not os.path.exists(path + api.partial_file_suffix)
+
+    assert log[0] is None
+    assert log[1] == 'bytes={0}-'.format(len(_file_body) // 2)
+    assert len(log) == 3
+
+
+def test_retrieve_file_backoff(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+    api.download_retry_delay = 0.5
+
+    with patch('allensdk.api.api.time') as time_mock:
+        with local_file_server(_file_body, truncate=(0, 1)) as url:
+            api.retrieve_file_over_http(url, path)
+
+    assert time_mock.sleep.call_args_list == [((0.5,),), ((1.0,),)]
+
+
+def test_retrieve_file_remote_changed(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+    updated_body = os.urandom(len(_file_body))
+    log = []
+
+    with local_file_server(_file_body, truncate=(0,), requests_log=log,
+                           updated_body=updated_body, updated_at=1) as url:
+        api.retrieve_file_over_http(url, path)
+
+    # the range request was refused and the new version fetched whole
+    assert log[1] == 'bytes={0}-'.format(len(_file_body) // 2)
+    with open(path, 'rb') as fil:
+        assert fil.read() == updated_body
+
+
+def test_retrieve_file_range_ignored(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+
+    with local_file_server(_file_body, truncate=(0,), honor_range=False) as url:
+        api.retrieve_file_over_http(url, path)
+
+    with open(path, 'rb') as fil:
+        assert fil.read() == _file_body
+
+
+def test_retrieve_file_resume_across_calls(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+    partial = path + api.partial_file_suffix
+    api.download_retries = 0
+
+    with local_file_server(_file_body, truncate=(0,)) as url:
+        with pytest.raises((StreamingError, 
+                            requests.exceptions.ChunkedEncodingError)):
+            api.retrieve_file_over_http(url, path)
+
+        assert not os.path.exists(path)
+        assert os.path.getsize(partial) == len(_file_body) // 2
+
+        api.retrieve_file_over_http(url, path)
+
+    with open(path, 'rb') as fil:
+        assert fil.read() == _file_body
+    assert not os.path.exists(partial)
+
+
+def test_retrieve_file_interrupted_keeps_existing(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+
+    with open(path, 'wb') as fil:
+        fil.write(_file_body)
+
+    with patch.object(api, 'resume_file_over_http',
+                      side_effect=requests.exceptions.ConnectionError):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            api.retrieve_file_over_http('http://example.com/data.nwb', path)
+
+    with open(path, 'rb') as fil:
+        assert fil.read() == _file_body
+
+
+def test_retrieve_file_chunked_encoding_keeps_partial(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+    partial = path + api.partial_file_suffix
+
+    def write_partial(url, partial_path, **kwargs):
+        with open(partial_path, 'wb') as fil:
+            fil.write(_file_body[:10])
+        raise requests.exceptions.ChunkedEncodingError
+
+    with patch.object(api, 'resume_file_over_http', side_effect=write_partial):
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            api.retrieve_file_over_http('http://example.com/data.nwb', path)
+
+    assert not os.path.exists(path)
+    assert os.path.getsize(partial) == 10
+
+
+def test_retrieve_file_stale_partial(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+    partial = path + api.partial_file_suffix
+
+    with open(partial, 'wb') as fil:
+        fil.write(b'0' * (len(_file_body) + 10))
+
+    with local_file_server(_file_body) as url:
+        api.retrieve_file_over_http(url, path)
+
+    with open(path, 'rb') as fil:
+        assert fil.read() == _file_body
+
+
+@pytest.mark.parametrize('checks', [{'expected_size': len(_file_body) + 1},
+                                    {'expected_md5': 'ab' * 16}])
+def test_retrieve_file_verification_fails(api, tmpdir_factory, checks):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+
+    with local_file_server(_file_body) as url:
+        with pytest.raises((IOError, requests.exceptions.RequestException)):
+            api.retrieve_file_over_http(url, path, **checks)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + api.partial_file_suffix)
+
+
+def test_retrieve_file_verification_passes(api, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('resume').join('data.nwb'))
+
+    with local_file_server(_file_body) as url:
+        api.retrieve_file_over_http(url, path, 
+                                    expected_size=len(_file_body), 
+                                    expected_md5=hashlib.md5(_file_body).hexdigest())
+
+    assert os.path.getsize(path) == len(_file_body)
+
+
+def test_retrieve_streamed_json_over_http(api):
+    payload = {'success': True,
+               'total_rows': 3,
+               'msg': [{'id': ii, 'name': u'röw {0}'.format(ii)} for ii in range(3)]}
+
+    with local_json_server(payload) as url:
+        envelope = {}
+        rows = api.retrieve_streamed_json_over_http(url, envelope=envelope)
+
+        assert not isinstance(rows, list)
+        assert list(rows) == payload['msg']
+        assert envelope == {'success': True, 'total_rows': 3}
+
+        assert list(api.json_msg_query(url, stream=True)) == payload['msg']
+        assert list(ju.read_url_get_rows(url)) == payload['msg']
+
+
+def test_retrieve_streamed_json_over_http_error_message(api):
+    with local_json_server({'success': False, 'msg': 'Query failed'}) as url:
+        with pytest.raises(ValueError) as e:
+            list(api.json_msg_query(url, stream=True))
+
+    assert 'Query failed' in str(e.value)
+
+
+def test_retrieve_streamed_json_over_http_bounded_memory(api):
+    tracemalloc = pytest.importorskip('tracemalloc')
+
+    payload = {'success': True,
+               'msg': [{'id': ii, 'value': 0.5 * ii, 'name': 'cell {0}'.format(ii) * 10}
+                       for ii in range(20000)]}
+
+    with local_json_server(payload) as url:
+        body_size = len(ju.write_string(payload))
+        del payload
+
+        tracemalloc.start()
+        try:
+            n = sum(1 for _ in api.json_msg_query(url, stream=True))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    assert n == 20000
+    assert peak < body_size / 10
+
+
+@pytest.mark.nightly
+def test_http_session_benchmark():
+
+    with local_json_server({'msg': [{'whatever': True}] * 100},
+                           connect_latency=0.02) as url:
+
+        n = 200
+
+        start = time.time()
+        for ii in range(n):
+            ju.read_url_get(url)
+        unpooled_rps = n / (time.time() - start)
+
+        session = HttpSession()
+        start = time.time()
+        for ii in range(n):
+            ju.read_url_get(url, session=session)
+        pooled_rps = n / (time.time() - start)
+
+    print('unpooled: {0:.1f} requests/s, pooled: {1:.1f} requests/s'.format(
+        unpooled_rps, pooled_rps))
+    assert pooled_rps > unpooled_rps
@@ -35,7 +35,7 @@
 #
 import os
 import pytest
-from mock import patch, MagicMock, call
+from mock import patch, MagicMock, call, ANY
 from collections import Counter
 import datetime
 from allensdk.api.queries.brain_observatory_api import (BrainObservatoryApi,
@@ -290,12 +290,27 @@ def test_get_cell_metrics_five_messages(bo_api, safe_msg5):
             'model::ApiCamCellMetric,'
             'rma::criteria,%5Bcell_specimen_id$in517394843,517394850%5D,'
             'rma::options%5Bnum_rows$eq2000%5D%5Bstart_row$eq{}%5D%5Border$eq%27cell_specimen_id%27%5D%5Bcount$eqfalse%5D')
-        expected_calls = map(lambda c: call(base_query.format(c)),
+        expected_calls = map(lambda c: call(base_query.format(c), session=ANY),
                             [0, 2000, 4000, 6000, 8000, 10000])
 
         assert ju_read_url_get.call_args_list == list(expected_calls)
 
 
+def test_get_cell_metrics_prefetch(bo_api):
+    def respond(url, *a, **k):
+        if 'count$eqtrue' in url:
+            return {'msg': [], 'total_rows': 4500}
+        start_row = int(url.split('start_row$eq')[1].split('%5D')[0])
+        return {'msg': [{'cell_specimen_id': ii} for ii in
+                        range(start_row, min(start_row + 2000, 4500))]}
+
+    with patch("allensdk.core.json_utilities.read_url_get", side_effect=respond) as ju_read_url_get:
+        metrics = list(bo_api.get_cell_metrics(prefetch=2))
+
+    assert [m['cell_specimen_id'] for m in metrics] == list(range(4500))
+    assert ju_read_url_get.call_count == 4
+
+
 def test_filter_experiment_containers_no_filters(bo_api, mock_containers):
     containers = bo_api.filter_experiment_containers(mock_containers)
     assert len(containers) == 3
@@ -398,7 +413,9 @@ def test_filter_cell_specimens(bo_api, mock_specimens):
 
 
 @patch.object(BrainObservatoryApi, "retrieve_file_over_http")
-@patch.object(BrainObservatoryApi, "json_msg_query", return_value=[{'download_link': '/url/path/to/file'}])
+@patch.object(BrainObservatoryApi, "json_msg_query", return_value=[{'download_link': '/url/path/to/file',
+                                                                    'file_size': 100,
+                                                                    'md5': 'ab' * 16}])
 def test_save_ophys_experiment_data(mock_json_msg_query,
                                     mock_retrieve_file_over_http,
                                     bo_api):
@@ -415,7 +432,9 @@ def test_save_ophys_experiment_data(mock_json_msg_query,
         "rma::options[num_rows$eq'all'][count$eqfalse]")
     mock_retrieve_file_over_http.assert_called_with(
         bo_api.api_url +  '/url/path/to/file',
-        '/path/to/filename')
+        '/path/to/filename',
+        expected_size=100,
+        expected_md5='ab' * 16)
 
 
 @patch.object(BrainObservatoryApi, "retrieve_file_over_http")
@@ -436,7 +455,9 @@ def test_save_ophys_experiment_event_data(mock_json_msg_query,
         "rma::options[num_rows$eq'all'][count$eqfalse]")
     mock_retrieve_file_over_http.assert_called_with(
         bo_api.api_url +  '/url/path/to/file',
-        '/path/to/filename')
+        '/path/to/filename',
+        expected_size=None,
+        expected_md5=None)
 
 
 @patch.object(BrainObservatoryApi, "retrieve_file_over_http")
@@ -457,7 +478,9 @@ def test_get_cell_specimen_id_mapping(mock_json_msg_query,
         "rma::options[num_rows$eq'all'][count$eqfalse]")
     mock_retrieve_file_over_http.assert_called_with(
         bo_api.api_url + '/url/path/to/file',
-        '/path/to/filename')
+        '/path/to/filename',
+        expected_size=None,
+        expected_md5=None)
 
 
 def test_find_container_tags():
@@ -40,9 +40,10 @@ import pandas.io.json as pj
 import numpy as np
 
 import pytest
-from mock import MagicMock, mock_open, patch
+import weakref
+from mock import MagicMock, mock_open, patch, ANY
 
-from allensdk.api.cache import Cache, memoize, get_default_manifest_file
+from allensdk.api.cache import Cache, memoize, cacheable, get_default_manifest_file
 from allensdk.api.queries.rma_api import RmaApi
 import allensdk.core.json_utilities as ju
 from allensdk.config.manifest import ManifestVersionError
@@ -138,7 +139,8 @@ def test_wrap_json(ju_read_url_get, ju_read, ju_write, rma, cache):
     assert df.loc[:, 'whatever'][0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
     ju_write.assert_called_once_with('example.txt', _msg)
     ju_read.assert_called_once_with('example.txt')
 
@@ -156,7 +158,8 @@ def test_wrap_dataframe(ju_read_url_get, ju_write, mock_read_json, rma, cache):
     assert json_data[0]['whatever']
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
     ju_write.assert_called_once_with('example.txt', _msg)
     mock_read_json.assert_called_once_with('example.txt', orient='records')
 
@@ -189,6 +192,252 @@ def test_memoize():
             fb.f(0), time.time() - t0
 
 
+
+def test_memoize_max_entries():
+    calls = []
+
+    @memoize(max_entries=2)
+    def f(x):
+        calls.append(x)
+        return x
+
+    for x in [0, 1, 0, 2, 1, 0]:
+        f(x)
+
+    # 1 is evicted by 2, as 0 was used more recently; then 0 is evicted by 1
+    assert calls == [0, 1, 2, 1, 0]
+
+    info = f.cache_info()
+    assert info.hits == 1
+    assert info.misses == 5
+    assert info.entries == 2
+
+
+def test_memoize_max_bytes():
+
+    @memoize(max_bytes=250)
+    def f(n):
+        return np.zeros(n, dtype=np.uint8)
+
+    f(100)
+    f(100)
+    f(120)
+    assert f.cache_info().nbytes == 220
+
+    f(50)
+    assert f.cache_info().nbytes == 170
+    assert f.cache_info().entries == 2
+
+    f(300)  # too big to hold
+    assert f.cache_info().entries == 2
+    assert f.cache_info().hits == 1
+
+
+def test_memoize_ttl():
+    calls = []
+
+    @memoize(ttl=10)
+    def f(x):
+        calls.append(x)
+        return x
+
+    with patch('time.time', return_value=100.0):
+        f(1)
+        f(1)
+    with patch('time.time', return_value=111.0):
+        f(1)
+
+    assert calls == [1, 1]
+
+
+def test_memoize_weak_owner():
+    import gc
+
+    class FooBar(object):
+
+        @memoize
+        def f(self, n):
+            return np.zeros(n)
+
+    fb = FooBar()
+    fb.f(10)
+    fb.f(10)
+    assert FooBar.f.cache_info().entries == 1
+
+    owner = weakref.ref(fb)
+    del fb
+    gc.collect()
+
+    assert owner() is None
+    assert FooBar.f.cache_info().entries == 0
+
+
+def test_memoize_cache_clear():
+
+    @memoize
+    def f(x, y=1):
+        return x + y
+
+    assert f(1, y=2) == 3
+    assert f(1, y=2) == 3
+    assert f.cache_info().hits == 1
+
+    f.cache_clear()
+    assert f.cache_info() == (0, 0, None, 0, None, 0)
+
+
+def test_memoize_unhashable():
+
+    @memoize
+    def f(x):
+        return sum(x)
+
+    assert f([1, 2]) == 3
+    assert f.cache_info().entries == 0
+
+
+def binary_formats():
+    formats = ['hdf5']
+    try:
+        import pyarrow
+        formats.extend(['parquet', 'feather'])
+    except ImportError:
+        pass
+    return formats
+
+
+_records = [{'id': 1, 'name': 'a', 'rate': 0.5, 'ok': True, 'nested': {'x': 1}},
+            {'id': 2, 'name': None, 'rate': np.nan, 'ok': False, 'nested': None},
+            {'id': 3, 'name': 'c', 'rate': 2.5, 'ok': True, 'nested': [1, 2]}]
+
+
+@pytest.mark.parametrize('fmt', binary_formats())
+def test_binary_dataframe_roundtrip(fmt, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('binary').join('records.dat'))
+
+    Cache.binary_writer(path, iter(_records), fmt=fmt)
+    df = Cache.binary_reader(path)
+
+    assert sorted(df.columns) == ['id', 'name', 'nested', 'ok', 'rate']
+    assert df['id'].dtype == np.int64
+    assert df['ok'].dtype == np.bool_
+    assert df['rate'].dtype == np.float64
+    assert df['name'][0] == 'a'
+    assert pd.isnull(df['name'][1])
+    assert df['nested'][0] == {'x': 1}
+    assert df['nested'][1] is None
+    assert df['nested'][2] == [1, 2]
+
+    projected = Cache.binary_reader(path, columns=['rate', 'id'])
+    assert set(projected.columns) == {'rate', 'id'}
+    assert np.allclose(projected['rate'], [0.5, np.nan, 2.5], equal_nan=True)
+
+
+@pytest.mark.parametrize('fmt', binary_formats())
+def test_binary_dataframe_json_columns(fmt, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('binary').join('records.dat'))
+    records = [{'id': 1, 'flag': True}, {'id': 2, 'flag': None}, 
+               {'id': 3, 'flag': False}]
+
+    Cache.binary_writer(path, records, fmt=fmt)
+
+    assert list(Cache.binary_reader(path, columns=['flag'])['flag']) == \
+        [True, None, False]
+    assert Cache.binary_reader(path, columns=['id'])['id'].dtype == np.int64
+
+
+def test_binary_reader_unknown(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('binary').join('records.csv'))
+    with open(path, 'w') as fil:
+        fil.write('a,b\n1,2\n')
+
+    with pytest.raises(IOError):
+        Cache.binary_reader(path)
+
+
+@pytest.mark.parametrize('fmt', binary_formats())
+def test_cacheable_binary_dataframe(fmt, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('binary').join('records.dat'))
+    calls = []
+
+    @cacheable()
+    def get_records():
+        calls.append(1)
+        return _records
+
+    for ii in range(2):
+        df = get_records(path=path, strategy='lazy',
+                         **Cache.cache_binary_dataframe(columns=['id', 'rate'], fmt=fmt))
+
+    assert len(calls) == 1
+    assert list(df['id']) == [1, 2, 3]
+    assert 'name' not in df.columns
+
+
+def test_binary_writer_chunked_rows(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('binary').join('records.dat'))
+    records = [{'id': ii, 'rate': 0.5 * ii if ii % 3 else None} 
+               for ii in range(10)]
+
+    df = Cache.rows_to_dataframe(iter(records), chunk_rows=3)
+
+    assert list(df['id']) == list(range(10))
+    assert list(df.index) == list(range(10))
+    assert np.isnan(df['rate'][0])
+    assert len(Cache.rows_to_dataframe(iter([]))) == 0
+
+    Cache.binary_writer(path, (r for r in records), fmt='hdf5')
+    assert list(Cache.binary_reader(path)['id']) == list(range(10))
+
+
+def test_cacher_removes_partial_file(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('partial').join('records.json'))
+
+    def streamed_records():
+        yield {'id': 1}
+        raise IOError('connection reset')
+
+    @cacheable()
+    def get_records():
+        return streamed_records()
+
+    with pytest.raises(IOError):
+        get_records(path=path, strategy='lazy', **Cache.cache_csv_json())
+
+    assert not os.path.exists(path)
+
+
+@pytest.mark.nightly
+def test_binary_dataframe_benchmark(tmpdir_factory):
+    import time
+    tmpdir = tmpdir_factory.mktemp('binary_benchmark')
+
+    n_rows, n_columns = 20000, 200
+    data = pd.DataFrame(np.random.rand(n_rows, n_columns), 
+                        columns=['metric_{}'.format(ii) for ii in range(n_columns)])
+    data['cell_specimen_id'] = np.arange(n_rows)
+    data['area'] = 'VISp'
+    records = data.to_dict('records')
+
+    strategies = [('csv', Cache.cache_csv_dataframe()),
+                  ('json', Cache.cache_json_dataframe())]
+    strategies += [(fmt, Cache.cache_binary_dataframe(fmt=fmt)) 
+                   for fmt in binary_formats()]
+
+    times = {}
+    for name, strategy in strategies:
+        path = str(tmpdir.join('metrics.' + name))
+        strategy['writer'](path, records)
+
+        start = time.time()
+        df = strategy['reader'](path)
+        times[name] = time.time() - start
+
+        assert len(df) == n_rows
+        assert np.allclose(df['metric_0'], data['metric_0'])
+
+    print(', '.join('{}: {:.3f}s'.format(k, v) for k, v in sorted(times.items())))
+
 def test_get_default_manifest_file():
     assert get_default_manifest_file('brain_observatory') == 'brain_observatory/manifest.json'
     assert get_default_manifest_file('cell_types') == 'cell_types/manifest.json'
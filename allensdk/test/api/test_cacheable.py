@@ -34,7 +34,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import pytest
-from mock import MagicMock, patch, mock_open
+from mock import MagicMock, patch, mock_open, ANY
 from allensdk.api.cache import Cache, cacheable
 from allensdk.api.queries.rma_api import RmaApi
 import pandas as pd
@@ -55,13 +55,14 @@ _csv_msg = pd.read_csv(StringIO.StringIO(""",whatever
 """), index_col=0)
 
 
+@patch('allensdk.api.cache.replace_file')
 @patch("allensdk.core.json_utilities.write")
 @patch("allensdk.core.json_utilities.read", return_value=_msg)
 @patch("allensdk.core.json_utilities.read_url_get", return_value={'msg': _msg})
 @patch('csv.DictWriter')
 @patch('pandas.read_csv', return_value=_csv_msg)
 def test_cacheable_csv_dataframe(read_csv, dictwriter, ju_read_url_get,
-                                 ju_read, ju_write):
+                                 ju_read, ju_write, replace_file):
     @cacheable()
     def get_hemispheres():
         return RmaApi().model_query(model='Hemisphere')
@@ -78,20 +79,24 @@ def test_cacheable_csv_dataframe(read_csv, dictwriter, ju_read_url_get,
     assert df.loc[:, 'whatever'][0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
     read_csv.assert_called_once_with('/xyz/abc/example.txt', parse_dates=True)
     assert not ju_write.called, 'write should not have been called'
     assert not ju_read.called, 'read should not have been called'
     mkdir.assert_called_once_with('/xyz/abc')
-    open_mock.assert_called_once_with('/xyz/abc/example.txt', 'w')
+    open_mock.assert_called_once_with('/xyz/abc/example.txt.part', 'w')
+    replace_file.assert_called_once_with('/xyz/abc/example.txt.part', '/xyz/abc/example.txt')
 
 
+@patch('allensdk.api.cache.replace_file')
 @patch("allensdk.core.json_utilities.write")
 @patch("allensdk.core.json_utilities.read", return_value=_msg)
 @patch("allensdk.core.json_utilities.read_url_get", return_value={'msg': _msg})
 @patch.object(Manifest, 'safe_mkdir')
 @patch('pandas.read_csv', return_value=_csv_msg)
-def test_cacheable_json(read_csv, mkdir, ju_read_url_get, ju_read, ju_write):
+def test_cacheable_json(read_csv, mkdir, ju_read_url_get, ju_read, ju_write,
+                        replace_file):
     @cacheable()
     def get_hemispheres():
         return RmaApi().model_query(model='Hemisphere')
@@ -103,18 +108,20 @@ def test_cacheable_json(read_csv, mkdir, ju_read_url_get, ju_read, ju_write):
     assert 'whatever' in df[0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
     assert not read_csv.called, 'read_csv should not have been called'
-    ju_write.assert_called_once_with('/xyz/abc/example.json',
-                                                      _msg)
+    ju_write.assert_called_once_with('/xyz/abc/example.json.part', _msg)
+    replace_file.assert_called_once_with('/xyz/abc/example.json.part', '/xyz/abc/example.json')
     ju_read.assert_called_once_with('/xyz/abc/example.json')
 
 
+@patch('allensdk.api.cache.replace_file')
 @patch("allensdk.core.json_utilities.write")
 @patch("allensdk.core.json_utilities.read", return_value=_msg)
 @patch("allensdk.core.json_utilities.read_url_get", return_value={'msg': _msg})
 @patch.object(Manifest, 'safe_mkdir')
-def test_excpt(mkdir, ju_read_url_get, ju_read, ju_write):
+def test_excpt(mkdir, ju_read_url_get, ju_read, ju_write, replace_file):
     @cacheable()
     def get_hemispheres_excpt():
         return RmaApi().model_query(model='Hemisphere',
@@ -127,8 +134,10 @@ def test_excpt(mkdir, ju_read_url_get, ju_read, ju_write):
     assert 'whatever' in df[0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere,rma::options%5Bexcept$eqsymbol%5D')
-    ju_write.assert_called_once_with('/xyz/abc/example.json', _msg)
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere,rma::options%5Bexcept$eqsymbol%5D',
+        session=ANY)
+    ju_write.assert_called_once_with('/xyz/abc/example.json.part', _msg)
+    replace_file.assert_called_once_with('/xyz/abc/example.json.part', '/xyz/abc/example.json')
     ju_read.assert_called_once_with('/xyz/abc/example.json')
     mkdir.assert_called_once_with('/xyz/abc')
 
@@ -154,6 +163,7 @@ def test_cacheable_no_cache_csv(read_csv, ju_read_url_get, ju_read, ju_write):
     assert not ju_read.called, 'json read should not have been called'
 
 
+@patch('allensdk.api.cache.replace_file')
 @patch("pandas.io.json.read_json", return_value=_pd_msg)
 @patch("pandas.read_csv", return_value=_csv_msg)
 @patch("allensdk.core.json_utilities.write")
@@ -161,7 +171,7 @@ def test_cacheable_no_cache_csv(read_csv, ju_read_url_get, ju_read, ju_write):
 @patch("allensdk.core.json_utilities.read_url_get", return_value={'msg': _msg})
 @patch.object(Manifest, 'safe_mkdir')
 def test_cacheable_json_dataframe(mkdir, ju_read_url_get, ju_read, ju_write,
-                                  read_csv, mock_read_json):
+                                  read_csv, mock_read_json, replace_file):
     @cacheable()
     def get_hemispheres():
         return RmaApi().model_query(model='Hemisphere')
@@ -173,15 +183,18 @@ def test_cacheable_json_dataframe(mkdir, ju_read_url_get, ju_read, ju_write,
     assert df.loc[:, 'whatever'][0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
     assert not read_csv.called, 'read_csv should not have been called'
     mock_read_json.assert_called_once_with('/xyz/abc/example.json',
                                       orient='records')
-    ju_write.assert_called_once_with('/xyz/abc/example.json', _msg)
+    ju_write.assert_called_once_with('/xyz/abc/example.json.part', _msg)
+    replace_file.assert_called_once_with('/xyz/abc/example.json.part', '/xyz/abc/example.json')
     assert not ju_read.called, 'json read should not have been called'
     mkdir.assert_called_once_with('/xyz/abc')
 
 
+@patch('allensdk.api.cache.replace_file')
 @patch("pandas.io.json.read_json", return_value=_pd_msg)
 @patch("pandas.read_csv", return_value=_csv_msg)
 @patch("allensdk.core.json_utilities.write")
@@ -190,7 +203,7 @@ def test_cacheable_json_dataframe(mkdir, ju_read_url_get, ju_read, ju_write,
 @patch('csv.DictWriter')
 @patch.object(Manifest, 'safe_mkdir')
 def test_cacheable_csv_json(mkdir, dictwriter, ju_read_url_get, ju_read,
-                            ju_write, read_csv, mock_read_json):
+                            ju_write, read_csv, mock_read_json, replace_file):
     @cacheable()
     def get_hemispheres():
         return RmaApi().model_query(model='Hemisphere')
@@ -206,14 +219,16 @@ def test_cacheable_csv_json(mkdir, dictwriter, ju_read_url_get, ju_read,
     assert 'whatever' in df[0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
     read_csv.assert_called_once_with('/xyz/example.csv', parse_dates=True)
     dictwriter.return_value.writerow.assert_called()
     assert not mock_read_json.called, 'pj.read_json should not have been called'
     assert not ju_write.called, 'ju.write should not have been called'
     assert not ju_read.called, 'json read should not have been called'
     mkdir.assert_called_once_with('/xyz')
-    open_mock.assert_called_once_with('/xyz/example.csv', 'w')
+    open_mock.assert_called_once_with('/xyz/example.csv.part', 'w')
+    replace_file.assert_called_once_with('/xyz/example.csv.part', '/xyz/example.csv')
 
 
 @patch("allensdk.core.json_utilities.write")
@@ -232,7 +247,8 @@ def test_cacheable_no_save(to_csv, read_csv, ju_read_url_get, ju_read,
     assert 'whatever' in data[0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
     assert not to_csv.called, 'to_csv should not have been called'
     assert not read_csv.called, 'read_csv should not have been called'
     assert not ju_write.called, 'json write should not have been called'
@@ -255,13 +271,15 @@ def test_cacheable_no_save_dataframe(to_csv, read_csv, ju_read_url_get,
     assert df.loc[:, 'whatever'][0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
     assert not to_csv.called, 'to_csv should not have been called'
     assert not read_csv.called, 'read_csv should not have been called'
     assert not ju_write.called, 'json write should not have been called'
     assert not ju_read.called, 'json read should not have been called'
 
 
+@patch('allensdk.api.cache.replace_file')
 @patch("pandas.read_csv", return_value=_csv_msg)
 @patch("allensdk.core.json_utilities.write")
 @patch("allensdk.core.json_utilities.read", return_value=_msg)
@@ -269,7 +287,7 @@ def test_cacheable_no_save_dataframe(to_csv, read_csv, ju_read_url_get,
 @patch('csv.DictWriter')
 @patch.object(Manifest, 'safe_mkdir')
 def test_cacheable_lazy_csv_no_file(mkdir, dictwriter, ju_read_url_get,
-                                    ju_read, ju_write, read_csv):
+                                    ju_read, ju_write, read_csv, replace_file):
     @cacheable()
     def get_hemispheres():
         return RmaApi().model_query(model='Hemisphere')
@@ -286,8 +304,10 @@ def test_cacheable_lazy_csv_no_file(mkdir, dictwriter, ju_read_url_get,
     assert df.loc[:, 'whatever'][0]
 
     ju_read_url_get.assert_called_once_with(
-        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere')
-    open_mock.assert_called_once_with('/xyz/abc/example.csv', 'w')
+        'http://api.brain-map.org/api/v2/data/query.json?q=model::Hemisphere',
+        session=ANY)
+    open_mock.assert_called_once_with('/xyz/abc/example.csv.part', 'w')
+    replace_file.assert_called_once_with('/xyz/abc/example.csv.part', '/xyz/abc/example.csv')
     dictwriter.return_value.writerow.assert_called()
     read_csv.assert_called_once_with('/xyz/abc/example.csv', parse_dates=True)
     assert not ju_write.called, 'json write should not have been called'
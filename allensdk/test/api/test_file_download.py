@@ -49,6 +49,12 @@ except:
     import io as StringIO
 
 
+@pytest.fixture(autouse=True)
+def in_tmpdir(tmpdir, monkeypatch):
+    # the relative cache paths used below land in a scratch directory
+    monkeypatch.chdir(tmpdir)
+
+
 @pytest.fixture
 def mca():
     return MCA()
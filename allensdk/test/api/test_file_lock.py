@@ -0,0 +1,278 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2019. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+from mock import patch
+
+from allensdk.api.api import Api
+from allensdk.api.cache import Cache
+from allensdk.api.file_lock import FileLock, LockTimeout
+import allensdk.core.json_utilities as ju
+from .test_api import local_file_server
+
+
+def test_file_lock_reentrant(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('lock').join('data.nwb'))
+
+    with FileLock(path):
+        with FileLock(path):
+            pass
+        assert os.path.exists(path + FileLock.suffix)
+        assert FileLock.pending(path)
+
+    assert not os.path.exists(path + FileLock.suffix)
+    assert not FileLock.pending(path)
+
+    with FileLock(path, timeout=0.1):
+        pass
+
+    assert FileLock._held == {}
+
+
+def test_file_lock_excludes_threads(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('lock').join('data.nwb'))
+    inside = []
+    overlaps = []
+
+    def work():
+        for ii in range(20):
+            with FileLock(path, poll_interval=0.001):
+                inside.append(1)
+                overlaps.append(len(inside))
+                time.sleep(0.001)
+                inside.pop()
+
+    threads = [threading.Thread(target=work) for ii in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(overlaps) == 1
+    assert not os.path.exists(path + FileLock.suffix)
+    assert FileLock._held == {}
+
+
+def _hold_lock(path, ready, done):
+    with FileLock(path):
+        ready.set()
+        done.wait(10)
+
+
+def test_file_lock_timeout(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('lock').join('data.nwb'))
+    ready = multiprocessing.Event()
+    done = multiprocessing.Event()
+
+    holder = multiprocessing.Process(target=_hold_lock, args=(path, ready, done))
+    holder.start()
+
+    try:
+        assert ready.wait(10)
+        with pytest.raises(LockTimeout):
+            with FileLock(path, timeout=0.2, poll_interval=0.01):
+                pass
+    finally:
+        done.set()
+        holder.join()
+
+    with FileLock(path, timeout=1):
+        pass
+
+
+def _count_in_lock(args):
+    path, counter = args
+    for ii in range(20):
+        with FileLock(path, poll_interval=0.001):
+            with open(counter) as fil:
+                count = int(fil.read())
+            with open(counter, 'w') as fil:
+                fil.write(str(count + 1))
+
+
+def test_file_lock_excludes_processes(tmpdir_factory):
+    directory = tmpdir_factory.mktemp('lock')
+    path = str(directory.join('data.nwb'))
+    counter = str(directory.join('count.txt'))
+    n_workers = 4
+
+    with open(counter, 'w') as fil:
+        fil.write('0')
+
+    # lock files are removed on every release, so workers regularly find 
+    # theirs unlinked out from under them
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        pool.map(_count_in_lock, [(path, counter)] * n_workers)
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(counter) as fil:
+        assert int(fil.read()) == 20 * n_workers
+    assert not os.path.exists(path + FileLock.suffix)
+
+
+def test_file_lock_unwritable_directory():
+    with patch.object(FileLock, '_log') as log:
+        with FileLock('/path/that/does/not/exist/data.nwb'):
+            pass
+
+    assert log.warning.called
+
+
+def test_file_lock_polls_after_stale_lock_file(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('lock').join('data.nwb'))
+
+    with patch('allensdk.api.file_lock._is_current', side_effect=[False, True]):
+        with patch('allensdk.api.file_lock.time.sleep') as sleep:
+            with FileLock(path, poll_interval=0.25):
+                pass
+
+    sleep.assert_called_once_with(0.25)
+
+
+_body = os.urandom(2 ** 18)
+
+
+def _lazy_download(args):
+    url, path = args
+    Cache.cacher(Api().retrieve_file_over_http, url, path, 
+                 path=path, strategy='lazy')
+
+    with open(path, 'rb') as fil:
+        return hashlib.md5(fil.read()).hexdigest()
+
+
+def test_cacher_one_transfer_per_file(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('shared_cache').join('data.nwb'))
+    log = []
+    n_workers = 8
+
+    with local_file_server(_body, requests_log=log, latency=0.5) as url:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            digests = pool.map(_lazy_download, [(url, path)] * n_workers)
+        finally:
+            pool.close()
+            pool.join()
+
+    assert len(log) == 1
+    assert digests == [hashlib.md5(_body).hexdigest()] * n_workers
+    assert not os.path.exists(path + FileLock.suffix)
+
+
+@pytest.mark.parametrize('strategy', ['file', 'lazy'])
+def test_cacher_reads_without_lock(tmpdir_factory, strategy):
+    path = str(tmpdir_factory.mktemp('shared_cache').join('data.json'))
+    with open(path, 'w') as fil:
+        fil.write('[1, 2, 3]')
+
+    with patch('allensdk.api.cache.FileLock') as lock:
+        data = Cache.cacher(lambda: None, path=path, strategy=strategy,
+                            reader=ju.read)
+
+    assert data == [1, 2, 3]
+    assert not lock.called
+
+
+def _write_under_lock(path, ready):
+    partial_path = path + Cache.partial_file_suffix
+
+    with FileLock(path):
+        with open(partial_path, 'w') as fil:
+            fil.write('[1, 2')
+        ready.set()
+
+        time.sleep(0.3)
+        with open(partial_path, 'w') as fil:
+            fil.write('[1, 2, 3]')
+        os.rename(partial_path, path)
+
+
+def test_cacher_lazy_waits_for_creation(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('shared_cache').join('data.json'))
+    ready = multiprocessing.Event()
+
+    writer = multiprocessing.Process(target=_write_under_lock, args=(path, ready))
+    writer.start()
+
+    try:
+        assert ready.wait(10)
+
+        # the file is still being written
+        data = Cache.cacher(lambda: None, path=path, strategy='lazy',
+                            reader=ju.read)
+    finally:
+        writer.join()
+
+    assert data == [1, 2, 3]
+
+
+def test_cacher_failed_write_leaves_no_file(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('shared_cache').join('data.json'))
+
+    def writer(pth, data):
+        with open(pth, 'w') as fil:
+            fil.write('[1, 2')
+        raise IOError('interrupted')
+
+    with pytest.raises(IOError):
+        Cache.cacher(lambda: [1, 2, 3], path=path, strategy='lazy',
+                     writer=writer, reader=ju.read)
+
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + Cache.partial_file_suffix)
+
+
+def test_cacher_ignores_abandoned_partial_file(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('shared_cache').join('data.json'))
+
+    # left behind by a writer that was killed, along with its lock file
+    with open(path + Cache.partial_file_suffix, 'w') as fil:
+        fil.write('[1, 2')
+    open(path + FileLock.suffix, 'w').close()
+
+    data = Cache.cacher(lambda: [1, 2, 3], path=path, strategy='lazy',
+                        writer=ju.write, reader=ju.read)
+
+    assert data == [1, 2, 3]
+    assert not os.path.exists(path + Cache.partial_file_suffix)
@@ -137,14 +137,16 @@ def test_download_deformation_field(grid_data):
         name='model_query', 
         return_value=[
             {'well_known_file_type': {'name': 'DeformationFieldHeader'}, 'id': 123}, 
-            {'well_known_file_type': {'name': 'DeformationFieldVoxels'}, 'id': 456}
+            {'well_known_file_type': {'name': 'DeformationFieldVoxels'}, 'id': 456, 'file_size': 10}
         ]
     )
 
     grid_data.download_deformation_field(789)
 
-    grid_data.retrieve_file_over_http.assert_any_call('http://api.brain-map.org/api/v2/well_known_file_download/123', '789_dfmfld.mhd')
-    grid_data.retrieve_file_over_http.assert_any_call('http://api.brain-map.org/api/v2/well_known_file_download/456', '789_dfmfld.raw')
+    grid_data.retrieve_file_over_http.assert_any_call('http://api.brain-map.org/api/v2/well_known_file_download/123', '789_dfmfld.mhd',
+                                                      expected_size=None, expected_md5=None)
+    grid_data.retrieve_file_over_http.assert_any_call('http://api.brain-map.org/api/v2/well_known_file_download/456', '789_dfmfld.raw',
+                                                      expected_size=10, expected_md5=None)
 
 
 def test_download_alignment3d(grid_data):
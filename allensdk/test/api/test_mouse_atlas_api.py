@@ -41,6 +41,12 @@ from allensdk.api.queries.mouse_atlas_api import MouseAtlasApi as MAA
 
 
 
+@pytest.fixture(autouse=True)
+def in_tmpdir(tmpdir, monkeypatch):
+    # the relative cache paths used below land in a scratch directory
+    monkeypatch.chdir(tmpdir)
+
+
 @pytest.fixture
 def atlas():
     maa = MAA()
@@ -45,6 +45,12 @@ MOCK_ANNOTATION_IMAGE = 'mock_annotation_image'
 DOWNLOAD_LINK = '/path/to/link'
 
 
+@pytest.fixture(autouse=True)
+def in_tmpdir(tmpdir, monkeypatch):
+    # the relative cache paths used below land in a scratch directory
+    monkeypatch.chdir(tmpdir)
+
+
 @pytest.fixture
 def connectivity():
     mca = MCA()
@@ -34,7 +34,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import pytest
-from mock import MagicMock, call, patch, mock_open
+from mock import MagicMock, call, patch, mock_open, ANY
 from allensdk.api.queries.rma_pager import RmaPager, pageable
 from allensdk.api.queries.rma_api import RmaApi
 import allensdk.core.json_utilities as ju
@@ -42,6 +42,7 @@ import pandas.io.json as pj
 import pandas as pd
 from six.moves import builtins
 import os
+import time
 import simplejson as json
 from allensdk.api.queries.rma_template import RmaTemplate
 from allensdk.api.cache import cacheable, Cache
@@ -112,7 +113,7 @@ def test_pageable_json(ju_read_url_get, rma):
          ',rma::options%5Bnum_rows$eq5%5D%5Bstart_row$eq{}%5D'
          '%5Bcount$eqfalse%5D')
 
-    expected_calls = map(lambda c: call(base_query.format(c)),
+    expected_calls = map(lambda c: call(base_query.format(c), session=ANY),
                          [0, 1, 2, 3, 4])
                      
     assert ju_read_url_get.call_args_list == list(expected_calls)
@@ -141,7 +142,7 @@ def test_all(safe_read_url_get_msg5, rma):
             '%5Bcount$eqfalse%5D')
 
         # we get one extra call if total_rows % num_rows == 0 with current implementation
-        expected_calls = map(lambda c: call(base_query.format(c)),
+        expected_calls = map(lambda c: call(base_query.format(c), session=ANY),
                             [0, 1, 2, 3, 4, 5])
                         
         assert ju_read_url_get.call_args_list == list(expected_calls)
@@ -151,9 +152,10 @@ def test_all(safe_read_url_get_msg5, rma):
                          (Cache.cache_csv,
                           Cache.cache_csv_json,
                           Cache.cache_csv_dataframe))
+@patch('allensdk.api.cache.replace_file')
 @patch("pandas.read_csv", return_value=_csv_msg)
 @patch("os.makedirs")
-def test_cacheable_pageable_csv(os_makedirs, read_csv,
+def test_cacheable_pageable_csv(os_makedirs, read_csv, replace_file,
                                 cache_style, safe_read_url_get_msg5):
     with patch("allensdk.core.json_utilities.read_url_get", side_effect=safe_read_url_get_msg5) as ju_read_url_get:
         archive_templates = \
@@ -194,10 +196,12 @@ def test_cacheable_pageable_csv(os_makedirs, read_csv,
                     'rma::options%5Bnum_rows$eq1%5D%5Bstart_row$eq{}%5D'
                     '%5Bcount$eqfalse%5D')
 
-        expected_calls = map(lambda c: call(base_query.format(c)),
+        expected_calls = map(lambda c: call(base_query.format(c), session=ANY),
                             [0, 1, 2, 3, 4, 5])
 
         assert ju_read_url_get.call_args_list == list(expected_calls)
+        replace_file.assert_called_once_with('/path/to/cam_cell_metrics.csv.part',
+                                             '/path/to/cam_cell_metrics.csv')
         read_csv.assert_called_once_with('/path/to/cam_cell_metrics.csv', parse_dates=True)
 
         assert csv_writerow.call_args_list == [call({'whatever': 'whatever'}),
@@ -213,8 +217,9 @@ def test_cacheable_pageable_csv(os_makedirs, read_csv,
                           Cache.cache_json_dataframe))
 @patch("allensdk.core.json_utilities.read", return_value=_read_msg5)
 @patch("pandas.io.json.read_json", return_value=_pj_msg5)
+@patch('allensdk.api.cache.replace_file')
 @patch("os.makedirs")
-def test_cacheable_pageable_json(os_makedirs, pj_read_json,
+def test_cacheable_pageable_json(os_makedirs, replace_file, pj_read_json,
                                  ju_read, cache_style, safe_read_url_get_msg5):
     with patch("allensdk.core.json_utilities.read_url_get", side_effect=safe_read_url_get_msg5) as ju_read_url_get:
 
@@ -263,10 +268,145 @@ def test_cacheable_pageable_json(os_makedirs, pj_read_json,
             'rma::options%5Bnum_rows$eq1%5D%5Bstart_row$eq{}%5D'
             '%5Bcount$eqfalse%5D')
 
-        expected_calls = map(lambda c: call(base_query.format(c)),
+        expected_calls = map(lambda c: call(base_query.format(c), session=ANY),
                             [0, 1, 2, 3, 4, 5])
 
-        open_mock.assert_called_once_with('/path/to/cam_cell_metrics.json', 'wb')
-        open_mock.return_value.write.assert_called_once_with('[\n  {\n    "whatever": true\n  },\n  {\n    "whatever": true\n  },\n  {\n    "whatever": true\n  },\n  {\n    "whatever": true\n  },\n  {\n    "whatever": true\n  }\n]')
+        open_mock.assert_called_once_with('/path/to/cam_cell_metrics.json.part', 'wb')
+        replace_file.assert_called_once_with('/path/to/cam_cell_metrics.json.part',
+                                             '/path/to/cam_cell_metrics.json')
+        open_mock.return_value.write.assert_called_once_with(b'[\n  {\n    "whatever": true\n  },\n  {\n    "whatever": true\n  },\n  {\n    "whatever": true\n  },\n  {\n    "whatever": true\n  },\n  {\n    "whatever": true\n  }\n]')
         assert ju_read_url_get.call_args_list == list(expected_calls)
         assert len(cam_cell_metrics) == 5
+
+
+def rows_by_start_row(url, *args, **kwargs):
+    ''' Apes an api.brain-map.org response for a 7-row model, paged by start_row.
+    '''
+    if 'count$eqtrue' in url:
+        return {'msg': [{'id': 0}], 'total_rows': 7}
+
+    num_rows = int(url.split('num_rows$eq')[1].split('%5D')[0])
+    start_row = int(url.split('start_row$eq')[1].split('%5D')[0])
+
+    # later pages come back first
+    time.sleep(0.01 * (7 - start_row) / 7.0)
+
+    return {'msg': [{'id': ii} for ii in range(start_row, min(start_row + num_rows, 7))]}
+
+
+# like the sequential pager, whole pages are returned
+@pytest.mark.parametrize('total_rows,expected', [('all', 7), (5, 6)])
+def test_prefetch(rma, total_rows, expected):
+    with patch("allensdk.core.json_utilities.read_url_get",
+               side_effect=rows_by_start_row) as ju_read_url_get:
+
+        @pageable()
+        def get_genes(**kwargs):
+            return rma.model_query(model='Gene', **kwargs)
+
+        rows = list(get_genes(num_rows=2, total_rows=total_rows, prefetch=3))
+
+    assert rows == [{'id': ii} for ii in range(expected)]
+
+    urls = [c[0][0] for c in ju_read_url_get.call_args_list]
+    assert 'count$eqtrue' in urls[0]
+    assert len(urls) == 1 + (expected + 1) // 2
+
+
+def test_prefetch_decorator_default(rma):
+    with patch("allensdk.core.json_utilities.read_url_get",
+               side_effect=rows_by_start_row):
+
+        @pageable(num_rows=3, total_rows='all', prefetch=2)
+        def get_genes(**kwargs):
+            return rma.model_query(model='Gene', **kwargs)
+
+        rows = list(get_genes())
+
+    assert rows == [{'id': ii} for ii in range(7)]
+
+
+def test_prefetch_bounded(rma):
+    in_flight = []
+    max_in_flight = []
+
+    def fn(count_only=False, start_row=None, num_rows=None, count=None):
+        if count_only:
+            return 100
+
+        in_flight.append(start_row)
+        max_in_flight.append(len(in_flight))
+        time.sleep(0.001)
+        in_flight.remove(start_row)
+
+        return list(range(start_row, start_row + num_rows))
+
+    rows = RmaPager.pager(fn, num_rows=10, total_rows='all', prefetch=4)
+
+    assert list(rows) == list(range(100))
+    assert max(max_in_flight) <= 4
+
+
+@pytest.mark.parametrize('kwargs', [{'total_rows': 'all'}, {'num_rows': 3}])
+@pytest.mark.parametrize('prefetch', [None, 2])
+def test_pager_unpaged(kwargs, prefetch):
+    calls = []
+
+    def fn(count_only=False, start_row=None, num_rows=None, count=None):
+        calls.append((count_only, start_row, num_rows))
+        return [{'id': ii} for ii in range(7)]
+
+    rows = RmaPager.pager(fn, prefetch=prefetch, **kwargs)
+
+    assert list(rows) == [{'id': ii} for ii in range(7)]
+    assert calls == [(False, 0, kwargs.get('num_rows'))]
+
+
+def test_pager_total_rows_without_num_rows():
+    start_rows = []
+
+    # the server pages by 50 rows when num_rows is not given
+    def fn(start_row=None, count=None):
+        start_rows.append(start_row)
+        return [{'id': ii} for ii in range(start_row, min(start_row + 50, 120))]
+
+    rows = RmaPager.pager(fn, total_rows=120)
+
+    assert list(rows) == [{'id': ii} for ii in range(120)]
+    assert start_rows == [0, 50, 100]
+
+
+@pytest.mark.parametrize('total_rows,prefetch', [('all', None), (7, None), ('all', 2)])
+def test_pager_streamed_pages(total_rows, prefetch):
+    streamed = []
+
+    def fn(count_only=False, start_row=None, num_rows=None, count=None):
+        if count_only:
+            return 7
+
+        def rows():
+            for ii in range(start_row, min(start_row + num_rows, 7)):
+                streamed.append(ii)
+                yield {'id': ii}
+
+        return rows()
+
+    rows = RmaPager.pager(fn, num_rows=3, total_rows=total_rows, 
+                          prefetch=prefetch)
+
+    assert list(rows) == [{'id': ii} for ii in range(7)]
+    assert streamed == list(range(7))
+
+
+def test_pageable_stream(rma):
+    with patch("allensdk.core.json_utilities.read_url_get_rows",
+               side_effect=lambda url, **k: iter(rows_by_start_row(url)['msg'])) as get_rows:
+
+        @pageable(num_rows=2, total_rows='all')
+        def get_genes(**kwargs):
+            return rma.model_query(model='Gene', **kwargs)
+
+        rows = list(get_genes(stream=True))
+
+    assert rows == [{'id': ii} for ii in range(7)]
+    assert get_rows.call_count == 4
@@ -41,6 +41,12 @@ import numpy as np
 from allensdk.api.queries.reference_space_api import ReferenceSpaceApi as RSA
 
 
+@pytest.fixture(autouse=True)
+def in_tmpdir(tmpdir, monkeypatch):
+    # the relative cache paths used below land in a scratch directory
+    monkeypatch.chdir(tmpdir)
+
+
 @pytest.fixture
 def ref_space():
     rsa = RSA()
@@ -0,0 +1,166 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+import time
+
+import pandas as pd
+import pytest
+from requests.exceptions import HTTPError
+
+from allensdk.api.cache import Cache, cacheable
+from allensdk.api.queries.rma_api import RmaApi
+from allensdk.api.queries.rma_pager import pageable
+from .rma_server import (Recording, RecordingSession, replay_server, 
+                         request_key, rma_options, rma_rows)
+
+
+_genes = [{'id': ii, 'acronym': 'Gene{0}'.format(ii)} for ii in range(7)]
+
+
+@pytest.fixture
+def recording():
+    recording = Recording()
+    recording.add_route(r'model::Gene', rma_rows(_genes))
+    recording.add('/api/v2/well_known_file_download/1', b'0123456789' * 100)
+
+    return recording
+
+
+def test_rma_options():
+    key = request_key("http://api.brain-map.org/api/v2/data/query.json?q="
+                      "model::Gene,rma::options%5Bnum_rows$eq'all'%5D"
+                      "%5Bstart_row$eq20%5D%5Bcount$eqfalse%5D")
+
+    assert key.startswith('/api/v2/data/query.json?q=model::Gene')
+    assert rma_options(key) == {'num_rows': 'all', 'start_row': 20, 'count': False}
+
+
+def test_replay_model_query(recording):
+    with replay_server(recording) as url:
+        api = RmaApi(base_uri=url)
+
+        assert api.model_query('Gene', num_rows='all') == _genes
+        assert api.model_query('Gene', count_only=True) == len(_genes)
+        assert list(api.model_query('Gene', num_rows=3, start_row=3, 
+                                    stream=True)) == _genes[3:6]
+
+        with pytest.raises(HTTPError):
+            api.model_query('Donor')
+
+    assert len(url.requests) == 4
+
+
+@pytest.mark.parametrize('prefetch', [None, 2])
+def test_replay_pager(recording, prefetch):
+    with replay_server(recording) as url:
+        api = RmaApi(base_uri=url)
+
+        @pageable(num_rows=2, total_rows='all')
+        def get_genes(**kwargs):
+            return api.model_query('Gene', **kwargs)
+
+        assert list(get_genes(prefetch=prefetch)) == _genes
+
+
+def test_replay_cache(recording, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('replay').join('genes.csv'))
+
+    with replay_server(recording) as url:
+        api = RmaApi(base_uri=url)
+
+        @cacheable()
+        @pageable(num_rows=3, total_rows='all')
+        def get_genes(**kwargs):
+            return api.model_query('Gene', **kwargs)
+
+        for ii in range(2):
+            genes = get_genes(path=path, strategy='lazy', 
+                              **Cache.cache_csv_dataframe())
+
+    assert list(genes['acronym']) == [g['acronym'] for g in _genes]
+    assert len(url.requests) == 3
+
+
+def test_replay_latency_and_bandwidth(recording, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('replay').join('file.nwb'))
+
+    with replay_server(recording, latency=0.05, bandwidth=10000, 
+                       chunk_size=100) as url:
+        api = RmaApi(base_uri=url)
+
+        start = time.time()
+        api.retrieve_file_over_http(api.well_known_file_endpoint + '/1', path)
+        elapsed = time.time() - start
+
+    assert os.path.getsize(path) == 1000
+    assert elapsed > 0.05 + 0.09
+
+
+def test_replay_error_injection(recording, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('replay').join('file.nwb'))
+
+    # the first download is cut off halfway and resumed with a range request
+    with replay_server(recording, errors={0: 'truncate', 2: 503}) as url:
+        api = RmaApi(base_uri=url)
+        api.retrieve_file_over_http(api.well_known_file_endpoint + '/1', path)
+
+        with pytest.raises(HTTPError):
+            api.model_query('Gene')
+
+    with open(path, 'rb') as fil:
+        assert fil.read() == b'0123456789' * 100
+    assert len(url.requests) == 3
+
+
+def test_replay_error_rate(recording):
+    with replay_server(recording, errors=1.0) as url:
+        with pytest.raises(HTTPError):
+            RmaApi(base_uri=url).model_query('Gene')
+
+
+def test_record_and_replay(recording, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('replay').join('recording.json'))
+    captured = Recording()
+
+    with replay_server(recording) as url:
+        api = RmaApi(base_uri=url)
+        api.session = RecordingSession(captured)
+        live = api.model_query('Gene', num_rows=4)
+
+    captured.save(path)
+
+    with replay_server(Recording.load(path)) as url:
+        assert RmaApi(base_uri=url).model_query('Gene', num_rows=4) == live
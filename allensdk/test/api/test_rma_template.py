@@ -34,7 +34,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import pytest
-from mock import MagicMock, patch
+from mock import MagicMock, patch, ANY
 import allensdk.core.json_utilities as ju
 from allensdk.api.queries.rma_template import RmaTemplate
 
@@ -140,7 +140,8 @@ def test_atlases_list(ju_read_url_get, rma):
     ju_read_url_get.assert_called_once_with(
         "http://api.brain-map.org/api/v2/data/query.json?q="
         "model::Atlas,rma::options"
-        "%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D")
+        "%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -151,7 +152,8 @@ def test_structure_graphs_list(ju_read_url_get, rma):
     ju_read_url_get.assert_called_once_with(
         "http://api.brain-map.org/api/v2/data/query.json?q="
         "model::StructureGraph,rma::options"
-        "%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D")
+        "%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -162,7 +164,8 @@ def test_structure_sets_list(ju_read_url_get, rma):
     ju_read_url_get.assert_called_once_with(
         "http://api.brain-map.org/api/v2/data/query.json?q="
         "model::StructureSet,rma::options"
-        "%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D")
+        "%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -176,7 +179,8 @@ def test_structures_by_graph_ids(ju_read_url_get, rma):
         "model::Structure,rma::criteria,"
         "%5Bgraph_id$in1%5D,rma::options"
         "%5Bnum_rows$eq%27all%27%5D%5Border$eqstructures.graph_order%5D"
-        "%5Bcount$eqfalse%5D")
+        "%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -191,7 +195,8 @@ def test_structures_by_two_graph_ids(ju_read_url_get, rma):
         "%5Bgraph_id$in1,2%5D,"
         "rma::options"
         "%5Bnum_rows$eq%27all%27%5D"
-        "%5Border$eqstructures.graph_order%5D%5Bcount$eqfalse%5D")
+        "%5Border$eqstructures.graph_order%5D%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -206,7 +211,8 @@ def test_structures_by_graph_names(ju_read_url_get, rma):
         "graph%5Bstructure_graphs.name$in%27Human+Brain+Atlas%27%5D,"
         "rma::options"
         "%5Bnum_rows$eq%27all%27%5D"
-        "%5Border$eqstructures.graph_order%5D%5Bcount$eqfalse%5D")
+        "%5Border$eqstructures.graph_order%5D%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -219,7 +225,8 @@ def test_structures_by_set_ids(ju_read_url_get, rma):
         "http://api.brain-map.org/api/v2/data/query.json?q="
         "model::Structure,rma::criteria,"
         "%5Bgraph_id$in1%5D,rma::options%5Bnum_rows$eq%27all%27%5D"
-        "%5Border$eqstructures.graph_order%5D%5Bcount$eqfalse%5D")
+        "%5Border$eqstructures.graph_order%5D%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -232,7 +239,8 @@ def test_atlases_table(ju_read_url_get, rma):
         "model::Atlas,rma::criteria,"
         "structure_graph%28ontology%29,graphic_group_labels,"
         "rma::include,%5Bstructure_graph%28ontology%29,graphic_group_labels,"
-        "rma::options%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D")
+        "rma::options%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -246,7 +254,8 @@ def test_atlases_table_one_graph(ju_read_url_get, rma):
         "model::Atlas,rma::criteria,"
         "%5Bgraph_id$in1%5D,structure_graph%28ontology%29,graphic_group_labels,"
         "rma::include,%5Bstructure_graph%28ontology%29,graphic_group_labels,"
-        "rma::options%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D")
+        "rma::options%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D",
+        session=ANY)
 
 
 @patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
@@ -262,4 +271,113 @@ def test_atlases_table_brief(ju_read_url_get, rma):
         "rma::options%5Bonly$eq%27atlases.id,atlases.name,atlases.image_type,"
         "ontologies.id,ontologies.name,structure_graphs.id,structure_graphs.name,"
         "graphic_group_labels.id,graphic_group_labels.name%27%5D%5B"
-        "num_rows$eq%27all%27%5D%5Bcount$eqfalse%5D")
+        "num_rows$eq%27all%27%5D%5Bcount$eqfalse%5D",
+        session=ANY)
+
+
+def test_templates_compiled_once(rma):
+    with patch("allensdk.api.queries.rma_template.Template") as tmpl:
+        rma.templates = rma.templates
+
+        with patch.object(rma, 'model_query') as model_query:
+            for _ in range(3):
+                rma.template_query('ontology_queries',
+                                   'structures_by_graph_ids',
+                                   graph_ids=[1, 2])
+
+    assert model_query.call_count == 3
+    assert tmpl.call_count == 0
+
+
+def test_compile_templates_index(rma):
+    registry = rma.compile_templates(rma.templates)
+
+    assert len(registry) == len(rma.templates['ontology_queries'])
+
+    entry, criteria, include, only = \
+        registry[('ontology_queries', 'atlases_table_brief')]
+
+    assert entry['model'] == 'Atlas'
+    assert criteria.render() == entry['criteria']
+    assert include.render() == entry['include']
+    assert only == [rma.quote_string(','.join(entry['only']))]
+
+    entry, criteria, include, only = \
+        registry[('ontology_queries', 'atlases_list')]
+
+    assert criteria is None
+    assert include is None
+    assert only is None
+
+
+def test_template_query_entry_not_found(rma):
+    with pytest.raises(Exception) as e:
+        rma.template_query('ontology_queries', 'no_such_entry')
+
+    assert 'Entry no_such_entry not found.' in str(e.value)
+
+    with pytest.raises(KeyError):
+        rma.template_query('no_such_queries', 'atlases_list')
+
+
+@patch("allensdk.core.json_utilities.read_url_get", return_value=_msg)
+def test_template_added_after_construction(ju_read_url_get, rma):
+    rma.templates['ontology_queries'].append(
+        {'name': 'ontologies_list',
+         'model': 'Ontology',
+         'num_rows': 'all',
+         'count': False})
+
+    rma.template_query('ontology_queries', 'ontologies_list')
+
+    ju_read_url_get.assert_called_once_with(
+        "http://api.brain-map.org/api/v2/data/query.json?q="
+        "model::Ontology,rma::options"
+        "%5Bnum_rows$eq%27all%27%5D%5Bcount$eqfalse%5D",
+        session=ANY)
+
+
+@pytest.mark.nightly
+def test_template_query_benchmark():
+    import time
+    from allensdk.api.queries.brain_observatory_api import BrainObservatoryApi
+    from allensdk.api.queries.ontologies_api import OntologiesApi
+
+    # MouseConnectivityCache issues its templated queries through the
+    # ontology templates
+    apis = [BrainObservatoryApi(), OntologiesApi()]
+    queries = []
+
+    for api in apis:
+        for group, entries in api.templates.items():
+            for entry in entries:
+                params = entry.get('criteria_params', []) + \
+                    entry.get('include_params', [])
+                kwargs = {p: [1, 2, 3] for p in params}
+                queries.append((api, group, entry['name'], kwargs))
+
+    def run(repeats, compiled):
+        start = time.time()
+
+        for _ in range(repeats):
+            for api, group, name, kwargs in queries:
+                if not compiled:
+                    api._registry = {}
+                    RmaTemplate._compiled_templates.clear()
+                api.template_query(group, name, **kwargs)
+
+        return time.time() - start
+
+    with patch.object(RmaTemplate, 'json_msg_query', return_value=[]):
+        cold = run(20, compiled=False)
+
+        for api in apis:
+            api.templates = api.templates
+
+        warm = run(20, compiled=True)
+
+    n = 20 * len(queries)
+    print('%d template queries: %.1f us/query uncompiled, '
+          '%.1f us/query compiled' % (n, 1e6 * cold / n, 1e6 * warm / n))
+
+    assert warm < cold
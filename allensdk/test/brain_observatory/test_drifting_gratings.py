@@ -36,8 +36,12 @@
 from allensdk.brain_observatory.drifting_gratings import DriftingGratings
 from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
 
+import numpy as np
+import pandas as pd
+import scipy.stats as st
 import pytest
 from mock import patch, MagicMock
+from allensdk.test_utilities import legacy_analysis
 
 
 @pytest.fixture
@@ -162,3 +166,151 @@ def test_harness(dataset, trigger):
 
     assert dg._dxcm is DriftingGratings._PRELOAD
     assert dg._dxtime is DriftingGratings._PRELOAD
+
+
+@pytest.fixture
+def synthetic_dg():
+    rng = np.random.RandomState(2)
+    n_cells = 6
+    orivals = np.array([0, 90, 180])
+    tfvals = np.array([0, 1, 2])
+
+    conditions = [ (o, t) for o in orivals for t in tfvals[1:] ] + [ (0, 0) ]
+    stim_table = pd.DataFrame([ c for c in conditions for _ in range(8) ],
+                              columns=['orientation', 'temporal_frequency'])
+
+    mean_sweep_response = rng.randn(len(stim_table), n_cells + 1)
+    mean_sweep_response[:, 2] = 1.0  # a silent cell
+
+    dg = DriftingGratings(MagicMock(name='dataset'))
+    dg._stim_table = stim_table
+    dg._orivals = orivals
+    dg._tfvals = tfvals
+    dg._number_ori = len(orivals)
+    dg._number_tf = len(tfvals)
+    dg._numbercells = n_cells
+    dg._mean_sweep_response = pd.DataFrame(
+        mean_sweep_response,
+        columns=list(map(str, range(n_cells))) + ['dx'])
+    dg._response = rng.randn(len(orivals), len(tfvals), n_cells + 1, 3)
+
+    return dg
+
+
+def upper_correlation(a, b, corr):
+    fn = st.pearsonr if corr == 'pearson' else st.spearmanr
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return fn(a, b)
+
+
+@pytest.mark.parametrize('corr', ('pearson', 'spearman'))
+def test_correlations_match_pairwise(synthetic_dg, corr):
+    dg = synthetic_dg
+    n = dg.numbercells
+
+    signal = dg.response[:, 1:, :n, 0].reshape(-1, n).T
+    signal_corr, signal_p = dg.get_signal_correlation(corr)
+    rep_sim, rep_sim_p = dg.get_representational_similarity(corr)
+
+    for i in range(n):
+        for j in range(i, n):
+            r, p = upper_correlation(signal[i], signal[j], corr)
+            assert np.allclose([signal_corr[i, j], signal_corr[j, i]], r, equal_nan=True)
+            assert np.allclose([signal_p[i, j], signal_p[j, i]], p, equal_nan=True)
+
+    stims = signal.T
+    for i in range(len(stims)):
+        for j in range(i, len(stims)):
+            r, p = upper_correlation(stims[i], stims[j], corr)
+            assert np.allclose([rep_sim[i, j], rep_sim[j, i]], r, equal_nan=True)
+            assert np.allclose([rep_sim_p[i, j], rep_sim_p[j, i]], p, equal_nan=True)
+
+    response, response_blank = dg.reshape_response_array()
+    noise_corr, noise_corr_p, noise_corr_blank, noise_corr_blank_p = \
+        dg.get_noise_correlation(corr)
+
+    for k in range(dg.number_ori):
+        for l in range(dg.number_tf - 1):
+            for i in range(n):
+                for j in range(i, n):
+                    r, p = upper_correlation(response[i, k, l], response[j, k, l], corr)
+                    assert np.allclose([noise_corr[i, j, k, l], noise_corr[j, i, k, l]], r, equal_nan=True)
+                    assert np.allclose(noise_corr_p[i, j, k, l], p, equal_nan=True)
+                    if j > i:
+                        assert noise_corr_p[j, i, k, l] == 0
+
+    for i in range(n):
+        for j in range(i, n):
+            r, p = upper_correlation(response_blank[i], response_blank[j], corr)
+            assert np.allclose([noise_corr_blank[i, j], noise_corr_blank[j, i]], r, equal_nan=True)
+            assert np.allclose(noise_corr_blank_p[i, j], p, equal_nan=True)
+
+
+def synthetic_drifting_gratings(n_cells, n_trials=3, seed=0):
+    rng = np.random.RandomState(seed)
+    sweeplength = 60
+    interlength = 30
+
+    conditions = [ (o, t) for o in range(0, 360, 45) for t in (1, 2, 4, 8, 15) ]
+    conditions += [ (np.nan, np.nan) ] * 2
+    stim = np.array([ c for c in conditions for _ in range(n_trials) ])
+    rng.shuffle(stim)
+    starts = interlength + (sweeplength + interlength) * np.arange(len(stim))
+    n_samples = starts[-1] + sweeplength + 2 * interlength
+
+    tuning = rng.rand(n_cells, len(conditions)) ** 4
+    codes = [ conditions.index(tuple(c)) if not np.isnan(c[0]) else len(conditions) - 1
+              for c in stim ]
+    celltraces = 1 + 0.05 * rng.randn(n_cells, n_samples)
+    for start, code in zip(starts, codes):
+        celltraces[:, start:start + sweeplength] += tuning[:, code][:, np.newaxis]
+
+    data_set = MagicMock(name='data_set')
+    data_set.get_stimulus_table.return_value = pd.DataFrame({
+        'orientation': stim[:, 0], 'temporal_frequency': stim[:, 1],
+        'start': starts, 'end': starts + sweeplength })
+    data_set.get_corrected_fluorescence_traces.return_value = \
+        (np.arange(n_samples) / 30.0, celltraces)
+    data_set.get_running_speed.return_value = \
+        (rng.gamma(0.2, 5.0, size=n_samples), np.arange(n_samples) / 30.0)
+    data_set.get_cell_specimen_ids.return_value = np.arange(n_cells) + 1000
+
+    return DriftingGratings(data_set)
+
+
+def test_get_response_matches_loop():
+    dg = synthetic_drifting_gratings(n_cells=5)
+
+    assert np.allclose(dg.get_response(),
+                       legacy_analysis.drifting_gratings_response(dg), equal_nan=True)
+
+
+def test_get_peak_matches_loop():
+    dg = synthetic_drifting_gratings(n_cells=6, n_trials=8)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = legacy_analysis.drifting_gratings_peak(dg)
+    peak = dg.get_peak()
+
+    legacy_analysis.assert_frames_close(
+        peak, expected,
+        exact=('ori_dg', 'tf_dg', 'cell_specimen_id'),
+        close=('reliability_dg', 'osi_dg', 'dsi_dg', 'peak_dff_dg',
+               'ptest_dg', 'p_run_dg', 'run_modulation_dg', 'cv_os_dg',
+               'cv_ds_dg', 'tf_index_dg'))
+    assert not np.isnan(peak.p_run_dg.values.astype(float)).all()
+
+
+@pytest.mark.nightly
+def test_get_peak_benchmark():
+    dg = synthetic_drifting_gratings(n_cells=100, n_trials=15)
+    dg.sweep_response, dg.response
+
+    expected, loop_time = legacy_analysis.timed(
+        legacy_analysis.drifting_gratings_peak, dg)
+    peak, array_time = legacy_analysis.timed(dg.get_peak)
+
+    print("loop %.3fs, array %.3fs" % (loop_time, array_time))
+
+    legacy_analysis.assert_frames_close(
+        peak, expected, close=('ptest_dg', 'reliability_dg'))
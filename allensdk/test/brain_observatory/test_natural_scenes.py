@@ -34,9 +34,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 from allensdk.brain_observatory.natural_scenes import NaturalScenes
+import allensdk.brain_observatory.natural_scenes as natural_scenes
 from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
+import numpy as np
+import pandas as pd
 import pytest
 from mock import patch, MagicMock
+from allensdk.test_utilities import legacy_analysis
 
 
 @pytest.fixture
@@ -161,3 +165,76 @@ def test_harness(dataset, trigger):
 
     assert ns._dxcm is NaturalScenes._PRELOAD
     assert ns._dxtime is NaturalScenes._PRELOAD
+
+
+def synthetic_natural_scenes(n_cells, n_trials=4, seed=0):
+    rng = np.random.RandomState(seed)
+    sweeplength = 7
+    interlength = 4 * sweeplength
+
+    frames = np.repeat(np.arange(-1, 118), n_trials)
+    rng.shuffle(frames)
+    starts = interlength + sweeplength * np.arange(len(frames))
+    n_samples = starts[-1] + sweeplength + 2 * interlength
+
+    tuning = rng.rand(n_cells, 119) ** 4
+    celltraces = 1 + 0.05 * rng.randn(n_cells, n_samples)
+    for start, frame in zip(starts, frames):
+        celltraces[:, start + 2:start + sweeplength + 2] += \
+            tuning[:, frame + 1][:, np.newaxis]
+
+    data_set = MagicMock(name='data_set')
+    data_set.get_stimulus_table.return_value = pd.DataFrame({
+        'frame': frames, 'start': starts, 'end': starts + sweeplength })
+    data_set.get_corrected_fluorescence_traces.return_value = \
+        (np.arange(n_samples) / 30.0, celltraces)
+    data_set.get_running_speed.return_value = \
+        (rng.gamma(0.2, 5.0, size=n_samples), np.arange(n_samples) / 30.0)
+    data_set.get_cell_specimen_ids.return_value = np.arange(n_cells) + 1000
+
+    return NaturalScenes(data_set)
+
+
+def test_image_selectivity():
+    rng = np.random.RandomState(1)
+    responses = rng.randn(4, 20)
+    responses[1] = np.round(responses[1])  # responses equal to thresholds
+    responses[2] = 3.0
+
+    expected = []
+    for row in responses:
+        fmin, fmax = row.min(), row.max()
+        rtj = [ (row > fmin + j * ((fmax - fmin) / 50.)).mean() for j in range(50) ]
+        expected.append(1 - 2 * np.mean(rtj))
+
+    assert np.allclose(natural_scenes.image_selectivity(responses, 50), expected)
+
+
+def test_get_peak_matches_loop():
+    ns = synthetic_natural_scenes(n_cells=6, n_trials=12)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = legacy_analysis.natural_scenes_peak(ns)
+    peak = ns.get_peak()
+
+    legacy_analysis.assert_frames_close(
+        peak, expected,
+        exact=('scene_ns', 'cell_specimen_id'),
+        close=('reliability_ns', 'peak_dff_ns', 'ptest_ns', 'p_run_ns',
+               'run_modulation_ns', 'time_to_peak_ns', 'image_selectivity_ns'))
+
+
+@pytest.mark.nightly
+def test_get_peak_benchmark():
+    ns = synthetic_natural_scenes(n_cells=100, n_trials=50)
+    ns.sweep_response, ns.response
+
+    expected, loop_time = legacy_analysis.timed(
+        legacy_analysis.natural_scenes_peak, ns)
+    peak, array_time = legacy_analysis.timed(ns.get_peak)
+
+    print("loop %.3fs, array %.3fs" % (loop_time, array_time))
+
+    legacy_analysis.assert_frames_close(
+        peak, expected, close=('reliability_ns', 'image_selectivity_ns'))
+
@@ -77,3 +77,56 @@ def test_init_by_pixels_large():
     npx = len(np.where(a)[0])
     assert npx == len(np.where(m.get_mask_plane())[0])
 
+
+
+def test_create_roi_mask_array():
+    a = np.zeros((6, 5), dtype=np.uint8)
+    a[1:3, 2:4] = 1
+    b = np.zeros((6, 5), dtype=np.uint8)
+    b[5, 0] = 1
+
+    rois = [roi_masks.create_roi_mask(5, 6, [0, 0, 0, 0], roi_mask=m)
+            for m in [a, b]]
+    arr = roi_masks.create_roi_mask_array(rois)
+
+    assert arr.dtype == np.uint8
+    assert np.array_equal(arr, np.array([a, b]))
+    assert roi_masks.create_roi_mask_array([]) is None
+
+
+def test_roi_mask_set():
+    rng = np.random.RandomState(0)
+    planes = (rng.random_sample((5, 20, 30)) > 0.9).astype(np.uint8)
+    planes[3] = 0
+    planes[4, :, :] = 0
+    planes[4, 7, 11] = 1
+
+    mask_set = roi_masks.RoiMaskSet.from_planes(iter(planes),
+                                                labels=list('abcde'))
+    assert len(mask_set) == 5
+    assert np.array_equal(mask_set.to_dense(), planes)
+    assert np.array_equal(mask_set.combined_mask(), planes.max(axis=0) > 0)
+    assert mask_set.nbytes < planes.nbytes
+
+    out = np.ones(planes.shape, dtype=np.float32)
+    assert mask_set.to_dense(out=out) is out
+    assert np.array_equal(out, planes)
+
+    # bounding boxes match RoiMask
+    for i in [0, 1, 2, 4]:
+        m = roi_masks.create_roi_mask(30, 20, [0, 0, 0, 0], roi_mask=planes[i])
+        assert (mask_set.x[i], mask_set.y[i], mask_set.width[i], mask_set.height[i]) == \
+            (m.x, m.y, m.width, m.height)
+
+        m = mask_set.get_roi_mask(i)
+        assert m.label == 'abcde'[i]
+        assert np.array_equal(m.get_mask_plane(), planes[i])
+
+    assert mask_set.width[3] == 0 and mask_set.height[3] == 0
+    assert mask_set.pixels(4) == (7, 11)
+
+    rois = [mask_set.get_roi_mask(i) for i in [0, 1, 2, 4]]
+    from_masks = roi_masks.RoiMaskSet.from_masks(rois)
+    assert np.array_equal(from_masks.to_dense(), planes[[0, 1, 2, 4]])
+    assert np.array_equal(from_masks.to_dense(),
+                          roi_masks.create_roi_mask_array(rois))
@@ -35,8 +35,11 @@
 #
 from allensdk.brain_observatory.static_gratings import StaticGratings
 from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
+import numpy as np
+import pandas as pd
 import pytest
 from mock import patch, MagicMock
+from allensdk.test_utilities import legacy_analysis
 
 
 @pytest.fixture
@@ -196,3 +199,75 @@ def test_harness(dataset, trigger):
 
     assert sg._dxcm is StaticGratings._PRELOAD
     assert sg._dxtime is StaticGratings._PRELOAD
+
+
+def synthetic_static_gratings(n_cells, n_trials=3, seed=0):
+    rng = np.random.RandomState(seed)
+    sweeplength = 7
+    interlength = 4 * sweeplength
+
+    conditions = [ (o, s, p) for o in range(0, 180, 30)
+                   for s in (0.02, 0.04, 0.08, 0.16, 0.32)
+                   for p in (0, 0.25, 0.5, 0.75) ]
+    blank = len(conditions)
+    codes = np.repeat(np.arange(blank + 1), n_trials)
+    rng.shuffle(codes)
+    stim = np.array(conditions + [ (np.nan, np.nan, np.nan) ])[codes]
+    starts = interlength + sweeplength * np.arange(len(stim))
+    n_samples = starts[-1] + sweeplength + 2 * interlength
+
+    tuning = rng.rand(n_cells, blank + 1) ** 4
+    celltraces = 1 + 0.05 * rng.randn(n_cells, n_samples)
+    for start, code in zip(starts, codes):
+        celltraces[:, start + 2:start + sweeplength + 2] += \
+            tuning[:, code][:, np.newaxis]
+
+    data_set = MagicMock(name='data_set')
+    data_set.get_stimulus_table.return_value = pd.DataFrame({
+        'orientation': stim[:, 0], 'spatial_frequency': stim[:, 1],
+        'phase': stim[:, 2], 'start': starts, 'end': starts + sweeplength })
+    data_set.get_corrected_fluorescence_traces.return_value = \
+        (np.arange(n_samples) / 30.0, celltraces)
+    data_set.get_running_speed.return_value = \
+        (rng.gamma(0.2, 5.0, size=n_samples), np.arange(n_samples) / 30.0)
+    data_set.get_cell_specimen_ids.return_value = np.arange(n_cells) + 1000
+
+    return StaticGratings(data_set)
+
+
+def test_get_response_matches_loop():
+    sg = synthetic_static_gratings(n_cells=5)
+
+    assert np.allclose(sg.get_response(),
+                       legacy_analysis.static_gratings_response(sg), equal_nan=True)
+
+
+def test_get_peak_matches_loop():
+    sg = synthetic_static_gratings(n_cells=6, n_trials=12)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = legacy_analysis.static_gratings_peak(sg)
+    peak = sg.get_peak()
+
+    legacy_analysis.assert_frames_close(
+        peak, expected,
+        exact=('ori_sg', 'sf_sg', 'phase_sg', 'cell_specimen_id'),
+        close=('reliability_sg', 'osi_sg', 'peak_dff_sg', 'ptest_sg',
+               'time_to_peak_sg', 'p_run_sg', 'run_modulation_sg',
+               'cv_os_sg', 'sf_index_sg'))
+    assert not np.isnan(peak.p_run_sg.values.astype(float)).all()
+
+
+@pytest.mark.nightly
+def test_get_peak_benchmark():
+    sg = synthetic_static_gratings(n_cells=100, n_trials=15)
+    sg.sweep_response, sg.response
+
+    expected, loop_time = legacy_analysis.timed(
+        legacy_analysis.static_gratings_peak, sg)
+    peak, array_time = legacy_analysis.timed(sg.get_peak)
+
+    print("loop %.3fs, array %.3fs" % (loop_time, array_time))
+
+    legacy_analysis.assert_frames_close(
+        peak, expected, close=('ptest_sg', 'reliability_sg'))
@@ -34,8 +34,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 from allensdk.brain_observatory.stimulus_analysis import StimulusAnalysis
+import allensdk.brain_observatory.stimulus_analysis as sa_module
+import numpy as np
+import pandas as pd
+import scipy.stats as st
 import pytest
 from mock import patch, MagicMock
+from allensdk.test_utilities import legacy_analysis
 
 
 @pytest.fixture
@@ -138,3 +143,247 @@ def test_harness(dataset,
         assert sa._binned_dx_vis is not StimulusAnalysis._PRELOAD
         assert sa._binned_cells_vis is not StimulusAnalysis._PRELOAD
         assert sa._peak_run is not StimulusAnalysis._PRELOAD
+
+
+def synthetic_analysis(n_cells, n_sweeps=60, sweeplength=7, interlength=28,
+                       extralength=7, seed=0):
+    rng = np.random.RandomState(seed)
+    spacing = sweeplength + 3
+    n_samples = 2 * interlength + spacing * n_sweeps
+
+    sa = StimulusAnalysis(MagicMock(name='dataset'))
+    sa.sweeplength = sweeplength
+    sa.interlength = interlength
+    sa.extralength = extralength
+    sa._celltraces = 1 + rng.rand(n_cells, n_samples)
+    sa._numbercells = n_cells
+    sa._dxcm = rng.randn(n_samples)
+    sa._stim_table = pd.DataFrame({
+        'start': interlength + spacing * np.arange(n_sweeps),
+        'end': interlength + spacing * np.arange(n_sweeps) + sweeplength },
+        index=np.arange(n_sweeps) + 5)
+
+    return sa
+
+
+def test_get_sweep_response_matches_loop():
+    sa = synthetic_analysis(n_cells=5)
+    expected = legacy_analysis.sweep_response(sa)
+
+    sweep_response = sa.sweep_response
+    mean_sweep_response = sa.mean_sweep_response
+    pval = sa.pval
+
+    assert sa.sweep_response_array.shape == (60, 6, 7 + 2 * 28)
+    assert list(sweep_response.columns) == list(expected[0].columns)
+    assert np.array_equal(sweep_response.index.values,
+                          expected[0].index.values)
+
+    for column in sweep_response.columns:
+        for index in sweep_response.index:
+            assert np.allclose(sweep_response[column][index],
+                               expected[0][column][index])
+
+    assert list(mean_sweep_response.columns) == list(expected[1].columns)
+    assert np.allclose(mean_sweep_response.values,
+                       expected[1].values.astype(float))
+    assert np.allclose(pval.values, expected[2].values.astype(float))
+
+
+def test_sweep_response_statistics():
+    rng = np.random.RandomState(3)
+    responses = rng.randn(10, 4, 30)
+    responses[0, 0, :] = 2.0
+    responses[1, 1, 12:] += 5.0
+
+    mean_response, p_values = sa_module.sweep_response_statistics(
+        responses, 12, 15, chunk_size=3)
+
+    for i in range(10):
+        for j in range(4):
+            x = responses[i, j]
+            assert np.isclose(mean_response[i, j], x[12:27].mean())
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                _, p = st.f_oneway(x[:12], x[12:27])
+            assert np.isclose(p_values[i, j], p, equal_nan=True)
+
+
+def test_get_sweep_response_array_out_of_range():
+    sa = synthetic_analysis(n_cells=2, n_sweeps=4)
+    sa._stim_table.loc[sa._stim_table.index[-1], 'start'] += 40
+
+    responses = sa.get_sweep_response_array()
+
+    assert np.all(np.isfinite(responses[:-1]))
+    assert np.isnan(responses[-1, :, -1]).all()
+
+
+@pytest.mark.parametrize('overhang', (10, 30, 40))
+def test_get_sweep_response_truncated_matches_loop(overhang):
+    sa = synthetic_analysis(n_cells=3, n_sweeps=6)
+    sa._stim_table.loc[sa._stim_table.index[-1], 'start'] += overhang
+    expected = legacy_analysis.sweep_response(sa)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sweep_response, mean_sweep_response, pval = sa.get_sweep_response()
+
+    for column in sweep_response.columns:
+        for index in sweep_response.index:
+            assert np.allclose(sweep_response[column][index],
+                               expected[0][column][index])
+
+    assert np.allclose(mean_sweep_response.values,
+                       expected[1].values.astype(float), equal_nan=True)
+    assert np.allclose(pval.values, expected[2].values.astype(float),
+                       equal_nan=True)
+
+
+@pytest.mark.nightly
+@pytest.mark.parametrize('n_cells', (100, 500, 1000))
+def test_get_sweep_response_benchmark(n_cells):
+    sa = synthetic_analysis(n_cells=n_cells, n_sweeps=120,
+                            sweeplength=60, interlength=30, extralength=0)
+
+    loop, loop_time = legacy_analysis.timed(legacy_analysis.sweep_response, sa)
+    (_, mean_sweep_response, pval), array_time = \
+        legacy_analysis.timed(sa.get_sweep_response)
+
+    print("%d cells: loop %.3fs, array %.3fs" % (n_cells, loop_time,
+                                                 array_time))
+
+    assert np.allclose(mean_sweep_response.values, loop[1].values.astype(float))
+    assert np.allclose(pval.values, loop[2].values.astype(float))
+
+
+
+def pairwise_correlation(data, corr):
+    fn = st.pearsonr if corr == 'pearson' else st.spearmanr
+    n = len(data)
+    r = np.empty((n, n))
+    p = np.empty((n, n))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(n):
+            for j in range(n):
+                r[i, j], p[i, j] = fn(data[i], data[j])
+
+    return r, p
+
+
+@pytest.mark.parametrize('corr', ('pearson', 'spearman'))
+@pytest.mark.parametrize('block_size', (None, 1, 4))
+def test_correlation_matrix(corr, block_size):
+    rng = np.random.RandomState(7)
+    data = rng.randn(9, 25)
+    data[1] = np.round(data[1])  # ties
+    data[2] = data[0] * 3 + 1  # perfectly correlated
+    data[3] = 2.0  # no variance
+    data[4, 5] = np.nan
+
+    expected_r, expected_p = pairwise_correlation(data, corr)
+    r, p = sa_module.correlation_matrix(data, corr, block_size=block_size)
+
+    assert np.allclose(r, expected_r, equal_nan=True)
+    assert np.allclose(p, expected_p, equal_nan=True, atol=1e-12)
+
+
+def test_correlation_matrix_bad_corr():
+    with pytest.raises(Exception):
+        sa_module.correlation_matrix(np.ones((3, 4)), 'kendall')
+
+
+@pytest.mark.nightly
+def test_correlation_matrix_benchmark():
+    data = np.random.RandomState(0).randn(200, 120)
+
+    (expected_r, expected_p), loop_time = legacy_analysis.timed(
+        pairwise_correlation, data, 'spearman')
+    (r, p), matrix_time = legacy_analysis.timed(
+        sa_module.correlation_matrix, data, 'spearman')
+
+    print("pairwise %.3fs, matrix %.3fs" % (loop_time, matrix_time))
+
+    assert np.allclose(r, expected_r)
+    assert np.allclose(p, expected_p, atol=1e-12)
+
+
+def synthetic_speed_analysis(n_cells, n_samples=6000, seed=0):
+    rng = np.random.RandomState(seed)
+
+    dxcm = rng.gamma(0.5, 8.0, size=n_samples)
+    dxcm[rng.rand(n_samples) < 0.01] = np.nan
+    dxcm[1000:3000][np.isnan(dxcm[1000:3000])] = 0.0
+
+    dfftraces = rng.randn(n_cells, n_samples + 10) * 0.1
+    dfftraces[:, :n_samples] += 0.02 * np.nan_to_num(dxcm)[np.newaxis, :] * \
+        rng.rand(n_cells)[:, np.newaxis]
+
+    data_set = MagicMock(name='data_set')
+    data_set.get_stimulus_table.return_value = pd.DataFrame(
+        {'start': [1000, 4000], 'end': [2500, 4600]})
+
+    sa = StimulusAnalysis(data_set)
+    sa._dfftraces = dfftraces
+    sa._dxcm = dxcm
+    sa._numbercells = n_cells
+
+    return sa
+
+
+@pytest.mark.parametrize('chunk_size', (None, 7))
+def test_get_speed_tuning_matches_loop(chunk_size):
+    sa = synthetic_speed_analysis(n_cells=8)
+
+    np.random.seed(11)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = legacy_analysis.speed_tuning(sa, 100)
+
+    actual = sa.get_speed_tuning(100, seed=11, chunk_size=chunk_size)
+
+    for e, a in zip(expected[:4], actual[:4]):
+        assert np.allclose(e, a, equal_nan=True)
+
+    legacy_analysis.assert_frames_close(
+        actual[4], expected[4],
+        exact=('mod_sp', 'mod_vis'),
+        close=('speed_max_sp', 'speed_min_sp', 'ptest_sp',
+               'speed_max_vis', 'speed_min_vis', 'ptest_vis'))
+
+
+def test_shuffled_bin_means():
+    rng = np.random.RandomState(4)
+    traces = rng.randn(3, 50)
+    order = rng.permutation(50)
+    edges = np.array([0, 12, 30, 48, 50, 50])
+
+    means = sa_module._shuffled_bin_means(traces, order, edges, 5,
+                                          np.random.RandomState(9),
+                                          chunk_size=2)
+
+    reference_rng = np.random.RandomState(9)
+    for shuf in range(5):
+        shuffled = traces[:, reference_rng.permutation(50)][:, order]
+        for i in range(4):
+            assert np.allclose(means[:, i, shuf],
+                               shuffled[:, edges[i]:edges[i + 1]].mean(axis=1))
+        assert np.isnan(means[:, 4, shuf]).all()
+
+
+@pytest.mark.nightly
+def test_get_speed_tuning_benchmark():
+    sa = synthetic_speed_analysis(n_cells=200, n_samples=30000)
+    sa.data_set.get_stimulus_table.return_value = pd.DataFrame(
+        {'start': [1000, 20000], 'end': [10000, 26000]})
+
+    np.random.seed(0)
+    expected, loop_time = legacy_analysis.timed(
+        legacy_analysis.speed_tuning, sa, 800)
+    actual, batch_time = legacy_analysis.timed(
+        sa.get_speed_tuning, 800, seed=0)
+
+    print("loop %.3fs, batched %.3fs" % (loop_time, batch_time))
+
+    for e, a in zip(expected[:4], actual[:4]):
+        assert np.allclose(e, a, equal_nan=True)
+
@@ -1,6 +1,7 @@
 import pytest
 import numpy as np
 import os
+import pandas as pd
 from allensdk.core.brain_observatory_nwb_data_set import BrainObservatoryNwbDataSet, si
 import numpy as np
 from pkg_resources import resource_filename  # @UnresolvedImport
@@ -53,6 +54,69 @@ def test_StimulusSearch(data_set):
     assert len(s.search(752)) == 3
 
 
+def test_IntervalIndex():
+    index = si.IntervalIndex([3, 0, 2, 1], [3.9, 0.9, 2.9, 1.9])
+    assert list(index.search([1.5, 0, 2.5, 3.5, 4, -1])) == [1, 0, 2, 3, -1, -1]
+
+    # shared endpoints belong to the interval that starts there
+    index = si.IntervalIndex([0, 1, 3], [1, 2, 3])
+    assert list(index.search([0, 1, 1.5, 2, 3])) == [0, 1, 1, -1, 2]
+
+
+@pytest.fixture
+def stimulus_search():
+    class DataSet(object):
+        def get_stimulus_epoch_table(self):
+            return pd.DataFrame({'stimulus': ['a', 'b', 'a', 'c'],
+                                 'start': [0, 20, 30, 50],
+                                 'end': [20, 28, 45, 50]})
+
+        def get_stimulus_table(self, stimulus_name):
+            assert stimulus_name == 'master'
+            return pd.DataFrame({'stimulus': ['a', 'a', 'b', 'a', 'a', 'c', 'z'],
+                                 'start': [2, 10, 21, 30, 40, 50, 60],
+                                 'end': [5, 10, 25, 35, 44, 50, 62]})
+
+    return si.StimulusSearch(DataSet())
+
+
+def test_StimulusSearch_synthetic(stimulus_search):
+    expected = {
+        -1: None, 0: None, 1: None, 2: 0, 4: 0,
+        # between presentations of an epoch: the most recent one
+        5: 0, 9: 0, 10: 1, 11: 1, 19: 1,
+        # back-to-back epochs carry the most recent presentation forward
+        20: 1,
+        # outside of any epoch
+        28: None, 29: None,
+        21: 2, 27: 2, 30: 3, 37: 3, 40: 4, 44: 4,
+        45: None, 50: 5, 51: None,
+        # presentations outside of an epoch are still found
+        60: 6, 61: 6, 62: None
+    }
+
+    for frame, row in expected.items():
+        result = stimulus_search.search(frame)
+        if row is None:
+            assert result is None
+        else:
+            assert result[2] == stimulus_search.master_df.iloc[row].to_dict()
+            assert result[0] <= frame
+
+    frames = np.array(sorted(expected))
+    rows = stimulus_search.search_indices(frames)
+    assert list(rows) == [-1 if expected[f] is None else expected[f] for f in frames]
+
+    table = stimulus_search.search_many(frames)
+    assert len(table) == len(frames)
+    assert list(table.columns) == list(stimulus_search.master_df.columns)
+    assert table.stimulus.isnull().sum() == sum(r is None for r in expected.values())
+    assert table.start.iloc[list(frames).index(19)] == 10
+
+    with pytest.raises(ValueError):
+        stimulus_search.search([1, 2])
+
+
 def test_sessions_with_stimulus():
 
     for session_type, stimulus_type_list in si.SESSION_STIMULUS_MAP.items():
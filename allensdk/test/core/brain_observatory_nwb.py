@@ -0,0 +1,225 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Writes small synthetic Brain Observatory NWB files.
+
+The files follow the layout read by BrainObservatoryNwbDataSet (pipeline
+version 3.0) so that readers and analyses can be exercised without
+downloading a real experiment.
+'''
+import h5py
+import numpy as np
+
+import allensdk.brain_observatory.stimulus_info as si
+from allensdk.core.brain_observatory_nwb_data_set import \
+    BrainObservatoryNwbDataSet
+
+
+PIPELINE = 'processing/%s' % BrainObservatoryNwbDataSet.PIPELINE_DATASET
+
+ORIENTATIONS = [0., 30., 60., 90., 120., 150.]
+SPATIAL_FREQUENCIES = [0.02, 0.04, 0.08, 0.16, 0.32]
+PHASES = [0., 0.25, 0.5, 0.75]
+
+
+def _static_gratings(rng, n_trials):
+    data = np.column_stack([
+        rng.choice(ORIENTATIONS, n_trials),
+        rng.choice(SPATIAL_FREQUENCIES, n_trials),
+        rng.choice(PHASES, n_trials)])
+
+    # some blank sweeps
+    data[rng.rand(n_trials) < 0.05, :] = np.nan
+
+    return data
+
+
+def _write_trials(f, name, starts, sweep, data, features=None):
+    group = f.create_group('stimulus/presentation/%s_stimulus' % name)
+    group['data'] = data
+    group['frame_duration'] = np.column_stack(
+        [starts, starts + sweep]).astype(float)
+
+    if features is not None:
+        group['features'] = np.array(features, dtype='S')
+
+    return group
+
+
+def write_brain_observatory_nwb(path,
+                                n_cells=10,
+                                n_trials=120,
+                                n_scenes=118,
+                                movie_frames=30,
+                                movie_repeats=10,
+                                sweep=7,
+                                gap=60,
+                                mask_shape=(64, 64),
+                                seed=0,
+                                session_type=si.THREE_SESSION_B):
+    ''' Write a synthetic session with static gratings, natural scenes, a
+    natural movie and spontaneous activity.
+
+    Static gratings and natural scenes are each shown in two epochs of
+    `n_trials` back-to-back sweeps of `sweep` frames, separated by `gap`
+    frames, which matches the epoch structure of a three_session_B
+    experiment.
+
+    Parameters
+    ----------
+    path: string
+        File to write.
+    n_cells: int
+        Number of ROIs.
+    n_trials: int
+        Number of sweeps per grating/scene epoch.
+    seed: int
+        Seed for the random traces and stimulus order.
+
+    Returns
+    -------
+    string
+        `path`
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    cursor = gap
+    epochs = []
+
+    def epoch(stimulus, n, length):
+        starts = cursor + np.arange(n) * length
+        epochs.append((stimulus, starts))
+        return starts[-1] + length + gap
+
+    for stimulus in [si.STATIC_GRATINGS, si.NATURAL_SCENES,
+                     si.SPONTANEOUS_ACTIVITY, si.NATURAL_MOVIE_ONE,
+                     si.STATIC_GRATINGS, si.NATURAL_SCENES]:
+        if stimulus == si.SPONTANEOUS_ACTIVITY:
+            cursor = epoch(stimulus, 1, 10 * gap)
+        elif stimulus == si.NATURAL_MOVIE_ONE:
+            cursor = epoch(stimulus, movie_frames * movie_repeats, 1)
+        else:
+            cursor = epoch(stimulus, n_trials, sweep)
+
+    n_frames = int(cursor)
+    timestamps = np.arange(n_frames) / 30.
+
+    with h5py.File(path, 'w') as f:
+        f['general/session_type'] = np.string_(session_type)
+        f['general/generated_by'] = np.array(
+            ['synthetic', 'pipeline_version', '3.0'], dtype='S')
+        f['general/session_id'] = np.string_('1')
+        f['general/experiment_container_id'] = np.string_('2')
+        f['general/subject/genotype'] = np.string_(
+            'Cux2-CreERT2/wt;Camk2a-tTA/wt;Ai93(TITL-GCaMP6f)/wt')
+        f['general/optophysiology/imaging_plane_1/imaging depth'] = \
+            np.string_('175 microns')
+        f['general/optophysiology/imaging_plane_1/location'] = \
+            np.string_('VISp')
+        f.create_group('analysis')
+
+        for name in [si.STATIC_GRATINGS, si.NATURAL_SCENES]:
+            starts = np.concatenate([s for st, s in epochs if st == name])
+            if name == si.STATIC_GRATINGS:
+                _write_trials(f, name, starts, sweep,
+                              _static_gratings(rng, len(starts)),
+                              ['orientation', 'spatial_frequency', 'phase'])
+            else:
+                # every scene, and the blank sweep (-1), is shown
+                scenes = np.resize(np.arange(-1, n_scenes), len(starts))
+                _write_trials(f, name, starts, sweep, rng.permutation(scenes))
+
+        starts = np.concatenate([s for st, s in epochs
+                                 if st == si.NATURAL_MOVIE_ONE])
+        _write_trials(f, si.NATURAL_MOVIE_ONE, starts, 1,
+                      np.tile(np.arange(movie_frames), movie_repeats))
+
+        starts = np.concatenate([s for st, s in epochs
+                                 if st == si.SPONTANEOUS_ACTIVITY])
+        spontaneous = f.create_group(
+            'stimulus/presentation/%s_stimulus' % si.SPONTANEOUS_ACTIVITY)
+        spontaneous['data'] = np.tile([1, -1], len(starts))
+        spontaneous['frame_duration'] = np.column_stack([
+            np.ravel(np.column_stack([starts, starts + 10 * gap])),
+            np.ravel(np.column_stack([starts, starts + 10 * gap])) + 1
+        ]).astype(float)
+
+        f['stimulus/templates/%s_image_stack/data' % si.NATURAL_SCENES] = \
+            rng.randint(0, 255, (n_scenes, 32, 48)).astype(np.uint8)
+        f['stimulus/templates/%s_image_stack/data' % si.NATURAL_MOVIE_ONE] = \
+            rng.randint(0, 255, (movie_frames, 32, 48)).astype(np.uint8)
+
+        fluorescence = rng.rand(n_cells, n_frames) + 1.0
+        f[PIPELINE + '/Fluorescence/imaging_plane_1/data'] = fluorescence
+        f[PIPELINE + '/Fluorescence/imaging_plane_1/timestamps'] = timestamps
+        f[PIPELINE + '/Fluorescence/imaging_plane_1_demixed_signal/data'] = \
+            fluorescence * 0.95
+        f[PIPELINE + '/Fluorescence/imaging_plane_1_neuropil_response/data'] = \
+            rng.rand(n_cells, n_frames) * 0.1
+        f[PIPELINE + '/Fluorescence/imaging_plane_1_neuropil_response/r'] = \
+            np.full(n_cells, 0.7)
+        f[PIPELINE + '/DfOverF/imaging_plane_1/data'] = \
+            rng.randn(n_cells, n_frames) * 0.1
+        f[PIPELINE + '/DfOverF/imaging_plane_1/timestamps'] = timestamps
+        f[PIPELINE + '/BehavioralTimeSeries/running_speed/data'] = \
+            np.abs(rng.randn(n_frames)) * 3
+        f[PIPELINE + '/BehavioralTimeSeries/running_speed/timestamps'] = \
+            timestamps
+
+        motion = PIPELINE + '/MotionCorrection/2p_image_series/xy_translation'
+        f[motion + '/data'] = rng.randn(n_frames, 2)
+        f[motion + '/timestamps'] = timestamps
+        f[motion + '/feature_description'] = np.array(['x', 'y'], dtype='S')
+
+        segmentation = PIPELINE + '/ImageSegmentation'
+        roi_names = ['roi_%d' % i for i in range(n_cells)]
+        f[segmentation + '/roi_ids'] = np.array(roi_names, dtype='S')
+        f[segmentation + '/cell_specimen_ids'] = \
+            np.arange(n_cells, dtype=np.int64) + 500000000
+        f[segmentation + '/imaging_plane_1/roi_list'] = \
+            np.array(roi_names, dtype='S')
+        f[segmentation + '/imaging_plane_1/reference_images/'
+          'maximum_intensity_projection_image/data'] = \
+            rng.randint(0, 255, mask_shape).astype(np.uint8)
+
+        for i, roi_name in enumerate(roi_names):
+            mask = np.zeros(mask_shape, dtype=np.uint8)
+            y, x = rng.randint(0, mask_shape[0] - 6), \
+                rng.randint(0, mask_shape[1] - 6)
+            mask[y:y + 5, x:x + 5] = 1
+            f[segmentation + '/imaging_plane_1/%s/img_mask' % roi_name] = mask
+
+    return path
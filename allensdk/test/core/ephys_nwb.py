@@ -0,0 +1,123 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Writes small synthetic in vitro electrophysiology NWB files.
+
+The files follow the layout read by NwbDataSet: each sweep's stimulus and
+response time series live under stimulus/presentation and acquisition,
+and are linked from an epochs/Sweep_N group and, after the test pulse, an
+epochs/Experiment_N group.
+'''
+import h5py
+import numpy as np
+
+
+def write_ephys_nwb(path,
+                    n_sweeps=10,
+                    n_samples=5000,
+                    test_pulse=500,
+                    rate=50000.0,
+                    version='1.1',
+                    dtype=np.float32,
+                    seed=0):
+    ''' Write a synthetic file of current clamp sweeps.
+
+    Stimuli are stored in pA and responses in mV, with conversion factors
+    to Amps and Volts.
+
+    Parameters
+    ----------
+    path: string
+        File to write.
+    n_sweeps: int
+        Number of sweeps, numbered from 1.
+    n_samples: int
+        Samples per sweep.
+    test_pulse: int
+        Samples before each sweep's experiment starts.
+    version: string
+        Pipeline version written to general/generated_by, or None.
+    dtype: numpy dtype
+        Type of the stored stimulus and response.
+    seed: int
+        Seed for the random responses.
+
+    Returns
+    -------
+    string
+        `path`
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    with h5py.File(path, 'w') as f:
+        if version is not None:
+            f.create_dataset('general/generated_by',
+                             data=np.array(['version', version], dtype=object),
+                             dtype=h5py.special_dtype(vlen=str))
+        else:
+            f.create_group('general')
+
+        for sweep_number in range(1, n_sweeps + 1):
+            name = 'Sweep_%d' % sweep_number
+            amplitude = 10.0 * sweep_number
+
+            stimulus = f.create_group('stimulus/presentation/%s' % name)
+            stimulus['data'] = np.full(n_samples, amplitude, dtype=dtype)
+            stimulus['data'].attrs['conversion'] = 1e-12
+            stimulus['data'].attrs['unit'] = b'Amps'
+            stimulus['starting_time'] = 0.0
+            stimulus['starting_time'].attrs['rate'] = rate
+            stimulus['aibs_stimulus_amplitude_pa'] = amplitude
+            stimulus['aibs_stimulus_name'] = b'Long Square'
+            stimulus['seal'] = 1.0
+
+            response = f.create_group('acquisition/timeseries/%s' % name)
+            response['data'] = (rng.randn(n_samples) - 70.0).astype(dtype)
+            response['data'].attrs['conversion'] = 1e-3
+            response['data'].attrs['unit'] = b'Volts'
+            response['starting_time'] = 0.0
+            response['starting_time'].attrs['rate'] = rate
+
+            for epoch, start in [('Sweep', 0), ('Experiment', test_pulse)]:
+                group = f.create_group('epochs/%s_%d' % (epoch, sweep_number))
+                for series, target in [('stimulus', stimulus),
+                                       ('response', response)]:
+                    g = group.create_group(series)
+                    g['idx_start'] = start
+                    g['count'] = n_samples - start
+                    g['timeseries'] = h5py.SoftLink(target.name)
+
+    return path
@@ -108,6 +108,19 @@ CACHE_MANIFEST = """
 """
 
 
+@pytest.fixture(autouse=True)
+def in_tmpdir(tmpdir, monkeypatch):
+    # the relative cache paths used below land in a scratch directory
+    monkeypatch.chdir(tmpdir)
+
+
+@pytest.fixture()
+def mock_replace_file():
+    # cached files are written beside their path and then moved onto it
+    with patch('allensdk.api.cache.replace_file') as replace_file:
+        yield replace_file
+
+
 @pytest.fixture()
 def events_test_data():
     return {"pattern": "/allen/aibs/informatics/module_test_data/observatory/events/%d_events.npz",
@@ -136,7 +149,8 @@ def brain_observatory_cache():
 
 @patch.object(BrainObservatoryApi, "json_msg_query")
 def test_get_all_targeted_structures(mock_json_msg_query,
-                                     brain_observatory_cache):
+                                     brain_observatory_cache,
+                                     mock_replace_file):
     with patch('os.path.exists') as m:
         m.return_value = False
 
@@ -157,7 +171,8 @@ def test_get_all_targeted_structures(mock_json_msg_query,
 
 @patch.object(BrainObservatoryApi, "json_msg_query")
 def test_get_experiment_containers(mock_json_msg_query,
-                                   brain_observatory_cache):
+                                   brain_observatory_cache,
+                                   mock_replace_file):
     with patch('os.path.exists') as m:
         m.return_value = False
 
@@ -179,7 +194,8 @@ def test_get_experiment_containers(mock_json_msg_query,
 
 @patch.object(BrainObservatoryApi, "json_msg_query")
 def test_get_all_cre_lines(mock_json_msg_query,
-                           brain_observatory_cache):
+                           brain_observatory_cache,
+                           mock_replace_file):
     with patch('os.path.exists') as m:
         m.return_value = False
 
@@ -200,7 +216,8 @@ def test_get_all_cre_lines(mock_json_msg_query,
 
 @patch.object(BrainObservatoryApi, "json_msg_query")
 def test_get_ophys_experiments(mock_json_msg_query,
-                               brain_observatory_cache):
+                               brain_observatory_cache,
+                               mock_replace_file):
     with patch('os.path.exists') as m:
         m.return_value = False
 
@@ -221,7 +238,8 @@ def test_get_ophys_experiments(mock_json_msg_query,
 
 @patch.object(BrainObservatoryApi, "json_msg_query")
 def test_get_all_session_types(mock_json_msg_query,
-                               brain_observatory_cache):
+                               brain_observatory_cache,
+                               mock_replace_file):
     with patch('os.path.exists') as m:
         m.return_value = False
 
@@ -242,7 +260,8 @@ def test_get_all_session_types(mock_json_msg_query,
 
 @patch.object(BrainObservatoryApi, "json_msg_query")
 def test_get_stimulus_mappings(mock_json_msg_query,
-                               brain_observatory_cache):
+                               brain_observatory_cache,
+                               mock_replace_file):
     with patch('os.path.exists') as m:
         m.return_value = False
 
@@ -259,20 +278,29 @@ def test_get_stimulus_mappings(mock_json_msg_query,
         "rma::options[num_rows$eq'all'][count$eqfalse]")
 
 
-@pytest.mark.skipif(True, reason="need to develop mocks")
-@patch.object(BrainObservatoryApi, "json_msg_query")
-def test_get_cell_specimens(mock_json_msg_query,
-                            brain_observatory_cache):
-    with patch('os.path.exists') as m:
-        m.return_value = False
-
-        with patch('allensdk.core.json_utilities.write',
-                   MagicMock(name='write_json')):
-            # Download a list of all transgenic driver lines
-            tls = brain_observatory_cache.get_cell_specimens()
-
-    mock_json_msg_query.assert_called_once_with(
-        "http://api.brain-map.org/api/v2/data/query.json?q=")
+def test_get_cell_specimens(tmpdir_factory):
+    manifest_file = str(tmpdir_factory.mktemp("boc").join("manifest.json"))
+    boc = BrainObservatoryCache(manifest_file=manifest_file)
+
+    rows = [{'cell_specimen_id': i,
+             'experiment_container_id': i % 2,
+             'failed_experiment_container': i == 3}
+            for i in range(5)]
+
+    with patch('allensdk.core.json_utilities.read_url_get_rows',
+               side_effect=lambda *a, **k: iter(rows)) as mock_rows:
+        cells = boc.get_cell_specimens(simple=False)
+        cached = boc.get_cell_specimens(simple=False)
+
+    # streamed rows are written to the cache whole and read back from it
+    assert mock_rows.call_count == 1
+    assert len(cells) == 4
+    assert cached == cells
+    assert len(json.load(open(boc.get_cache_path(
+        None, boc.CELL_SPECIMENS_KEY)))) == 5
+
+    cells = boc.get_cell_specimens(simple=False, experiment_container_ids=[0])
+    assert [c['cell_specimen_id'] for c in cells] == [0, 2, 4]
 
 
 def test_build_manifest(tmpdir_factory):
@@ -35,16 +35,22 @@
 #
 import functools
 import numpy as np
+import pandas as pd
 from pkg_resources import resource_filename  # @UnresolvedImport
 from allensdk.core.brain_observatory_nwb_data_set import BrainObservatoryNwbDataSet, si
 import allensdk.core.brain_observatory_nwb_data_set as bonds
 import pytest
 import os
+import threading
+import time
 import h5py
+from mock import patch
 
 from allensdk.brain_observatory.brain_observatory_exceptions import MissingStimulusException
+import allensdk.brain_observatory.roi_masks as roi
 
 from test_h5_utilities import mem_h5
+from allensdk.test.core.brain_observatory_nwb import write_brain_observatory_nwb
 
 
 NWB_FLAVORS = []
@@ -67,6 +73,18 @@ def data_set(request):
     return data_set
 
 
+@pytest.fixture
+def synthetic_nwb(tmpdir_factory):
+    return write_brain_observatory_nwb(
+        str(tmpdir_factory.mktemp('nwb').join('synthetic.nwb')), n_cells=4)
+
+
+@pytest.fixture
+def h5_opens():
+    with patch.object(bonds.h5py, 'File', wraps=h5py.File) as h5_file:
+        yield h5_file
+
+
 @pytest.fixture
 def stim_pres_h5(mem_h5):
     def make_stim_pres_h5(stimulus_name):
@@ -358,3 +376,580 @@ def test_find_stimulus_presentation_group_duplicate(stim_pres_h5):
 
     with pytest.raises(MissingStimulusException):
         obt = bonds._find_stimulus_presentation_group(stim_pres_h5, stimulus_name)
+
+
+def read_session(data_set):
+    data_set.get_metadata()
+    data_set.get_cell_specimen_ids()
+    data_set.get_roi_ids()
+    data_set.get_dff_traces()
+    data_set.get_corrected_fluorescence_traces()
+    data_set.get_running_speed()
+    data_set.get_roi_mask()
+    data_set.get_motion_correction()
+
+    return data_set.get_stimulus_table('master')
+
+
+def test_open_reuses_handle(synthetic_nwb, h5_opens):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    expected = read_session(data_set)
+    h5_opens.reset_mock()
+
+    with data_set as ds:
+        assert ds is data_set
+        assert data_set.is_open
+        obtained = read_session(data_set)
+
+    assert h5_opens.call_count == 1
+    assert not data_set.is_open
+    assert obtained.equals(expected)
+
+    read_session(data_set)
+    assert h5_opens.call_count > 10
+
+
+def test_open_nested(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+
+    with data_set:
+        with data_set:
+            data_set.get_cell_specimen_ids()
+        assert data_set.is_open
+        handle = data_set._thread_handle()
+        assert handle
+
+    assert not data_set.is_open
+    assert not handle
+
+    # extra closes are harmless
+    data_set.close()
+    assert not data_set.is_open
+
+
+def test_open_caches_objects(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+
+    with data_set:
+        with data_set._h5_file() as f:
+            a = data_set._pipeline_object(f, 'DfOverF/imaging_plane_1/data')
+            b = data_set._pipeline_object(f, 'DfOverF/imaging_plane_1/data')
+        assert a is b
+
+    with data_set._h5_file() as f:
+        c = data_set._pipeline_object(f, 'DfOverF/imaging_plane_1/data')
+        assert c is not a
+
+
+def test_open_thread_local_handles(synthetic_nwb, h5_opens):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    h5_opens.reset_mock()
+
+    handles = {}
+    results = {}
+
+    def read(i):
+        for _ in range(3):
+            results[i] = data_set.get_dff_traces()[1]
+        handles[i] = data_set._thread_handle()
+
+    with data_set:
+        threads = [threading.Thread(target=read, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(set(id(h) for h in handles.values())) == 4
+        assert h5_opens.call_count == 4
+
+    assert not any(handles.values())
+    for i in range(1, 4):
+        assert np.array_equal(results[0], results[i])
+
+
+def test_open_save_analysis_arrays(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+
+    with data_set:
+        data_set.get_cell_specimen_ids()
+        data_set.save_analysis_arrays(('fish', np.arange(3)))
+        ids = data_set.get_cell_specimen_ids()
+
+    assert len(ids) == 4
+    with h5py.File(synthetic_nwb, 'r') as f:
+        assert np.array_equal(f['analysis/fish'][()], np.arange(3))
+
+
+@pytest.mark.nightly
+def test_open_session_analysis_benchmark(synthetic_nwb, h5_opens, tmpdir):
+    from allensdk.brain_observatory.session_analysis import SessionAnalysis
+
+    def run(keep_open):
+        h5_opens.reset_mock()
+        start = time.time()
+
+        analysis = SessionAnalysis(synthetic_nwb, str(tmpdir.join('out.h5')))
+        if keep_open:
+            analysis.nwb.open()
+        analysis.session_b(save_flag=False)
+        analysis.nwb.close()
+
+        return h5_opens.call_count, time.time() - start
+
+    def read(keep_open, repeats=20):
+        data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+        h5_opens.reset_mock()
+        start = time.time()
+
+        if keep_open:
+            data_set.open()
+        for _ in range(repeats):
+            read_session(data_set)
+        data_set.close()
+
+        return h5_opens.call_count, (time.time() - start) / repeats
+
+    closed_opens, closed_time = run(False)
+    open_opens, open_time = run(True)
+    closed_read_opens, closed_read_time = read(False)
+    open_read_opens, open_read_time = read(True)
+
+    print("session_b: %d opens %.2fs, open: %d opens %.2fs" %
+          (closed_opens, closed_time, open_opens, open_time))
+    print("reads: %d opens %.1fms, open: %d opens %.1fms" %
+          (closed_read_opens, closed_read_time * 1e3,
+           open_read_opens, open_read_time * 1e3))
+
+    assert open_opens < closed_opens
+    assert open_read_opens == 1
+
+
+def test_get_cell_specimen_indices_cached(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    ids = data_set.get_cell_specimen_ids()
+
+    with patch.object(data_set, 'get_cell_specimen_ids',
+                      wraps=data_set.get_cell_specimen_ids) as get_ids:
+        assert data_set.get_cell_specimen_indices(ids[::-1]) == [3, 2, 1, 0]
+        assert data_set.get_cell_specimen_indices([ids[2], ids[2]]) == [2, 2]
+
+    assert get_ids.call_count == 1
+
+    with pytest.raises(ValueError):
+        data_set.get_cell_specimen_indices([ids[0], -1])
+
+
+@pytest.mark.parametrize('inds,runs', [
+    ([], 0),
+    ([3], 1),
+    ([0, 1, 2, 3], 1),
+    ([3, 1, 2, 9, 5, 1], 3),
+    ([9, 7, 5], 3),
+    ([1, 2, 5, 6], 2)
+])
+def test_read_rows(mem_h5, inds, runs):
+    values = np.arange(40).reshape(10, 4)
+    ds = mem_h5.create_dataset('traces', data=values)
+
+    reads = []
+    class Dataset(object):
+        shape = ds.shape
+        dtype = ds.dtype
+
+        def __getitem__(self, key):
+            reads.append(key)
+            return ds[key]
+
+    obtained = bonds._read_rows(Dataset(), inds)
+
+    assert np.array_equal(obtained, values[inds])
+    assert obtained.shape == (len(inds), 4)
+    assert len(reads) == runs
+    assert all(isinstance(key, slice) for key in reads)
+
+
+def test_read_rows_single_run():
+    values = np.arange(40).reshape(10, 4)
+
+    # one run of increasing rows is returned as read, without a copy
+    assert np.shares_memory(bonds._read_rows(values, [2, 3, 4]), values)
+    assert np.shares_memory(bonds._read_rows(values, [2, 3], slice(1, 3)), values)
+    assert np.array_equal(bonds._read_rows(values, [2, 3], slice(1, 3)), 
+                          values[2:4, 1:3])
+    assert not np.shares_memory(bonds._read_rows(values, [3, 2]), values)
+
+
+def test_get_traces_subset(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    ids = data_set.get_cell_specimen_ids()
+    subset = [ids[3], ids[0], ids[3]]
+
+    for getter in [data_set.get_fluorescence_traces,
+                   data_set.get_neuropil_traces,
+                   data_set.get_demixed_traces,
+                   data_set.get_corrected_fluorescence_traces,
+                   data_set.get_dff_traces]:
+        _, traces = getter()
+        _, subset_traces = getter(subset)
+        assert np.array_equal(subset_traces, traces[[3, 0, 3]])
+
+    r = data_set.get_neuropil_r()
+    assert np.array_equal(data_set.get_neuropil_r(subset), r[[3, 0, 3]])
+
+
+@pytest.mark.parametrize('key', [
+    (slice(None),),
+    (2,),
+    (-1, slice(100, 200)),
+    (slice(None), slice(100, 200)),
+    (slice(1, 3), slice(None, None, 7)),
+    ([3, 0, 3], slice(50, 60)),
+    (np.array([True, False, True, False]), 5),
+    (slice(None), [40, 2, 9]),
+    (slice(None), slice(60, 50, -2)),
+    (slice(None), slice(60, 50)),
+    ([], slice(None)),
+])
+@pytest.mark.parametrize('getter', [
+    'get_fluorescence_traces',
+    'get_neuropil_traces',
+    'get_demixed_traces',
+    'get_corrected_fluorescence_traces',
+    'get_dff_traces'
+])
+def test_lazy_traces(synthetic_nwb, getter, key):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+
+    timestamps, traces = getattr(data_set, getter)()
+    lazy_timestamps, lazy = getattr(data_set, getter)(lazy=True)
+
+    assert np.array_equal(timestamps, lazy_timestamps)
+    assert lazy.shape == traces.shape
+    assert len(lazy) == len(traces)
+
+    obtained = lazy[key]
+    expected = traces[key]
+    assert obtained.shape == expected.shape
+    assert np.allclose(obtained, expected)
+
+    obtained = lazy.astype(np.float32)[key]
+    assert obtained.dtype == np.float32
+    assert np.allclose(obtained, expected.astype(np.float32))
+
+
+def test_lazy_traces_subset(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    ids = data_set.get_cell_specimen_ids()
+
+    _, traces = data_set.get_dff_traces([ids[3], ids[1]])
+    _, lazy = data_set.get_dff_traces([ids[3], ids[1]], lazy=True)
+
+    assert lazy.shape == traces.shape
+    assert np.array_equal(np.asarray(lazy), traces)
+    assert np.array_equal(lazy[1, 10:20], traces[1, 10:20])
+
+    with pytest.raises(IndexError):
+        lazy[2]
+    with pytest.raises(IndexError):
+        lazy[0, 0, 0]
+
+
+def test_lazy_traces_read_window(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    _, lazy = data_set.get_dff_traces(lazy=True)
+
+    with patch.object(bonds, '_read_rows', wraps=bonds._read_rows) as read_rows:
+        lazy[[2, 3], 100:110]
+
+    read_rows.assert_called_once()
+    args = read_rows.call_args[0]
+    assert list(args[1]) == [2, 3]
+    assert args[2] == slice(100, 110, 1)
+
+
+def test_lazy_traces_memory(tmpdir):
+    import tracemalloc
+
+    nwb_file = write_brain_observatory_nwb(str(tmpdir.join('wide.nwb')),
+                                           n_cells=100)
+    data_set = BrainObservatoryNwbDataSet(nwb_file)
+    _, lazy = data_set.get_dff_traces(lazy=True)
+    lazy = lazy.astype(np.float32)
+
+    tracemalloc.start()
+    try:
+        means = [ lazy[:, i:i + 100].mean(axis=1)
+                  for i in range(0, lazy.shape[1], 100) ]
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    _, traces = data_set.get_dff_traces()
+    assert np.allclose(means[3], traces[:, 300:400].mean(axis=1), atol=1e-6)
+    assert peak < traces.nbytes / 10
+
+
+@pytest.mark.parametrize('trace_type,getter', [
+    ('dff', 'get_dff_traces'),
+    ('corrected', 'get_corrected_fluorescence_traces')
+])
+def test_get_trial_responses(synthetic_nwb, trace_type, getter):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    stim_table = data_set.get_stimulus_table('static_gratings')
+    _, traces = getattr(data_set, getter)()
+
+    responses = data_set.get_trial_responses(stim_table, pre=28, post=28,
+                                             trace_type=trace_type)
+
+    assert responses.shape == (len(stim_table), traces.shape[0], 28 + 7 + 28)
+    for i, start in enumerate(stim_table.start.values[:20]):
+        assert np.array_equal(responses[i], traces[:, start - 28:start + 35])
+
+
+def test_get_trial_responses_frames(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    ids = data_set.get_cell_specimen_ids()
+    _, traces = data_set.get_dff_traces()
+    n_frames = traces.shape[1]
+
+    starts = np.array([n_frames - 2, 5, 100])
+    responses = data_set.get_trial_responses(starts, pre=10, length=3,
+                                             cell_specimen_ids=[ids[2], ids[0]],
+                                             dtype=np.float32)
+
+    assert responses.shape == (3, 2, 13)
+    assert responses.dtype == np.float32
+
+    # samples outside of the recording
+    assert np.isnan(responses[0, :, -1]).all()
+    assert np.isnan(responses[1, :, :5]).all()
+    assert np.allclose(responses[0, :, :-1], traces[[2, 0], -12:])
+    assert np.allclose(responses[1, :, 5:], traces[[2, 0], :8])
+    assert np.allclose(responses[2], traces[[2, 0], 90:103])
+
+    responses = data_set.get_trial_responses(np.column_stack([starts, starts + 3]),
+                                             pre=10)
+    assert responses.shape == (3, 4, 13)
+
+    assert data_set.get_trial_responses([], length=3).shape == (0, 4, 3)
+
+    with pytest.raises(ValueError):
+        data_set.get_trial_responses(starts)
+
+    with pytest.raises(KeyError):
+        data_set.get_trial_responses(starts, length=3, trace_type='fish')
+
+
+@pytest.mark.nightly
+def test_get_trial_responses_benchmark(tmpdir):
+    nwb_file = write_brain_observatory_nwb(str(tmpdir.join('wide.nwb')),
+                                           n_cells=100)
+    data_set = BrainObservatoryNwbDataSet(nwb_file)
+    stim_table = data_set.get_stimulus_table('natural_scenes')
+
+    start = time.time()
+    _, traces = data_set.get_dff_traces()
+    loop = np.empty((len(stim_table), traces.shape[0], 63))
+    for i, row in enumerate(stim_table.itertuples()):
+        for nc in range(traces.shape[0]):
+            loop[i, nc] = traces[nc, row.start - 28:row.start + 35]
+    loop_time = time.time() - start
+
+    start = time.time()
+    responses = data_set.get_trial_responses(stim_table, pre=28, post=28)
+    gather_time = time.time() - start
+
+    print("per-trial slicing %.3fs, gather %.3fs" % (loop_time, gather_time))
+
+    assert np.array_equal(loop, responses)
+
+
+def iterrows_master_stimulus_table(data_set):
+    # reference implementation: select each epoch's presentations row by row
+    epoch_table = data_set.get_stimulus_epoch_table()
+
+    table_list = []
+    for stimulus in data_set.list_stimuli():
+        curr_stimtable = data_set.get_stimulus_table(stimulus)
+
+        for _, row in epoch_table[epoch_table['stimulus'] == stimulus].iterrows():
+            curr_subtable = curr_stimtable[(row['start'] <= curr_stimtable['start']) &
+                                           (curr_stimtable['end'] <= row['end'])].copy()
+            curr_subtable['stimulus'] = stimulus
+            table_list.append(curr_subtable)
+
+    new_table = pd.concat(table_list, sort=True)
+    new_table.reset_index(drop=True, inplace=True)
+
+    return new_table
+
+
+def test_stimulus_epoch_table_synthetic(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    epochs = data_set.get_stimulus_epoch_table()
+
+    assert list(epochs.columns) == ['stimulus', 'start', 'end']
+    assert list(epochs.stimulus) == ['static_gratings', 'natural_scenes',
+                                     'spontaneous', 'natural_movie_one',
+                                     'static_gratings', 'natural_scenes']
+    assert np.all(np.diff(epochs.start.values) > 0)
+    assert np.all(epochs.end.values > epochs.start.values)
+
+    master = data_set.get_stimulus_table('master')
+    expected = iterrows_master_stimulus_table(data_set)
+
+    pd.testing.assert_frame_equal(master, expected)
+
+
+def test_stimulus_tables_cached(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+
+    with patch.object(data_set, '_read_stimulus_table',
+                      wraps=data_set._read_stimulus_table) as read_table:
+        master = data_set.get_stimulus_table('master')
+        data_set.get_stimulus_epoch_table()
+        data_set.get_stimulus_table('master')
+        assert read_table.call_count == len(data_set.list_stimuli())
+
+        # callers get copies
+        master['start'] = -1
+        data_set.get_stimulus_table('static_gratings')['start'] = -1
+        assert (data_set.get_stimulus_table('master').start >= 0).all()
+        assert (data_set.get_stimulus_table('static_gratings').start >= 0).all()
+        assert read_table.call_count == len(data_set.list_stimuli())
+
+        # a modified file is read again
+        mtime = os.path.getmtime(synthetic_nwb)
+        os.utime(synthetic_nwb, (mtime + 10, mtime + 10))
+        data_set.get_stimulus_table('master')
+        assert read_table.call_count == 2 * len(data_set.list_stimuli())
+
+
+def test_get_frame_stimulus_table(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    epochs = data_set.get_stimulus_epoch_table()
+    frames = np.arange(-1, epochs.end.max() + 2)
+
+    table = data_set.get_frame_stimulus_table(frames)
+    assert len(table) == len(frames)
+
+    for frame, (_, row) in zip(frames, table.iterrows()):
+        search_result, template = data_set.get_stimulus(frame)
+        if search_result is None:
+            assert pd.isnull(row.stimulus) or \
+                row.stimulus == si.SPONTANEOUS_ACTIVITY
+        else:
+            assert search_result[2]['stimulus'] == row.stimulus
+            assert search_result[0] == row.start
+
+
+def test_get_roi_mask_set(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    ids = data_set.get_cell_specimen_ids()
+
+    mask_set = data_set.get_roi_mask_set()
+    rois = data_set.get_roi_mask()
+    assert len(mask_set) == len(ids)
+    assert np.array_equal(mask_set.to_dense(),
+                          roi.create_roi_mask_array(rois))
+    assert np.array_equal(data_set.get_roi_mask_array(), mask_set.to_dense())
+    assert [ m.label for m in rois ] == mask_set.labels
+
+    mask_set = data_set.get_roi_mask_set([ids[2], ids[0]])
+    assert np.array_equal(mask_set.to_dense(),
+                          roi.create_roi_mask_array([rois[2], rois[0]]))
+
+
+@pytest.mark.nightly
+def test_get_roi_mask_set_benchmark(tmpdir):
+    import tracemalloc
+
+    nwb_file = write_brain_observatory_nwb(str(tmpdir.join('rois.nwb')),
+                                           n_cells=1000, n_trials=10,
+                                           mask_shape=(512, 512))
+    data_set = BrainObservatoryNwbDataSet(nwb_file)
+
+    def measure(fn):
+        tracemalloc.start()
+        try:
+            start = time.time()
+            result = fn()
+            elapsed = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return result, elapsed, peak
+
+    dense, dense_time, dense_peak = measure(
+        lambda: roi.create_roi_mask_array(data_set.get_roi_mask()))
+    mask_set, sparse_time, sparse_peak = measure(data_set.get_roi_mask_set)
+
+    print("per-roi masks %.2fs %.1fMB, sparse set %.2fs %.1fMB (%.2fMB stored)" %
+          (dense_time, dense_peak / 1e6, sparse_time, sparse_peak / 1e6,
+           mask_set.nbytes / 1e6))
+
+    assert np.array_equal(mask_set.to_dense(), dense)
+    assert sparse_peak < dense.nbytes / 10
+
+
+def test_lazy_stimulus_template(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    movie = data_set.get_stimulus_template(si.NATURAL_MOVIE_ONE)
+    lazy = data_set.get_stimulus_template(si.NATURAL_MOVIE_ONE, lazy=True)
+
+    assert lazy is data_set.get_stimulus_template(si.NATURAL_MOVIE_ONE, lazy=True)
+    assert lazy.shape == movie.shape
+    assert lazy.dtype == movie.dtype
+    assert np.array_equal(np.asarray(lazy), movie)
+
+    assert np.array_equal(lazy[3], movie[3])
+    assert np.array_equal(lazy[-1, 2:5], movie[-1, 2:5])
+    assert np.array_equal(lazy[5:10], movie[5:10])
+    assert np.array_equal(lazy[[7, 2, 7], :4, ::2], movie[[7, 2, 7], :4, ::2])
+
+    # cached frames are not handed out to be modified
+    frame = lazy[3]
+    frame[:] = 0
+    assert np.array_equal(lazy[3], movie[3])
+
+
+def test_lazy_stimulus_template_cache(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    lazy = data_set.get_stimulus_template(si.NATURAL_SCENES, lazy=True)
+    lazy.cache_clear()
+
+    with patch.object(bonds, '_read_rows', wraps=bonds._read_rows) as read_rows:
+        lazy[10:20]
+        lazy[12]
+        lazy[[15, 19]]
+        assert read_rows.call_count == 1
+        assert list(read_rows.call_args[0][1]) == list(range(10, 20))
+
+        lazy[:, :4]
+        lazy[::-1]
+        assert read_rows.call_count == 2
+
+        # the whole movie is read as one hyperslab, without the frame cache
+        scenes = data_set.get_stimulus_template(si.NATURAL_SCENES)
+        assert read_rows.call_count == 2
+
+    assert np.array_equal(scenes[::-1], lazy[::-1])
+    assert np.array_equal(scenes[:, :4], lazy[:, :4])
+
+    info = lazy.cache_info()
+    assert info.entries == 10
+    assert info.entries <= info.max_entries == lazy.cache_frames
+
+
+def test_get_stimulus_reads_frame(synthetic_nwb):
+    data_set = BrainObservatoryNwbDataSet(synthetic_nwb)
+    scenes = data_set.get_stimulus_template(si.NATURAL_SCENES)
+    row = data_set.get_stimulus_table(si.NATURAL_SCENES).iloc[5]
+
+    with patch.object(bonds, '_read_rows', wraps=bonds._read_rows) as read_rows:
+        search_result, frame = data_set.get_stimulus(row.start)
+
+    assert search_result[2]['stimulus'] == si.NATURAL_SCENES
+    assert np.array_equal(frame, scenes[int(row.frame)])
+    assert list(read_rows.call_args[0][1]) == [int(row.frame)]
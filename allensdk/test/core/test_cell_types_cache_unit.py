@@ -79,6 +79,13 @@ def cache_fixture(tmpdir_factory):
     return ctc
 
 
+@pytest.fixture
+def mock_replace_file():
+    # cached files are written beside _MOCK_PATH and then moved onto it
+    with patch('allensdk.api.cache.replace_file') as replace_file:
+        yield replace_file
+
+
 @pytest.mark.parametrize('path_exists',
                          (False, True))
 @patch('allensdk.core.cell_types_cache.NwbDataSet')
@@ -114,7 +121,9 @@ def test_sweep_data_with_api(mock_nwb,
         assert mkd.call_args_list == [call(_MOCK_PATH)]
         assert query_mock.called
         mock_http.assert_called_once_with('http://api.brain-map.org/path/to/data.nwb',
-                                          _MOCK_PATH)
+                                          _MOCK_PATH,
+                                          expected_size=None,
+                                          expected_md5=None)
 
 
 def test_sweep_data_exception(cache_fixture):
@@ -192,6 +201,7 @@ def test_get_cells(cache_fixture,
                                     (False, True),
                                     (RS.POSITIVE, ['list', 'of', 'statuses'])))
 def test_get_cells_with_api(cache_fixture,
+                            mock_replace_file,
                             path_exists,
                             morph_flag,
                             recon_flag,
@@ -369,7 +379,9 @@ def test_get_reconstruction_markers_with_api(cache_fixture,
         assert marker_mock.called
     else:
         mock_http.assert_called_once_with('http://api.brain-map.org/mock/path_to_file',
-                                          _MOCK_PATH)
+                                          _MOCK_PATH,
+                                          expected_size=None,
+                                          expected_md5=None)
 
 
 def test_get_reconstruction_markers_exception(cache_fixture,
@@ -417,6 +429,7 @@ def test_get_ephys_features(cache_fixture,
 def test_get_ephys_features_with_api(read_csv,
                                      to_csv,
                                      cache_fixture,
+                                     mock_replace_file,
                                      df,
                                      path_exists):
     ctc = cache_fixture
@@ -476,6 +489,7 @@ def test_get_ephys_features_cache_roundtrip(cached_csv,
 def test_get_morphology_features(read_csv,
                                  to_csv,
                                  cache_fixture,
+                                 mock_replace_file,
                                  path_exists,
                                  df):
     ctc = cache_fixture
@@ -538,6 +552,7 @@ def test_get_ephys_sweeps(cache_fixture,
 @pytest.mark.parametrize('path_exists',
                          (False, True))
 def test_get_ephys_sweeps_with_api(cache_fixture,
+                                   mock_replace_file,
                                    path_exists):
     ctc = cache_fixture
 
@@ -577,6 +592,7 @@ def test_get_all_features(read_csv,
                           to_csv,
                           mock_merge,
                           cache_fixture,
+                          mock_replace_file,
                           path_exists,
                           require_reconstruction):
     ctc = cache_fixture
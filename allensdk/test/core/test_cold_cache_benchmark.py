@@ -0,0 +1,225 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import itertools
+import re
+
+import numpy as np
+import pytest
+
+from allensdk.core.brain_observatory_cache import BrainObservatoryCache
+from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
+from allensdk.test.api.rma_server import (Recording, replay_server, rma_rows,
+                                          time_cold_cache)
+
+
+# a wide-area link: per-response latency and ~20 MB/s
+_latency = 0.02
+_bandwidth = 20 * 2 ** 20
+
+
+def _specimen(ii):
+    return {'name': 'Cux2-CreERT2;Camk2a-tTA;Ai93-{0}'.format(ii),
+            'donor': {'external_donor_name': str(ii),
+                      'date_of_birth': '2015-01-01T00:00:00Z',
+                      'conditions': [],
+                      'transgenic_lines': [
+                          {'name': 'Cux2-CreERT2', 
+                           'transgenic_line_type_name': 'driver'},
+                          {'name': 'Ai93(TITL-GCaMP6f)', 
+                           'transgenic_line_type_name': 'reporter'}]}}
+
+
+def brain_observatory_recording(n_containers=50, n_cells=20000, n_metrics=60):
+    containers = [{'id': ii,
+                   'imaging_depth': 175,
+                   'targeted_structure': {'acronym': 'VISp'},
+                   'specimen': _specimen(ii),
+                   'failed': False}
+                  for ii in range(n_containers)]
+
+    sessions = ['three_session_A', 'three_session_B', 'three_session_C2']
+    experiments = [dict(c, 
+                        id=3 * c['id'] + jj,
+                        experiment_container_id=c['id'],
+                        experiment_container={'failed': False},
+                        stimulus_name=session,
+                        date_of_acquisition='2016-01-01T00:00:00Z',
+                        fail_eye_tracking=False)
+                   for c in containers 
+                   for jj, session in enumerate(sessions)]
+
+    mappings = [{'id': 1, 'item': 'thumbnail_dg', 'item_type': 'T', 'level': 'R'},
+                {'id': 2, 'item': 'osi_dg', 'item_type': 'M', 'level': 'R'}]
+
+    rng = np.random.RandomState(0)
+    metrics = ['metric_{0}'.format(ii) for ii in range(n_metrics)]
+    cells = [dict(zip(metrics, rng.rand(n_metrics).tolist()),
+                  cell_specimen_id=ii,
+                  experiment_container_id=ii % n_containers,
+                  failed_experiment_container=False,
+                  thumbnail_dg='/thumbnails/{0}.png'.format(ii))
+             for ii in range(n_cells)]
+
+    recording = Recording()
+    recording.add_route(r'model::ExperimentContainer,', rma_rows(containers))
+    recording.add_route(r'model::OphysExperiment,', rma_rows(experiments))
+    recording.add_route(r'model::ApiCamStimulusMapping,', rma_rows(mappings))
+    recording.add_route(r'model::ApiCamCellMetric,', rma_rows(cells))
+
+    return recording
+
+
+def mouse_connectivity_recording(n_experiments=200, n_structures=800):
+    structures = [{'id': 997, 'acronym': 'root', 'name': 'root', 
+                   'graph_id': 1, 'graph_order': 0,
+                   'structure_id_path': '/997/', 
+                   'color_hex_triplet': 'FFFFFF',
+                   'structure_sets': [{'id': 1}]}]
+    structures += [{'id': ii, 'acronym': 'S{0}'.format(ii), 
+                    'name': 'structure {0}'.format(ii), 
+                    'graph_id': 1, 'graph_order': ii,
+                    'structure_id_path': '/997/{0}/'.format(ii), 
+                    'color_hex_triplet': '00FF00',
+                    'structure_sets': [{'id': 1}]}
+                   for ii in range(1, n_structures)]
+
+    experiments = [{'data_set_id': ii, 
+                    'name': 'experiment {0}'.format(ii),
+                    'storage_directory': '/external/{0}'.format(ii),
+                    'transgenic_line': {'name': 'Rbp4-Cre_KL100'} if ii % 2 else None,
+                    'injection_structures': '{0}/{1}'.format(ii % n_structures + 1, 
+                                                             (ii + 1) % n_structures + 1),
+                    'structure_id': ii % n_structures + 1}
+                   for ii in range(n_experiments)]
+
+    rng = np.random.RandomState(0)
+
+    def unionizes(experiment_id):
+        values = rng.rand(len(structures) * 6)
+
+        return [{'id': experiment_id * 10 ** 5 + jj,
+                 'section_data_set_id': experiment_id,
+                 'structure_id': structure['id'],
+                 'hemisphere_id': hemisphere,
+                 'is_injection': is_injection,
+                 'projection_density': value,
+                 'projection_energy': value * 10,
+                 'projection_volume': value / 100,
+                 'normalized_projection_volume': value,
+                 'volume': 0.1}
+                for jj, ((structure, hemisphere, is_injection), value) in enumerate(
+                    zip(itertools.product(structures, [1, 2, 3], [True, False]), 
+                        values))]
+
+    # unionizes are generated for the experiments that are asked for
+    handlers = {}
+
+    def unionizes_handler(key):
+        experiment_id = int(re.search(r'section_data_set_id\$in(\d+)', key).group(1))
+
+        if experiment_id not in handlers:
+            handlers[experiment_id] = rma_rows(unionizes(experiment_id))
+
+        return handlers[experiment_id](key)
+
+    recording = Recording()
+    recording.add_route(r'model::Structure,', rma_rows(structures))
+    recording.add_route(r'model::ApiConnectivity,', rma_rows(experiments))
+    recording.add_route(r'model::ProjectionStructureUnionize,', unionizes_handler)
+
+    return recording
+
+
+def _expect_rows(call, n_rows):
+    # every timed call must also return the whole recording
+    def checked(cache):
+        result = call(cache)
+        assert len(result) == n_rows
+
+    return checked
+
+
+def _report(name, times):
+    print('{0} cold cache: {1}'.format(name, ', '.join(
+        '{0} {1:.3f}s'.format(k, v) for k, v in sorted(times.items()))))
+
+
+@pytest.mark.nightly
+def test_brain_observatory_cache_cold_benchmark(tmpdir_factory):
+    calls = [('experiment_containers', 
+              _expect_rows(lambda c: c.get_experiment_containers(), 50)),
+             ('ophys_experiments', 
+              _expect_rows(lambda c: c.get_ophys_experiments(), 150)),
+             ('cell_specimens', 
+              _expect_rows(lambda c: c.get_cell_specimens(), 20000))]
+
+    with replay_server(brain_observatory_recording(), 
+                       latency=_latency, bandwidth=_bandwidth) as url:
+        def make_cache():
+            manifest = str(tmpdir_factory.mktemp('boc').join('manifest.json'))
+            return BrainObservatoryCache(manifest_file=manifest, base_uri=url)
+
+        times = time_cold_cache(make_cache, calls)
+
+        experiments = make_cache().get_ophys_experiments()
+
+    _report('BrainObservatoryCache', times)
+
+    assert len(experiments) == 150
+
+
+@pytest.mark.nightly
+def test_mouse_connectivity_cache_cold_benchmark(tmpdir_factory):
+    calls = [('structure_tree', 
+              _expect_rows(lambda c: c.get_structure_tree().nodes(), 800)),
+             ('experiments', _expect_rows(lambda c: c.get_experiments(), 200)),
+             ('structure_unionizes', 
+              _expect_rows(lambda c: c.get_structure_unionizes(list(range(10))),
+                           10 * 800 * 6))]
+
+    with replay_server(mouse_connectivity_recording(), 
+                       latency=_latency, bandwidth=_bandwidth) as url:
+        def make_cache():
+            manifest = str(tmpdir_factory.mktemp('mcc').join('manifest.json'))
+            return MouseConnectivityCache(manifest_file=manifest, base_uri=url)
+
+        times = time_cold_cache(make_cache, calls)
+
+        unionizes = make_cache().get_structure_unionizes([0, 1])
+
+    _report('MouseConnectivityCache', times)
+
+    assert len(unionizes) == 2 * 800 * 6
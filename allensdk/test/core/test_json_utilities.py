@@ -122,3 +122,54 @@ def test_write_list(dict_obj):
   ]
 }"""
     assert s_in == s_out
+
+
+_envelope = {"success": True, "id": 0, "start_row": 0, "num_rows": 5, "total_rows": 5}
+_rows = [{"a": 1.25, "b": u"xéy", "c": [1, {"d": None}], "e": 123456789},
+         {"a": -3e5, "b": "esc\"aped\\n"},
+         17,
+         "s",
+         True]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 2 ** 16])
+def test_iter_json_array(chunk_size):
+    doc = dict(_envelope, msg=_rows)
+    body = ju.write_string(doc).encode('utf-8')
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+    envelope = {}
+    rows = list(ju.iter_json_array(chunks, envelope=envelope))
+
+    assert rows == _rows
+    assert envelope == _envelope
+
+
+def test_iter_json_array_empty():
+    assert list(ju.iter_json_array([b'{"msg": []}'])) == []
+    assert list(ju.iter_json_array([b' { "a" : 1 , "msg" : [ 1 , 2 ] } '])) == [1, 2]
+    assert list(ju.iter_json_array([b'{"rows": [3]}'], key='rows')) == [3]
+
+
+def test_iter_json_array_not_array():
+    with pytest.raises(ValueError) as e:
+        list(ju.iter_json_array([b'{"success": false, "msg": "Query failed"}']))
+
+    assert 'Query failed' in str(e.value)
+
+
+def test_iter_json_array_truncated():
+    with pytest.raises(ValueError):
+        list(ju.iter_json_array([b'{"msg": [{"a": 1}, {"a"']))
+
+    with pytest.raises(ValueError):
+        list(ju.iter_json_array([b'{"msg": [1, 2']))
+
+
+def test_write_generator(tmpdir):
+    file_name = str(tmpdir.join('rows.json'))
+    rows = ({"id": i, "value": i / 2.0} for i in range(5))
+
+    ju.write(file_name, rows)
+
+    assert ju.read(file_name) == [{"id": i, "value": i / 2.0} for i in range(5)]
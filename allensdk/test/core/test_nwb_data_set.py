@@ -37,8 +37,11 @@ from mock import patch, MagicMock
 from pkg_resources import resource_filename  # @UnresolvedImport
 import numpy as np
 from allensdk.core.nwb_data_set import NwbDataSet
+from allensdk.test.core.ephys_nwb import write_ephys_nwb
+import h5py
 import pytest
 import os
+import time
 
 NWB_FLAVORS = []
 
@@ -231,3 +234,210 @@ def test_get_sweep_metadata(data_set):
     sweep_metadata = data_set.get_sweep_metadata(1)
 
     assert sweep_metadata is not None
+
+
+@pytest.fixture
+def ephys_nwb(tmpdir_factory):
+    return write_ephys_nwb(
+        str(tmpdir_factory.mktemp('nwb').join('ephys.nwb')), n_sweeps=5)
+
+
+def test_get_sweep_synthetic(ephys_nwb):
+    data_set = NwbDataSet(ephys_nwb)
+    sweep = data_set.get_sweep(3)
+
+    assert data_set.get_pipeline_version() == (1, 1)
+    assert np.allclose(sweep['stimulus'], 30e-12)
+    assert np.allclose(sweep['response'].mean(), -70e-3, atol=1e-3)
+    assert sweep['stimulus_unit'] == 'Amps'
+    assert sweep['index_range'] == (500, 4999)
+    assert sweep['sampling_rate'] == 50000.0
+
+
+def test_get_sweeps(ephys_nwb):
+    data_set = NwbDataSet(ephys_nwb)
+    sweeps = data_set.get_sweeps([4, 1, 2])
+
+    assert len(sweeps) == 3
+    for sweep_number, sweep in zip([4, 1, 2], sweeps):
+        expected = data_set.get_sweep(sweep_number)
+        assert set(sweep.keys()) == set(expected.keys())
+        for key in ['stimulus', 'response']:
+            assert sweep[key].dtype == expected[key].dtype
+            assert np.array_equal(sweep[key], expected[key])
+        assert sweep['index_range'] == expected['index_range']
+
+    sweeps = data_set.get_sweeps([1, 2], dtype=np.float64, metadata=True)
+    assert sweeps[0]['response'].dtype == np.float64
+    assert np.allclose(sweeps[0]['response'],
+                       data_set.get_sweep(1)['response'])
+    assert sweeps[1]['metadata'] == data_set.get_sweep_metadata(2)
+    assert sweeps[1]['metadata']['aibs_stimulus_amplitude_pa'] == 20.0
+
+    raw = data_set.get_sweeps([2], convert=False)[0]
+    assert raw['stimulus_conversion'] == 1e-12
+    assert raw['response_conversion'] == 1e-3
+    assert np.allclose(raw['stimulus'], 20.0)
+    assert np.allclose(raw['response'] * raw['response_conversion'],
+                       data_set.get_sweep(2)['response'])
+
+
+def test_get_sweeps_old_version(tmpdir):
+    nwb_file = write_ephys_nwb(str(tmpdir.join('old.nwb')), n_sweeps=2,
+                               version=None)
+    data_set = NwbDataSet(nwb_file)
+
+    # files before 1.1 store SI units and are not converted
+    assert data_set.get_pipeline_version() == (0, 0)
+    sweep = data_set.get_sweeps([1], dtype=np.float64, convert=False)[0]
+    assert np.allclose(data_set.get_sweep(1)['stimulus'], 10.0)
+    assert np.allclose(sweep['stimulus'], 10.0)
+    assert sweep['stimulus_conversion'] == 1.0
+
+
+def test_get_sweeps_single_open(ephys_nwb):
+    data_set = NwbDataSet(ephys_nwb)
+
+    with patch('h5py.File', wraps=h5py.File) as h5_file:
+        data_set.get_sweeps([1, 2, 3, 4, 5])
+        assert h5_file.call_count == 1
+
+        data_set.get_pipeline_version()
+        data_set.get_sweep(1)
+        assert h5_file.call_count == 2
+
+
+@pytest.mark.nightly
+def test_get_sweeps_benchmark(tmpdir):
+    nwb_file = write_ephys_nwb(str(tmpdir.join('sweeps.nwb')), n_sweeps=100,
+                               n_samples=200000)
+    sweep_numbers = list(range(1, 101))
+
+    start = time.time()
+    loop = [ NwbDataSet(nwb_file).get_sweep(n) for n in sweep_numbers ]
+    loop_time = time.time() - start
+
+    start = time.time()
+    batch = NwbDataSet(nwb_file).get_sweeps(sweep_numbers)
+    batch_time = time.time() - start
+
+    print("get_sweep %.3fs, get_sweeps %.3fs" % (loop_time, batch_time))
+
+    for a, b in zip(loop, batch):
+        assert np.array_equal(a['response'], b['response'])
+
+
+def test_writer_matches_set_sweep(tmpdir):
+    per_sweep = write_ephys_nwb(str(tmpdir.join('per_sweep.nwb')), n_sweeps=4)
+    batched = write_ephys_nwb(str(tmpdir.join('batched.nwb')), n_sweeps=4)
+
+    rng = np.random.RandomState(1)
+    responses = { n: rng.randn(4000) for n in range(1, 5) }
+    spikes = { n: np.sort(rng.rand(n)) for n in range(1, 5) }
+
+    data_set = NwbDataSet(per_sweep)
+    for n in [3, 1, 4, 2]:
+        data_set.set_sweep(n, None, responses[n])
+        data_set.set_spike_times(n, spikes[n])
+
+    with NwbDataSet(batched).writer() as writer:
+        for n in [3, 1, 4, 2]:
+            writer.set_sweep(n, None, responses[n])
+            writer.set_spike_times(n, spikes[n])
+
+    expected = NwbDataSet(per_sweep)
+    actual = NwbDataSet(batched)
+    for n in range(1, 5):
+        a, b = expected.get_sweep(n), actual.get_sweep(n)
+        assert np.array_equal(a['stimulus'], b['stimulus'])
+        assert np.array_equal(a['response'], b['response'])
+        assert np.array_equal(expected.get_spike_times(n),
+                              actual.get_spike_times(n))
+
+    # padded with zeros to the sweep length
+    assert np.all(actual.get_sweep(1)['response'][4000:] == 0)
+
+
+def test_writer_buffers(ephys_nwb):
+    data_set = NwbDataSet(ephys_nwb)
+    response = np.ones(5000)
+
+    with patch('h5py.File', wraps=h5py.File) as h5_file:
+        writer = data_set.writer()
+        with writer:
+            for n in range(1, 6):
+                writer.set_sweep(n, None, response * n)
+                writer.set_spike_times(n, [0.1 * n])
+
+            # reads see buffered sweeps
+            sweep = writer.get_sweep(2)
+            assert np.allclose(sweep['response'], 2e-3)
+            assert 2 not in writer._sweeps
+            assert 3 in writer._sweeps
+
+        assert h5_file.call_count == 1
+
+    assert np.allclose(data_set.get_sweep(5)['response'], 5e-3)
+    assert np.array_equal(data_set.get_spike_times(5), [0.5])
+
+
+def test_writer_max_buffered_bytes(ephys_nwb):
+    data_set = NwbDataSet(ephys_nwb)
+
+    with data_set.writer(max_buffered_bytes=50000) as writer:
+        writer.set_sweep(1, None, np.ones(5000))
+        assert 1 in writer._sweeps
+
+        writer.set_sweep(2, None, np.ones(5000))
+        assert len(writer._sweeps) == 0
+
+        assert np.allclose(data_set.get_sweep(1)['response'], 1e-3)
+
+
+def test_writer_buffered_bytes(ephys_nwb):
+    data_set = NwbDataSet(ephys_nwb)
+
+    with data_set.writer() as writer:
+        # re-buffering a sweep replaces its size
+        writer.set_sweep(1, None, np.ones(5000))
+        writer.set_sweep(1, None, np.ones(5000))
+        writer.set_spike_times(1, [0.1, 0.2])
+        writer.set_spike_times(1, [0.1])
+        writer.set_sweep(2, None, np.ones(5000))
+        assert writer._buffered_bytes == 80000 + 8
+
+        # flushed sweeps no longer count
+        writer.flush([1])
+        assert writer._buffered_bytes == 40000
+
+
+@pytest.mark.nightly
+def test_writer_benchmark(tmpdir):
+    n_sweeps = 200
+    per_sweep = write_ephys_nwb(str(tmpdir.join('per_sweep.nwb')),
+                                n_sweeps=n_sweeps, n_samples=50000)
+    batched = write_ephys_nwb(str(tmpdir.join('batched.nwb')),
+                              n_sweeps=n_sweeps, n_samples=50000)
+    response = np.random.RandomState(0).randn(50000)
+
+    start = time.time()
+    data_set = NwbDataSet(per_sweep)
+    for n in range(1, n_sweeps + 1):
+        data_set.set_sweep(n, None, response)
+        data_set.set_spike_times(n, [0.1, 0.2])
+    per_sweep_time = time.time() - start
+
+    start = time.time()
+    with NwbDataSet(batched).writer() as writer:
+        for n in range(1, n_sweeps + 1):
+            writer.set_sweep(n, None, response)
+            writer.set_spike_times(n, [0.1, 0.2])
+    batched_time = time.time() - start
+
+    print("set_sweep %.3fs, writer %.3fs" % (per_sweep_time, batched_time))
+
+    for n in (1, n_sweeps):
+        assert np.array_equal(NwbDataSet(per_sweep).get_sweep(n)['response'],
+                              NwbDataSet(batched).get_sweep(n)['response'])
+        assert np.array_equal(NwbDataSet(per_sweep).get_spike_times(n),
+                              NwbDataSet(batched).get_spike_times(n))
@@ -0,0 +1,432 @@
+""" Per-sweep and per-cell reference implementations of brain observatory
+stimulus analysis methods that are now computed as array operations.  Each
+function takes the analysis object in place of self and returns what the
+original method returned, so tests can compare the two.
+"""
+import itertools
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.stats as st
+
+from allensdk.brain_observatory.brain_observatory_exceptions import BrainObservatoryAnalysisException
+from allensdk.brain_observatory.findlevel import findlevel
+
+
+def timed(fn, *args, **kwargs):
+    """ Call fn and return its result and the elapsed wall-clock seconds.
+    Benchmarks only report these times; they depend on the machine.
+    """
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+def assert_frames_close(actual, expected, exact=(), close=()):
+    """ Compare two result DataFrames: columns in exact must be equal, and
+    columns in close must be numerically close, with NaNs in the same places.
+    """
+    assert list(actual.columns) == list(expected.columns)
+
+    for column in exact:
+        assert list(actual[column]) == list(expected[column])
+
+    for column in close:
+        assert np.allclose(actual[column].values.astype(float),
+                           expected[column].values.astype(float),
+                           equal_nan=True)
+
+
+def sweep_response(sa):
+    """ StimulusAnalysis.get_sweep_response, filling a DataFrame one sweep
+    and cell at a time.
+    """
+    response_stop = sa.interlength + sa.sweeplength + sa.extralength
+
+    def do_mean(x):
+        return np.mean(x[sa.interlength:response_stop])
+
+    def do_p_value(x):
+        (_, p) = st.f_oneway(x[:sa.interlength], x[sa.interlength:response_stop])
+        return p
+
+    sweep_response = pd.DataFrame(index=sa.stim_table.index.values,
+                                  columns=list(map(str, range(sa.numbercells + 1))))
+    sweep_response.rename(columns={str(sa.numbercells): 'dx'}, inplace=True)
+
+    for index, row in sa.stim_table.iterrows():
+        start = int(row['start'] - sa.interlength)
+        end = int(row['start'] + sa.sweeplength + sa.interlength)
+
+        for nc in range(sa.numbercells):
+            temp = sa.celltraces[int(nc), start:end]
+            sweep_response[str(nc)][index] = 100 * \
+                ((temp / np.mean(temp[:sa.interlength])) - 1)
+        sweep_response['dx'][index] = sa.dxcm[start:end]
+
+    return (sweep_response, sweep_response.applymap(do_mean),
+            sweep_response.applymap(do_p_value))
+
+
+def speed_tuning(sa, binsize):
+    """ StimulusAnalysis.get_speed_tuning, binning each of 200 shuffles one
+    bin at a time.  Shuffles are drawn from the global numpy random state.
+    """
+    dxcm = sa.dxcm
+    celltraces = sa.dfftraces[:, :len(dxcm)]
+
+    # the last one or two spontaneous epochs
+    spontaneous = sa.data_set.get_stimulus_table('spontaneous')
+    epochs = [ (spontaneous.start.iloc[-1], spontaneous.end.iloc[-1]) ]
+    if len(spontaneous) > 1:
+        epochs.append((spontaneous.start.iloc[-2], spontaneous.end.iloc[-2]))
+
+    dx_sp = np.concatenate([ dxcm[start:end] for start, end in epochs ])
+    celltraces_sp = np.concatenate([ celltraces[:, start:end]
+                                     for start, end in epochs ], axis=1)
+
+    dx_vis = dxcm
+    celltraces_vis = celltraces
+    for start, end in epochs:
+        dx_vis = np.delete(dx_vis, np.arange(start, end))
+        celltraces_vis = np.delete(celltraces_vis, np.arange(start, end), axis=1)
+    celltraces_vis = celltraces_vis[:, ~np.isnan(dx_vis)]
+    dx_vis = dx_vis[~np.isnan(dx_vis)]
+
+    if np.all(np.isnan(dx_sp)):
+        raise BrainObservatoryAnalysisException("dx is filled with NaNs")
+
+    binned = { 'sp': _bin_by_speed(dx_sp, celltraces_sp, binsize),
+               'vis': _bin_by_speed(dx_vis, celltraces_vis, binsize) }
+
+    peak_run = pd.DataFrame(index=range(sa.numbercells), columns=(
+        'speed_max_sp', 'speed_min_sp', 'ptest_sp', 'mod_sp',
+        'speed_max_vis', 'speed_min_vis', 'ptest_vis', 'mod_vis'))
+
+    for epoch in ('sp', 'vis'):
+        binned_dx, binned_cells, celltraces_sorted, shuffled = binned[epoch]
+
+        variance_threshold = np.percentile(shuffled.std(axis=1) ** 2, 99.9,
+                                           axis=1)
+        response_variance = binned_cells[:, :, 0].std(axis=1) ** 2
+
+        for nc in range(sa.numbercells):
+            if response_variance[nc] > variance_threshold[nc]:
+                peak_run.loc[nc, 'mod_' + epoch] = True
+            if response_variance[nc] <= variance_threshold[nc]:
+                peak_run.loc[nc, 'mod_' + epoch] = False
+
+            start_max = binned_cells[nc, :, 0].argmax()
+            start_min = binned_cells[nc, :, 0].argmin()
+            speed_max = binned_dx[start_max, 0]
+            speed_min = binned_dx[start_min, 0]
+            peak_run.loc[nc, 'speed_max_' + epoch] = speed_max
+            peak_run.loc[nc, 'speed_min_' + epoch] = speed_min
+
+            # compare the peak (or trough) bin to all other samples
+            peak = start_max if speed_max > speed_min else start_min
+            in_bin = range(peak * binsize, (peak + 1) * binsize)
+            test_values = celltraces_sorted[nc, peak * binsize:(peak + 1) * binsize]
+            other_values = np.delete(celltraces_sorted[nc, :], in_bin)
+            (_, p) = st.ks_2samp(test_values, other_values)
+            peak_run.loc[nc, 'ptest_' + epoch] = p
+
+    return (binned['sp'][0], binned['sp'][1], binned['vis'][0],
+            binned['vis'][1], peak_run)
+
+
+def _bin_by_speed(dx, celltraces, binsize, n_shuffles=200):
+    """ Sort samples by running speed and bin them: all samples below 1 cm/s,
+    then successive bins of binsize samples.  Returns the mean and standard
+    error of speed and of each trace in each bin, the sorted traces, and the
+    bin means of n_shuffles shuffles of the traces.
+    """
+    nbins = 1 + len(np.where(dx >= 1)[0]) // binsize
+    order = np.argsort(dx)
+    dx_sorted = dx[order]
+    celltraces_sorted = celltraces[:, order]
+
+    offset = findlevel(dx_sorted, 1, 'up')
+    if offset is None:
+        offset = len(dx_sorted)
+
+    # (start, stop, samples used for the standard error)
+    bins = [ (0, offset, offset) ]
+    bins += [ (offset + (i - 1) * binsize, offset + i * binsize, binsize)
+              for i in range(1, nbins) ]
+
+    binned_dx = np.zeros((nbins, 2))
+    binned_cells = np.zeros((len(celltraces), nbins, 2))
+    for i, (start, stop, n) in enumerate(bins):
+        binned_dx[i, 0] = np.mean(dx_sorted[start:stop])
+        binned_dx[i, 1] = np.std(dx_sorted[start:stop]) / np.sqrt(n)
+        binned_cells[:, i, 0] = np.mean(celltraces_sorted[:, start:stop], axis=1)
+        binned_cells[:, i, 1] = np.std(celltraces_sorted[:, start:stop],
+                                       axis=1) / np.sqrt(n)
+
+    shuffled = np.empty((len(celltraces), nbins, n_shuffles))
+    for shuf in range(n_shuffles):
+        shuffled_sorted = celltraces[
+            :, np.random.permutation(celltraces.shape[1])][:, order]
+        for i, (start, stop, _) in enumerate(bins):
+            shuffled[:, i, shuf] = np.mean(shuffled_sorted[:, start:stop], axis=1)
+
+    return binned_dx, binned_cells, celltraces_sorted, shuffled
+
+
+def natural_scenes_peak(ns):
+    """ NaturalScenes.get_peak, one cell at a time. """
+    peak = pd.DataFrame(index=range(ns.numbercells), columns=(
+        'scene_ns', 'reliability_ns', 'peak_dff_ns', 'ptest_ns', 'p_run_ns',
+        'run_modulation_ns', 'time_to_peak_ns', 'cell_specimen_id',
+        'image_selectivity_ns'))
+    cids = ns.data_set.get_cell_specimen_ids()
+
+    for nc in range(ns.numbercells):
+        column = str(nc)
+        nsp = np.argmax(ns.response[1:, nc, 0])
+        preferred = ns.stim_table.frame == nsp
+
+        peak.cell_specimen_id.iloc[nc] = cids[nc]
+        peak.scene_ns.iloc[nc] = nsp
+        peak.peak_dff_ns.iloc[nc] = ns.response[nsp + 1, nc, 0]
+
+        groups = [ ns.mean_sweep_response[ns.stim_table.frame == (im - 1)][column].values
+                   for im in range(ns.number_scenes) ]
+        (_, peak.ptest_ns.iloc[nc]) = st.f_oneway(*groups)
+
+        test = ns.sweep_response[preferred][column].mean()
+        peak.time_to_peak_ns.iloc[nc] = \
+            (np.argmax(test) - ns.interlength) / ns.acquisition_rate
+
+        peak.p_run_ns.iloc[nc], peak.run_modulation_ns.iloc[nc] = \
+            _run_modulation(ns.mean_sweep_response[preferred][[column, 'dx']],
+                            min_trials=5)
+        peak.reliability_ns.iloc[nc] = \
+            _reliability(ns.sweep_response[preferred][column], 28, 42)
+        peak.image_selectivity_ns.iloc[nc] = \
+            _image_selectivity(ns.response[1:, nc, 0])
+
+    return peak
+
+
+def _run_modulation(trials, min_trials):
+    """ Welch's t test p value and the relative modulation of a cell's mean
+    responses on running (dx >= 1) versus stationary trials.  trials has
+    the cell's column and 'dx'.  Both are NaN without min_trials of each.
+    """
+    column = trials.columns[0]
+    run = trials[trials.dx >= 1][column]
+    stat = trials[trials.dx < 1][column]
+
+    if len(run) < min_trials or len(stat) < min_trials:
+        return np.nan, np.nan
+
+    (_, p) = st.ttest_ind(run, stat, equal_var=False)
+
+    if run.mean() > stat.mean():
+        return p, (run.mean() - stat.mean()) / np.abs(run.mean())
+    elif run.mean() < stat.mean():
+        return p, -1 * ((stat.mean() - run.mean()) / np.abs(stat.mean()))
+    return p, np.nan
+
+
+def _reliability(traces, start, stop):
+    """ Mean pearson correlation over all pairs of trial traces, using
+    samples start to stop of each.
+    """
+    r = [ st.pearsonr(traces.iloc[i][start:stop], traces.iloc[j][start:stop])[0]
+          for i in range(len(traces)) for j in range(i + 1, len(traces)) ]
+
+    return np.nanmean(r) if r else np.nan
+
+
+def _image_selectivity(responses, n_thresholds=1000):
+    """ 1 - 2 * the mean, over evenly spaced thresholds between the weakest
+    and strongest response, of the fraction of responses above threshold.
+    """
+    fmin = responses.min()
+    fmax = responses.max()
+    rtj = [ (responses > fmin + j * ((fmax - fmin) / float(n_thresholds))).mean()
+            for j in range(n_thresholds) ]
+
+    return 1 - 2 * np.mean(rtj)
+
+
+def drifting_gratings_response(dg):
+    """ DriftingGratings.get_response, one condition at a time. """
+    return _grating_response(dg, [ ('orientation', dg.orivals),
+                                   ('temporal_frequency', dg.tfvals) ],
+                             0.05 / (8 * 5))
+
+
+def static_gratings_response(sg):
+    """ StaticGratings.get_response, one condition at a time. """
+    return _grating_response(sg, [ ('orientation', sg.orivals),
+                                   ('spatial_frequency', sg.sfvals),
+                                   ('phase', sg.phasevals) ],
+                             0.05 / (sg.number_ori * (sg.number_sf - 1)))
+
+
+def _grating_response(gratings, conditions, threshold):
+    """ Mean, standard error and number of significant trials of the mean
+    sweep response for every combination of the (stim_table column, values)
+    pairs in conditions.
+    """
+    shape = tuple(len(values) for _, values in conditions)
+    response = np.empty(shape + (gratings.numbercells + 1, 3))
+
+    for index in itertools.product(*[ range(n) for n in shape ]):
+        rows = _condition(gratings.stim_table, **dict(
+            (column, values[i]) for (column, values), i in zip(conditions, index)))
+        subset_response = gratings.mean_sweep_response[rows]
+        subset_pval = gratings.pval[rows]
+
+        response[index + (slice(None), 0)] = subset_response.mean(axis=0)
+        response[index + (slice(None), 1)] = \
+            subset_response.std(axis=0) / np.sqrt(len(subset_response))
+        response[index + (slice(None), 2)] = (subset_pval < threshold).sum(axis=0)
+
+    return response
+
+
+def drifting_gratings_peak(dg):
+    """ DriftingGratings.get_peak, one cell and condition at a time. """
+    peak = pd.DataFrame(index=range(dg.numbercells), columns=(
+        'ori_dg', 'tf_dg', 'reliability_dg', 'osi_dg', 'dsi_dg', 'peak_dff_dg',
+        'ptest_dg', 'p_run_dg', 'run_modulation_dg', 'cv_os_dg', 'cv_ds_dg',
+        'tf_index_dg', 'cell_specimen_id'))
+    cids = dg.data_set.get_cell_specimen_ids()
+    orivals_rad = np.deg2rad(dg.orivals)
+    table = dg.stim_table
+
+    for nc in range(dg.numbercells):
+        column = str(nc)
+        response = dg.response[:, :, nc, 0]
+        cell_peak = np.where(response[:, 1:] == np.nanmax(response[:, 1:]))
+        prefori = cell_peak[0][0]
+        preftf = cell_peak[1][0] + 1
+        peak.cell_specimen_id.iloc[nc] = cids[nc]
+        peak.ori_dg.iloc[nc] = prefori
+        peak.tf_dg.iloc[nc] = preftf
+
+        pref = response[prefori, preftf]
+        orth = (response[np.mod(prefori + 2, 8), preftf] +
+                response[np.mod(prefori - 2, 8), preftf]) / 2
+        null = response[np.mod(prefori + 4, 8), preftf]
+
+        tuning = np.where(response[:, preftf] > 0, response[:, preftf], 0)
+        peak.cv_os_dg.iloc[nc] = _circular_tuning(tuning, 2 * orivals_rad)
+        peak.cv_ds_dg.iloc[nc] = _circular_tuning(tuning, orivals_rad)
+        peak.osi_dg.iloc[nc] = (pref - orth) / (pref + orth)
+        peak.dsi_dg.iloc[nc] = (pref - null) / (pref + null)
+        peak.peak_dff_dg.iloc[nc] = pref
+
+        groups = [ dg.mean_sweep_response[_condition(
+                       table, temporal_frequency=tf, orientation=ori)][column]
+                   for ori in dg.orivals for tf in dg.tfvals[1:] ]
+        groups.append(dg.mean_sweep_response[
+            _condition(table, temporal_frequency=0)][column])
+        (_, peak.ptest_dg.iloc[nc]) = st.f_oneway(*groups)
+
+        preferred = _condition(table, temporal_frequency=dg.tfvals[preftf],
+                               orientation=dg.orivals[prefori])
+        peak.p_run_dg.iloc[nc], peak.run_modulation_dg.iloc[nc] = \
+            _run_modulation(dg.mean_sweep_response[preferred][[column, 'dx']],
+                            min_trials=3)
+        peak.reliability_dg.iloc[nc] = \
+            _reliability(dg.sweep_response[preferred][column], 30, 90)
+
+        trials = dg.mean_sweep_response[
+            (table.temporal_frequency != 0).values &
+            _condition(table, orientation=dg.orivals[prefori])][column].values
+        peak.tf_index_dg.iloc[nc] = _tuning_index(response[prefori, 1:], trials)
+
+    return peak
+
+
+def static_gratings_peak(sg):
+    """ StaticGratings.get_peak, one cell and condition at a time. """
+    peak = pd.DataFrame(index=range(sg.numbercells), columns=(
+        'ori_sg', 'sf_sg', 'phase_sg', 'reliability_sg', 'osi_sg',
+        'peak_dff_sg', 'ptest_sg', 'time_to_peak_sg', 'cell_specimen_id',
+        'p_run_sg', 'cv_os_sg', 'run_modulation_sg', 'sf_index_sg'))
+    cids = sg.data_set.get_cell_specimen_ids()
+    orivals_rad = np.deg2rad(sg.orivals)
+    table = sg.stim_table
+
+    for nc in range(sg.numbercells):
+        column = str(nc)
+        response = sg.response[:, :, :, nc, 0]
+        cell_peak = np.where(response[:, 1:] == np.nanmax(response[:, 1:]))
+        pref_ori = cell_peak[0][0]
+        pref_sf = cell_peak[1][0] + 1
+        pref_phase = cell_peak[2][0]
+        peak.cell_specimen_id.iloc[nc] = cids[nc]
+        peak.ori_sg.iloc[nc] = pref_ori
+        peak.sf_sg.iloc[nc] = pref_sf
+        peak.phase_sg.iloc[nc] = pref_phase
+
+        pref = response[pref_ori, pref_sf, pref_phase]
+        orth = response[np.mod(pref_ori + 3, 6), pref_sf, pref_phase]
+
+        tuning = response[:, pref_sf, pref_phase]
+        tuning = np.where(tuning > 0, tuning, 0)
+        peak.cv_os_sg.iloc[nc] = _circular_tuning(tuning, 2 * orivals_rad)
+        peak.osi_sg.iloc[nc] = (pref - orth) / (pref + orth)
+        peak.peak_dff_sg.iloc[nc] = pref
+
+        groups = [ sg.mean_sweep_response[_condition(
+                       table, spatial_frequency=sf, orientation=ori,
+                       phase=phase)][column]
+                   for ori in sg.orivals for sf in sg.sfvals[1:]
+                   for phase in sg.phasevals ]
+        groups.append(sg.mean_sweep_response[
+            _condition(table, spatial_frequency=0)][column])
+        (_, peak.ptest_sg.iloc[nc]) = st.f_oneway(*groups)
+
+        preferred = _condition(table, orientation=sg.orivals[pref_ori],
+                               spatial_frequency=sg.sfvals[pref_sf],
+                               phase=sg.phasevals[pref_phase])
+        test = sg.sweep_response[preferred][column].mean()
+        peak.time_to_peak_sg.iloc[nc] = \
+            (np.argmax(test) - sg.interlength) / sg.acquisition_rate
+
+        peak.p_run_sg.iloc[nc], peak.run_modulation_sg.iloc[nc] = \
+            _run_modulation(sg.mean_sweep_response[preferred][[column, 'dx']],
+                            min_trials=5)
+        peak.reliability_sg.iloc[nc] = \
+            _reliability(sg.sweep_response[preferred][column], 28, 42)
+
+        trials = sg.mean_sweep_response[
+            (table.spatial_frequency != 0).values &
+            _condition(table, orientation=sg.orivals[pref_ori],
+                       phase=sg.phasevals[pref_phase])][column].values
+        peak.sf_index_sg.iloc[nc] = \
+            _tuning_index(response[pref_ori, 1:, pref_phase], trials)
+
+    return peak
+
+
+def _condition(stim_table, **values):
+    """ Boolean mask of the stim_table rows whose columns equal values. """
+    rows = np.ones(len(stim_table), dtype=bool)
+    for column, value in values.items():
+        rows &= (stim_table[column] == value).values
+
+    return rows
+
+
+def _circular_tuning(tuning, angles):
+    """ Length of the tuning-weighted mean of unit vectors at angles. """
+    return np.abs((tuning * np.exp(1j * angles)).sum()) / tuning.sum()
+
+
+def _tuning_index(tuning, trials):
+    """ Range of a tuning curve relative to the range plus twice the spread
+    of the individual trials.
+    """
+    sse_part = np.sqrt(np.sum((trials - trials.mean()) ** 2) / (len(trials) - 5))
+
+    return np.ptp(tuning) / (np.ptp(tuning) + 2 * sse_part)